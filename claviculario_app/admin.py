@@ -1,8 +1,30 @@
 # claviculario_app/admin.py
 
-from django.contrib import admin
-from .models import Unidade, Local, Pessoa, Chave, Emprestimo
+from django import forms
+from django.contrib import admin, messages
+from django.db.models import Q
+from django.utils import timezone
+from . import painel, resumo
+from .models import Unidade, Local, Pessoa, Chave, Emprestimo, ImportacaoJob
 from .forms import PessoaForm
+from .busca import reindexar
+from .services import DEVOLVIDO, RetiradaNoFuturoError, registrar_devolucoes, registrar_retirada, validar_data_retirada
+
+
+class ReindexarBuscaMixin:
+    """
+    Refaz o texto da busca do relatório dos empréstimos afetados quando o
+    objeto é criado ou um dos campos listados em 'campos_busca' é alterado pelo admin.
+    """
+    campos_busca = ()
+
+    def emprestimos_afetados(self, obj):
+        return obj.emprestimos.all()
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change or set(self.campos_busca) & set(form.changed_data):
+            reindexar(self.emprestimos_afetados(obj))
 
 @admin.register(Unidade)
 class UnidadeAdmin(admin.ModelAdmin):
@@ -16,52 +38,180 @@ class UnidadeAdmin(admin.ModelAdmin):
     filter_horizontal = ('membros',)
 
 @admin.register(Local)
-class LocalAdmin(admin.ModelAdmin):
+class LocalAdmin(ReindexarBuscaMixin, admin.ModelAdmin):
     """
     Configuração de como o modelo 'Local' aparece no painel de admin.
     """
-    list_display = ('nome', 'ativa')
+    list_display = ('nome', 'unidade', 'ativa')
+    list_select_related = ('unidade',)
     search_fields = ('nome',)
-    list_filter = ('ativa',)
+    list_filter = ('unidade', 'ativa')
+    campos_busca = ('nome',)
+
+    def emprestimos_afetados(self, obj):
+        return Emprestimo.objects.filter(chave__local=obj)
+
+class DisponivelFilter(admin.SimpleListFilter):
+    title = 'disponível'
+    parameter_name = 'disponivel'
+
+    def lookups(self, request, model_admin):
+        return (('1', 'Sim'), ('0', 'Não'))
+
+    def queryset(self, request, queryset):
+        if self.value() in ('0', '1'):
+            return queryset.filter(emprestimo_atual__isnull=self.value() == '1')
+        return queryset
 
 @admin.register(Chave)
-class ChaveAdmin(admin.ModelAdmin):
+class ChaveAdmin(ReindexarBuscaMixin, admin.ModelAdmin):
     """
     Configuração de como o modelo 'Chave' aparece no painel de admin.
     """
-    list_display = ('descricao', 'local', 'disponivel', 'ativa')
+    list_display = ('descricao', 'local', 'unidade', 'disponivel', 'ativa')
+    list_select_related = ('local', 'unidade')
     search_fields = ('descricao', 'local__nome')
-    list_filter = ('ativa', 'disponivel', 'local')
+    list_filter = ('unidade', 'ativa', DisponivelFilter, 'local')
+    campos_busca = ('descricao', 'local')
+    # O empréstimo atual só muda pela retirada e pela devolução
+    readonly_fields = ('emprestimo_atual',)
     # Organiza os campos no formulário de edição
     fieldsets = (
         (None, {
             'fields': ('descricao', 'local')
         }),
         ('Status', {
-            'fields': ('disponivel', 'ativa')
+            'fields': ('emprestimo_atual', 'ativa')
         }),
     )
 
+    @admin.display(boolean=True, description='Disponível')
+    def disponivel(self, obj):
+        return obj.disponivel
+
+    def save_model(self, request, obj, form, change):
+        # A chave é sempre da unidade do seu local
+        obj.unidade_id = obj.local.unidade_id
+        super().save_model(request, obj, form, change)
+
 @admin.register(Pessoa)
-class PessoaAdmin(admin.ModelAdmin):
+class PessoaAdmin(ReindexarBuscaMixin, admin.ModelAdmin):
     """
     Configuração de como o modelo 'Pessoa' aparece no painel de admin.
     Usa o PessoaForm customizado para garantir a criptografia do PIN.
     """
     form = PessoaForm
-    list_display = ('nome', 'empresa', 'cpf_saran', 'ativa')
+    list_display = ('nome', 'empresa', 'cpf_saran', 'unidade', 'ativa')
+    list_select_related = ('unidade',)
     search_fields = ('nome', 'empresa', 'cpf_saran')
-    list_filter = ('ativa', 'empresa')
+    list_filter = ('unidade', 'ativa', 'empresa')
     # O campo 'pin' (criptografado) não deve ser editado diretamente
     exclude = ('pin',)
+    # A unidade vem antes do CPF/SARAN, que só precisa ser único dentro dela
+    fields = ('unidade', 'nome', 'empresa', 'cpf_saran', 'pin', 'confirmar_pin')
+    campos_busca = ('nome', 'cpf_saran')
+
+class EmprestimoAdminForm(forms.ModelForm):
+    """ No cadastro, as mesmas verificações da retirada pela mesa (ver services.registrar_retirada). """
+    def clean(self):
+        dados = super().clean()
+        if self.instance.pk is not None:
+            return dados
+        chave, pessoa, data_retirada = dados.get('chave'), dados.get('pessoa'), dados.get('data_retirada')
+        if data_retirada:
+            try:
+                validar_data_retirada(data_retirada)
+            except RetiradaNoFuturoError as erro:
+                self.add_error('data_retirada', str(erro))
+        if chave and (chave.emprestimo_atual_id is not None or not chave.ativa):
+            self.add_error('chave', "Esta chave não está disponível.")
+        elif chave and data_retirada and chave.emprestimos.filter(
+                Q(data_devolucao__isnull=True) | Q(data_devolucao__gt=data_retirada)).exists():
+            self.add_error('data_retirada', "Nesse horário a chave ainda estava com outra pessoa.")
+        if chave and pessoa and pessoa.unidade_id != chave.unidade_id:
+            self.add_error('pessoa', "A pessoa é de outra unidade.")
+        return dados
+
+
+def _atualizar_resumos(emprestimos):
+    """
+    Refaz os resumos dos dias tocados pelos empréstimos (retirada e devolução)
+    e invalida o painel das unidades deles: para o que o admin altera ou
+    apaga fora dos serviços de retirada e devolução.
+    """
+    if not emprestimos:
+        return
+    dias = [timezone.localdate(data) for e in emprestimos for data in (e.data_retirada, e.data_devolucao) if data]
+    resumo.reconstruir(min(dias), max(dias))
+    for unidade_id in {e.unidade_id for e in emprestimos}:
+        painel.invalidar_dashboard(unidade_id)
+
 
 @admin.register(Emprestimo)
-class EmprestimoAdmin(admin.ModelAdmin):
+class EmprestimoAdmin(ReindexarBuscaMixin, admin.ModelAdmin):
     """
     Configuração de como o modelo 'Emprestimo' aparece no painel de admin.
     """
-    list_display = ('chave', 'pessoa', 'data_retirada', 'previsao_devolucao', 'data_devolucao')
-    list_filter = ('pessoa', 'chave')
+    list_display = ('chave', 'pessoa', 'unidade', 'data_retirada', 'previsao_devolucao', 'data_devolucao')
+    # Chave.__str__ usa o local; sem isso cada linha da lista faria novas consultas
+    list_select_related = ('chave__local', 'pessoa', 'unidade')
+    list_filter = ('unidade', 'pessoa', 'chave')
     search_fields = ('chave__descricao', 'pessoa__nome')
-    # Torna os campos de data apenas leitura, pois são gerenciados pelo sistema
-    readonly_fields = ('data_retirada', 'data_devolucao')
\ No newline at end of file
+    form = EmprestimoAdminForm
+    # A devolução é gerenciada pelo sistema (ver a ação registrar_devolucao);
+    # a retirada só é informada no cadastro
+    readonly_fields = ('data_devolucao',)
+    # A unidade é sempre a da chave (ver services.registrar_retirada)
+    exclude = ('unidade',)
+    campos_busca = ('chave', 'pessoa', 'observacao')
+    actions = ['registrar_devolucao']
+
+    def get_readonly_fields(self, request, obj=None):
+        # Trocar a chave de um empréstimo existente deixaria Chave.emprestimo_atual para trás
+        return self.readonly_fields + ('chave', 'data_retirada') if obj else self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            # Pelo mesmo caminho da mesa: Chave.emprestimo_atual, resumos, painel e eventos
+            emprestimo = registrar_retirada(obj.chave_id, obj.pessoa_id, obj.data_retirada,
+                                            obj.previsao_devolucao, obj.observacao)
+            obj.pk = emprestimo.pk
+            obj.refresh_from_db()
+            return
+        super().save_model(request, obj, form, change)
+        # A previsão decide se a devolução foi no prazo ou com atraso
+        if 'previsao_devolucao' in form.changed_data and obj.data_devolucao is not None:
+            _atualizar_resumos([obj])
+        else:
+            painel.invalidar_dashboard(obj.unidade_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        _atualizar_resumos([obj])
+
+    def delete_queryset(self, request, queryset):
+        emprestimos = list(queryset)
+        super().delete_queryset(request, queryset)
+        _atualizar_resumos(emprestimos)
+
+    @admin.action(description="Registrar a devolução agora")
+    def registrar_devolucao(self, request, queryset):
+        resultados = registrar_devolucoes(emprestimo_ids=list(queryset.values_list('id', flat=True)))
+        devolvidos = sum(situacao == DEVOLVIDO for situacao in resultados.values())
+        self.message_user(request, f"{devolvidos} empréstimo(s) devolvido(s).", messages.SUCCESS)
+
+    def emprestimos_afetados(self, obj):
+        return Emprestimo.objects.filter(pk=obj.pk)
+
+@admin.register(ImportacaoJob)
+class ImportacaoJobAdmin(admin.ModelAdmin):
+    """
+    Configuração de como o modelo 'ImportacaoJob' aparece no painel de admin.
+    """
+    list_display = ('nome_arquivo', 'tipo', 'status', 'unidade', 'usuario', 'criado_em', 'linhas_processadas', 'total_linhas')
+    list_filter = ('unidade', 'tipo', 'status')
+    search_fields = ('nome_arquivo', 'usuario__username')
+    # O conteúdo da planilha não é exibido e os contadores são mantidos pelo worker
+    exclude = ('arquivo',)
+    readonly_fields = ('criado_em', 'iniciado_em', 'concluido_em', 'total_linhas', 'linhas_processadas',
+                       'criados', 'ignorados', 'conflitos', 'erros')
\ No newline at end of file
@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class ClavicularioAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'claviculario_app'
+
+    def ready(self):
+        from allauth.account.signals import user_signed_up
+        from django.core import checks
+
+        from .particoes import verificar_migracoes
+        from .unidades import incluir_na_unidade_padrao
+
+        user_signed_up.connect(incluir_na_unidade_padrao, dispatch_uid='claviculario_unidade_padrao')
+        checks.register(verificar_migracoes, checks.Tags.database)
@@ -0,0 +1,199 @@
+# claviculario_app/arquivo.py
+
+import os
+from datetime import datetime, time, timedelta
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import busca, particoes
+from .models import Chave, Emprestimo, Local, Pessoa
+from .paginacao import PROXIMA
+from .particoes import ParticionamentoError, inicio_do_ano
+
+TAMANHO_LOTE = 50_000
+
+# Colunas de cada empréstimo arquivado: os nomes da chave, do local e da
+# pessoa vão junto, porque as linhas antigas podem sobreviver a elas
+COLUNAS = (
+    'id', 'unidade_id', 'chave_id', 'pessoa_id', 'data_retirada', 'previsao_devolucao', 'data_devolucao',
+    'observacao', 'texto_busca', 'chave__descricao', 'chave__local__nome', 'pessoa__nome', 'pessoa__cpf_saran',
+)
+
+
+def diretorio_do_arquivo():
+    """ Onde ficam os anos arquivados (CLAVICULARIO_ARQUIVO_EMPRESTIMOS). """
+    return Path(getattr(settings, 'CLAVICULARIO_ARQUIVO_EMPRESTIMOS', settings.BASE_DIR / 'arquivo'))
+
+
+def caminho(ano):
+    return diretorio_do_arquivo() / f'emprestimos_{ano}.parquet'
+
+
+def anos_arquivados():
+    """ Os anos que já saíram do banco para o arquivo, em ordem. Só olha o diretório. """
+    diretorio = diretorio_do_arquivo()
+    if not diretorio.is_dir():
+        return []
+    return sorted(int(arquivo.stem.rsplit('_', 1)[1]) for arquivo in diretorio.glob('emprestimos_*.parquet'))
+
+
+def anos_para_arquivar(anos):
+    """ Anos com partição no banco que terminaram há mais de 'anos' anos. """
+    if not particoes.particionada():
+        raise ParticionamentoError("A tabela de empréstimos não é particionada (ver particionar_emprestimos).")
+    limite = timezone.localdate().year - anos
+    return [ano for ano in particoes.anos_particionados() if ano < limite]
+
+
+def _esquema():
+    import pyarrow as pa
+
+    data = pa.timestamp('us', tz='UTC')
+    tipos = {'id': pa.int64(), 'unidade_id': pa.int64(), 'chave_id': pa.int64(), 'pessoa_id': pa.int64(),
+             'data_retirada': data, 'previsao_devolucao': data, 'data_devolucao': data}
+    return pa.schema([(coluna, tipos.get(coluna, pa.string())) for coluna in COLUNAS])
+
+
+def arquivar(ano):
+    """
+    Exporta os empréstimos de um ano para um Parquet (zstd) e tira a partição
+    do ano do banco. O ano precisa estar encerrado: nenhum empréstimo em
+    aberto. A partição só é apagada depois de conferir o número de linhas
+    gravadas, e o arquivo só é publicado quando a remoção é confirmada no
+    banco; retorna o número de linhas.
+
+    Os resumos por hora do ano ficam no banco (ver resumo.reconstruir), então
+    os gráficos de análise continuam cobrindo os anos arquivados.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if ano not in particoes.anos_particionados():
+        raise ParticionamentoError(f"Não há partição de {ano} na tabela de empréstimos.")
+    emprestimos = Emprestimo.objects.filter(data_retirada__gte=inicio_do_ano(ano), data_retirada__lt=inicio_do_ano(ano + 1))
+    destino = caminho(ano)
+    temporario = destino.with_suffix('.parquet.tmp')
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    esquema = _esquema()
+    try:
+        with transaction.atomic():
+            # Ninguém altera o ano enquanto ele é copiado (as leituras continuam)
+            particoes.bloquear_particao(ano)
+            if emprestimos.filter(data_devolucao__isnull=True).exists():
+                raise ParticionamentoError(f"{ano} ainda tem empréstimos em aberto.")
+            linhas = emprestimos.order_by('data_retirada', 'id').values_list(*COLUNAS).iterator(chunk_size=TAMANHO_LOTE)
+            total = 0
+            with pq.ParquetWriter(temporario, esquema, compression='zstd') as escritor:
+                while lote := list(islice(linhas, TAMANHO_LOTE)):
+                    colunas = [pa.array(valores, type=campo.type) for valores, campo in zip(zip(*lote), esquema)]
+                    escritor.write_batch(pa.RecordBatch.from_arrays(colunas, schema=esquema))
+                    total += len(lote)
+            gravadas = pq.ParquetFile(temporario).metadata.num_rows
+            if gravadas != total:
+                raise ParticionamentoError(f"O arquivo de {ano} tem {gravadas} linha(s); o banco tem {total}.")
+            particoes.remover_particao(ano)
+            # O relatório passa a ler o ano do arquivo só quando a partição
+            # sai de fato do banco; antes disso, o ano estaria nos dois. Se a
+            # troca de nome falhar, o erro vai para o log e o .tmp fica com os dados
+            transaction.on_commit(partial(os.replace, temporario, destino), robust=True)
+    except BaseException:
+        temporario.unlink(missing_ok=True)
+        raise
+    return total
+
+
+def _emprestimo(linha):
+    """ Um empréstimo arquivado como objeto (não salvo), para os mesmos templates do relatório. """
+    local = Local(unidade_id=linha['unidade_id'], nome=linha['chave__local__nome'])
+    chave = Chave(id=linha['chave_id'], unidade_id=linha['unidade_id'], descricao=linha['chave__descricao'], local=local)
+    pessoa = Pessoa(id=linha['pessoa_id'], unidade_id=linha['unidade_id'], nome=linha['pessoa__nome'],
+                    cpf_saran=linha['pessoa__cpf_saran'])
+    return Emprestimo(
+        id=linha['id'], unidade_id=linha['unidade_id'], chave=chave, pessoa=pessoa,
+        data_retirada=linha['data_retirada'], previsao_devolucao=linha['previsao_devolucao'],
+        data_devolucao=linha['data_devolucao'], observacao=linha['observacao'], texto_busca=linha['texto_busca'],
+    )
+
+
+class EmprestimosArquivados:
+    """
+    Os empréstimos de anos arquivados que um relatório pede, com os mesmos
+    filtros do RelatorioForm. A paginação por cursor (ver
+    paginacao.paginar_por_cursor) junta estas linhas às do banco; todas são
+    anteriores a 'fim', então o arquivo só é lido quando a página chega lá.
+    """
+    def __init__(self, anos, unidade, data_inicio=None, data_fim=None, pessoa=None, chave=None, termo=None):
+        self.anos = sorted(anos)
+        self.unidade = unidade
+        self.data_inicio = data_inicio
+        self.data_fim = data_fim
+        self.pessoa = pessoa
+        self.chave = chave
+        self.palavras = busca.normalizar(termo).split()
+        self.fim = inicio_do_ano(self.anos[-1] + 1)
+
+    def _filtros(self, posicao, direcao):
+        # Aplicados na leitura: o Parquet pula os grupos de linhas fora do período
+        fuso = timezone.get_current_timezone()
+        filtros = [('unidade_id', '=', self.unidade.pk)]
+        if self.data_inicio:
+            filtros.append(('data_retirada', '>=', datetime.combine(self.data_inicio, time.min, tzinfo=fuso)))
+        if self.data_fim:
+            filtros.append(('data_retirada', '<', datetime.combine(self.data_fim + timedelta(days=1), time.min, tzinfo=fuso)))
+        if self.pessoa:
+            filtros.append(('pessoa_id', '=', self.pessoa.pk))
+        if self.chave:
+            filtros.append(('chave_id', '=', self.chave.pk))
+        if posicao:
+            filtros.append(('data_retirada', '<=' if direcao == PROXIMA else '>=', posicao[0]))
+        return filtros
+
+    def ler(self, posicao, direcao, limite):
+        """
+        Até 'limite' empréstimos depois de 'posicao' ((data_retirada, id), ou
+        None para o começo), do mais recente para o mais antigo se 'direcao'
+        for PROXIMA, ao contrário se for ANTERIOR.
+        """
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        tabela = pq.read_table([caminho(ano) for ano in self.anos], filters=self._filtros(posicao, direcao))
+        # A mesma busca por prefixo de palavra do busca.filtrar
+        for palavra in self.palavras:
+            texto = tabela['texto_busca']
+            tabela = tabela.filter(pc.or_(pc.starts_with(texto, palavra), pc.match_substring(texto, f' {palavra}')))
+        if posicao:
+            data_retirada, emprestimo_id = posicao
+            depois = pc.less if direcao == PROXIMA else pc.greater
+            tabela = tabela.filter(pc.or_(
+                depois(tabela['data_retirada'], data_retirada),
+                pc.and_(pc.equal(tabela['data_retirada'], data_retirada), depois(tabela['id'], emprestimo_id)),
+            ))
+        ordem = 'descending' if direcao == PROXIMA else 'ascending'
+        tabela = tabela.sort_by([('data_retirada', ordem), ('id', ordem)]).slice(0, limite)
+        return [_emprestimo(linha) for linha in tabela.to_pylist()]
+
+
+def do_relatorio(form, unidade):
+    """
+    Os empréstimos arquivados que entram no relatório do formulário (já
+    validado), ou None quando o período não alcança nenhum ano arquivado.
+    Pendentes nunca estão no arquivo: só anos encerrados são arquivados.
+    """
+    anos = anos_arquivados()
+    if not anos or not form.is_valid():
+        return None
+    dados = form.cleaned_data
+    if dados.get('status') == 'pendentes':
+        return None
+    data_inicio, data_fim = dados.get('data_inicio'), dados.get('data_fim')
+    anos = [ano for ano in anos
+            if (not data_inicio or ano >= data_inicio.year) and (not data_fim or ano <= data_fim.year)]
+    if not anos:
+        return None
+    return EmprestimosArquivados(anos, unidade, data_inicio, data_fim, dados.get('pessoa'), dados.get('chave'), dados.get('busca'))
@@ -0,0 +1,80 @@
+# claviculario_app/busca.py
+
+import re
+import unicodedata
+from itertools import islice
+
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Emprestimo
+
+TAMANHO_LOTE = 2000
+
+# Documento da busca no PostgreSQL. O índice GIN da migração 0012 é criado a
+# partir de uma cópia desta expressão, então qualquer mudança aqui exige nova
+# migração (a 0012 também guarda uma cópia do texto_emprestimo).
+# A configuração 'simple' não aplica radicais: nomes, salas e CPFs são buscados como foram escritos.
+DOCUMENTO = SearchVector('texto_busca', config='simple')
+
+
+def normalizar(texto):
+    """ Minúsculas, sem acentos e só com letras e números separados por espaço. """
+    texto = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.findall(r'[a-z0-9]+', texto.lower()))
+
+
+def texto_emprestimo(descricao_chave, nome_local, nome_pessoa, cpf_saran, observacao):
+    """
+    Texto pesquisável de um empréstimo. O CPF/SARAN entra em partes e também
+    só com os dígitos, para ser encontrado com ou sem pontuação.
+    """
+    cpf = normalizar(cpf_saran)
+    digitos = cpf.replace(' ', '')
+    partes = [descricao_chave, nome_local, nome_pessoa, cpf, digitos if digitos != cpf else '', observacao]
+    return ' '.join(texto for texto in map(normalizar, partes) if texto)
+
+
+def reindexar(emprestimos=None):
+    """
+    Refaz o texto pesquisável dos empréstimos informados (todos, por padrão).
+
+    Usado quando a descrição de uma chave, o nome de um local ou os dados de uma
+    pessoa mudam. Os textos são montados em lotes e gravados com bulk_update;
+    retorna o número de empréstimos alterados.
+    """
+    emprestimos = Emprestimo.objects.all() if emprestimos is None else emprestimos
+    linhas = emprestimos.order_by().values_list(
+        'id', 'texto_busca', 'chave__descricao', 'chave__local__nome', 'pessoa__nome', 'pessoa__cpf_saran', 'observacao',
+    ).iterator(chunk_size=TAMANHO_LOTE)
+    alterados = 0
+    with transaction.atomic():
+        while lote := list(islice(linhas, TAMANHO_LOTE)):
+            mudancas = []
+            for emprestimo_id, atual, *dados in lote:
+                texto = texto_emprestimo(*dados)
+                if texto != atual:
+                    mudancas.append(Emprestimo(id=emprestimo_id, texto_busca=texto))
+            Emprestimo.objects.bulk_update(mudancas, ['texto_busca'], batch_size=TAMANHO_LOTE)
+            alterados += len(mudancas)
+    return alterados
+
+
+def filtrar(emprestimos, termo):
+    """
+    Filtra os empréstimos cujo texto contém palavras começando com cada termo
+    digitado ("sala jo" encontra "Sala 12 ... João").
+
+    No PostgreSQL a busca é textual (tsquery com prefixos) e usa o índice GIN;
+    nos outros bancos cai num LIKE sobre o mesmo texto normalizado.
+    """
+    palavras = normalizar(termo).split()
+    if not palavras:
+        return emprestimos
+    if connection.vendor == 'postgresql':
+        consulta = SearchQuery(' & '.join(f'{palavra}:*' for palavra in palavras), config='simple', search_type='raw')
+        return emprestimos.alias(documento=DOCUMENTO).filter(documento=consulta)
+    for palavra in palavras:
+        emprestimos = emprestimos.filter(Q(texto_busca__startswith=palavra) | Q(texto_busca__contains=f' {palavra}'))
+    return emprestimos
@@ -0,0 +1,244 @@
+# claviculario_app/carga.py
+
+import asyncio
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Local, Emprestimo
+from .unidades import SESSAO_UNIDADE
+
+USUARIO_CARGA = 'teste_carga'
+# Começos de nome usados nas buscas de pessoas (os mesmos do gerador de dados sintéticos)
+BUSCAS_PESSOAS = ["ana", "bru", "car", "die", "eli", "gab", "joa", "luc", "mar", "pau", "silva", "lima"]
+BUSCAS_RELATORIO = ["sala", "hangar", "silva", "manutencao", "bloco 001", "ana lima"]
+AGRUPAMENTOS = ['day', 'time_of_day', 'weekday_avg', 'month_day_avg']
+
+
+def _host():
+    """ Um nome aceito por ALLOWED_HOSTS (com DEBUG e a lista vazia, o Django aceita 'localhost'). """
+    for host in settings.ALLOWED_HOSTS:
+        if '*' not in host and not host.startswith('.'):
+            return host
+    return 'localhost'
+
+
+class Resultados:
+    """ Tempos e falhas por endpoint, compartilhados entre as threads. """
+    def __init__(self):
+        self._trava = threading.Lock()
+        self.tempos = defaultdict(list)
+        self.falhas = defaultdict(int)
+        self.recusas = defaultdict(int)
+        self.inicio = time.perf_counter()
+        self.fim = None
+
+    def registrar(self, nome, segundos, falha=False, recusa=False):
+        with self._trava:
+            self.tempos[nome].append(segundos)
+            if falha:
+                self.falhas[nome] += 1
+            if recusa:
+                self.recusas[nome] += 1
+
+    def resumo(self):
+        """ {endpoint: {'requisicoes', 'falhas', 'recusas', 'por_segundo', 'p50_ms', 'p95_ms', 'p99_ms'}} """
+        duracao = (self.fim or time.perf_counter()) - self.inicio
+        linhas = {}
+        for nome, tempos in sorted(self.tempos.items()):
+            if len(tempos) > 1:
+                cortes = statistics.quantiles(tempos, n=100, method='inclusive')
+                p50, p95, p99 = cortes[49], cortes[94], cortes[98]
+            else:
+                p50 = p95 = p99 = tempos[0]
+            linhas[nome] = {
+                'requisicoes': len(tempos),
+                'falhas': self.falhas[nome],
+                'recusas': self.recusas[nome],
+                'por_segundo': len(tempos) / duracao if duracao else 0.0,
+                'p50_ms': p50 * 1000,
+                'p95_ms': p95 * 1000,
+                'p99_ms': p99 * 1000,
+            }
+        return linhas
+
+    def tabela(self):
+        cabecalho = f"{'endpoint':<28} {'req':>7} {'falhas':>7} {'recusas':>8} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        linhas = [cabecalho, '-' * len(cabecalho)]
+        for nome, dados in self.resumo().items():
+            linhas.append(
+                f"{nome:<28} {dados['requisicoes']:>7} {dados['falhas']:>7} {dados['recusas']:>8} "
+                f"{dados['por_segundo']:>8.1f} {dados['p50_ms']:>9.1f} {dados['p95_ms']:>9.1f} {dados['p99_ms']:>9.1f}"
+            )
+        return '\n'.join(linhas)
+
+
+class UsuarioVirtual:
+    """
+    Um atendente do balcão: a cada iteração abre a página inicial, empresta
+    uma chave (busca o local e a pessoa, confirma com o PIN), consulta o
+    relatório e os gráficos e devolve a chave.
+    """
+    def __init__(self, resultados, usuario, unidade_id, pin, locais, aleatorio, host):
+        self.resultados = resultados
+        self.pin = pin
+        self.locais = locais
+        self.aleatorio = aleatorio
+        self.client = Client(HTTP_HOST=host)
+        self.client.force_login(usuario)
+        # Trabalha na unidade dos locais escolhidos
+        sessao = self.client.session
+        sessao[SESSAO_UNIDADE] = unidade_id
+        sessao.save()
+
+    def _requisicao(self, metodo, nome, args=None, dados=None):
+        inicio = time.perf_counter()
+        try:
+            response = getattr(self.client, metodo)(reverse(nome, args=args), dados or {})
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+        except Exception:
+            self.resultados.registrar(nome, time.perf_counter() - inicio, falha=True)
+            return None
+        duracao = time.perf_counter() - inicio
+        if response.status_code >= 400:
+            self.resultados.registrar(nome, duracao, falha=True)
+            return None
+        recusa = response.get('Content-Type') == 'application/json' and response.json().get('success') is False
+        self.resultados.registrar(nome, duracao, recusa=recusa)
+        return response
+
+    def _retirar(self):
+        chaves = self._requisicao('get', 'filtrar_chaves_por_local', dados={'local_id': self.aleatorio.choice(self.locais)})
+        pessoas = self._requisicao('get', 'filtrar_pessoas', dados={'q': self.aleatorio.choice(BUSCAS_PESSOAS)})
+        if not chaves or not pessoas or not chaves.json()['results'] or not pessoas.json()['results']:
+            return None
+        chave_id = self.aleatorio.choice(chaves.json()['results'])['id']
+        agora = timezone.localtime()
+        response = self._requisicao('post', 'verificar_pin_e_registrar', dados={
+            'chave_id': chave_id,
+            'pessoa_id': self.aleatorio.choice(pessoas.json()['results'])['id'],
+            'pin': self.pin,
+            'data_retirada': agora.strftime('%Y-%m-%dT%H:%M:%S'),
+            'previsao_devolucao': (agora + timedelta(hours=4)).strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        if not response or not response.json().get('success'):
+            return None
+        # A API não devolve o id do empréstimo; o atendente o encontraria na tela de devolução
+        return Emprestimo.objects.filter(chave_id=chave_id, data_devolucao__isnull=True).values_list('id', flat=True).first()
+
+    def _consultar(self):
+        self._requisicao('get', 'view_relatorio', dados=self.aleatorio.choice([
+            {}, {'status': 'pendentes'}, {'busca': self.aleatorio.choice(BUSCAS_RELATORIO)},
+        ]))
+        self._requisicao('get', 'relatorio_dados', dados={'limite': 50})
+        inicio = timezone.localdate() - timedelta(days=self.aleatorio.choice([7, 30, 365]))
+        self._requisicao('get', 'analytics_data', dados={
+            'group_by': self.aleatorio.choice(AGRUPAMENTOS), 'start_date': inicio.isoformat(),
+        })
+
+    def iteracao(self):
+        self._requisicao('get', 'dashboard')
+        emprestimo_id = self._retirar()
+        self._consultar()
+        if emprestimo_id:
+            self._requisicao('post', 'registrar_devolucao', args=[emprestimo_id])
+
+
+def executar(usuarios=4, duracao=30.0, iteracoes=None, pin='1234', semente=None, host=None, unidade=None):
+    """
+    Roda 'usuarios' atendentes virtuais em paralelo (threads, cada uma com o
+    seu Client e a sua conexão com o banco) até passar 'duracao' segundos ou,
+    se informado, até cada um completar 'iteracoes' ciclos. As requisições
+    passam por toda a pilha do Django (middlewares, sessão, views e banco),
+    mas sem servidor HTTP. Os atendentes trabalham na 'unidade' informada ou
+    na do primeiro local ativo. Retorna os Resultados.
+    """
+    usuario, _ = User.objects.get_or_create(
+        username=USUARIO_CARGA, defaults={'is_superuser': True, 'is_staff': True},
+    )
+    ativos = Local.objects.filter(ativa=True).order_by('id')
+    if unidade is None:
+        unidade = ativos.values_list('unidade_id', flat=True).first()
+    locais = list(ativos.da_unidade(unidade).values_list('id', flat=True))
+    if not locais:
+        raise ValueError("Não há locais cadastrados: gere os dados com 'gerar_dados_sinteticos' antes.")
+    unidade_id = getattr(unidade, 'pk', unidade)
+    resultados = Resultados()
+    prazo = time.perf_counter() + duracao if iteracoes is None else None
+
+    def atendente(numero):
+        try:
+            virtual = UsuarioVirtual(resultados, usuario, unidade_id, pin, locais, random.Random(f"{semente}-{numero}"), host or _host())
+            feitas = 0
+            while (iteracoes is None and time.perf_counter() < prazo) or (iteracoes is not None and feitas < iteracoes):
+                virtual.iteracao()
+                feitas += 1
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    if usuarios == 1:
+        atendente(0)
+    else:
+        threads = [threading.Thread(target=atendente, args=(numero,)) for numero in range(usuarios)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    resultados.fim = time.perf_counter()
+    return resultados
+
+
+async def requisicao_asgi(aplicacao, metodo, caminho, dados=None, cookies=None, host=None, cabecalhos=None):
+    """
+    Uma requisição feita direto na aplicação ASGI (config.asgi), sem servidor
+    HTTP no meio, como um servidor a faria. Os dados vão na query string
+    (GET) ou como formulário (POST). Retorna (status, corpo).
+    """
+    texto = urlencode(dados or {})
+    corpo = texto.encode() if metodo != 'GET' else b''
+    headers = [(b'host', (host or _host()).encode())]
+    if cookies:
+        headers.append((b'cookie', '; '.join(f"{nome}={valor}" for nome, valor in cookies.items()).encode()))
+    if corpo:
+        headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+    headers += [(nome.lower().encode(), valor.encode()) for nome, valor in (cabecalhos or {}).items()]
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'method': metodo, 'path': caminho, 'raw_path': caminho.encode(), 'root_path': '',
+        'query_string': texto.encode() if metodo == 'GET' else b'', 'headers': headers,
+        'client': ('127.0.0.1', 0), 'server': (host or _host(), 80),
+    }
+    enviado = False
+
+    async def receive():
+        nonlocal enviado
+        if not enviado:
+            enviado = True
+            return {'type': 'http.request', 'body': corpo, 'more_body': False}
+        # O cliente nunca desconecta: o Django cancela esta espera quando a resposta termina
+        await asyncio.Future()
+
+    resposta = {'status': None, 'corpo': []}
+
+    async def send(mensagem):
+        if mensagem['type'] == 'http.response.start':
+            resposta['status'] = mensagem['status']
+        elif mensagem['type'] == 'http.response.body':
+            resposta['corpo'].append(mensagem.get('body', b''))
+
+    await aplicacao(scope, receive, send)
+    return resposta['status'], b''.join(resposta['corpo'])
@@ -0,0 +1,165 @@
+# claviculario_app/dados_sinteticos.py
+
+import random
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from . import resumo
+from .busca import texto_emprestimo
+from .hashers import hasher_pin
+from .models import Local, Chave, Pessoa, Emprestimo, Unidade
+
+TAMANHO_LOTE = 5000
+
+NOMES = ["Ana", "Bruno", "Carla", "Diego", "Elisa", "Fábio", "Gabriela", "Heitor", "Isabel", "João",
+         "Karina", "Lucas", "Marina", "Nelson", "Olívia", "Paulo", "Raquel", "Sérgio", "Tânia", "Vítor"]
+SOBRENOMES = ["Silva", "Souza", "Oliveira", "Pereira", "Costa", "Rodrigues", "Almeida", "Nascimento",
+              "Lima", "Araújo", "Ferreira", "Gomes", "Barbosa", "Ribeiro", "Martins", "Carvalho"]
+EMPRESAS = ["FAB", "FAB", "FAB", "Limpeza Total", "Segurança Alfa", "Manutenção Beta", None]
+TIPOS_DE_SALA = ["Sala", "Laboratório", "Almoxarifado", "Depósito", "Gabinete", "Arquivo", "Hangar"]
+OBSERVACOES = ["", "", "", "", "Levou o controle do ar-condicionado", "Manutenção", "Limpeza", "Plantão"]
+
+# Peso de cada hora do dia nas retiradas: picos na troca de turno (7h),
+# depois do almoço (13h) e no fim do expediente (17h), quase nada de madrugada
+PESO_POR_HORA = [1, 1, 1, 1, 1, 2, 6, 20, 14, 10, 8, 6, 7, 14, 10, 8, 7, 10, 5, 3, 2, 2, 1, 1]
+# Segunda a domingo: fim de semana só com plantão
+PESO_POR_DIA_DA_SEMANA = [1.0, 1.0, 1.0, 1.0, 0.9, 0.25, 0.15]
+# Prazos de devolução oferecidos no balcão, em horas (None = sem prazo)
+PRAZOS = [1, 2, 4, 4, 8, 8, 8, None]
+
+
+def _instantes_do_dia(aleatorio, dia, quantidade, fuso):
+    horas = aleatorio.choices(range(24), weights=PESO_POR_HORA, k=quantidade)
+    return sorted(
+        datetime.combine(dia, time(hora, aleatorio.randrange(60), aleatorio.randrange(60)), tzinfo=fuso)
+        for hora in horas
+    )
+
+
+def _duracao(aleatorio, prazo):
+    """ Quanto tempo a chave ficou fora: em geral dentro do prazo, às vezes bem depois. """
+    referencia = prazo if prazo is not None else 3
+    if aleatorio.random() < 0.12:
+        return timedelta(hours=referencia * aleatorio.uniform(1.05, 3))
+    return timedelta(hours=referencia * aleatorio.uniform(0.1, 0.95))
+
+
+def gerar(locais=20, chaves=500, pessoas=3000, dias=365, emprestimos_por_dia=400, abertos=30,
+          pin='1234', semente=None, progresso=None, unidade=None):
+    """
+    Preenche o banco com um cadastro e um histórico de empréstimos sintéticos.
+
+    Todas as pessoas recebem o mesmo PIN, criptografado uma única vez com o
+    hasher do projeto (a verificação custa o mesmo que em produção). Os
+    empréstimos cobrem os últimos 'dias', com mais movimento nos dias úteis e
+    nos horários de pico; uma chave nunca é emprestada duas vezes ao mesmo
+    tempo. Os 'abertos' mais recentes ficam sem devolução (parte deles
+    atrasada). Tudo fica na 'unidade' informada ou, sem ela, numa unidade
+    nova. Ao final os resumos dos gráficos são refeitos.
+    'progresso', se informado, recebe (dias_gerados, emprestimos_gerados).
+    Retorna um dicionário com as quantidades criadas.
+    """
+    aleatorio = random.Random(semente)
+    fuso = timezone.get_current_timezone()
+
+    with transaction.atomic():
+        if unidade is None:
+            unidade = Unidade.objects.create(nome="Unidade sintética")
+        lista_locais = Local.objects.bulk_create([Local(unidade=unidade, nome=f"Bloco {i + 1:03d}") for i in range(locais)])
+        lista_chaves = Chave.objects.bulk_create([
+            Chave(unidade=unidade, descricao=f"{aleatorio.choice(TIPOS_DE_SALA)} {i + 1:05d}", local=lista_locais[i % locais])
+            for i in range(chaves)
+        ], batch_size=TAMANHO_LOTE)
+        pin_hash = make_password(pin, hasher=hasher_pin())
+        lista_pessoas = Pessoa.objects.bulk_create([
+            Pessoa(
+                unidade=unidade,
+                nome=f"{aleatorio.choice(NOMES)} {aleatorio.choice(SOBRENOMES)} {aleatorio.choice(SOBRENOMES)}",
+                empresa=aleatorio.choice(EMPRESAS),
+                cpf_saran=f"{i + 1:011d}",
+                pin=pin_hash,
+            )
+            for i in range(pessoas)
+        ], batch_size=TAMANHO_LOTE)
+        nomes_locais = {local.id: local.nome for local in lista_locais}
+
+        agora = timezone.now()
+        primeiro_dia = timezone.localdate() - timedelta(days=dias)
+        livre_em = [None] * chaves
+        lote = []
+        total = 0
+
+        def gravar():
+            nonlocal lote, total
+            Emprestimo.objects.bulk_create(lote, batch_size=TAMANHO_LOTE)
+            total += len(lote)
+            lote = []
+
+        for numero_dia in range(dias + 1):
+            dia = primeiro_dia + timedelta(days=numero_dia)
+            quantidade = round(emprestimos_por_dia * PESO_POR_DIA_DA_SEMANA[dia.weekday()] * aleatorio.uniform(0.85, 1.15))
+            for retirada in _instantes_do_dia(aleatorio, dia, quantidade, fuso):
+                if retirada >= agora:
+                    break
+                # Algumas tentativas de achar uma chave que já voltou; no pico, nem sempre há
+                for _ in range(5):
+                    indice = aleatorio.randrange(chaves)
+                    if livre_em[indice] is None or livre_em[indice] <= retirada:
+                        break
+                else:
+                    continue
+                chave = lista_chaves[indice]
+                pessoa = aleatorio.choice(lista_pessoas)
+                prazo = aleatorio.choice(PRAZOS)
+                devolucao = retirada + _duracao(aleatorio, prazo)
+                if devolucao >= agora:
+                    continue
+                observacao = aleatorio.choice(OBSERVACOES) or None
+                livre_em[indice] = devolucao
+                lote.append(Emprestimo(
+                    unidade=unidade, chave=chave, pessoa=pessoa, data_retirada=retirada,
+                    previsao_devolucao=retirada + timedelta(hours=prazo) if prazo is not None else None,
+                    data_devolucao=devolucao, observacao=observacao,
+                    texto_busca=texto_emprestimo(chave.descricao, nomes_locais[chave.local_id], pessoa.nome,
+                                                 pessoa.cpf_saran, observacao),
+                ))
+                if len(lote) >= TAMANHO_LOTE:
+                    gravar()
+            if progresso:
+                progresso(numero_dia + 1, total + len(lote))
+        gravar()
+
+        # Empréstimos em aberto: chaves que já voltaram, retiradas nas últimas horas
+        livres = [i for i in range(chaves) if livre_em[i] is None or livre_em[i] < agora - timedelta(hours=12)]
+        escolhidas = aleatorio.sample(livres, min(abertos, len(livres)))
+        for posicao, indice in enumerate(escolhidas):
+            chave = lista_chaves[indice]
+            pessoa = aleatorio.choice(lista_pessoas)
+            retirada = agora - timedelta(hours=aleatorio.uniform(0.2, 11))
+            # Um terço dos abertos já passou do prazo
+            prazo = timedelta(hours=aleatorio.uniform(0.1, 1)) if posicao % 3 == 0 else timedelta(hours=12)
+            lote.append(Emprestimo(
+                unidade=unidade, chave=chave, pessoa=pessoa, data_retirada=retirada, previsao_devolucao=retirada + prazo,
+                texto_busca=texto_emprestimo(chave.descricao, nomes_locais[chave.local_id], pessoa.nome,
+                                             pessoa.cpf_saran, None),
+            ))
+        em_aberto = lote
+        gravar()
+        Chave.objects.bulk_update(
+            [Chave(id=emprestimo.chave_id, emprestimo_atual_id=emprestimo.id) for emprestimo in em_aberto],
+            ['emprestimo_atual'], batch_size=TAMANHO_LOTE,
+        )
+
+        resumo.reconstruir()
+
+    return {
+        'unidade': unidade,
+        'locais': locais,
+        'chaves': chaves,
+        'pessoas': pessoas,
+        'emprestimos': total,
+        'abertos': len(escolhidas),
+    }
@@ -0,0 +1,290 @@
+# claviculario_app/eventos.py
+
+import asyncio
+import itertools
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.db.models import Min
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Emprestimo
+
+logger = logging.getLogger(__name__)
+
+# Tipos de evento enviados às mesas
+RETIRADA = 'retirada'
+DEVOLUCAO = 'devolucao'
+CHAVE_DESATIVADA = 'chave_desativada'
+ATRASO = 'atraso'
+# O cliente perdeu eventos (reconectou tarde demais ou não deu conta do ritmo) e deve recarregar a página
+RECARREGAR = 'recarregar'
+
+BACKEND_PADRAO = 'claviculario_app.eventos.MemoriaBackend'
+
+# 'texto' é o evento já no formato do text/event-stream: montado uma vez, enviado a todas as conexões
+Evento = namedtuple('Evento', ['id', 'tipo', 'dados', 'texto'])
+
+
+def _formatar(id_evento, tipo, dados):
+    texto = f"event: {tipo}\ndata: {json.dumps(dados, cls=DjangoJSONEncoder)}\n\n"
+    return f"id: {id_evento}\n{texto}" if id_evento else texto
+
+
+def evento_recarregar():
+    return Evento(None, RECARREGAR, {}, _formatar(None, RECARREGAR, {}))
+
+
+def _da_unidade(evento, unidade_id):
+    """ Se o evento interessa a quem assinou a unidade (eventos sem unidade valem para todas). """
+    return unidade_id is None or evento.dados.get('unidade_id', unidade_id) == unidade_id
+
+
+#------------------------------------------------------------------
+# BACKENDS
+#------------------------------------------------------------------
+class MemoriaBackend:
+    """
+    Publicação e assinatura dentro do próprio processo.
+
+    Cada conexão aberta é uma fila asyncio no loop em que ela roda; publicar
+    (de qualquer thread) coloca o mesmo objeto Evento em todas as filas. Os
+    últimos eventos ficam guardados para que uma mesa que reconecta (com o
+    cabeçalho Last-Event-ID) receba o que perdeu. Uma conexão que assina
+    com 'unidade_id' só recebe os eventos daquela unidade. Só serve quando há um
+    único processo servindo a aplicação; com vários workers, use o
+    PostgresBackend.
+    """
+    def __init__(self, historico=500, tamanho_fila=1000):
+        self._trava = threading.Lock()
+        self._assinantes = set()
+        self._recentes = deque(maxlen=historico)
+        self._tamanho_fila = tamanho_fila
+        # Os ids valem só neste processo: o prefixo denuncia um Last-Event-ID de outro
+        self._prefixo = uuid.uuid4().hex[:8]
+        self._sequencia = itertools.count(1)
+
+    def publicar(self, tipo, dados):
+        """ Envia o evento a todos os assinantes. 'dados' precisa ser serializável em JSON. """
+        self.distribuir(tipo, dados)
+
+    def distribuir(self, tipo, dados):
+        """ Entrega o evento às conexões deste processo. """
+        with self._trava:
+            id_evento = f"{self._prefixo}-{next(self._sequencia)}"
+            evento = Evento(id_evento, tipo, dados, _formatar(id_evento, tipo, dados))
+            self._recentes.append(evento)
+            assinantes = list(self._assinantes)
+        for loop, fila, unidade_id in assinantes:
+            if not _da_unidade(evento, unidade_id):
+                continue
+            try:
+                loop.call_soon_threadsafe(self._entregar, fila, evento)
+            except RuntimeError:
+                pass  # O loop daquela conexão já foi encerrado
+        return evento
+
+    @staticmethod
+    def _entregar(fila, evento):
+        try:
+            fila.put_nowait(evento)
+        except asyncio.QueueFull:
+            # Cliente lento demais: descarta o que ele não leu e pede que recarregue
+            while not fila.empty():
+                fila.get_nowait()
+            fila.put_nowait(evento_recarregar())
+
+    def _perdidos(self, ultimo_id, unidade_id=None):
+        """ Eventos depois de 'ultimo_id', ou None se ele não puder mais ser reconstituído. """
+        recentes = list(self._recentes)
+        for posicao, evento in enumerate(recentes):
+            if evento.id == ultimo_id:
+                return [recente for recente in recentes[posicao + 1:] if _da_unidade(recente, unidade_id)]
+        return None
+
+    def assinantes(self):
+        with self._trava:
+            return len(self._assinantes)
+
+    def _ao_assinar(self):
+        """ Gancho para os backends que precisam de algo rodando enquanto houver assinantes. """
+
+    async def assinar(self, ultimo_id=None, pulso=None, unidade_id=None):
+        """
+        Gerador assíncrono com os eventos publicados a partir de agora (ou
+        depois de 'ultimo_id'), só os da unidade, se informada. Se 'pulso' for
+        informado, produz None a cada 'pulso' segundos sem eventos, para a
+        conexão mandar um sinal de vida.
+        """
+        assinante = (asyncio.get_running_loop(), asyncio.Queue(self._tamanho_fila), unidade_id)
+        with self._trava:
+            self._assinantes.add(assinante)
+            perdidos = self._perdidos(ultimo_id, unidade_id) if ultimo_id else []
+        self._ao_assinar()
+        fila = assinante[1]
+        try:
+            if perdidos is None:
+                yield evento_recarregar()
+            for evento in perdidos or ():
+                yield evento
+            while True:
+                try:
+                    yield await asyncio.wait_for(fila.get(), pulso)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._trava:
+                self._assinantes.discard(assinante)
+
+
+class PostgresBackend(MemoriaBackend):
+    """
+    Eventos compartilhados entre processos via LISTEN/NOTIFY do PostgreSQL.
+
+    Publicar é um pg_notify na conexão do Django. Em cada processo, uma
+    thread com uma conexão própria escuta o canal enquanto houver alguma
+    mesa conectada e repassa os eventos às conexões locais.
+    """
+    CANAL = 'claviculario_eventos'
+    # Segundos entre as verificações de que ainda há alguém conectado
+    INTERVALO = 5
+
+    def __init__(self, alias='default', **opcoes):
+        super().__init__(**opcoes)
+        self.alias = alias
+        self._ouvinte = None
+        self._trava_ouvinte = threading.Lock()
+
+    def publicar(self, tipo, dados):
+        mensagem = json.dumps({'tipo': tipo, 'dados': dados}, cls=DjangoJSONEncoder)
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.CANAL, mensagem])
+
+    def _ao_assinar(self):
+        with self._trava_ouvinte:
+            if self._ouvinte is None or not self._ouvinte.is_alive():
+                self._ouvinte = threading.Thread(target=self._ouvir, name='eventos-listen', daemon=True)
+                self._ouvinte.start()
+
+    def _ouvir(self):
+        conexao_django = connections[self.alias]
+        conexao = conexao_django.Database.connect(**conexao_django.get_connection_params())
+        conexao.autocommit = True
+        try:
+            with conexao.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.CANAL}")
+            while self.assinantes():
+                if select.select([conexao], [], [], self.INTERVALO) == ([], [], []):
+                    continue
+                conexao.poll()
+                while conexao.notifies:
+                    mensagem = json.loads(conexao.notifies.pop(0).payload)
+                    self.distribuir(mensagem['tipo'], mensagem['dados'])
+        except Exception:
+            logger.exception("Erro ao escutar os eventos do PostgreSQL")
+        finally:
+            conexao.close()
+
+
+_backend = None
+_trava_backend = threading.Lock()
+
+
+def backend():
+    """ O backend configurado em CLAVICULARIO_EVENTOS_BACKEND (um por processo). """
+    global _backend
+    with _trava_backend:
+        if _backend is None:
+            _backend = import_string(getattr(settings, 'CLAVICULARIO_EVENTOS_BACKEND', BACKEND_PADRAO))()
+        return _backend
+
+
+@receiver(setting_changed)
+def _trocar_backend(setting, **kwargs):
+    global _backend
+    if setting == 'CLAVICULARIO_EVENTOS_BACKEND':
+        _backend = None
+
+
+def publicar(tipo, dados):
+    """ Publica o evento assim que a transação atual for confirmada (e só se for). """
+    transaction.on_commit(lambda: backend().publicar(tipo, dados))
+
+
+#------------------------------------------------------------------
+# EMPRÉSTIMOS QUE VENCEM
+#------------------------------------------------------------------
+# Intervalo máximo entre duas verificações: um empréstimo novo pode vencer antes do próximo conhecido
+INTERVALO_ATRASOS = 30
+
+
+def publicar_atrasos(desde, ate, distribuir):
+    """
+    Publica um evento ATRASO para cada empréstimo aberto cujo prazo venceu
+    entre 'desde' e 'ate'. Retorna quando vence o próximo, se houver.
+    """
+    abertos = Emprestimo.objects.filter(data_devolucao__isnull=True)
+    vencidos = abertos.filter(previsao_devolucao__gt=desde, previsao_devolucao__lte=ate).values(
+        'id', 'unidade_id', 'chave_id', 'chave__descricao', 'pessoa__nome', 'previsao_devolucao',
+    )
+    for emprestimo in vencidos:
+        distribuir(ATRASO, {
+            'unidade_id': emprestimo['unidade_id'],
+            'emprestimo_id': emprestimo['id'],
+            'chave_id': emprestimo['chave_id'],
+            'chave': emprestimo['chave__descricao'],
+            'pessoa': emprestimo['pessoa__nome'],
+            'previsao_devolucao': emprestimo['previsao_devolucao'].isoformat(),
+        })
+    return abertos.filter(previsao_devolucao__gt=ate).aggregate(proximo=Min('previsao_devolucao'))['proximo']
+
+
+_vigia = None
+_trava_vigia = threading.Lock()
+
+
+def iniciar_vigia_de_atrasos():
+    """
+    Garante uma thread por processo acompanhando os prazos enquanto houver
+    mesas conectadas. Atrasos não nascem de nenhuma ação de usuário, então é
+    ela que os anuncia: uma consulta por vencimento, qualquer que seja o número
+    de conexões. Cada processo anuncia só às suas próprias conexões.
+    """
+    global _vigia
+    with _trava_vigia:
+        if _vigia is None or not _vigia.is_alive():
+            _vigia = threading.Thread(target=_vigiar_atrasos, name='eventos-atrasos', daemon=True)
+            _vigia.start()
+
+
+def _vigiar_atrasos():
+    eventos = backend()
+    desde = timezone.now()
+    try:
+        # Espera a primeira conexão terminar de assinar
+        time.sleep(1)
+        while eventos.assinantes():
+            agora = timezone.now()
+            proximo = publicar_atrasos(desde, agora, eventos.distribuir)
+            desde = agora
+            espera = INTERVALO_ATRASOS
+            if proximo is not None:
+                espera = min(espera, max(0.5, (proximo - agora + timedelta(milliseconds=50)).total_seconds()))
+            connections.close_all()
+            time.sleep(espera)
+    except Exception:
+        logger.exception("Erro ao acompanhar os empréstimos atrasados")
+    finally:
+        connections.close_all()
@@ -1,15 +1,83 @@
 # claviculario_app/forms.py
 
 from django import forms
-from .models import Emprestimo, Chave, Pessoa, Local
+from .models import Emprestimo, Chave, Pessoa, Local, Unidade
 from django.utils import timezone
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
+from django.core.exceptions import ValidationError
+from django.urls import reverse_lazy
+from .services import validar_data_retirada, RetiradaNoFuturoError
+
+
+class SelectAssincrono(forms.Select):
+    """
+    Select de um ModelChoiceField que não lista o cadastro inteiro no HTML.
+
+    Só a opção já escolhida é renderizada; as demais são buscadas pela página
+    na URL de 'data-busca-url' conforme o usuário digita (formato do Select2:
+    {'results': [{'id', 'text'}], 'pagination': {'more'}}).
+    """
+    def __init__(self, url, attrs=None):
+        super().__init__(attrs={'class': 'form-select', **(attrs or {})})
+        self.url = url
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['attrs']['data-busca-url'] = str(self.url)
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        campo = self.choices.field
+        escolhidos = [v for v in value if v]
+        try:
+            objetos = list(campo.queryset.filter(pk__in=escolhidos)) if escolhidos else []
+        except (ValueError, TypeError, ValidationError):
+            objetos = []  # Valor inválido: o formulário já mostra o erro
+        opcoes = self.choices
+        self.choices = [('', campo.empty_label or '')] + [(obj.pk, campo.label_from_instance(obj)) for obj in objetos]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = opcoes
+
+
+class CamposDaUnidadeMixin:
+    """
+    Formulário usado dentro de uma unidade (argumento 'unidade'): as listas de
+    escolha só mostram os registros dela e o objeto novo é criado nela. Sem
+    unidade (admin), nada é filtrado.
+    """
+    def __init__(self, *args, unidade=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if unidade is None:
+            return
+        for campo in self.fields.values():
+            if hasattr(getattr(campo, 'queryset', None), 'da_unidade'):
+                campo.queryset = campo.queryset.da_unidade(unidade)
+        instance = getattr(self, 'instance', None)
+        if instance is not None and instance.pk is None:
+            instance.unidade = unidade
+
+
+#FORMULÁRIO PARA TROCAR DE UNIDADE
+class SelecionarUnidadeForm(forms.Form):
+    unidade = forms.ModelChoiceField(
+        queryset=Unidade.objects.none(),
+        empty_label=None,
+        label="Unidade",
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+
+    def __init__(self, *args, unidades, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Só as unidades a que o usuário tem acesso (ver unidades.unidades_do_usuario)
+        self.fields['unidade'].queryset = unidades
 
 
 #FORMULÁRIO PARA CRIAR E EDITAR EMPRESTIMOS 
-class EmprestimoForm(forms.ModelForm):
+class EmprestimoForm(CamposDaUnidadeMixin, forms.ModelForm):
     data_retirada = forms.DateTimeField(
         initial=timezone.now,
         widget=forms.DateTimeInput(attrs={'type': 'datetime-local', 'class': 'form-control'}),
@@ -19,18 +87,26 @@ class EmprestimoForm(forms.ModelForm):
         model = Emprestimo
         fields = ['chave', 'pessoa', 'data_retirada', 'previsao_devolucao','observacao']
         widgets = {
-            'chave': forms.Select(attrs={'class': 'form-select'}),
-            'pessoa': forms.Select(attrs={'class': 'form-select'}),
+            'chave': SelectAssincrono(reverse_lazy('filtrar_chaves_por_local')),
+            'pessoa': SelectAssincrono(reverse_lazy('filtrar_pessoas')),
             'previsao_devolucao': forms.DateTimeInput(attrs={'type': 'datetime-local', 'class': 'form-control'}),
             'observacao': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
         }
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['chave'].queryset = Chave.objects.filter(disponivel=True, ativa=True).order_by('descricao')
-        self.fields['pessoa'].queryset = Pessoa.objects.all().order_by('nome')
+        # select_related: o texto de cada opção (Chave.__str__) usa o nome do local
+        self.fields['chave'].queryset = self.fields['chave'].queryset.filter(emprestimo_atual__isnull=True, ativa=True).select_related('local').order_by('descricao')
+
+    def clean_data_retirada(self):
+        data_retirada = self.cleaned_data['data_retirada']
+        try:
+            validar_data_retirada(data_retirada)
+        except RetiradaNoFuturoError as erro:
+            raise forms.ValidationError(str(erro))
+        return data_retirada
 
 #FORMULÁRIO PARA CRIAR E EDITAR CHAVES
-class ChaveForm(forms.ModelForm):
+class ChaveForm(CamposDaUnidadeMixin, forms.ModelForm):
     class Meta:
         model = Chave
         fields = ['descricao', 'local']
@@ -46,24 +122,25 @@ class ChaveForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # ADICIONA O FILTRO: O dropdown de 'local' agora só mostra locais ativos.
-        self.fields['local'].queryset = Local.objects.filter(ativa=True).order_by('nome')
+        self.fields['local'].queryset = self.fields['local'].queryset.filter(ativa=True).order_by('nome')
     
-    # Validação para garantir que a descrição da chave seja única
+    # Validação para garantir que a descrição da chave seja única na unidade
     def clean_descricao(self):
         descricao = self.cleaned_data.get('descricao')
+        chaves = Chave.objects.filter(unidade=self.instance.unidade_id, descricao=descricao)
         if self.instance and self.instance.pk:
             # Editando: verifica se outra chave já tem essa descrição
-            if Chave.objects.filter(descricao=descricao).exclude(pk=self.instance.pk).exists():
+            if chaves.exclude(pk=self.instance.pk).exists():
                 raise forms.ValidationError("Já existe uma chave com esta descrição.")
         else:
             # Criando: verifica se qualquer chave já tem essa descrição
-            if Chave.objects.filter(descricao=descricao).exists():
+            if chaves.exists():
                 raise forms.ValidationError("Já existe uma chave com esta descrição.")
         return descricao
 
 
 #FORMULÁRIO PARA O RELATÓRIO
-class RelatorioForm(forms.Form):
+class RelatorioForm(CamposDaUnidadeMixin, forms.Form):
     data_inicio = forms.DateField(
         label="De",
         required=False,
@@ -75,20 +152,28 @@ class RelatorioForm(forms.Form):
         widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'})
     )
 
-    # CAMPO: Filtro por Pessoa
+    # CAMPO: Busca livre (chave, local, pessoa, CPF/SARAN e observação)
+    busca = forms.CharField(
+        label="Busca",
+        required=False,
+        max_length=200,
+        widget=forms.TextInput(attrs={'type': 'search', 'class': 'form-control', 'placeholder': 'Chave, local, pessoa, CPF/SARAN ou observação...'})
+    )
+
+    # CAMPO: Filtro por Pessoa (inclusive as desativadas, que continuam no histórico)
     pessoa = forms.ModelChoiceField(
-        queryset=Pessoa.objects.all().order_by('nome'),
+        queryset=Pessoa.objects.all(),
         required=False,
         label="Pessoa",
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=SelectAssincrono(reverse_lazy('filtrar_pessoas'), attrs={'data-busca-params': 'inativas=1'})
     )
     
     # CAMPO: Filtro por Chave
     chave = forms.ModelChoiceField(
-        queryset=Chave.objects.all().order_by('descricao'),
+        queryset=Chave.objects.select_related('local'),
         required=False,
         label="Chave",
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=SelectAssincrono(reverse_lazy('buscar_chaves'))
     )
 
     STATUS_CHOICES = (
@@ -102,8 +187,49 @@ class RelatorioForm(forms.Form):
         widget=forms.Select(attrs={'class': 'form-select'})
     )
 
+#FORMULÁRIO DA CONSULTA "QUEM ESTAVA COM A CHAVE"
+def _campo_horario(label):
+    return forms.DateTimeField(
+        label=label,
+        required=False,
+        widget=forms.DateTimeInput(attrs={'type': 'datetime-local', 'class': 'form-control'}, format='%Y-%m-%dT%H:%M'),
+    )
+
+class ConsultaHorarioForm(CamposDaUnidadeMixin, forms.Form):
+    # Um instante ("às 02:30 de terça") ou um intervalo ("entre 02:00 e 03:00")
+    instante = _campo_horario("Em")
+    inicio = _campo_horario("Entre")
+    fim = _campo_horario("E")
+    chave = forms.ModelChoiceField(
+        queryset=Chave.objects.select_related('local'),
+        required=False,
+        label="Chave",
+        widget=SelectAssincrono(reverse_lazy('buscar_chaves'))
+    )
+    local = forms.ModelChoiceField(
+        queryset=Local.objects.all(),
+        required=False,
+        label="Local",
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    pessoa = forms.ModelChoiceField(
+        queryset=Pessoa.objects.all(),
+        required=False,
+        label="Pessoa",
+        widget=SelectAssincrono(reverse_lazy('filtrar_pessoas'), attrs={'data-busca-params': 'inativas=1'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        instante, inicio, fim = (cleaned_data.get(campo) for campo in ('instante', 'inicio', 'fim'))
+        if instante is None and (inicio is None or fim is None):
+            raise ValidationError("Informe um instante ou um intervalo (início e fim).")
+        if instante is None and inicio >= fim:
+            raise ValidationError("O fim do intervalo deve ser depois do início.")
+        return cleaned_data
+
 #FORMULÁRIO PARA CADASTRO DE PESSOAS
-class PessoaForm(forms.ModelForm):
+class PessoaForm(CamposDaUnidadeMixin, forms.ModelForm):
     pin = forms.CharField(
         label="PIN (4 a 6 dígitos)",
         widget=forms.PasswordInput(attrs={'class': 'form-control'}),
@@ -130,6 +256,9 @@ class PessoaForm(forms.ModelForm):
     def clean_cpf_saran(self):
         # Pega o CPF/SARAN do formulário que o usuário enviou
         cpf_saran = self.cleaned_data.get('cpf_saran')
+        # O CPF/SARAN só se repete entre unidades. No admin, a unidade é um campo do formulário.
+        pessoas = Pessoa.objects.filter(unidade=self.cleaned_data.get('unidade', self.instance.unidade_id),
+                                        cpf_saran=cpf_saran)
         
         # self.instance é o objeto Pessoa que está sendo editado.
         # Ao criar uma nova pessoa, self.instance não terá um 'pk' (id).
@@ -137,11 +266,11 @@ class PessoaForm(forms.ModelForm):
         if self.instance and self.instance.pk:
             # Estamos editando. Vamos procurar por pessoas com o mesmo CPF/SARAN,
             # mas EXCLUINDO a própria pessoa que estamos editando da busca.
-            if Pessoa.objects.filter(cpf_saran=cpf_saran).exclude(pk=self.instance.pk).exists():
+            if pessoas.exclude(pk=self.instance.pk).exists():
                 raise forms.ValidationError("Este CPF ou SARAN já está cadastrado para outra pessoa.")
         else:
             # Estamos criando uma nova pessoa. A lógica antiga funciona.
-            if Pessoa.objects.filter(cpf_saran=cpf_saran).exists():
+            if pessoas.exists():
                 raise forms.ValidationError("Este CPF ou SARAN já está cadastrado.")
                 
         return cpf_saran
@@ -166,7 +295,7 @@ class PessoaForm(forms.ModelForm):
         return pessoa
 
 #FORMULÁRIO PARA CRIAR E EDITAR LOCAIS
-class LocalForm(forms.ModelForm):
+class LocalForm(CamposDaUnidadeMixin, forms.ModelForm):
     class Meta:
         model = Local
         fields = ['nome']
@@ -177,14 +306,15 @@ class LocalForm(forms.ModelForm):
             'nome': 'Nome do Local',
         }
 
-    # Validação para garantir que o nome do local seja único
+    # Validação para garantir que o nome do local seja único na unidade
     def clean_nome(self):
         nome = self.cleaned_data.get('nome')
+        locais = Local.objects.filter(unidade=self.instance.unidade_id, nome=nome)
         if self.instance and self.instance.pk:
-            if Local.objects.filter(nome=nome).exclude(pk=self.instance.pk).exists():
+            if locais.exclude(pk=self.instance.pk).exists():
                 raise forms.ValidationError("Já existe um local com este nome.")
         else:
-            if Local.objects.filter(nome=nome).exists():
+            if locais.exists():
                 raise forms.ValidationError("Já existe um local com este nome.")
         return nome
     
@@ -211,16 +341,31 @@ class CustomUserChangeForm(forms.ModelForm):
         label="Funções (Grupos)"
     )
 
+    # Só as unidades de quem edita (ver unidades.unidades_do_usuario): é aqui
+    # que quem entrou pelo login social ganha uma unidade
+    unidades = forms.ModelMultipleChoiceField(
+        queryset=Unidade.objects.none(),
+        widget=forms.CheckboxSelectMultiple,
+        required=False,
+        label="Unidades"
+    )
+
     class Meta:
         model = User
-        fields = ('username', 'email', 'is_active', 'grupos')
+        fields = ('username', 'email', 'is_active', 'grupos', 'unidades')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, unidades=None, **kwargs):
         super().__init__(*args, **kwargs)
+        if unidades is None:
+            del self.fields['unidades']
+        else:
+            self.fields['unidades'].queryset = unidades
         # Se o formulário for para um usuário existente, preenchemos o campo 'grupos'
         # com os grupos aos quais ele já pertence.
         if self.instance.pk:
             self.fields['grupos'].initial = self.instance.groups.all()
+            if 'unidades' in self.fields:
+                self.fields['unidades'].initial = self.instance.unidades_membro.all()
 
     def save(self, commit=True):
         # A lógica de salvar é customizada: primeiro salvamos o usuário,
@@ -230,5 +375,10 @@ class CustomUserChangeForm(forms.ModelForm):
             user.save()
             # O .set() limpa os grupos antigos e adiciona os novos selecionados.
             user.groups.set(self.cleaned_data['grupos'])
+            if 'unidades' in self.fields:
+                # As unidades que quem edita não vê ficam como estão
+                visiveis = self.fields['unidades'].queryset
+                user.unidades_membro.remove(*visiveis.exclude(pk__in=self.cleaned_data['unidades']))
+                user.unidades_membro.add(*self.cleaned_data['unidades'])
             self.save_m2m() # Necessário para salvar relações ManyToMany
         return user
\ No newline at end of file
@@ -0,0 +1,52 @@
+# claviculario_app/hashers.py
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, get_hasher
+from django.db import connections
+
+HASHER_PIN_PADRAO = 'pbkdf2_pin'
+# Medido com o PinsHashersBenchmark: cerca de 30 ms por conferência (o
+# PBKDF2 padrão do Django, com 1.000.000 de iterações, leva mais de 500 ms)
+ITERACOES_PIN_PADRAO = 50_000
+
+
+class PBKDF2PinHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 com menos iterações, só para os PINs.
+
+    Um PIN de 4 a 6 dígitos tem no máximo um milhão de combinações: se os
+    hashes vazarem, nenhum custo de hash razoável impede que sejam todos
+    testados. O que protege o PIN é o bloqueio de tentativas (ver
+    claviculario_app.pin); o hash só precisa não ser trivial, e cada
+    conferência custa uma fração do PBKDF2 das senhas. As iterações vêm de
+    CLAVICULARIO_PIN_ITERACOES; ao mudá-las, os PINs são refeitos no próximo
+    acerto.
+    """
+    algorithm = HASHER_PIN_PADRAO
+
+    @property
+    def iterations(self):
+        return getattr(settings, 'CLAVICULARIO_PIN_ITERACOES', ITERACOES_PIN_PADRAO)
+
+
+def hasher_pin():
+    """
+    O hasher de CLAVICULARIO_PIN_HASHER, se estiver em PASSWORD_HASHERS;
+    senão, o hasher padrão das senhas.
+    """
+    try:
+        return get_hasher(getattr(settings, 'CLAVICULARIO_PIN_HASHER', HASHER_PIN_PADRAO))
+    except ValueError:
+        return get_hasher('default')
+
+
+def iniciar_processo_de_hashes():
+    """
+    Inicializador dos processos que calculam hashes de PIN (ver
+    importacao.gerar_hashes_pins): o Django, sem nenhuma conexão aberta com o
+    banco. Fica aqui porque o processo novo o importa antes do django.setup(),
+    e este módulo não depende dos models.
+    """
+    django.setup()
+    connections.close_all()
@@ -0,0 +1,217 @@
+# claviculario_app/importacao.py
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+
+from .hashers import hasher_pin, iniciar_processo_de_hashes
+from .models import Pessoa, Chave, Local
+
+# Abaixo deste número de PINs não compensa subir um pool de processos
+MINIMO_PARA_POOL = 64
+TAMANHO_LOTE = 1000
+
+COLUNAS_PESSOAS = ['nome_completo', 'cpf_saran', 'pin']
+COLUNAS_CHAVES = ['descricao_chave', 'nome_local']
+
+
+def _normalizar_colunas(df, colunas):
+    """ Converte as colunas para texto sem espaços, tratando células vazias como ''. """
+    df = df.copy()
+    for coluna in colunas:
+        if coluna not in df.columns:
+            df[coluna] = ''
+        df[coluna] = df[coluna].fillna('').astype(str).str.strip()
+    return df
+
+
+def _id(unidade):
+    return getattr(unidade, 'pk', unidade)
+
+
+def _gerar_hashes(pins):
+    hasher = hasher_pin()
+    return [make_password(pin, hasher=hasher) for pin in pins]
+
+
+def gerar_hashes_pins(pins, workers=None, progresso=None):
+    """
+    Gera o hash de cada PIN, em paralelo quando a lista é grande.
+
+    O make_password é propositalmente lento (PBKDF2) e preso à CPU, então a
+    lista é dividida entre processos. Cada processo inicializa o Django para
+    usar o mesmo hasher de PIN do projeto. Os processos começam do zero
+    ('spawn'), não de uma cópia (fork) do processo atual: a importação roda
+    numa thread de um servidor com outras threads, travas e conexões com o
+    banco abertas, que um fork herdaria. Se 'progresso' for informado, ele
+    é chamado com a quantidade de PINs já processados ao fim de cada fatia.
+    """
+    pins = list(pins)
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1 and len(pins) >= MINIMO_PARA_POOL:
+        tamanho = -(-len(pins) // (workers * 4))  # Divisão arredondada para cima
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=iniciar_processo_de_hashes)
+    else:
+        tamanho = max(1, MINIMO_PARA_POOL)
+
+    fatias = [pins[i:i + tamanho] for i in range(0, len(pins), tamanho)]
+    hashes = []
+    try:
+        resultados = pool.map(_gerar_hashes, fatias) if pool else map(_gerar_hashes, fatias)
+        for fatia in resultados:
+            hashes.extend(fatia)
+            if progresso:
+                progresso(len(hashes))
+    finally:
+        if pool:
+            pool.shutdown()
+    return hashes
+
+
+def importar_pessoas(df, unidade, workers=None, tamanho_lote=TAMANHO_LOTE, progresso=None):
+    """
+    Importa pessoas de um DataFrame (colunas: nome_completo, empresa, cpf_saran, pin)
+    para a unidade informada (objeto ou id); as das outras unidades não contam.
+
+    Os CPF/SARAN já cadastrados são lidos numa única consulta e comparados como
+    conjunto; só as pessoas novas têm o PIN criptografado e são gravadas com
+    bulk_create em lotes. Pessoas existentes nunca são alteradas: se o nome da
+    planilha divergir do cadastro, ou se outra sessão cadastrar o CPF/SARAN
+    durante a importação, a linha entra na lista de conflitos.
+    'progresso', se informado, recebe o número de linhas já tratadas.
+    """
+    df = _normalizar_colunas(df, COLUNAS_PESSOAS + ['empresa'])
+    # Ignora linhas com dados essenciais faltando
+    df = df[(df['cpf_saran'] != '') & (df['nome_completo'] != '') & (df['pin'] != '')]
+
+    nomes_existentes = dict(Pessoa.objects.da_unidade(unidade).order_by().values_list('cpf_saran', 'nome'))
+    # Um CPF repetido na planilha se comporta como já cadastrado pela primeira ocorrência
+    primeira_ocorrencia = ~df['cpf_saran'].duplicated()
+    ja_cadastrada = df['cpf_saran'].isin(nomes_existentes.keys())
+    novas = df[primeira_ocorrencia & ~ja_cadastrada]
+    nomes_existentes.update(zip(novas['cpf_saran'], novas['nome_completo']))
+
+    ignoradas = df[~(primeira_ocorrencia & ~ja_cadastrada)]
+    nome_no_sistema = ignoradas['cpf_saran'].map(nomes_existentes)
+    conflitos = [
+        f"CPF/SARAN {cpf_saran}: Nome no sistema '{nome_sistema}', nome na planilha '{nome}'. Nenhum dado foi alterado."
+        for cpf_saran, nome, nome_sistema in zip(ignoradas['cpf_saran'], ignoradas['nome_completo'], nome_no_sistema)
+        if nome != nome_sistema
+    ]
+
+    if progresso:
+        progresso(len(ignoradas))
+    hashes = gerar_hashes_pins(
+        novas['pin'], workers=workers,
+        progresso=(lambda feitos: progresso(len(ignoradas) + feitos)) if progresso else None,
+    )
+    pessoas = [
+        Pessoa(unidade_id=_id(unidade), nome=nome, cpf_saran=cpf_saran, empresa=empresa or None, pin=pin_hash)
+        for nome, cpf_saran, empresa, pin_hash in zip(novas['nome_completo'], novas['cpf_saran'], novas['empresa'], hashes)
+    ]
+    criados = len(pessoas)
+    # Cada lote é uma transação, como em importar_chaves
+    for inicio in range(0, len(pessoas), tamanho_lote):
+        for pessoa in _inserir(Pessoa, pessoas[inicio:inicio + tamanho_lote], 'cpf_saran'):
+            conflitos.append(f"CPF/SARAN {pessoa.cpf_saran}: cadastrado durante a importação. Nenhum dado foi alterado.")
+            criados -= 1
+
+    return {
+        'criados': criados,
+        'ignorados': len(df) - criados,
+        'conflitos': conflitos,
+    }
+
+
+def _inserir(modelo, lote, campo):
+    """
+    Insere um lote de objetos de 'modelo' e devolve os que ficaram de fora
+    porque outra sessão cadastrou o mesmo 'campo' (único na unidade) no meio
+    da importação.
+
+    Sem ignore_conflicts: ele não diz quais linhas entraram. Se o INSERT
+    esbarrar num valor novo, os valores do lote são relidos (agora já
+    confirmados pela outra sessão), saem do lote e o resto é inserido de novo.
+    """
+    ignorados = []
+    while lote:
+        try:
+            with transaction.atomic():
+                modelo.objects.bulk_create(lote)
+            break
+        except IntegrityError:
+            cadastrados = set(modelo.objects.filter(
+                unidade_id=lote[0].unidade_id, **{f'{campo}__in': [getattr(objeto, campo) for objeto in lote]},
+            ).values_list(campo, flat=True))
+            if not cadastrados:
+                raise
+            ignorados += [objeto for objeto in lote if getattr(objeto, campo) in cadastrados]
+            lote = [objeto for objeto in lote if getattr(objeto, campo) not in cadastrados]
+    return ignorados
+
+
+def importar_chaves(df, unidade, tamanho_lote=TAMANHO_LOTE, progresso=None):
+    """
+    Importa chaves de um DataFrame (colunas: descricao_chave, nome_local) para
+    a unidade informada (objeto ou id), com os locais dessa unidade.
+
+    As descrições e os locais já cadastrados são lidos uma única vez; os locais
+    que faltam são criados com um bulk_create e as chaves são inseridas em lotes.
+    Cada linha ignorada é reportada em 'conflitos' com o número da linha na
+    planilha, inclusive as chaves que outra sessão cadastrou enquanto a
+    importação rodava. Cada lote é uma transação: se a importação parar no
+    meio, as chaves já gravadas ficam, e importar a planilha de novo só cria
+    as que faltam. 'progresso', se informado, recebe o número de linhas já
+    tratadas.
+    """
+    df = _normalizar_colunas(df, COLUNAS_CHAVES).reset_index(drop=True)
+    # Número da linha como o usuário vê no Excel (a linha 1 é o cabeçalho)
+    df['linha'] = df.index + 2
+
+    df = df[(df['descricao_chave'] != '') & (df['nome_local'] != '')]
+    descricoes_existentes = set(Chave.objects.da_unidade(unidade).order_by().values_list('descricao', flat=True))
+    ja_cadastrada = df['descricao_chave'].isin(descricoes_existentes)
+    repetida = df['descricao_chave'].duplicated()
+    novas = df[~ja_cadastrada & ~repetida]
+
+    motivos = {}
+    for linha, descricao in zip(df.loc[repetida, 'linha'], df.loc[repetida, 'descricao_chave']):
+        motivos[linha] = f"Linha {linha}: a chave '{descricao}' aparece mais de uma vez na planilha."
+    for linha, descricao in zip(df.loc[ja_cadastrada, 'linha'], df.loc[ja_cadastrada, 'descricao_chave']):
+        motivos[linha] = f"Linha {linha}: a chave '{descricao}' já está cadastrada."
+
+    unidade_id = _id(unidade)
+    locais = dict(Local.objects.da_unidade(unidade_id).order_by().values_list('nome', 'id'))
+    locais_faltantes = set(novas['nome_local']) - locais.keys()
+    if locais_faltantes:
+        # ignore_conflicts não devolve os ids, então eles são lidos logo em seguida
+        Local.objects.bulk_create([Local(unidade_id=unidade_id, nome=nome, ativa=True) for nome in locais_faltantes],
+                                  ignore_conflicts=True)
+        locais.update(Local.objects.da_unidade(unidade_id).filter(nome__in=locais_faltantes).values_list('nome', 'id'))
+
+    chaves = [
+        Chave(unidade_id=unidade_id, descricao=descricao, local_id=locais[nome_local])
+        for descricao, nome_local in zip(novas['descricao_chave'], novas['nome_local'])
+    ]
+    linhas = dict(zip(novas['descricao_chave'], novas['linha']))
+    criados = len(chaves)
+    # Cada lote é confirmado por si: o progresso, gravado entre um lote e
+    # outro, fica visível para as outras conexões durante a importação
+    for inicio in range(0, len(chaves), tamanho_lote):
+        for chave in _inserir(Chave, chaves[inicio:inicio + tamanho_lote], 'descricao'):
+            linha = linhas[chave.descricao]
+            motivos[linha] = f"Linha {linha}: a chave '{chave.descricao}' foi cadastrada durante a importação."
+            criados -= 1
+        if progresso:
+            progresso(len(df) - len(novas) + min(inicio + tamanho_lote, len(chaves)))
+
+    return {
+        'criados': criados,
+        'ignorados': len(df) - criados,
+        'conflitos': [motivos[linha] for linha in sorted(motivos)],
+    }
@@ -0,0 +1,125 @@
+# claviculario_app/instrumentacao.py
+
+import logging
+import time
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .replicas import banco_de_relatorios
+
+logger = logging.getLogger(__name__)
+
+
+class Medicao:
+    """
+    Tempos e consultas SQL de uma requisição.
+
+    Funciona como 'execute_wrapper' do Django: enquanto estiver instalada na
+    conexão, cada consulta executada é contada e tem o seu tempo somado.
+    """
+    def __init__(self, nome):
+        self.nome = nome
+        self.inicio = time.perf_counter()
+        self.total = None
+        self.etapas = {}
+        self.consultas = 0
+        self.tempo_sql = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.tempo_sql += time.perf_counter() - inicio
+
+    @contextmanager
+    def etapa(self, nome):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.etapas[nome] = self.etapas.get(nome, 0.0) + time.perf_counter() - inicio
+
+    def finalizar(self):
+        self.total = time.perf_counter() - self.inicio
+        logger.info(
+            "%s: total=%.1fms %s sql=%d consultas/%.1fms",
+            self.nome, self.total * 1000,
+            ' '.join(f"{nome}={tempo * 1000:.1f}ms" for nome, tempo in self.etapas.items()),
+            self.consultas, self.tempo_sql * 1000,
+            extra={'medicao': self.como_dict()},
+        )
+
+    def como_dict(self):
+        return {
+            'view': self.nome,
+            'total_ms': round(self.total * 1000, 1) if self.total is not None else None,
+            'etapas_ms': {nome: round(tempo * 1000, 1) for nome, tempo in self.etapas.items()},
+            'consultas': self.consultas,
+            'sql_ms': round(self.tempo_sql * 1000, 1),
+        }
+
+    def server_timing(self):
+        """ Valor do cabeçalho Server-Timing (aparece na aba de rede do navegador). """
+        partes = [f"{nome};dur={tempo * 1000:.1f}" for nome, tempo in self.etapas.items()]
+        partes.append(f'sql;dur={self.tempo_sql * 1000:.1f};desc="{self.consultas} consultas"')
+        partes.append(f"view;dur={(time.perf_counter() - self.inicio) * 1000:.1f}")
+        return ', '.join(partes)
+
+
+def etapa(request, nome):
+    """ Mede um trecho da view, se a requisição estiver sendo instrumentada. """
+    medicao = getattr(request, 'medicao', None)
+    return medicao.etapa(nome) if medicao else nullcontext()
+
+
+@contextmanager
+def _medindo(medicao):
+    """ Instala a medição no banco principal e, se houver, no de relatórios (ver replicas.py). """
+    with ExitStack() as pilha:
+        for alias in {DEFAULT_DB_ALIAS, banco_de_relatorios()} - {None}:
+            pilha.enter_context(connections[alias].execute_wrapper(medicao))
+        yield
+
+
+def _acompanhar_streaming(conteudo, medicao):
+    # Nas respostas em streaming as consultas rodam enquanto o conteúdo é
+    # enviado, então a medição só termina quando o último pedaço sai.
+    try:
+        with _medindo(medicao):
+            yield from conteudo
+    finally:
+        medicao.finalizar()
+
+
+def instrumentar(nome):
+    """
+    Decorador de view: registra no log o tempo total, o tempo de cada etapa e
+    a quantidade e o tempo das consultas SQL da requisição.
+
+    Com CLAVICULARIO_SERVER_TIMING = True o resultado também vai no cabeçalho
+    Server-Timing da resposta (em streaming, só o que foi medido até a view
+    retornar).
+    """
+    def decorador(view):
+        @wraps(view)
+        def _view(request, *args, **kwargs):
+            medicao = Medicao(nome)
+            request.medicao = medicao
+            with _medindo(medicao):
+                response = view(request, *args, **kwargs)
+
+            if getattr(settings, 'CLAVICULARIO_SERVER_TIMING', False):
+                response['Server-Timing'] = medicao.server_timing()
+            # Um FileResponse já tem o arquivo pronto: não há mais consultas a medir
+            if response.streaming and getattr(response, 'file_to_stream', None) is None:
+                response.streaming_content = _acompanhar_streaming(response.streaming_content, medicao)
+            else:
+                medicao.finalizar()
+            return response
+        return _view
+    return decorador
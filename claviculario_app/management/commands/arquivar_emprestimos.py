@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from claviculario_app.arquivo import anos_para_arquivar, arquivar, caminho
+from claviculario_app.particoes import ParticionamentoError
+
+
+class Command(BaseCommand):
+    help = (
+        "Exporta para Parquet (em CLAVICULARIO_ARQUIVO_EMPRESTIMOS) os anos de empréstimos encerrados há mais de "
+        "--anos anos e os apaga do banco. Exige a tabela particionada (particionar_emprestimos --converter)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--anos', type=int, required=True, help="Mantém no banco o ano atual e os N anteriores.")
+
+    def handle(self, *args, **options):
+        if options['anos'] < 1:
+            raise CommandError("--anos precisa ser pelo menos 1.")
+        try:
+            anos = anos_para_arquivar(options['anos'])
+        except ParticionamentoError as erro:
+            raise CommandError(str(erro)) from erro
+        for ano in anos:
+            try:
+                linhas = arquivar(ano)
+            except ParticionamentoError as erro:
+                self.stderr.write(self.style.WARNING(f"{ano} não foi arquivado: {erro}"))
+                continue
+            self.stdout.write(self.style.SUCCESS(f"{ano}: {linhas} empréstimo(s) em {caminho(ano)}."))
+        if not anos:
+            self.stdout.write("Nenhum ano para arquivar.")
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from claviculario_app.dados_sinteticos import gerar
+from claviculario_app.models import Local, Chave, Pessoa, Emprestimo, ResumoHorario, Unidade
+
+
+class Command(BaseCommand):
+    help = ("Gera locais, chaves, pessoas (com PIN já criptografado) e anos de histórico de empréstimos "
+            "sintéticos, para reproduzir o volume de produção localmente.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locais', type=int, default=20)
+        parser.add_argument('--chaves', type=int, default=500)
+        parser.add_argument('--pessoas', type=int, default=3000)
+        parser.add_argument('--anos', type=float, default=1.0, help="Anos de histórico até hoje.")
+        parser.add_argument('--emprestimos-por-dia', type=int, default=400, help="Média num dia útil.")
+        parser.add_argument('--abertos', type=int, default=30, help="Empréstimos ainda sem devolução.")
+        parser.add_argument('--pin', default='1234', help="PIN de todas as pessoas geradas.")
+        parser.add_argument('--semente', type=int, help="Semente do gerador, para repetir os mesmos dados.")
+        parser.add_argument('--unidade', help="Nome da unidade dos dados (criada se não existir).")
+        parser.add_argument('--limpar', action='store_true',
+                            help="Apaga empréstimos, resumos, chaves, pessoas, locais e unidades antes de gerar.")
+
+    def handle(self, *args, **options):
+        if options['limpar']:
+            for modelo in (ResumoHorario, Emprestimo, Chave, Pessoa, Local, Unidade):
+                modelo.objects.all().delete()
+        elif Local.objects.exists() or Pessoa.objects.exists():
+            raise CommandError("O banco já tem cadastros. Use --limpar para apagá-los antes de gerar os dados.")
+
+        dias = round(options['anos'] * 365)
+        unidade = None
+        if options['unidade']:
+            unidade, _ = Unidade.objects.get_or_create(nome=options['unidade'])
+
+        def progresso(dias_gerados, emprestimos):
+            if dias_gerados % 30 == 0 or dias_gerados == dias + 1:
+                self.stdout.write(f"{dias_gerados}/{dias + 1} dias, {emprestimos} empréstimos...")
+
+        totais = gerar(
+            locais=options['locais'], chaves=options['chaves'], pessoas=options['pessoas'], dias=dias,
+            emprestimos_por_dia=options['emprestimos_por_dia'], abertos=options['abertos'],
+            pin=options['pin'], semente=options['semente'], progresso=progresso, unidade=unidade,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Unidade '{totais['unidade']}': {totais['locais']} locais, {totais['chaves']} chaves, {totais['pessoas']} pessoas e "
+            f"{totais['emprestimos']} empréstimos ({totais['abertos']} em aberto) gerados."
+        ))
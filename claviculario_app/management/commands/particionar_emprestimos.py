@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from claviculario_app.particoes import ParticionamentoError, criar_particoes, particionada, particionar
+
+
+class Command(BaseCommand):
+    help = (
+        "Particiona a tabela de empréstimos por ano (só PostgreSQL) e cria as partições dos próximos anos. "
+        "Sem --converter, só cria as partições que faltam numa tabela já particionada: rode periodicamente."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--converter', action='store_true',
+                            help="Converte a tabela atual. Copia todos os dados com a tabela bloqueada: faça numa janela de manutenção.")
+        parser.add_argument('--anos-a-frente', type=int, default=1, help="Anos futuros que já devem ter partição. Padrão: 1.")
+
+    def handle(self, *args, **options):
+        ate_ano = timezone.localdate().year + options['anos_a_frente']
+        try:
+            if options['converter'] and not particionada():
+                anos = particionar(ate_ano)
+                self.stdout.write(self.style.SUCCESS(f"Tabela particionada: {anos[0]} a {anos[-1]}."))
+            else:
+                anos = criar_particoes(ate_ano)
+                self.stdout.write(self.style.SUCCESS(f"{len(anos)} partição(ões) criada(s)."))
+        except ParticionamentoError as erro:
+            raise CommandError(str(erro)) from erro
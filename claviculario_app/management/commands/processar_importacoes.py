@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from claviculario_app.tarefas import processar_pendentes
+
+
+class Command(BaseCommand):
+    help = "Processa as importações de planilhas que estão na fila."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Continua rodando e verificando a fila periodicamente.")
+        parser.add_argument('--intervalo', type=float, default=2.0, help="Segundos entre verificações da fila (com --loop).")
+
+    def handle(self, *args, **options):
+        while True:
+            processados = processar_pendentes()
+            if processados:
+                self.stdout.write(self.style.SUCCESS(f"{processados} importação(ões) processada(s)."))
+            if not options['loop']:
+                break
+            time.sleep(options['intervalo'])
@@ -0,0 +1,17 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from claviculario_app.resumo import reconstruir
+
+
+class Command(BaseCommand):
+    help = "Refaz os resumos por hora usados nos gráficos de análise a partir dos empréstimos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inicio', type=date.fromisoformat, help="Primeiro dia a refazer (AAAA-MM-DD). Padrão: todo o histórico.")
+        parser.add_argument('--fim', type=date.fromisoformat, help="Último dia a refazer (AAAA-MM-DD).")
+
+    def handle(self, *args, **options):
+        linhas = reconstruir(inicio=options['inicio'], fim=options['fim'])
+        self.stdout.write(self.style.SUCCESS(f"{linhas} linha(s) de resumo gravada(s)."))
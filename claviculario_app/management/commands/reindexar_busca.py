@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from claviculario_app.busca import reindexar
+
+
+class Command(BaseCommand):
+    help = "Refaz o texto da busca livre do relatório a partir das chaves, locais e pessoas de cada empréstimo."
+
+    def handle(self, *args, **options):
+        alterados = reindexar()
+        self.stdout.write(self.style.SUCCESS(f"{alterados} empréstimo(s) atualizado(s)."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from claviculario_app import carga
+
+
+class Command(BaseCommand):
+    help = ("Simula atendentes fazendo retiradas (com PIN), devoluções e consultas ao painel, relatório "
+            "e gráficos, e mostra a latência (p50/p95/p99) e a vazão de cada endpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--usuarios', type=int, default=4, help="Atendentes simultâneos (threads).")
+        parser.add_argument('--duracao', type=float, default=30.0, help="Segundos de teste.")
+        parser.add_argument('--iteracoes', type=int,
+                            help="Ciclos por atendente; se informado, substitui --duracao.")
+        parser.add_argument('--pin', default='1234', help="PIN das pessoas (o mesmo do gerar_dados_sinteticos).")
+        parser.add_argument('--semente', type=int)
+
+    def handle(self, *args, **options):
+        if options['usuarios'] < 1:
+            raise CommandError("--usuarios deve ser pelo menos 1.")
+        try:
+            resultados = carga.executar(
+                usuarios=options['usuarios'], duracao=options['duracao'], iteracoes=options['iteracoes'],
+                pin=options['pin'], semente=options['semente'],
+            )
+        except ValueError as erro:
+            raise CommandError(str(erro))
+
+        self.stdout.write(resultados.tabela())
+        falhas = sum(linha['falhas'] for linha in resultados.resumo().values())
+        estilo = self.style.SUCCESS if not falhas else self.style.WARNING
+        self.stdout.write(estilo(f"{falhas} falhas em {resultados.fim - resultados.inicio:.1f}s."))
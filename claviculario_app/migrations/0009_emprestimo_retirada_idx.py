@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0008_importacaojob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['data_retirada'], name='emprestimo_retirada_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0009_emprestimo_retirada_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResumoHorario',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField()),
+                ('hora', models.PositiveSmallIntegerField()),
+                ('retiradas', models.PositiveIntegerField(default=0)),
+                ('devolucoes', models.PositiveIntegerField(default=0)),
+                ('no_prazo', models.PositiveIntegerField(default=0)),
+                ('atrasadas', models.PositiveIntegerField(default=0)),
+                ('chave', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumos', to='claviculario_app.chave')),
+            ],
+            options={
+                'verbose_name': 'Resumo por hora',
+                'verbose_name_plural': 'Resumos por hora',
+                'ordering': ['dia', 'hora'],
+                'constraints': [models.UniqueConstraint(fields=('dia', 'hora', 'chave'), name='resumo_dia_hora_chave_unico')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+# Mesma expressão que o Django gera para __icontains no PostgreSQL: UPPER(coluna::text) LIKE UPPER(...)
+INDICES_TRIGRAMA = {
+    'pessoa_nome_trgm_idx': 'nome',
+    'pessoa_empresa_trgm_idx': 'empresa',
+}
+
+
+def criar_indices_trigrama(apps, schema_editor):
+    """
+    Cria a extensão pg_trgm e os índices GIN de trigramas usados pela busca de
+    pessoas. Em outros bancos (SQLite nos testes) ou em servidores sem o pacote
+    contrib do PostgreSQL nada é feito: a busca continua funcionando, só sem índice.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    tabela = schema_editor.quote_name(apps.get_model('claviculario_app', 'Pessoa')._meta.db_table)
+    for nome_indice, coluna in INDICES_TRIGRAMA.items():
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {nome_indice} ON {tabela} "
+            f"USING gin (UPPER({schema_editor.quote_name(coluna)}::text) gin_trgm_ops)"
+        )
+
+
+def remover_indices_trigrama(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for nome_indice in INDICES_TRIGRAMA:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {nome_indice}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0010_resumohorario'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pessoa',
+            index=models.Index(fields=['nome', 'id'], name='pessoa_nome_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pessoa',
+            index=models.Index(fields=['cpf_saran'], name='pessoa_cpf_prefixo_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(criar_indices_trigrama, remover_indices_trigrama),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:01
+
+import re
+import unicodedata
+from itertools import islice
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+
+NOME_INDICE = 'emprestimo_busca_idx'
+TAMANHO_LOTE = 2000
+
+# O documento e o texto da busca como eram em busca.DOCUMENTO e
+# busca.texto_emprestimo quando esta migração foi escrita
+DOCUMENTO = SearchVector('texto_busca', config='simple')
+
+
+def normalizar(texto):
+    texto = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.findall(r'[a-z0-9]+', texto.lower()))
+
+
+def texto_emprestimo(descricao_chave, nome_local, nome_pessoa, cpf_saran, observacao):
+    cpf = normalizar(cpf_saran)
+    digitos = cpf.replace(' ', '')
+    partes = [descricao_chave, nome_local, nome_pessoa, cpf, digitos if digitos != cpf else '', observacao]
+    return ' '.join(texto for texto in map(normalizar, partes) if texto)
+
+
+def preencher_texto_busca(apps, schema_editor):
+    """ Monta o texto pesquisável dos empréstimos que já existem. """
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    linhas = Emprestimo.objects.order_by().values_list(
+        'id', 'chave__descricao', 'chave__local__nome', 'pessoa__nome', 'pessoa__cpf_saran', 'observacao',
+    ).iterator(chunk_size=TAMANHO_LOTE)
+    while lote := list(islice(linhas, TAMANHO_LOTE)):
+        Emprestimo.objects.bulk_update(
+            [Emprestimo(id=emprestimo_id, texto_busca=texto_emprestimo(*dados)) for emprestimo_id, *dados in lote],
+            ['texto_busca'],
+        )
+
+
+def criar_indice_busca(apps, schema_editor):
+    """
+    Índice GIN sobre to_tsvector('simple', texto_busca), a mesma expressão que
+    busca.filtrar usa. Só no PostgreSQL: nos outros bancos a busca usa LIKE.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.add_index(apps.get_model('claviculario_app', 'Emprestimo'), GinIndex(DOCUMENTO, name=NOME_INDICE))
+
+
+def remover_indice_busca(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f"DROP INDEX IF EXISTS {NOME_INDICE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0011_busca_pessoas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emprestimo',
+            name='texto_busca',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(preencher_texto_busca, migrations.RunPython.noop),
+        migrations.RunPython(criar_indice_busca, remover_indice_busca),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0012_emprestimo_texto_busca'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='emprestimo',
+            name='emprestimo_retirada_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chave',
+            index=models.Index(fields=['local', 'ativa', 'disponivel', 'descricao'], name='chave_disponiveis_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['-data_retirada', '-id'], name='emprestimo_retirada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['chave', '-data_retirada', '-id'], name='emprestimo_chave_retirada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['pessoa', '-data_retirada', '-id'], name='emprestimo_pessoa_retirada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(condition=models.Q(('data_devolucao__isnull', True)), fields=['-data_retirada'], name='emprestimo_abertos_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(condition=models.Q(('data_devolucao__isnull', True), ('previsao_devolucao__isnull', False)), fields=['previsao_devolucao'], name='emprestimo_vencimento_idx'),
+        ),
+        # Os índices das chaves estrangeiras só saem depois que os compostos existem
+        migrations.AlterField(
+            model_name='chave',
+            name='local',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='chaves', to='claviculario_app.local'),
+        ),
+        migrations.AlterField(
+            model_name='emprestimo',
+            name='chave',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='emprestimos', to='claviculario_app.chave'),
+        ),
+        migrations.AlterField(
+            model_name='emprestimo',
+            name='pessoa',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='emprestimos', to='claviculario_app.pessoa'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def conferir_abertos(apps, schema_editor):
+    """ O índice único não é criado se alguma chave tiver mais de um empréstimo aberto. """
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    repetidas = list(
+        Emprestimo.objects.filter(data_devolucao__isnull=True).order_by()
+        .values('chave_id').annotate(abertos=models.Count('id')).filter(abertos__gt=1)
+        .values_list('chave_id', flat=True)
+    )
+    if repetidas:
+        raise RuntimeError(
+            f"Chaves com mais de um empréstimo em aberto (ids {repetidas}): registre a devolução "
+            "dos empréstimos indevidos antes de aplicar esta migração."
+        )
+
+
+def preencher_emprestimo_atual(apps, schema_editor):
+    Chave = apps.get_model('claviculario_app', 'Chave')
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    abertos = Emprestimo.objects.filter(chave=models.OuterRef('pk'), data_devolucao__isnull=True)
+    Chave.objects.filter(models.Exists(abertos)).update(emprestimo_atual=models.Subquery(abertos.values('id')[:1]))
+
+
+def preencher_disponivel(apps, schema_editor):
+    Chave = apps.get_model('claviculario_app', 'Chave')
+    Chave.objects.filter(emprestimo_atual__isnull=False).update(disponivel=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0013_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chave',
+            name='emprestimo_atual',
+            field=models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='claviculario_app.emprestimo', verbose_name='Empréstimo atual'),
+        ),
+        migrations.RunPython(conferir_abertos, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='emprestimo',
+            constraint=models.UniqueConstraint(condition=models.Q(('data_devolucao__isnull', True)), fields=('chave',), name='emprestimo_aberto_por_chave'),
+        ),
+        migrations.RunPython(preencher_emprestimo_atual, preencher_disponivel),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Separada da 0014: no PostgreSQL, a tabela das chaves não pode ser alterada
+    # na mesma transação em que as suas chaves estrangeiras foram preenchidas
+
+    dependencies = [
+        ('claviculario_app', '0014_chave_emprestimo_atual'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chave',
+            name='chave_disponiveis_idx',
+        ),
+        migrations.RemoveField(
+            model_name='chave',
+            name='disponivel',
+        ),
+        migrations.AddIndex(
+            model_name='chave',
+            index=models.Index(fields=['local', 'ativa', 'descricao'], include=['emprestimo_atual'], name='chave_disponiveis_idx'),
+        ),
+    ]
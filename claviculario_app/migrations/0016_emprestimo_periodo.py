@@ -0,0 +1,101 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:30
+
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import RangeOperators
+from django.contrib.postgres.indexes import GistIndex
+from django.contrib.postgres.fields import DateTimeRangeField
+from django.db import migrations
+from django.db.models import DateTimeField, F, Func, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+NOME_INDICE = 'emprestimo_periodo_idx'
+NOME_EXCLUSAO = 'emprestimo_sem_sobreposicao'
+
+# O período como era em periodos.PERIODO quando esta migração foi escrita
+PERIODO = Func(
+    F('data_retirada'),
+    Coalesce(F('data_devolucao'), RawSQL("'infinity'::timestamptz", (), output_field=DateTimeField())),
+    Value('[)'),
+    function='tstzrange',
+    output_field=DateTimeRangeField(),
+)
+
+
+def _periodo_sql(alias):
+    return f"tstzrange({alias}.data_retirada, COALESCE({alias}.data_devolucao, 'infinity'::timestamptz), '[)')"
+
+
+def _restricao_exclusao():
+    """
+    Dois empréstimos da mesma chave não podem ter períodos que se cruzam. O
+    GiST não compara inteiros com '=' sem a extensão btree_gist, então a chave
+    entra como o intervalo [chave_id, chave_id], que o GiST de ranges compara.
+    """
+    return ExclusionConstraint(
+        name=NOME_EXCLUSAO,
+        index_type='gist',
+        expressions=[
+            (Func(F('chave_id'), F('chave_id'), Value('[]'), function='int8range'), RangeOperators.EQUAL),
+            (PERIODO, RangeOperators.OVERLAPS),
+        ],
+    )
+
+
+def verificar_periodos(connection, tabela):
+    """
+    Antes de criar a restrição, aponta os empréstimos que a impediriam:
+    devolvidos antes da retirada (o tstzrange nem chega a ser montado) e
+    períodos sobrepostos da mesma chave.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT id FROM {tabela} WHERE data_devolucao < data_retirada ORDER BY id LIMIT 20")
+        invertidos = [linha[0] for linha in cursor.fetchall()]
+        if invertidos:
+            raise RuntimeError(
+                f"Empréstimos devolvidos antes da retirada (ids {invertidos}): corrija as datas de retirada e "
+                "devolução antes de aplicar esta migração."
+            )
+        cursor.execute(
+            f"SELECT a.id, b.id FROM {tabela} AS a JOIN {tabela} AS b ON a.chave_id = b.chave_id AND a.id < b.id "
+            f"AND {_periodo_sql('a')} && {_periodo_sql('b')} ORDER BY a.id, b.id LIMIT 20"
+        )
+        sobrepostos = cursor.fetchall()
+    if sobrepostos:
+        raise RuntimeError(
+            f"Empréstimos da mesma chave com períodos sobrepostos (pares de ids {sobrepostos}): corrija as "
+            "datas de retirada e devolução antes de aplicar esta migração."
+        )
+
+
+def criar_indice_e_exclusao(apps, schema_editor):
+    """
+    Índice GiST sobre o período dos empréstimos (consultas "quem estava com a
+    chave") e a restrição de exclusão. Só no PostgreSQL: nos outros bancos as
+    consultas comparam as datas sem índice próprio.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    verificar_periodos(schema_editor.connection, schema_editor.quote_name(Emprestimo._meta.db_table))
+    schema_editor.add_index(Emprestimo, GistIndex(PERIODO, name=NOME_INDICE))
+    schema_editor.add_constraint(Emprestimo, _restricao_exclusao())
+
+
+def remover_indice_e_exclusao(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    tabela = schema_editor.quote_name(apps.get_model('claviculario_app', 'Emprestimo')._meta.db_table)
+    schema_editor.execute(f"ALTER TABLE {tabela} DROP CONSTRAINT IF EXISTS {NOME_EXCLUSAO}")
+    schema_editor.execute(f"DROP INDEX IF EXISTS {NOME_INDICE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0015_remove_chave_disponivel'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_indice_e_exclusao, remover_indice_e_exclusao),
+    ]
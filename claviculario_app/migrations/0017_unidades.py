@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+MODELOS_DA_UNIDADE = ('Local', 'Chave', 'Pessoa', 'Emprestimo', 'ResumoHorario', 'ImportacaoJob')
+
+
+def preencher_unidade(apps, schema_editor):
+    """
+    Até aqui só havia um cadastro: tudo o que já existe vai para a primeira
+    unidade (criada se ainda não houver nenhuma), e todos os usuários passam
+    a ser membros dela, para que ninguém perca o acesso.
+    """
+    modelos = [apps.get_model('claviculario_app', nome) for nome in MODELOS_DA_UNIDADE]
+    if not any(modelo.objects.exists() for modelo in modelos):
+        return
+    Unidade = apps.get_model('claviculario_app', 'Unidade')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    unidade = Unidade.objects.order_by('id').first()
+    if unidade is None:
+        dono = User.objects.filter(is_superuser=True).order_by('id').first()
+        unidade = Unidade.objects.create(nome="Unidade principal", owner=dono)
+    unidade.membros.add(*User.objects.values_list('id', flat=True))
+    for modelo in modelos:
+        modelo.objects.filter(unidade__isnull=True).update(unidade=unidade)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0016_emprestimo_periodo'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='unidade',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='unidades_criadas', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='local',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='locais', to='claviculario_app.unidade'),
+        ),
+        migrations.AddField(
+            model_name='chave',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='chaves', to='claviculario_app.unidade'),
+        ),
+        migrations.AddField(
+            model_name='pessoa',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='pessoas', to='claviculario_app.unidade'),
+        ),
+        migrations.AddField(
+            model_name='emprestimo',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='emprestimos', to='claviculario_app.unidade'),
+        ),
+        migrations.AddField(
+            model_name='resumohorario',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='claviculario_app.unidade'),
+        ),
+        migrations.AddField(
+            model_name='importacaojob',
+            name='unidade',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='importacoes', to='claviculario_app.unidade'),
+        ),
+        migrations.RunPython(preencher_unidade, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,159 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+import django.db.models.deletion
+from django.contrib.postgres.fields import BigIntegerRangeField, DateTimeRangeField
+from django.contrib.postgres.indexes import GistIndex
+from django.db import migrations, models
+from django.db.models import DateTimeField, F, Func, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+NOME_INDICE_PERIODO = 'emprestimo_periodo_idx'
+
+# O período e a unidade como eram em periodos.PERIODO e periodos.UNIDADE
+# quando esta migração foi escrita
+PERIODO = Func(
+    F('data_retirada'),
+    Coalesce(F('data_devolucao'), RawSQL("'infinity'::timestamptz", (), output_field=DateTimeField())),
+    Value('[)'),
+    function='tstzrange',
+    output_field=DateTimeRangeField(),
+)
+UNIDADE = Func(F('unidade_id'), F('unidade_id'), Value('[]'), function='int8range', output_field=BigIntegerRangeField())
+
+
+def indice_periodo_por_unidade(apps, schema_editor):
+    """
+    O índice GiST do período (0016) passa a começar pela unidade, como os
+    outros. Só no PostgreSQL.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    schema_editor.execute(f"DROP INDEX IF EXISTS {NOME_INDICE_PERIODO}")
+    schema_editor.add_index(Emprestimo, GistIndex(UNIDADE, PERIODO, name=NOME_INDICE_PERIODO))
+
+
+def indice_periodo_sem_unidade(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Emprestimo = apps.get_model('claviculario_app', 'Emprestimo')
+    schema_editor.execute(f"DROP INDEX IF EXISTS {NOME_INDICE_PERIODO}")
+    schema_editor.add_index(Emprestimo, GistIndex(PERIODO, name=NOME_INDICE_PERIODO))
+
+
+class Migration(migrations.Migration):
+    # Separada da 0017 pelo mesmo motivo da 0015: no PostgreSQL, as tabelas não
+    # podem ser alteradas na mesma transação em que as chaves estrangeiras
+    # foram preenchidas
+
+    dependencies = [
+        ('claviculario_app', '0017_unidades'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='local',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='locais', to='claviculario_app.unidade'),
+        ),
+        migrations.AlterField(
+            model_name='chave',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='chaves', to='claviculario_app.unidade'),
+        ),
+        migrations.AlterField(
+            model_name='pessoa',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='pessoas', to='claviculario_app.unidade'),
+        ),
+        migrations.AlterField(
+            model_name='emprestimo',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='emprestimos', to='claviculario_app.unidade'),
+        ),
+        migrations.AlterField(
+            model_name='resumohorario',
+            name='unidade',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='claviculario_app.unidade'),
+        ),
+        migrations.AlterField(
+            model_name='importacaojob',
+            name='unidade',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='importacoes', to='claviculario_app.unidade'),
+        ),
+        # Nomes, descrições e CPFs passam a ser únicos dentro de cada unidade
+        migrations.AlterField(
+            model_name='local',
+            name='nome',
+            field=models.CharField(max_length=100, verbose_name='Nome do Local'),
+        ),
+        migrations.AlterField(
+            model_name='chave',
+            name='descricao',
+            field=models.CharField(max_length=150, verbose_name='Descrição da Chave'),
+        ),
+        migrations.AlterField(
+            model_name='pessoa',
+            name='cpf_saran',
+            field=models.CharField(max_length=20, verbose_name='CPF ou SARAN'),
+        ),
+        migrations.AddConstraint(
+            model_name='local',
+            constraint=models.UniqueConstraint(fields=('unidade', 'nome'), name='local_nome_por_unidade'),
+        ),
+        migrations.AddConstraint(
+            model_name='chave',
+            constraint=models.UniqueConstraint(fields=('unidade', 'descricao'), name='chave_descricao_por_unidade'),
+        ),
+        migrations.AddConstraint(
+            model_name='pessoa',
+            constraint=models.UniqueConstraint(fields=('unidade', 'cpf_saran'), name='pessoa_cpf_por_unidade'),
+        ),
+        # Os índices compostos passam a começar pela unidade
+        migrations.RemoveIndex(
+            model_name='pessoa',
+            name='pessoa_nome_idx',
+        ),
+        migrations.AddIndex(
+            model_name='pessoa',
+            index=models.Index(fields=['unidade', 'nome', 'id'], name='pessoa_nome_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='pessoa',
+            name='pessoa_cpf_prefixo_idx',
+        ),
+        migrations.AddIndex(
+            model_name='pessoa',
+            index=models.Index(fields=['unidade', 'cpf_saran'], name='pessoa_cpf_prefixo_idx', opclasses=['int8_ops', 'varchar_pattern_ops']),
+        ),
+        migrations.RemoveIndex(
+            model_name='emprestimo',
+            name='emprestimo_retirada_idx',
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['unidade', '-data_retirada', '-id'], name='emprestimo_retirada_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='emprestimo',
+            name='emprestimo_abertos_idx',
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(condition=models.Q(('data_devolucao__isnull', True)), fields=['unidade', '-data_retirada'], name='emprestimo_abertos_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='emprestimo',
+            name='emprestimo_vencimento_idx',
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(condition=models.Q(('data_devolucao__isnull', True), ('previsao_devolucao__isnull', False)), fields=['unidade', 'previsao_devolucao'], name='emprestimo_vencimento_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resumohorario',
+            index=models.Index(fields=['unidade', 'dia'], name='resumo_unidade_dia_idx'),
+        ),
+        migrations.RunPython(indice_periodo_por_unidade, indice_periodo_sem_unidade),
+    ]
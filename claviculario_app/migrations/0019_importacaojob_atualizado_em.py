@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claviculario_app', '0018_unidade_obrigatoria'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importacaojob',
+            name='atualizado_em',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -47,7 +47,19 @@ class PaginaAtivaMixin:
             return {'artigo': 'A', 'final': 'a'}
         return {'artigo': 'O', 'final': 'o'}
 
-class BaseListView(PaginaAtivaMixin, LoginRequiredMixin, PermissionRequiredMixin, ListView):
+class UnidadeMixin:
+    """ Só os registros da unidade da requisição: um objeto de outra unidade dá 404. """
+    def get_queryset(self):
+        return super().get_queryset().da_unidade(self.request.unidade)
+
+class FormDaUnidadeMixin(UnidadeMixin):
+    """ Além do filtro, passa a unidade para o formulário (ver forms.CamposDaUnidadeMixin). """
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['unidade'] = self.request.unidade
+        return kwargs
+
+class BaseListView(PaginaAtivaMixin, LoginRequiredMixin, PermissionRequiredMixin, UnidadeMixin, ListView):
     paginate_by = 15
     def get_context_object_name(self, object_list):
         # Gera o nome da variável para o template
@@ -58,7 +70,7 @@ class BaseListView(PaginaAtivaMixin, LoginRequiredMixin, PermissionRequiredMixin
     def get_template_names(self):
         return [f'claviculario_app/{self.model._meta.model_name}_list.html']
 
-class BaseCreateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, PaginaAtivaMixin, CreateView):
+class BaseCreateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, PaginaAtivaMixin, FormDaUnidadeMixin, CreateView):
     title = ""
     success_message_template = "{artigo} {verbose_name} foi cadastrad{final} com sucesso!"
     def get_permission_required(self):
@@ -82,7 +94,7 @@ class BaseCreateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessage
         messages.success(self.request, success_message)
         return response
 
-class BaseUpdateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, PaginaAtivaMixin, UpdateView):
+class BaseUpdateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessageMixin, PaginaAtivaMixin, FormDaUnidadeMixin, UpdateView):
     title = ""
     success_message_template = "{artigo} {verbose_name} foi atualizad{final} com sucesso!"
     def get_permission_required(self):
@@ -106,7 +118,7 @@ class BaseUpdateView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMessage
         messages.success(self.request, success_message)
         return response
 
-class BaseDesativarView(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
+class BaseDesativarView(LoginRequiredMixin, PermissionRequiredMixin, PaginaAtivaMixin, UnidadeMixin, UpdateView):
     fields = ['ativa']
     def get_permission_required(self):
         return (f'{self.model._meta.app_label}.delete_{self.model._meta.model_name}',)
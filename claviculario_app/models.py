@@ -5,73 +5,168 @@ from django.utils import timezone
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import User
 
+from .hashers import hasher_pin
+
+
+class DaUnidadeQuerySet(models.QuerySet):
+    def da_unidade(self, unidade):
+        """ Só os registros da unidade (objeto ou id). Sem unidade, nenhum registro. """
+        if unidade is None:
+            return self.none()
+        return self.filter(unidade=unidade)
+
+
+# Cada unidade tem o seu cadastro e o seu histórico: os modelos abaixo levam a
+# unidade, e os índices compostos começam por ela para que as consultas de uma
+# unidade nunca percorram as linhas das outras.
 class Local(models.Model):
     genero = 'm'
-    nome = models.CharField(max_length=100, unique=True, verbose_name="Nome do Local")
+    unidade = models.ForeignKey('Unidade', on_delete=models.PROTECT, related_name='locais', db_index=False)
+    nome = models.CharField(max_length=100, verbose_name="Nome do Local")
     ativa = models.BooleanField(default=True, verbose_name="Local ativo?")
+    objects = DaUnidadeQuerySet.as_manager()
     class Meta:
         verbose_name = "Local"
         verbose_name_plural = "Locais"
         ordering = ['nome'] # Dica extra!
+        constraints = [
+            # O índice desta restrição também atende às listas de locais da unidade
+            models.UniqueConstraint(fields=['unidade', 'nome'], name='local_nome_por_unidade'),
+        ]
     def __str__(self):
         return self.nome
     
 
 class Pessoa(models.Model):
     genero = 'f'
+    unidade = models.ForeignKey('Unidade', on_delete=models.PROTECT, related_name='pessoas', db_index=False)
     nome = models.CharField(max_length=200, verbose_name="Nome Completo")
     empresa = models.CharField(max_length=100, blank=True, null=True)
-    cpf_saran = models.CharField(max_length=20, unique=True, verbose_name="CPF ou SARAN")
+    cpf_saran = models.CharField(max_length=20, verbose_name="CPF ou SARAN")
     pin = models.CharField(max_length=128, verbose_name="Pin de Confirmação")
     ativa = models.BooleanField(default=True, verbose_name="Pessoa ativa?")
+    objects = DaUnidadeQuerySet.as_manager()
     class Meta:
         verbose_name = "Pessoa"
         verbose_name_plural = "Pessoas"
         ordering = ['nome']
+        indexes = [
+            # Listas e busca sem filtro, sempre em ordem alfabética
+            models.Index(fields=['unidade', 'nome', 'id'], name='pessoa_nome_idx'),
+            # Busca pelo início do CPF/SARAN (LIKE 'x%'), independente da collation do banco
+            models.Index(fields=['unidade', 'cpf_saran'], name='pessoa_cpf_prefixo_idx',
+                         opclasses=['int8_ops', 'varchar_pattern_ops']),
+        ]
+        constraints = [
+            # A mesma pessoa pode estar cadastrada em mais de uma unidade
+            models.UniqueConstraint(fields=['unidade', 'cpf_saran'], name='pessoa_cpf_por_unidade'),
+        ]
+        # Os índices de trigramas (pg_trgm) de nome e empresa só existem no
+        # PostgreSQL e são criados direto na migração 0011. Sem a extensão
+        # btree_gin eles não podem começar pela unidade: a busca por trecho
+        # filtra a unidade depois de consultar o índice.
     def set_pin(self, raw_pin):
-        self.pin = make_password(raw_pin)
+        self.pin = make_password(raw_pin, hasher=hasher_pin())
     def check_pin(self, raw_pin):
-        return check_password(raw_pin, self.pin)
+        # Sem bloqueio de tentativas: nas telas, use claviculario_app.pin.verificar_pin
+        return check_password(raw_pin, self.pin, preferred=hasher_pin())
     def __str__(self):
         return f"{self.nome} ({self.cpf_saran})"
     
 
 class Chave(models.Model):
     genero = 'f'
-    descricao = models.CharField(max_length=150, verbose_name="Descrição da Chave", unique=True)
-    local = models.ForeignKey(Local, on_delete=models.PROTECT, related_name='chaves')
-    disponivel = models.BooleanField(default=True)
+    # Sempre a mesma do local; repetida aqui para filtrar as chaves sem juntar os locais
+    unidade = models.ForeignKey('Unidade', on_delete=models.PROTECT, related_name='chaves', db_index=False)
+    descricao = models.CharField(max_length=150, verbose_name="Descrição da Chave")
+    # Sem índice próprio: o chave_disponiveis_idx começa pelo local
+    local = models.ForeignKey(Local, on_delete=models.PROTECT, related_name='chaves', db_index=False)
+    # Empréstimo em aberto da chave (nulo = disponível). Mantido pela retirada e
+    # pela devolução (ver services.py), na mesma transação que o empréstimo.
+    emprestimo_atual = models.OneToOneField('Emprestimo', on_delete=models.SET_NULL, null=True, blank=True,
+                                            editable=False, related_name='+', verbose_name="Empréstimo atual")
     ativa = models.BooleanField(default=True, verbose_name="Chave ativa?")
+    objects = DaUnidadeQuerySet.as_manager()
     class Meta:
         verbose_name = "Chave"
         verbose_name_plural = "Chaves"
         ordering = ['descricao']
+        indexes = [
+            # Chaves disponíveis de um local, já em ordem alfabética (retirada).
+            # O local vem primeiro porque é o filtro mais seletivo e assim o
+            # índice também atende às buscas só pelo local. Não precisa começar
+            # pela unidade: o local já pertence a uma só. O empréstimo atual
+            # fica fora da chave do índice: "IS NULL" não é igualdade, e depois
+            # dele o PostgreSQL já não aproveitaria a ordem da descrição.
+            models.Index(fields=['local', 'ativa', 'descricao'], include=['emprestimo_atual'],
+                         name='chave_disponiveis_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['unidade', 'descricao'], name='chave_descricao_por_unidade'),
+        ]
+    @property
+    def disponivel(self):
+        return self.emprestimo_atual_id is None
     def __str__(self):
         status = "Disponível" if self.disponivel else "Emprestada"
         return f"[{self.descricao}] - {self.local.nome} ({status})"
 
 class Emprestimo(models.Model):
     genero = 'm'
-    chave = models.ForeignKey(Chave, on_delete=models.PROTECT, related_name='emprestimos')
-    pessoa = models.ForeignKey(Pessoa, on_delete=models.PROTECT, related_name='emprestimos')
+    # A mesma da chave e da pessoa (ver services.registrar_retirada)
+    unidade = models.ForeignKey('Unidade', on_delete=models.PROTECT, related_name='emprestimos', db_index=False)
+    # Sem índice próprio: os índices compostos do Meta começam pela chave e pela pessoa
+    chave = models.ForeignKey(Chave, on_delete=models.PROTECT, related_name='emprestimos', db_index=False)
+    pessoa = models.ForeignKey(Pessoa, on_delete=models.PROTECT, related_name='emprestimos', db_index=False)
     data_retirada = models.DateTimeField(verbose_name="Data e Hora da Retirada")
     previsao_devolucao = models.DateTimeField(verbose_name="Previsão de Devolução",
                                               null=True,
                                               blank=True)
     data_devolucao = models.DateTimeField(null=True, blank=True, verbose_name="Data e Hora da Devolução")
     observacao = models.TextField(blank=True, null=True)
+    # Chave, local, pessoa e observação normalizados para a busca livre do relatório (ver busca.py)
+    texto_busca = models.TextField(blank=True, default='', editable=False)
+    objects = DaUnidadeQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Empréstimo"
         verbose_name_plural = "Empréstimos"
         ordering = ['-data_retirada'] # Ordena pelos mais recentes primeiro
+        indexes = [
+            # Relatório (paginação por cursor em (data_retirada, id)) e filtros por período
+            models.Index(fields=['unidade', '-data_retirada', '-id'], name='emprestimo_retirada_idx'),
+            # Históricos da chave e da pessoa, na mesma ordem do relatório.
+            # Substituem os índices simples das chaves estrangeiras. A chave e
+            # a pessoa já pertencem a uma só unidade: não precisam começar por ela.
+            models.Index(fields=['chave', '-data_retirada', '-id'], name='emprestimo_chave_retirada_idx'),
+            models.Index(fields=['pessoa', '-data_retirada', '-id'], name='emprestimo_pessoa_retirada_idx'),
+            # Empréstimos abertos (retirada, devolução e página inicial): só uma
+            # fração pequena da tabela, então os índices parciais ficam minúsculos
+            models.Index(fields=['unidade', '-data_retirada'], name='emprestimo_abertos_idx',
+                         condition=models.Q(data_devolucao__isnull=True)),
+            # Atrasados e próximo vencimento entre os abertos (previsao_devolucao < agora)
+            models.Index(fields=['unidade', 'previsao_devolucao'], name='emprestimo_vencimento_idx',
+                         condition=models.Q(data_devolucao__isnull=True, previsao_devolucao__isnull=False)),
+        ]
+        constraints = [
+            # Uma chave nunca tem dois empréstimos abertos
+            models.UniqueConstraint(fields=['chave'], condition=models.Q(data_devolucao__isnull=True),
+                                    name='emprestimo_aberto_por_chave'),
+        ]
+        # O índice GIN da busca textual (texto_busca) só existe no PostgreSQL e
+        # é criado direto na migração 0012. Também só no PostgreSQL, a migração
+        # 0016 cria o índice GiST do período de cada empréstimo e a restrição
+        # que impede períodos sobrepostos da mesma chave (ver periodos.py). A
+        # 0018 refaz o índice do período começando pela unidade.
     def __str__(self):
         return f"{self.chave.descricao} para {self.pessoa.nome}"
     
 class Unidade(models.Model):
     nome = models.CharField(max_length=100, verbose_name="Nome da Unidade")
-    # O 'owner' é o usuário criador e administrador principal da unidade
-    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="unidades_criadas")
+    # O 'owner' é o usuário criador e administrador principal da unidade. A
+    # unidade criada pela migração 0017 para os dados que já existiam pode não
+    # ter dono, e excluir o usuário não apaga a unidade com todo o histórico.
+    owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="unidades_criadas")
     # Campo para o logo customizado
     logo = models.ImageField(upload_to='logos/', null=True, blank=True, verbose_name="Logo da Unidade")
     # Campo para o esquema de cores
@@ -84,4 +179,90 @@ class Unidade(models.Model):
         verbose_name_plural = "Unidades"
 
     def __str__(self):
-        return self.nome
\ No newline at end of file
+        return self.nome
+
+class ImportacaoJob(models.Model):
+    """ Importação de planilha processada em segundo plano. """
+    TIPO_PESSOAS = 'pessoas'
+    TIPO_CHAVES = 'chaves'
+    TIPO_CHOICES = (
+        (TIPO_PESSOAS, "Pessoas"),
+        (TIPO_CHAVES, "Chaves"),
+    )
+    STATUS_PENDENTE = 'pendente'
+    STATUS_PROCESSANDO = 'processando'
+    STATUS_CONCLUIDA = 'concluida'
+    STATUS_ERRO = 'erro'
+    STATUS_CHOICES = (
+        (STATUS_PENDENTE, "Na fila"),
+        (STATUS_PROCESSANDO, "Processando"),
+        (STATUS_CONCLUIDA, "Concluída"),
+        (STATUS_ERRO, "Erro"),
+    )
+
+    unidade = models.ForeignKey(Unidade, on_delete=models.CASCADE, related_name='importacoes')
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDENTE)
+    usuario = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="importacoes")
+    nome_arquivo = models.CharField(max_length=255)
+    # O conteúdo da planilha fica no banco para que qualquer worker consiga processá-la
+    arquivo = models.BinaryField()
+    criado_em = models.DateTimeField(auto_now_add=True)
+    iniciado_em = models.DateTimeField(null=True, blank=True)
+    concluido_em = models.DateTimeField(null=True, blank=True)
+    # Último sinal de vida do worker (reserva e cada progresso); um job
+    # 'processando' parado há muito tempo é dado como interrompido
+    atualizado_em = models.DateTimeField(null=True, blank=True)
+    total_linhas = models.PositiveIntegerField(default=0)
+    linhas_processadas = models.PositiveIntegerField(default=0)
+    criados = models.PositiveIntegerField(default=0)
+    ignorados = models.PositiveIntegerField(default=0)
+    conflitos = models.JSONField(default=list, blank=True)
+    erros = models.TextField(blank=True, default='')
+    objects = DaUnidadeQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Importação"
+        verbose_name_plural = "Importações"
+        ordering = ['-criado_em']
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} - {self.nome_arquivo} ({self.get_status_display()})"
+
+    @property
+    def finalizada(self):
+        return self.status in (self.STATUS_CONCLUIDA, self.STATUS_ERRO)
+
+class ResumoHorario(models.Model):
+    """
+    Totais pré-calculados de empréstimos por dia x hora x chave (horário local).
+
+    Mantido pelos serviços de retirada e devolução e usado pelos gráficos de
+    análise. As devoluções entram na hora em que aconteceram; os contadores
+    no prazo/com atraso entram na hora da retirada do empréstimo.
+    Pode ser refeito com o comando 'reconstruir_resumo'.
+    """
+    unidade = models.ForeignKey(Unidade, on_delete=models.CASCADE, related_name='+', db_index=False)
+    dia = models.DateField()
+    hora = models.PositiveSmallIntegerField()
+    chave = models.ForeignKey(Chave, on_delete=models.CASCADE, related_name='resumos')
+    retiradas = models.PositiveIntegerField(default=0)
+    devolucoes = models.PositiveIntegerField(default=0)
+    no_prazo = models.PositiveIntegerField(default=0)
+    atrasadas = models.PositiveIntegerField(default=0)
+    objects = DaUnidadeQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Resumo por hora"
+        verbose_name_plural = "Resumos por hora"
+        ordering = ['dia', 'hora']
+        indexes = [
+            # Os gráficos de uma unidade num período
+            models.Index(fields=['unidade', 'dia'], name='resumo_unidade_dia_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['dia', 'hora', 'chave'], name='resumo_dia_hora_chave_unico'),
+        ]
+
+    def __str__(self):
+        return f"{self.dia:%d/%m/%Y} {self.hora:02d}h - chave {self.chave_id}"
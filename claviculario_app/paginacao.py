@@ -0,0 +1,131 @@
+# claviculario_app/paginacao.py
+
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+
+POR_PAGINA = 15
+SALT_CURSOR = 'claviculario_app.paginacao.cursor'
+
+PROXIMA = 'p'
+ANTERIOR = 'a'
+
+
+class CursorInvalido(ValueError):
+    """ O cursor recebido foi alterado, é de outra versão ou está malformado. """
+
+
+def _posicao(linha):
+    """ (data_retirada, id) de um empréstimo, seja ele um objeto ou um dicionário de values(). """
+    if isinstance(linha, dict):
+        return linha['data_retirada'], linha['id']
+    return linha.data_retirada, linha.id
+
+
+def gerar_cursor(linha, direcao):
+    """ Token opaco (e assinado) que aponta para antes ou depois de 'linha'. """
+    data_retirada, emprestimo_id = _posicao(linha)
+    return signing.dumps([data_retirada.isoformat(), emprestimo_id, direcao], salt=SALT_CURSOR, compress=True)
+
+
+def ler_cursor(cursor):
+    try:
+        data_retirada, emprestimo_id, direcao = signing.loads(cursor, salt=SALT_CURSOR)
+        return datetime.fromisoformat(data_retirada), int(emprestimo_id), direcao
+    except (signing.BadSignature, TypeError, ValueError) as erro:
+        raise CursorInvalido(str(erro)) from erro
+
+
+class PaginaCursor:
+    """
+    Uma página de empréstimos paginados por cursor. Tem a mesma cara de uma
+    Page do Django nos templates (iterável, has_next, has_previous,
+    has_other_pages), mas sem número de página nem total.
+    """
+    def __init__(self, object_list, cursor_anterior=None, cursor_proximo=None):
+        self.object_list = object_list
+        self.cursor_anterior = cursor_anterior
+        self.cursor_proximo = cursor_proximo
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.cursor_proximo is not None
+
+    def has_previous(self):
+        return self.cursor_anterior is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _com_arquivados(linhas, arquivados, posicao, direcao, limite):
+    """
+    Junta às linhas do banco as do arquivo (ver arquivo.EmprestimosArquivados),
+    que são todas anteriores a 'arquivados.fim'. O arquivo só é lido quando
+    alguma linha dele pode entrar na página.
+    """
+    if direcao == PROXIMA:
+        if len(linhas) == limite and _posicao(linhas[-1])[0] >= arquivados.fim:
+            return linhas
+    elif posicao[0] >= arquivados.fim:
+        # Voltando de uma linha do banco: o arquivo inteiro fica para trás
+        return linhas
+    linhas = linhas + arquivados.ler(posicao, direcao, limite)
+    return sorted(linhas, key=_posicao, reverse=direcao == PROXIMA)[:limite]
+
+
+def paginar_por_cursor(emprestimos, cursor=None, por_pagina=POR_PAGINA, arquivados=None):
+    """
+    Página de 'emprestimos' do mais recente para o mais antigo, ordenada por
+    (data_retirada, id), começando no ponto indicado por 'cursor'.
+
+    Em vez de COUNT(*) e OFFSET, cada página é um "WHERE (data_retirada, id) <
+    (último da página anterior) LIMIT n + 1": o custo é o mesmo na primeira
+    página e na milésima. A linha a mais só serve para saber se há outra
+    página depois. 'arquivados', se informado, acrescenta os empréstimos dos
+    anos já arquivados depois dos do banco. Levanta CursorInvalido se o
+    cursor não for reconhecido.
+    """
+    emprestimos = emprestimos.order_by('-data_retirada', '-id')
+    posicao, direcao = None, PROXIMA
+    if cursor:
+        data_retirada, emprestimo_id, direcao = ler_cursor(cursor)
+        posicao = (data_retirada, emprestimo_id)
+    if direcao == PROXIMA:
+        if posicao:
+            # O filtro redundante em data_retirada deixa o banco usar o índice da coluna
+            emprestimos = emprestimos.filter(data_retirada__lte=data_retirada).filter(
+                Q(data_retirada__lt=data_retirada) | Q(id__lt=emprestimo_id)
+            )
+        linhas = list(emprestimos[:por_pagina + 1])
+    elif direcao == ANTERIOR:
+        emprestimos = emprestimos.filter(data_retirada__gte=data_retirada).filter(
+            Q(data_retirada__gt=data_retirada) | Q(id__gt=emprestimo_id)
+        )
+        # Voltando: lê em ordem crescente a partir do cursor e inverte
+        linhas = list(emprestimos.reverse()[:por_pagina + 1])
+    else:
+        raise CursorInvalido(f"Direção desconhecida: {direcao!r}")
+
+    if arquivados is not None:
+        linhas = _com_arquivados(linhas, arquivados, posicao, direcao, por_pagina + 1)
+    if direcao == PROXIMA:
+        anterior = posicao is not None
+        proxima = len(linhas) > por_pagina
+        linhas = linhas[:por_pagina]
+    else:
+        anterior = len(linhas) > por_pagina
+        proxima = True
+        linhas = linhas[:por_pagina][::-1]
+
+    return PaginaCursor(
+        linhas,
+        cursor_anterior=gerar_cursor(linhas[0], ANTERIOR) if anterior and linhas else None,
+        cursor_proximo=gerar_cursor(linhas[-1], PROXIMA) if proxima and linhas else None,
+    )
@@ -0,0 +1,73 @@
+# claviculario_app/painel.py
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import Chave, Emprestimo
+
+CHAVE_CACHE = 'claviculario:dashboard'
+
+
+def _tempo_cache():
+    return getattr(settings, 'CLAVICULARIO_DASHBOARD_CACHE_SEGUNDOS', 30)
+
+
+def _chave_cache(unidade_id):
+    """ Cada unidade tem a sua página inicial e a sua entrada no cache. """
+    return f'{CHAVE_CACHE}:{unidade_id}'
+
+
+def _calcular(unidade):
+    agora = timezone.now()
+    abertos = Emprestimo.objects.da_unidade(unidade).filter(data_devolucao__isnull=True)
+    totais = abertos.aggregate(
+        atrasadas=Count('id', filter=Q(previsao_devolucao__lt=agora)),
+        # Primeiro empréstimo que ainda vai vencer: a partir dele os números mudam sozinhos
+        proximo_vencimento=Min('previsao_devolucao', filter=Q(previsao_devolucao__gte=agora)),
+    )
+    # Disponíveis e emprestadas saem do próprio ponteiro da chave, não da diferença entre contagens
+    chaves = Chave.objects.da_unidade(unidade).aggregate(
+        total=Count('id'),
+        disponiveis=Count('id', filter=Q(emprestimo_atual__isnull=True)),
+    )
+    dados = {
+        'total_chaves': chaves['total'],
+        'chaves_emprestadas_count': chaves['total'] - chaves['disponiveis'],
+        'chaves_disponiveis': chaves['disponiveis'],
+        'chaves_atrasadas_count': totais['atrasadas'],
+        'ultimas_atividades': list(
+            Emprestimo.objects.da_unidade(unidade).select_related('chave', 'pessoa').order_by('-data_retirada')[:5]
+        ),
+        'emprestimos_atrasados': list(
+            abertos.filter(previsao_devolucao__lt=agora).select_related('chave', 'pessoa').order_by('previsao_devolucao')
+        ),
+    }
+    return dados, totais['proximo_vencimento']
+
+
+def estatisticas_dashboard(unidade):
+    """
+    Números e listas da página inicial da unidade, guardados no cache do Django.
+
+    O cache é apagado pelas retiradas, devoluções e alterações de chaves
+    (ver invalidar_dashboard) e, no máximo, dura até o próximo empréstimo
+    vencer, para que a contagem de atrasadas nunca fique para trás.
+    """
+    chave_cache = _chave_cache(unidade.pk)
+    dados = cache.get(chave_cache)
+    if dados is None:
+        dados, proximo_vencimento = _calcular(unidade)
+        tempo = _tempo_cache()
+        if proximo_vencimento is not None:
+            tempo = min(tempo, max(1, int((proximo_vencimento - timezone.now()).total_seconds())))
+        cache.set(chave_cache, dados, tempo)
+    return dados
+
+
+def invalidar_dashboard(unidade_id):
+    """ Apaga o cache da página inicial da unidade assim que a transação atual for confirmada. """
+    chave_cache = _chave_cache(unidade_id)
+    transaction.on_commit(lambda: cache.delete(chave_cache))
@@ -0,0 +1,318 @@
+# claviculario_app/particoes.py
+
+from datetime import datetime
+
+from django.core import checks
+from django.db import connection, migrations, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+
+from .models import Chave, Emprestimo
+
+TABELA = Emprestimo._meta.db_table
+CHAVES = Chave._meta.db_table
+SEQUENCIA = f'{TABELA}_id_seq'
+
+# Período do empréstimo e chave como intervalo, na mesma forma da migração 0016
+PERIODO_SQL = "tstzrange(data_retirada, COALESCE(data_devolucao, 'infinity'::timestamptz), '[)')"
+FAIXA_CHAVE_SQL = "int8range(chave_id, chave_id, '[]')"
+
+
+class ParticionamentoError(Exception):
+    """ A operação pedida não cabe no estado atual da tabela de empréstimos. """
+
+
+def _executar(sql, parametros=None):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, parametros)
+        return cursor.fetchall() if cursor.description else None
+
+
+def _verificar_pendentes():
+    # As chaves estrangeiras são DEFERRABLE: o PostgreSQL não altera uma tabela
+    # com verificações adiadas pendentes na transação, então elas vão antes
+    _executar("SET CONSTRAINTS ALL IMMEDIATE")
+
+
+def _exigir_postgresql():
+    if connection.vendor != 'postgresql':
+        raise ParticionamentoError("O particionamento dos empréstimos só existe no PostgreSQL.")
+
+
+def nome_particao(ano):
+    return f'{TABELA}_{ano}'
+
+
+def inicio_do_ano(ano):
+    """ 1º de janeiro à meia-noite no fuso do app: os relatórios e os gráficos contam anos locais. """
+    return timezone.make_aware(datetime(ano, 1, 1))
+
+
+def particionada():
+    """ Se a tabela de empréstimos já é particionada por ano (só no PostgreSQL). """
+    if connection.vendor != 'postgresql':
+        return False
+    return bool(_executar("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABELA]))
+
+
+def anos_particionados():
+    """ Os anos que têm partição, em ordem. """
+    if not particionada():
+        return []
+    nomes = _executar(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass",
+        [TABELA],
+    )
+    return sorted(int(nome.rsplit('_', 1)[1]) for (nome,) in nomes)
+
+
+def _restricoes_da_particao(particao):
+    """
+    O que o PostgreSQL 16 não aceita na tabela particionada: índices únicos
+    e restrições de exclusão precisariam incluir data_retirada. Ficam em cada
+    partição, e valem dentro de cada ano; entre anos, quem garante as mesmas
+    regras são os gatilhos de _GATILHOS.
+    """
+    return [
+        f"CREATE UNIQUE INDEX {particao}_aberto_por_chave ON {particao} (chave_id) WHERE data_devolucao IS NULL",
+        f"ALTER TABLE {particao} ADD CONSTRAINT {particao}_sem_sobreposicao "
+        f"EXCLUDE USING gist ({FAIXA_CHAVE_SQL} WITH =, {PERIODO_SQL} WITH &&)",
+    ]
+
+
+# O que os índices únicos, a restrição de exclusão e a chave estrangeira de
+# Chave.emprestimo_atual garantiam na tabela inteira, para todas as partições.
+# Os erros têm o mesmo SQLSTATE e o mesmo nome de restrição de antes, então
+# services.registrar_retirada continua traduzindo a sobreposição em
+# PeriodoOcupadoError.
+_GATILHOS = [
+    f"""
+    CREATE FUNCTION {TABELA}_verificar_periodo() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        -- Uma verificação por chave de cada vez, mesmo em partições diferentes
+        PERFORM 1 FROM {CHAVES} WHERE id = NEW.chave_id FOR UPDATE;
+        IF NEW.data_devolucao IS NULL AND EXISTS (
+            SELECT 1 FROM {TABELA} WHERE chave_id = NEW.chave_id AND data_devolucao IS NULL AND id <> NEW.id
+        ) THEN
+            RAISE EXCEPTION 'A chave % já tem um empréstimo aberto', NEW.chave_id
+                USING ERRCODE = 'unique_violation', CONSTRAINT = 'emprestimo_aberto_por_chave';
+        END IF;
+        IF EXISTS (
+            SELECT 1 FROM {TABELA} WHERE chave_id = NEW.chave_id AND id <> NEW.id
+            AND data_retirada < COALESCE(NEW.data_devolucao, 'infinity'::timestamptz)
+            AND {PERIODO_SQL} && tstzrange(NEW.data_retirada, COALESCE(NEW.data_devolucao, 'infinity'::timestamptz), '[)')
+        ) THEN
+            RAISE EXCEPTION 'O período cruza outro empréstimo da chave %', NEW.chave_id
+                USING ERRCODE = 'exclusion_violation', CONSTRAINT = 'emprestimo_sem_sobreposicao';
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    f"""
+    CREATE TRIGGER emprestimo_verificar_periodo BEFORE INSERT OR UPDATE OF chave_id, data_retirada, data_devolucao
+    ON {TABELA} FOR EACH ROW EXECUTE FUNCTION {TABELA}_verificar_periodo()
+    """,
+    # Chave.emprestimo_atual: verificado no fim da transação, como a chave estrangeira (DEFERRABLE)
+    f"""
+    CREATE FUNCTION {CHAVES}_verificar_emprestimo_atual() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NEW.emprestimo_atual_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM {TABELA} WHERE id = NEW.emprestimo_atual_id
+        ) THEN
+            RAISE EXCEPTION 'A chave % aponta para o empréstimo %, que não existe', NEW.id, NEW.emprestimo_atual_id
+                USING ERRCODE = 'foreign_key_violation';
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    f"""
+    CREATE CONSTRAINT TRIGGER chave_emprestimo_atual_existe AFTER INSERT OR UPDATE OF emprestimo_atual_id
+    ON {CHAVES} DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION {CHAVES}_verificar_emprestimo_atual()
+    """,
+    f"""
+    CREATE FUNCTION {TABELA}_verificar_remocao() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM {CHAVES} WHERE emprestimo_atual_id = OLD.id) THEN
+            RAISE EXCEPTION 'O empréstimo % ainda é o atual de uma chave', OLD.id
+                USING ERRCODE = 'foreign_key_violation';
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    f"""
+    CREATE CONSTRAINT TRIGGER emprestimo_atual_removido AFTER DELETE
+    ON {TABELA} DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION {TABELA}_verificar_remocao()
+    """,
+]
+
+
+def _criar_particao(ano):
+    particao = nome_particao(ano)
+    _executar(
+        f"CREATE TABLE {particao} PARTITION OF {TABELA} FOR VALUES FROM (%s) TO (%s)",
+        [inicio_do_ano(ano), inicio_do_ano(ano + 1)],
+    )
+    return particao
+
+
+def criar_particoes(ate_ano):
+    """
+    Cria as partições que faltam depois da última existente, até 'ate_ano'.
+    Rode com antecedência (por exemplo, todo mês, pelo particionar_emprestimos):
+    sem a partição do ano, as retiradas daquele ano falham. Retorna os anos criados.
+    """
+    _exigir_postgresql()
+    anos = anos_particionados()
+    if not anos:
+        raise ParticionamentoError("A tabela de empréstimos ainda não é particionada.")
+    criados = list(range(anos[-1] + 1, ate_ano + 1))
+    with transaction.atomic():
+        for ano in criados:
+            particao = _criar_particao(ano)
+            for sql in _restricoes_da_particao(particao):
+                _executar(sql)
+    return criados
+
+
+def particionar(ate_ano):
+    """
+    Converte a tabela de empréstimos numa tabela particionada por ano de
+    data_retirada, com uma partição para cada ano do histórico até 'ate_ano'.
+
+    Tudo numa transação, com a tabela bloqueada: os dados são copiados, então
+    conte com o tempo de reescrever a tabela e os índices. Os índices e as
+    chaves estrangeiras atuais são recriados na tabela particionada (e
+    propagados às partições). O que o PostgreSQL 16 não aceita nela muda de forma:
+
+    - a chave primária passa a ser (id, data_retirada), com o id vindo de uma
+      sequência (identity não é aceito em tabela particionada);
+    - uma retirada aberta por chave e períodos sem sobreposição valem por
+      índices em cada partição e, entre partições, por gatilhos (_GATILHOS);
+    - a chave estrangeira de Chave.emprestimo_atual (que exigiria um índice
+      único só no id) vira um par de gatilhos verificados no fim da transação.
+
+    O estado das migrações continua o de antes (e o mesmo do SQLite e das
+    instalações não particionadas). Migrações novas que mexam em Emprestimo ou
+    em Chave.emprestimo_atual precisam ser escritas à mão, com
+    SeparateDatabaseAndState; verificar_migracoes barra o migrate até lá.
+    """
+    _exigir_postgresql()
+    if particionada():
+        raise ParticionamentoError("A tabela de empréstimos já é particionada.")
+    with transaction.atomic():
+        _verificar_pendentes()
+        _executar(f"LOCK TABLE {TABELA} IN ACCESS EXCLUSIVE MODE")
+        # Índices comuns e chaves estrangeiras, para recriar na tabela nova
+        indices = [sql for (sql,) in _executar(
+            "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+            "WHERE i.indrelid = %s::regclass AND NOT i.indisunique AND NOT i.indisprimary "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)",
+            [TABELA],
+        )]
+        estrangeiras = _executar(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+            [TABELA],
+        )
+        for (nome,) in _executar(
+            "SELECT conname FROM pg_constraint WHERE confrelid = %s::regclass AND conrelid = %s::regclass",
+            [TABELA, CHAVES],
+        ):
+            _executar(f"ALTER TABLE {CHAVES} DROP CONSTRAINT {nome}")
+        primeiro, ultimo, maior_id = _executar(
+            "SELECT EXTRACT(YEAR FROM MIN(data_retirada) AT TIME ZONE %s)::int, "
+            "EXTRACT(YEAR FROM MAX(data_retirada) AT TIME ZONE %s)::int, MAX(id) FROM " + TABELA,
+            [timezone.get_current_timezone_name()] * 2,
+        )[0]
+
+        antiga = f'{TABELA}_antiga'
+        _executar(f"ALTER TABLE {TABELA} RENAME TO {antiga}")
+        _executar(f"CREATE TABLE {TABELA} (LIKE {antiga} INCLUDING DEFAULTS) PARTITION BY RANGE (data_retirada)")
+        # Do primeiro ano com dados (ou do atual) até 'ate_ano'
+        ano_atual = timezone.localdate().year
+        anos = range(min(primeiro or ano_atual, ano_atual), max(ultimo or ate_ano, ate_ano) + 1)
+        particoes = [_criar_particao(ano) for ano in anos]
+        _executar(f"INSERT INTO {TABELA} SELECT * FROM {antiga}")
+        # Leva junto a sequência do identity, os índices e as restrições da tabela antiga
+        _executar(f"DROP TABLE {antiga}")
+
+        _executar(f"CREATE SEQUENCE {SEQUENCIA} OWNED BY {TABELA}.id")
+        _executar("SELECT setval(%s, %s, %s)", [SEQUENCIA, maior_id or 1, maior_id is not None])
+        _executar(f"ALTER TABLE {TABELA} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCIA}')")
+        _executar(f"ALTER TABLE {TABELA} ADD PRIMARY KEY (id, data_retirada)")
+        for sql in indices:
+            _executar(sql)
+        for nome, definicao in estrangeiras:
+            _executar(f"ALTER TABLE {TABELA} ADD CONSTRAINT {nome} {definicao}")
+        for particao in particoes:
+            for sql in _restricoes_da_particao(particao):
+                _executar(sql)
+        for sql in _GATILHOS:
+            _executar(sql)
+    return list(anos)
+
+
+def bloquear_particao(ano):
+    """ Impede escritas na partição do ano até o fim da transação; leituras continuam. """
+    _executar(f"LOCK TABLE {nome_particao(ano)} IN EXCLUSIVE MODE")
+
+
+def remover_particao(ano):
+    """ Desanexa e apaga a partição de um ano (ver arquivo.arquivar). """
+    particao = nome_particao(ano)
+    _verificar_pendentes()
+    _executar(f"ALTER TABLE {TABELA} DETACH PARTITION {particao}")
+    _executar(f"DROP TABLE {particao}")
+
+
+def _aponta_para_emprestimo(campo):
+    alvo = getattr(getattr(campo, 'remote_field', None), 'model', None)
+    if alvo is None:
+        return False
+    rotulo = alvo if isinstance(alvo, str) else alvo._meta.label
+    return rotulo.lower() in ('emprestimo', Emprestimo._meta.label_lower)
+
+
+def mexe_no_particionado(app_label, operacao):
+    """
+    Se a operação de migração altera no banco o que particionar() mudou de
+    forma: a tabela de empréstimos, Chave.emprestimo_atual ou chaves
+    estrangeiras novas para Emprestimo. Em SeparateDatabaseAndState só contam
+    as operações de banco.
+    """
+    if isinstance(operacao, migrations.SeparateDatabaseAndState):
+        return any(mexe_no_particionado(app_label, o) for o in operacao.database_operations)
+    campos = [campo for _, campo in getattr(operacao, 'fields', [])] + [getattr(operacao, 'field', None)]
+    if any(_aponta_para_emprestimo(campo) for campo in campos if campo is not None):
+        return True
+    if app_label != Emprestimo._meta.app_label:
+        return False
+    modelo = (getattr(operacao, 'model_name', None) or getattr(operacao, 'old_name', None)
+              or getattr(operacao, 'name', '')).lower()
+    if modelo == Emprestimo._meta.model_name:
+        return True
+    campo = (getattr(operacao, 'old_name', None) or getattr(operacao, 'name', '')).lower()
+    return modelo == Chave._meta.model_name and campo == 'emprestimo_atual'
+
+
+def verificar_migracoes(app_configs=None, databases=None, **kwargs):
+    """
+    Verificação de sistema (roda no migrate): com a tabela particionada, as
+    migrações pendentes que mexem no particionado falhariam ou desfariam os
+    gatilhos. Cada uma vira um erro, e o migrate não roda.
+    """
+    if not databases or 'default' not in databases or not particionada():
+        return []
+    executor = MigrationExecutor(connection)
+    plano = executor.migration_plan(executor.loader.graph.leaf_nodes())
+    return [
+        checks.Error(
+            f"A migração {migracao.app_label}.{migracao.name} altera empréstimos, mas a tabela é particionada "
+            "e não tem mais a forma que o estado das migrações descreve.",
+            hint="Reescreva a migração com SeparateDatabaseAndState, com o SQL equivalente para a tabela "
+                 "particionada (ver particoes.particionar).",
+            obj=migracao,
+            id='claviculario_app.E001',
+        )
+        for migracao, _ in plano
+        if any(mexe_no_particionado(migracao.app_label, operacao) for operacao in migracao.operations)
+    ]
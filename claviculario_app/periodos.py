@@ -0,0 +1,74 @@
+# claviculario_app/periodos.py
+
+from django.contrib.postgres.fields import BigIntegerRangeField, DateTimeRangeField
+from django.db import connection
+from django.db.models import DateTimeField, F, Func, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+# Período em que a chave esteve fora: [data_retirada, data_devolucao), sem fim
+# enquanto não for devolvida. O índice GiST e a restrição de exclusão das
+# migrações 0016 e 0018 são criados a partir de cópias desta expressão, então
+# qualquer mudança aqui exige nova migração.
+PERIODO = Func(
+    F('data_retirada'),
+    Coalesce(F('data_devolucao'), RawSQL("'infinity'::timestamptz", (), output_field=DateTimeField())),
+    Value('[)'),
+    function='tstzrange',
+    output_field=DateTimeRangeField(),
+)
+
+# A unidade do empréstimo como o intervalo [unidade_id, unidade_id]: o GiST não
+# compara inteiros sem a extensão btree_gist (o mesmo recurso da restrição de
+# exclusão da 0016). É a primeira coluna do índice do período, desde a 0018
+# (que também guarda uma cópia).
+UNIDADE = Func(F('unidade_id'), F('unidade_id'), Value('[]'), function='int8range', output_field=BigIntegerRangeField())
+
+
+def _da_unidade(emprestimos, unidade):
+    """ No PostgreSQL, repete o filtro da unidade na forma que o índice GiST entende. """
+    if unidade is None:
+        return emprestimos
+    return emprestimos.alias(faixa_unidade=UNIDADE).filter(faixa_unidade__contains=unidade.pk)
+
+
+def no_instante(emprestimos, instante, unidade=None):
+    """
+    Os empréstimos em que a chave estava fora no 'instante'.
+
+    No PostgreSQL a consulta é sobre o período (tstzrange @> instante) e usa o
+    índice GiST; nos outros bancos, comparações simples das duas datas. Os
+    'emprestimos' já devem estar restritos à 'unidade', se ela for informada:
+    aqui ela só ajuda o PostgreSQL a usar o índice.
+    """
+    if connection.vendor == 'postgresql':
+        return _da_unidade(emprestimos, unidade).alias(periodo=PERIODO).filter(periodo__contains=instante)
+    return emprestimos.filter(Q(data_devolucao__isnull=True) | Q(data_devolucao__gt=instante),
+                              data_retirada__lte=instante)
+
+
+def no_intervalo(emprestimos, inicio, fim, unidade=None):
+    """ Os empréstimos em que a chave esteve fora em algum momento de [inicio, fim). """
+    if connection.vendor == 'postgresql':
+        return _da_unidade(emprestimos, unidade).alias(periodo=PERIODO).filter(periodo__overlap=(inicio, fim))
+    return emprestimos.filter(Q(data_devolucao__isnull=True) | Q(data_devolucao__gt=inicio),
+                              data_retirada__lt=fim)
+
+
+def quem_estava(emprestimos, instante=None, inicio=None, fim=None, chave=None, local=None, pessoa=None, unidade=None):
+    """
+    Com quem estavam as chaves num instante (ou num intervalo), opcionalmente
+    só de uma chave, de um local ou de uma pessoa. Informe 'instante' ou
+    'inicio' e 'fim'.
+    """
+    if instante is not None:
+        emprestimos = no_instante(emprestimos, instante, unidade)
+    else:
+        emprestimos = no_intervalo(emprestimos, inicio, fim, unidade)
+    if chave is not None:
+        emprestimos = emprestimos.filter(chave=chave)
+    if local is not None:
+        emprestimos = emprestimos.filter(chave__local=local)
+    if pessoa is not None:
+        emprestimos = emprestimos.filter(pessoa=pessoa)
+    return emprestimos
@@ -0,0 +1,147 @@
+# claviculario_app/pin.py
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.cache import cache
+
+from .hashers import hasher_pin
+from .models import Pessoa
+
+# Tentativas erradas aceitas antes do bloqueio. Por endereço, só quando
+# CLAVICULARIO_PIN_TENTATIVAS_IP é configurado (ver config/settings.py): com
+# todos os clientes atrás do mesmo proxy ou NAT, esse contador bloquearia o
+# site inteiro.
+TENTATIVAS_POR_PESSOA = 5
+BLOQUEIO_SEGUNDOS = 15 * 60
+
+
+class PinBloqueadoError(Exception):
+    """ Tentativas erradas demais para a pessoa ou para o endereço: o PIN nem foi conferido. """
+    def __init__(self, segundos):
+        super().__init__(f"Conferência de PIN bloqueada por até {segundos} segundos.")
+        self.segundos = segundos
+
+
+#------------------------------------------------------------------
+# CONTADORES DE TENTATIVAS
+#------------------------------------------------------------------
+def _tempo_bloqueio():
+    return getattr(settings, 'CLAVICULARIO_PIN_BLOQUEIO_SEGUNDOS', BLOQUEIO_SEGUNDOS)
+
+
+def _contador_pessoa(pessoa_id):
+    return f'claviculario:pin:pessoa:{pessoa_id}'
+
+
+def ip_do_cliente(request):
+    """
+    Endereço do cliente para o contador por IP. Sem
+    CLAVICULARIO_PIN_IP_CABECALHO, é o REMOTE_ADDR. Com ele, o endereço vem
+    do cabeçalho (uma lista como a do X-Forwarded-For, em que cada proxy
+    acrescenta à direita quem o chamou): é o que o proxy mais externo dos
+    CLAVICULARIO_PIN_PROXIES_CONFIAVEIS anotou. O que está à esquerda dele
+    veio do cliente e pode ser forjado. None se o cabeçalho não trouxer
+    endereços suficientes.
+    """
+    cabecalho = getattr(settings, 'CLAVICULARIO_PIN_IP_CABECALHO', None)
+    if not cabecalho:
+        return request.META.get('REMOTE_ADDR')
+    proxies = getattr(settings, 'CLAVICULARIO_PIN_PROXIES_CONFIAVEIS', 1)
+    enderecos = [endereco.strip() for endereco in request.META.get(cabecalho, '').split(',') if endereco.strip()]
+    return enderecos[-proxies] if 0 < proxies <= len(enderecos) else None
+
+
+def _contadores(pessoa_id, ip):
+    """ [(chave no cache, limite)] dos contadores que valem para a tentativa. """
+    contadores = [(_contador_pessoa(pessoa_id), getattr(settings, 'CLAVICULARIO_PIN_TENTATIVAS', TENTATIVAS_POR_PESSOA))]
+    limite_ip = getattr(settings, 'CLAVICULARIO_PIN_TENTATIVAS_IP', None)
+    if ip and limite_ip:
+        contadores.append((f'claviculario:pin:ip:{ip}', limite_ip))
+    return contadores
+
+
+def bloqueado(pessoa_id, ip=None):
+    """ Se a pessoa ou o endereço já esgotaram as tentativas. Só consulta o cache. """
+    contadores = _contadores(pessoa_id, ip)
+    falhas = cache.get_many([chave for chave, _ in contadores])
+    return any(falhas.get(chave, 0) >= limite for chave, limite in contadores)
+
+
+def _registrar_falha(pessoa_id, ip):
+    tempo = _tempo_bloqueio()
+    for chave, limite in _contadores(pessoa_id, ip):
+        # A contagem vale por 'tempo' segundos a partir do primeiro erro
+        cache.add(chave, 0, tempo)
+        try:
+            falhas = cache.incr(chave)
+        except ValueError:  # Expirou entre o add e o incr
+            cache.set(chave, 1, tempo)
+            falhas = 1
+        if falhas >= limite:
+            # Bloqueado: o prazo recomeça a cada nova tentativa errada
+            cache.touch(chave, tempo)
+
+
+def _registrar(pessoa, ip, correto, novo_hash):
+    if not correto:
+        _registrar_falha(pessoa.pk, ip)
+        return
+    # O acerto zera os erros da pessoa, mas não os do endereço
+    cache.delete(_contador_pessoa(pessoa.pk))
+    if novo_hash:
+        Pessoa.objects.filter(pk=pessoa.pk).update(pin=novo_hash)
+        pessoa.pin = novo_hash
+
+
+#------------------------------------------------------------------
+# CONFERÊNCIA
+#------------------------------------------------------------------
+# O hash do PIN é só CPU. Ele roda sempre neste pool, com um número limitado
+# de threads: uma rajada de tentativas ocupa no máximo esses núcleos, e as
+# demais requisições continuam sendo atendidas. O hashlib libera o GIL durante
+# o cálculo, então as threads trabalham de fato em paralelo.
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'CLAVICULARIO_PIN_THREADS', None) or min(4, os.cpu_count() or 1),
+    thread_name_prefix='pin',
+)
+
+
+def _conferir(pin, codificado):
+    """
+    (correto, novo_hash). 'novo_hash' só vem quando o PIN confere mas foi
+    criptografado com outro hasher ou outro custo que não os de hasher_pin().
+    """
+    hasher = hasher_pin()
+    refeito = []
+    correto = check_password(pin, codificado, setter=lambda bruto: refeito.append(make_password(bruto, hasher=hasher)),
+                             preferred=hasher)
+    return correto, refeito[0] if refeito else None
+
+
+def verificar_pin(pessoa, pin, ip=None):
+    """
+    Confere o PIN da pessoa contando as tentativas erradas por pessoa e, se
+    ligado, por endereço ('ip', ver ip_do_cliente), no cache do Django.
+    Esgotadas as tentativas, levanta PinBloqueadoError antes de calcular
+    qualquer hash. No acerto, um PIN guardado com outro hasher é refeito com
+    o de hasher_pin().
+    """
+    if bloqueado(pessoa.pk, ip):
+        raise PinBloqueadoError(_tempo_bloqueio())
+    correto, novo_hash = _executor.submit(_conferir, pin, pessoa.pin).result()
+    _registrar(pessoa, ip, correto, novo_hash)
+    return correto
+
+
+async def verificar_pin_async(pessoa, pin, ip=None):
+    """ verificar_pin sem bloquear o loop de eventos. """
+    if await sync_to_async(bloqueado)(pessoa.pk, ip):
+        raise PinBloqueadoError(_tempo_bloqueio())
+    correto, novo_hash = await asyncio.get_running_loop().run_in_executor(_executor, _conferir, pin, pessoa.pin)
+    await sync_to_async(_registrar)(pessoa, ip, correto, novo_hash)
+    return correto
@@ -0,0 +1,114 @@
+# claviculario_app/replicas.py
+
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+
+# Cookie que prende o navegador ao banco principal logo depois de uma escrita
+COOKIE_PRIMARIO = 'claviculario_primario'
+
+# Banco das leituras da requisição atual (None: o que o Django escolher, o 'default')
+_banco_de_leitura = ContextVar('claviculario_banco_de_leitura', default=None)
+
+
+def banco_de_relatorios():
+    """ Alias da réplica de leitura (CLAVICULARIO_BANCO_RELATORIOS), ou None se não houver. """
+    return getattr(settings, 'CLAVICULARIO_BANCO_RELATORIOS', None)
+
+
+def _espera():
+    return getattr(settings, 'CLAVICULARIO_REPLICA_ATRASO_SEGUNDOS', 5)
+
+
+class RelatoriosRouter:
+    """
+    Manda para a réplica as leituras das views marcadas com @le_da_replica.
+    Escritas, e todas as outras leituras, continuam no banco principal.
+    """
+    def db_for_read(self, model, **hints):
+        return _banco_de_leitura.get()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A réplica é uma cópia do principal: um objeto lido de cada lado se relaciona
+        bancos = {DEFAULT_DB_ALIAS, banco_de_relatorios()}
+        if obj1._state.db in bancos and obj2._state.db in bancos:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # As migrações chegam à réplica pela própria replicação
+        if db == banco_de_relatorios():
+            return False
+        return None
+
+
+def _na_replica(request):
+    """ Se as leituras desta requisição podem ir para a réplica. """
+    return banco_de_relatorios() is not None and COOKIE_PRIMARIO not in request.COOKIES
+
+
+def _ler_streaming(conteudo, banco):
+    # Nas respostas em streaming as consultas rodam enquanto o conteúdo é
+    # enviado. O servidor pode fechar o gerador em outro contexto, onde um
+    # token de reset() não vale: restaura o valor anterior diretamente.
+    anterior = _banco_de_leitura.get()
+    _banco_de_leitura.set(banco)
+    try:
+        yield from conteudo
+    finally:
+        _banco_de_leitura.set(anterior)
+
+
+def le_da_replica(view):
+    """
+    Decorador de view: as leituras da view (e do conteúdo em streaming) vão
+    para o banco de relatórios, se houver um. Logo depois de uma escrita do
+    mesmo navegador (ver ReplicaMiddleware), a view lê do banco principal,
+    para que ninguém deixe de ver o que acabou de gravar por atraso da réplica.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def _view_async(request, *args, **kwargs):
+            if not _na_replica(request):
+                return await view(request, *args, **kwargs)
+            token = _banco_de_leitura.set(banco_de_relatorios())
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _banco_de_leitura.reset(token)
+        return _view_async
+
+    @wraps(view)
+    def _view(request, *args, **kwargs):
+        if not _na_replica(request):
+            return view(request, *args, **kwargs)
+        banco = banco_de_relatorios()
+        token = _banco_de_leitura.set(banco)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _banco_de_leitura.reset(token)
+        if response.streaming and getattr(response, 'file_to_stream', None) is None:
+            response.streaming_content = _ler_streaming(response.streaming_content, banco)
+        return response
+    return _view
+
+
+class ReplicaMiddleware(MiddlewareMixin):
+    """
+    Depois de uma escrita bem-sucedida (POST, PUT, PATCH ou DELETE), prende o
+    navegador ao banco principal por CLAVICULARIO_REPLICA_ATRASO_SEGUNDOS: um
+    cookie que expira sozinho, sem custo no banco.
+    """
+    def process_response(self, request, response):
+        if (banco_de_relatorios() is not None and request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+                and response.status_code < 400):
+            response.set_cookie(COOKIE_PRIMARIO, '1', max_age=_espera(), httponly=True, samesite='Lax')
+        return response
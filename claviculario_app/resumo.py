@@ -0,0 +1,138 @@
+# claviculario_app/resumo.py
+
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncDate, ExtractHour
+from django.utils import timezone
+
+from .arquivo import anos_arquivados
+from .models import Emprestimo, ResumoHorario
+
+CONTADORES = ('retiradas', 'devolucoes', 'no_prazo', 'atrasadas')
+TAMANHO_LOTE = 5000
+
+
+def _hora_local(momento):
+    """ (dia, hora) no horário local, que é como os gráficos agrupam. """
+    local = timezone.localtime(momento)
+    return local.date(), local.hour
+
+
+def acumular(incrementos):
+    """
+    Soma os incrementos aos resumos, criando as linhas que ainda não existem.
+
+    'incrementos' é um dicionário {(unidade_id, dia, hora, chave_id): {contador: valor}}.
+    A unidade é sempre a da chave; ela só vai para a linha para que os
+    gráficos de cada unidade leiam os resumos pelo resumo_unidade_dia_idx.
+    Cada lote é um único INSERT ... ON CONFLICT DO UPDATE (PostgreSQL e SQLite),
+    então duas mesas atualizando a mesma hora não perdem contagens.
+    """
+    if not incrementos:
+        return
+    qn = connection.ops.quote_name
+    tabela = qn(ResumoHorario._meta.db_table)
+    colunas = ('unidade_id', 'dia', 'hora', 'chave_id') + CONTADORES
+    linhas = [
+        (unidade_id, connection.ops.adapt_datefield_value(dia), hora, chave_id, *(valores.get(c, 0) for c in CONTADORES))
+        for (unidade_id, dia, hora, chave_id), valores in incrementos.items()
+    ]
+    soma = ', '.join(f"{qn(c)} = {tabela}.{qn(c)} + EXCLUDED.{qn(c)}" for c in CONTADORES)
+    tamanho = connection.ops.bulk_batch_size(colunas, linhas)
+    with connection.cursor() as cursor:
+        for inicio in range(0, len(linhas), tamanho):
+            lote = linhas[inicio:inicio + tamanho]
+            marcadores = ', '.join(['(' + ', '.join(['%s'] * len(colunas)) + ')'] * len(lote))
+            cursor.execute(
+                f"INSERT INTO {tabela} ({', '.join(qn(c) for c in colunas)}) VALUES {marcadores} "
+                f"ON CONFLICT ({qn('dia')}, {qn('hora')}, {qn('chave_id')}) DO UPDATE SET {soma}",
+                [valor for linha in lote for valor in linha],
+            )
+
+
+def contar_retirada(unidade_id, chave_id, data_retirada):
+    dia, hora = _hora_local(data_retirada)
+    acumular({(unidade_id, dia, hora, chave_id): {'retiradas': 1}})
+
+
+def contar_devolucoes(emprestimos, data_devolucao):
+    """
+    Conta as devoluções de um lote: 'emprestimos' são tuplas
+    (unidade_id, chave_id, data_retirada, previsao_devolucao) dos empréstimos encerrados.
+    """
+    incrementos = defaultdict(Counter)
+    dia_devolucao, hora_devolucao = _hora_local(data_devolucao)
+    for unidade_id, chave_id, data_retirada, previsao_devolucao in emprestimos:
+        incrementos[(unidade_id, dia_devolucao, hora_devolucao, chave_id)]['devolucoes'] += 1
+        if previsao_devolucao is not None:
+            dia, hora = _hora_local(data_retirada)
+            situacao = 'atrasadas' if data_devolucao > previsao_devolucao else 'no_prazo'
+            incrementos[(unidade_id, dia, hora, chave_id)][situacao] += 1
+    acumular(incrementos)
+
+
+def _no_periodo(queryset, campo, inicio, fim):
+    """ Filtra 'campo' entre as datas locais informadas (inclusive), sem converter a coluna. """
+    fuso = timezone.get_current_timezone()
+    if inicio:
+        queryset = queryset.filter(**{f'{campo}__gte': datetime.combine(inicio, time.min, tzinfo=fuso)})
+    if fim:
+        queryset = queryset.filter(**{f'{campo}__lt': datetime.combine(fim + timedelta(days=1), time.min, tzinfo=fuso)})
+    return queryset
+
+
+def _agrupar_por_hora(queryset, campo, **contadores):
+    fuso = timezone.get_current_timezone()
+    return (
+        queryset.order_by()
+        .annotate(dia=TruncDate(campo, tzinfo=fuso), hora=ExtractHour(campo, tzinfo=fuso))
+        .values('unidade_id', 'dia', 'hora', 'chave_id')
+        .annotate(**contadores)
+        .iterator(chunk_size=TAMANHO_LOTE)
+    )
+
+
+def reconstruir(inicio=None, fim=None):
+    """
+    Refaz os resumos a partir dos empréstimos, para todo o histórico ou só
+    para os dias entre 'inicio' e 'fim'. A contagem é feita no banco e
+    gravada em lotes; retorna o número de linhas de resumo no período.
+
+    Os dias dos anos arquivados (ver arquivo.py) não são refeitos: os
+    empréstimos deles já não estão no banco e os resumos são o que sobra
+    deles para os gráficos.
+    """
+    if arquivados := anos_arquivados():
+        primeiro_dia = date(arquivados[-1] + 1, 1, 1)
+        inicio = max(inicio, primeiro_dia) if inicio else primeiro_dia
+    with transaction.atomic():
+        resumos = ResumoHorario.objects.all()
+        if inicio:
+            resumos = resumos.filter(dia__gte=inicio)
+        if fim:
+            resumos = resumos.filter(dia__lte=fim)
+        resumos.delete()
+
+        emprestimos = Emprestimo.objects.all()
+        retiradas = _agrupar_por_hora(
+            _no_periodo(emprestimos, 'data_retirada', inicio, fim), 'data_retirada',
+            retiradas=Count('id'),
+            no_prazo=Count('id', filter=Q(data_devolucao__lte=F('previsao_devolucao'))),
+            atrasadas=Count('id', filter=Q(data_devolucao__gt=F('previsao_devolucao'))),
+        )
+        while lote := list(islice(retiradas, TAMANHO_LOTE)):
+            ResumoHorario.objects.bulk_create([ResumoHorario(**linha) for linha in lote])
+
+        # As devoluções caem em horas que podem já ter linha (ou não): vão pelo acumular
+        devolucoes = _agrupar_por_hora(
+            _no_periodo(emprestimos.filter(data_devolucao__isnull=False), 'data_devolucao', inicio, fim),
+            'data_devolucao',
+            devolucoes=Count('id'),
+        )
+        while lote := list(islice(devolucoes, TAMANHO_LOTE)):
+            acumular({(linha['unidade_id'], linha['dia'], linha['hora'], linha['chave_id']): linha for linha in lote})
+    return resumos.count()
@@ -0,0 +1,195 @@
+# claviculario_app/services.py
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import DateTimeField, F, OuterRef, Subquery, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import busca, eventos, painel, resumo
+from .models import Emprestimo, Chave, Pessoa
+
+
+class ChaveIndisponivelError(Exception):
+    """ A chave já está emprestada (ou foi desativada) no momento da retirada. """
+
+
+class PeriodoOcupadoError(ChaveIndisponivelError):
+    """ A chave está livre agora, mas na data de retirada informada ainda estava com outra pessoa. """
+
+
+class RetiradaNoFuturoError(ValueError):
+    """ A data de retirada informada ainda não chegou. """
+
+
+# Folga para relógios das mesas e do servidor um pouco desencontrados
+TOLERANCIA_RELOGIO = timedelta(minutes=5)
+
+# SQLSTATE de exclusion_violation (restrição emprestimo_sem_sobreposicao, só no PostgreSQL)
+VIOLACAO_DE_EXCLUSAO = '23P01'
+
+
+#------------------------------------------------------------------
+# RETIRADA DE CHAVES
+#------------------------------------------------------------------
+def validar_data_retirada(data_retirada):
+    """
+    Recusa retiradas no futuro (além de TOLERANCIA_RELOGIO). Um empréstimo que
+    começa depois da sua devolução não tem período válido no banco.
+    """
+    if data_retirada > timezone.now() + TOLERANCIA_RELOGIO:
+        raise RetiradaNoFuturoError("A data de retirada não pode estar no futuro.")
+
+
+def registrar_retirada(chave_id, pessoa_id, data_retirada, previsao_devolucao=None, observacao=None):
+    """
+    Empresta a chave para a pessoa numa única unidade de trabalho.
+
+    A linha da chave é bloqueada (SELECT ... FOR UPDATE) só se ela ainda
+    estiver disponível. Se duas mesas tentarem retirar a mesma chave ao mesmo
+    tempo, a segunda espera a primeira terminar, não encontra mais a chave
+    livre e recebe ChaveIndisponivelError. O empréstimo criado passa a ser o
+    Chave.emprestimo_atual; o índice único emprestimo_aberto_por_chave garante,
+    no banco, que uma chave nunca tenha dois empréstimos abertos. No
+    PostgreSQL, uma retirada com data anterior à última devolução da chave
+    esbarra na restrição de exclusão dos períodos e vira PeriodoOcupadoError.
+    A pessoa precisa ser da unidade da chave (senão, Pessoa.DoesNotExist), e o
+    empréstimo fica nessa unidade. Datas de retirada no futuro levantam
+    RetiradaNoFuturoError.
+
+    Depois da confirmação, as mesas conectadas recebem um evento RETIRADA.
+    """
+    validar_data_retirada(data_retirada)
+    with transaction.atomic():
+        # Chave, local e pessoa numa única consulta: servem ao texto da busca e
+        # ao evento. Só a linha da chave é bloqueada, não a do local.
+        pessoa = Pessoa.objects.filter(pk=pessoa_id, unidade=OuterRef('unidade'))
+        dados = Chave.objects.select_for_update(of=('self',)).filter(
+            pk=chave_id, emprestimo_atual__isnull=True, ativa=True,
+        ).annotate(
+            nome_pessoa=Subquery(pessoa.values('nome')),
+            cpf_pessoa=Subquery(pessoa.values('cpf_saran')),
+        ).values('unidade_id', 'descricao', 'local_id', 'local__nome', 'nome_pessoa', 'cpf_pessoa').first()
+        if dados is None:
+            # Só no caminho de falha descobrimos se a chave existe de fato
+            if not Chave.objects.filter(pk=chave_id).exists():
+                raise Chave.DoesNotExist
+            raise ChaveIndisponivelError
+        if dados['nome_pessoa'] is None:
+            # A pessoa não existe ou é de outra unidade
+            raise Pessoa.DoesNotExist
+
+        unidade_id = dados['unidade_id']
+        try:
+            emprestimo = Emprestimo.objects.create(
+                unidade_id=unidade_id,
+                chave_id=chave_id,
+                pessoa_id=pessoa_id,
+                data_retirada=data_retirada,
+                previsao_devolucao=previsao_devolucao,
+                observacao=observacao,
+                texto_busca=busca.texto_emprestimo(
+                    dados['descricao'], dados['local__nome'], dados['nome_pessoa'], dados['cpf_pessoa'], observacao,
+                ),
+            )
+        except IntegrityError as erro:
+            if getattr(erro.__cause__, 'pgcode', None) == VIOLACAO_DE_EXCLUSAO:
+                raise PeriodoOcupadoError from erro
+            raise
+        Chave.objects.filter(pk=chave_id).update(emprestimo_atual=emprestimo)
+        resumo.contar_retirada(unidade_id, chave_id, data_retirada)
+        painel.invalidar_dashboard(unidade_id)
+        eventos.publicar(eventos.RETIRADA, {
+            'unidade_id': unidade_id,
+            'emprestimo_id': emprestimo.id,
+            'chave_id': chave_id,
+            'chave': dados['descricao'],
+            'local_id': dados['local_id'],
+            'local': dados['local__nome'],
+            'pessoa_id': emprestimo.pessoa_id,
+            'pessoa': dados['nome_pessoa'],
+            'data_retirada': data_retirada.isoformat(),
+            'previsao_devolucao': previsao_devolucao.isoformat() if previsao_devolucao else None,
+        })
+        return emprestimo
+
+
+#------------------------------------------------------------------
+# DEVOLUÇÃO DE CHAVES
+#------------------------------------------------------------------
+DEVOLVIDO = 'devolvido'
+JA_DEVOLVIDO = 'ja_devolvido'
+NAO_ENCONTRADO = 'nao_encontrado'
+
+
+def registrar_devolucoes(emprestimo_ids=None, pessoa_id=None, data_devolucao=None, unidade=None):
+    """
+    Encerra vários empréstimos de uma vez, numa única transação.
+
+    Recebe uma lista de ids de empréstimo ou o id de uma pessoa (que significa
+    "tudo o que esta pessoa está segurando"). Os empréstimos abertos são
+    bloqueados, encerrados com um único UPDATE e as chaves que apontavam para
+    eles são liberadas com outro; os resumos dos gráficos são atualizados num terceiro.
+    Cada empréstimo encerrado gera um evento DEVOLUCAO após a confirmação.
+    Com 'unidade', os empréstimos de outras unidades contam como não encontrados.
+    Um empréstimo nunca termina antes de começar: se a retirada for posterior
+    a 'data_devolucao' (relógio adiantado na retirada), a devolução fica no
+    próprio instante da retirada. Retorna um dicionário {id_do_emprestimo: situação}.
+    """
+    if emprestimo_ids is None and pessoa_id is None:
+        raise ValueError("Informe os empréstimos ou a pessoa.")
+    data_devolucao = data_devolucao or timezone.now()
+
+    with transaction.atomic():
+        # Bloqueia só os empréstimos: a chave e o local vêm no mesmo SELECT apenas para o evento
+        abertos = Emprestimo.objects.select_for_update(of=('self',)).filter(data_devolucao__isnull=True)
+        if unidade is not None:
+            abertos = abertos.da_unidade(unidade)
+        if emprestimo_ids is not None:
+            emprestimo_ids = {int(i) for i in emprestimo_ids}
+            abertos = abertos.filter(id__in=emprestimo_ids)
+        if pessoa_id is not None:
+            abertos = abertos.filter(pessoa_id=pessoa_id)
+        encerrados = list(abertos.order_by().values_list(
+            'id', 'unidade_id', 'chave_id', 'data_retirada', 'previsao_devolucao',
+            'chave__descricao', 'chave__local_id', 'chave__local__nome',
+        ))
+        abertos = {emprestimo_id: chave_id for emprestimo_id, _, chave_id, *_ in encerrados}
+
+        if abertos:
+            Emprestimo.objects.filter(id__in=list(abertos)).update(
+                data_devolucao=Greatest(Value(data_devolucao, output_field=DateTimeField()), F('data_retirada')),
+            )
+            Chave.objects.filter(emprestimo_atual__in=list(abertos)).update(emprestimo_atual=None)
+            por_devolucao = defaultdict(list)
+            for linha in encerrados:
+                por_devolucao[max(data_devolucao, linha[3])].append(linha)
+            for devolucao, linhas in por_devolucao.items():
+                resumo.contar_devolucoes([linha[1:5] for linha in linhas], devolucao)
+            for unidade_id in {linha[1] for linha in encerrados}:
+                painel.invalidar_dashboard(unidade_id)
+            for emprestimo_id, unidade_id, chave_id, data_retirada, _, descricao, local_id, nome_local in encerrados:
+                eventos.publicar(eventos.DEVOLUCAO, {
+                    'unidade_id': unidade_id,
+                    'emprestimo_id': emprestimo_id,
+                    'chave_id': chave_id,
+                    'chave': descricao,
+                    'local_id': local_id,
+                    'local': nome_local,
+                    'data_devolucao': max(data_devolucao, data_retirada).isoformat(),
+                })
+
+    resultados = {emprestimo_id: DEVOLVIDO for emprestimo_id in abertos}
+    faltantes = (emprestimo_ids or set()) - abertos.keys()
+    if faltantes:
+        # Só no caminho de falha descobrimos se o empréstimo existe de fato
+        existentes = Emprestimo.objects.filter(id__in=faltantes)
+        if unidade is not None:
+            existentes = existentes.da_unidade(unidade)
+        existentes = set(existentes.values_list('id', flat=True))
+        for emprestimo_id in faltantes:
+            resultados[emprestimo_id] = JA_DEVOLVIDO if emprestimo_id in existentes else NAO_ENCONTRADO
+    return resultados
+
@@ -0,0 +1,136 @@
+# claviculario_app/tarefas.py
+
+import io
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pandas as pd
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import importacao
+from .models import ImportacaoJob
+from .painel import invalidar_dashboard
+
+logger = logging.getLogger(__name__)
+
+# Um único worker por processo: as importações rodam em fila, fora do ciclo da requisição
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='importacao')
+
+IMPORTADORES = {
+    ImportacaoJob.TIPO_PESSOAS: (importacao.importar_pessoas, importacao.COLUNAS_PESSOAS),
+    ImportacaoJob.TIPO_CHAVES: (importacao.importar_chaves, importacao.COLUNAS_CHAVES),
+}
+
+
+def enfileirar_importacao(job):
+    """
+    Agenda o processamento da importação assim que a transação atual terminar.
+
+    Com CLAVICULARIO_IMPORTACAO_EM_THREAD = False (ex: quando há vários
+    servidores), nada é agendado aqui e o job fica na fila até que o comando
+    'processar_importacoes' o pegue.
+    """
+    if getattr(settings, 'CLAVICULARIO_IMPORTACAO_EM_THREAD', True):
+        transaction.on_commit(lambda: _executor.submit(_executar_em_thread, job.pk))
+
+
+def _executar_em_thread(job_id):
+    try:
+        executar_importacao(job_id)
+    finally:
+        # As conexões são por thread; fecha as desta thread para não vazar
+        connections.close_all()
+
+
+def _reservar_job(job_id):
+    """ Marca o job como 'processando' só se ele ainda estiver na fila. """
+    agora = timezone.now()
+    return ImportacaoJob.objects.filter(pk=job_id, status=ImportacaoJob.STATUS_PENDENTE).update(
+        status=ImportacaoJob.STATUS_PROCESSANDO,
+        iniciado_em=agora,
+        atualizado_em=agora,
+    )
+
+
+def encerrar_interrompidos(jobs=None):
+    """
+    Marca como erro os jobs 'processando' (de 'jobs', ou todos) sem progresso
+    há mais de CLAVICULARIO_IMPORTACAO_SEM_PROGRESSO_SEGUNDOS: o processo que
+    os pegou morreu e ninguém mais vai concluí-los. Retorna quantos foram
+    encerrados.
+    """
+    segundos = getattr(settings, 'CLAVICULARIO_IMPORTACAO_SEM_PROGRESSO_SEGUNDOS', 900)
+    limite = timezone.now() - timedelta(seconds=segundos)
+    jobs = ImportacaoJob.objects.all() if jobs is None else jobs
+    return jobs.filter(status=ImportacaoJob.STATUS_PROCESSANDO).filter(
+        Q(atualizado_em__lt=limite) | Q(atualizado_em__isnull=True, iniciado_em__lt=limite)
+    ).update(
+        status=ImportacaoJob.STATUS_ERRO,
+        erros="A importação foi interrompida antes de terminar. Envie a planilha de novo: "
+              "as linhas que já foram gravadas aparecem como já cadastradas.",
+        concluido_em=timezone.now(),
+    )
+
+
+def executar_importacao(job_id):
+    """
+    Processa um job de importação. Retorna False se outro worker já o pegou.
+
+    O progresso é gravado no próprio job à medida que as linhas são tratadas,
+    e é isso que a página de importação consulta. Cada gravação é confirmada
+    na hora (a importação não roda dentro de uma transação única), então as
+    outras conexões a veem.
+    """
+    if not _reservar_job(job_id):
+        return False
+
+    job = ImportacaoJob.objects.get(pk=job_id)
+    jobs = ImportacaoJob.objects.filter(pk=job_id)
+    importar, colunas_necessarias = IMPORTADORES[job.tipo]
+    try:
+        df = pd.read_excel(io.BytesIO(job.arquivo), dtype=str)
+        if not all(coluna in df.columns for coluna in colunas_necessarias):
+            raise ValueError(f"O arquivo enviado não contém as colunas necessárias: {colunas_necessarias}")
+        jobs.update(total_linhas=len(df))
+
+        resultado = importar(df, job.unidade_id, progresso=lambda feitas: jobs.update(linhas_processadas=feitas, atualizado_em=timezone.now()))
+        if job.tipo == ImportacaoJob.TIPO_CHAVES:
+            invalidar_dashboard(job.unidade_id)
+
+        jobs.update(
+            status=ImportacaoJob.STATUS_CONCLUIDA,
+            linhas_processadas=len(df),
+            criados=resultado['criados'],
+            ignorados=resultado['ignorados'],
+            conflitos=resultado['conflitos'],
+            concluido_em=timezone.now(),
+        )
+    except Exception as e:
+        logger.exception("Erro ao processar a importação %s", job_id)
+        jobs.update(
+            status=ImportacaoJob.STATUS_ERRO,
+            erros=f"{e}\n\n{traceback.format_exc()}",
+            concluido_em=timezone.now(),
+        )
+    return True
+
+
+def processar_pendentes(limite=None):
+    """
+    Processa os jobs na fila, do mais antigo para o mais novo. Retorna quantos
+    foram processados. Antes, encerra os que ficaram parados em 'processando'.
+    """
+    encerrados = encerrar_interrompidos()
+    if encerrados:
+        logger.warning("%s importação(ões) interrompida(s) marcada(s) como erro", encerrados)
+    processados = 0
+    pendentes = ImportacaoJob.objects.filter(status=ImportacaoJob.STATUS_PENDENTE).order_by('criado_em')
+    for job_id in pendentes.values_list('id', flat=True)[:limite]:
+        if executar_importacao(job_id):
+            processados += 1
+    return processados
@@ -1,3 +1,2809 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from importlib import import_module
+from pathlib import Path
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+from openpyxl import load_workbook
+from allauth.account.signals import user_signed_up
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.auth.models import User, Group, Permission
+from asgiref.sync import sync_to_async
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.checks import Tags, run_checks
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.paginator import Paginator
+from django.utils.crypto import get_random_string
+from django.db import IntegrityError, connection, connections, migrations, models, transaction
+from django.db.models import Sum
+from django.test import AsyncClient, Client, RequestFactory, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+
+from . import (
+    arquivo, busca, carga, dados_sinteticos, eventos, importacao, paginacao, painel, particoes, periodos, pin, replicas,
+    resumo, tarefas, unidades, urls, views,
+)
+from .forms import EmprestimoForm
+from .models import Local, Chave, Pessoa, Emprestimo, ImportacaoJob, ResumoHorario, Unidade
+from .pin import verificar_pin, verificar_pin_async, PinBloqueadoError
+from .services import (
+    registrar_retirada, registrar_devolucoes, ChaveIndisponivelError, PeriodoOcupadoError, RetiradaNoFuturoError,
+    DEVOLVIDO, JA_DEVOLVIDO, NAO_ENCONTRADO,
+)
+
+# Os benchmarks só rodam quando pedidos explicitamente:
+#   CLAVICULARIO_BENCHMARK=1 python manage.py test --tag benchmark
+BENCHMARK = bool(os.environ.get('CLAVICULARIO_BENCHMARK'))
+
+# Hasher rápido para os testes que criam muitas pessoas (mesmo o hasher dos PINs leva ~30ms por PIN)
+HASHER_RAPIDO = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def unidade_de_teste(nome="Unidade de teste"):
+    """ A unidade em que os testes criam os seus dados (a mesma a cada chamada com o mesmo nome). """
+    return Unidade.objects.get_or_create(nome=nome)[0]
+
+
+def criar_dados_basicos(num_chaves=1, num_pessoas=1, unidade=None):
+    """ Cria um local com algumas chaves e pessoas para os testes. """
+    unidade = unidade or unidade_de_teste()
+    local = Local.objects.create(unidade=unidade, nome="Bloco A")
+    chaves = [Chave.objects.create(unidade=unidade, descricao=f"Sala {i}", local=local) for i in range(num_chaves)]
+    pessoas = []
+    for i in range(num_pessoas):
+        pessoa = Pessoa(unidade=unidade, nome=f"Pessoa {i}", cpf_saran=f"{i:011d}")
+        pessoa.set_pin("1234")
+        pessoa.save()
+        pessoas.append(pessoa)
+    return local, chaves, pessoas
+
+
+def criar_historico(num_emprestimos, chaves, pessoas, inicio=None):
+    """
+    Cria empréstimos já devolvidos, um por hora, em massa (sem passar pelo
+    serviço). Cada devolução acontece antes da próxima retirada da mesma chave.
+    """
+    inicio = inicio or timezone.now() - timedelta(hours=num_emprestimos + 1)
+    emprestimos = []
+    for i in range(num_emprestimos):
+        retirada = inicio + timedelta(hours=i)
+        duracao = min(30 + (i % 4) * 40, 60 * len(chaves) - 10)
+        emprestimos.append(Emprestimo(
+            unidade_id=chaves[i % len(chaves)].unidade_id,
+            chave=chaves[i % len(chaves)],
+            pessoa=pessoas[i % len(pessoas)],
+            data_retirada=retirada,
+            previsao_devolucao=retirada + timedelta(hours=2),
+            data_devolucao=retirada + timedelta(minutes=duracao),
+            observacao=f"Empréstimo {i}",
+        ))
+    return Emprestimo.objects.bulk_create(emprestimos, batch_size=5000)
+
+
+def usuario_gerente(client=None):
+    """ Cria um superusuário e, se um client for informado, faz o login com ele. """
+    usuario = User.objects.create_superuser('gerente_geral', 'gerente@exemplo.com', 'x')
+    if client is not None:
+        client.force_login(usuario)
+    return usuario
+
+
+#------------------------------------------------------------------
+# RETIRADA DE CHAVES
+#------------------------------------------------------------------
+class RegistrarRetiradaTests(TestCase):
+    def setUp(self):
+        self.local, (self.chave,), (self.pessoa,) = criar_dados_basicos()
+
+    def test_retirada_cria_emprestimo_e_reserva_chave(self):
+        emprestimo = registrar_retirada(self.chave.id, self.pessoa.id, timezone.now())
+        self.chave.refresh_from_db()
+        self.assertFalse(self.chave.disponivel)
+        self.assertEqual(self.chave.emprestimo_atual_id, emprestimo.id)
+        self.assertIsNone(emprestimo.data_devolucao)
+        self.assertEqual(emprestimo.chave_id, self.chave.id)
+
+    def test_quem_esta_com_a_chave_numa_consulta(self):
+        registrar_retirada(self.chave.id, self.pessoa.id, timezone.now())
+        with self.assertNumQueries(1):
+            chave = Chave.objects.select_related('emprestimo_atual__pessoa').get(pk=self.chave.pk)
+            self.assertEqual(chave.emprestimo_atual.pessoa, self.pessoa)
+
+    def test_banco_impede_dois_emprestimos_abertos_da_mesma_chave(self):
+        Emprestimo.objects.create(unidade=self.chave.unidade, chave=self.chave, pessoa=self.pessoa, data_retirada=timezone.now())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Emprestimo.objects.create(unidade=self.chave.unidade, chave=self.chave, pessoa=self.pessoa, data_retirada=timezone.now())
+        # Devolvidos não contam
+        Emprestimo.objects.create(unidade=self.chave.unidade, chave=self.chave, pessoa=self.pessoa, data_retirada=timezone.now() - timedelta(hours=2),
+                                  data_devolucao=timezone.now() - timedelta(hours=1))
+
+    def test_segunda_retirada_da_mesma_chave_falha(self):
+        registrar_retirada(self.chave.id, self.pessoa.id, timezone.now())
+        with self.assertRaises(ChaveIndisponivelError):
+            registrar_retirada(self.chave.id, self.pessoa.id, timezone.now())
+        self.assertEqual(Emprestimo.objects.count(), 1)
+
+    def test_chave_desativada_nao_pode_ser_retirada(self):
+        Chave.objects.filter(pk=self.chave.pk).update(ativa=False)
+        with self.assertRaises(ChaveIndisponivelError):
+            registrar_retirada(self.chave.id, self.pessoa.id, timezone.now())
+
+    def test_chave_inexistente(self):
+        with self.assertRaises(Chave.DoesNotExist):
+            registrar_retirada(999999, self.pessoa.id, timezone.now())
+
+    def test_retirada_no_futuro_e_recusada(self):
+        with self.assertRaises(RetiradaNoFuturoError):
+            registrar_retirada(self.chave.id, self.pessoa.id, timezone.now() + timedelta(hours=1))
+        self.assertIsNone(Chave.objects.get(pk=self.chave.pk).emprestimo_atual)
+        formulario = EmprestimoForm({
+            'chave': self.chave.id, 'pessoa': self.pessoa.id,
+            'data_retirada': timezone.localtime(timezone.now() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M'),
+        }, unidade=self.chave.unidade)
+        self.assertIn('data_retirada', formulario.errors)
+        # Um relógio um pouco adiantado ainda passa
+        registrar_retirada(self.chave.id, self.pessoa.id, timezone.now() + timedelta(minutes=2))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "A restrição de exclusão dos períodos só existe no PostgreSQL.")
+    def test_retirada_com_data_anterior_a_ultima_devolucao(self):
+        agora = timezone.now()
+        emprestimo = registrar_retirada(self.chave.id, self.pessoa.id, agora - timedelta(hours=3))
+        registrar_devolucoes([emprestimo.id], data_devolucao=agora - timedelta(hours=1))
+        with self.assertRaises(PeriodoOcupadoError):
+            registrar_retirada(self.chave.id, self.pessoa.id, agora - timedelta(hours=2))
+        self.assertIsNone(Chave.objects.get(pk=self.chave.pk).emprestimo_atual)
+        # Encostar na devolução anterior pode: o período não inclui o fim
+        registrar_retirada(self.chave.id, self.pessoa.id, agora - timedelta(hours=1))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "A restrição de exclusão dos períodos só existe no PostgreSQL.")
+    def test_migracao_dos_periodos_aponta_datas_invalidas(self):
+        migracao = import_module('claviculario_app.migrations.0016_emprestimo_periodo')
+        tabela = connection.ops.quote_name(Emprestimo._meta.db_table)
+        with connection.cursor() as cursor:
+            # O banco de antes da 0016, que aceitava qualquer data
+            cursor.execute(f"ALTER TABLE {tabela} DROP CONSTRAINT {migracao.NOME_EXCLUSAO}")
+            cursor.execute(f"DROP INDEX {migracao.NOME_INDICE}")
+        agora = timezone.now()
+        invertido = Emprestimo.objects.create(unidade=self.chave.unidade, chave=self.chave, pessoa=self.pessoa,
+                                              data_retirada=agora - timedelta(hours=1), data_devolucao=agora - timedelta(hours=2))
+        with self.assertRaisesMessage(RuntimeError, f"devolvidos antes da retirada (ids [{invertido.id}])"):
+            migracao.verificar_periodos(connection, tabela)
+
+        Emprestimo.objects.filter(pk=invertido.pk).update(data_devolucao=agora)
+        sobreposto = Emprestimo.objects.create(unidade=self.chave.unidade, chave=self.chave, pessoa=self.pessoa,
+                                               data_retirada=agora - timedelta(minutes=30), data_devolucao=agora)
+        with self.assertRaisesMessage(RuntimeError, f"[({invertido.id}, {sobreposto.id})]"):
+            migracao.verificar_periodos(connection, tabela)
+
+
+@unittest.skipIf(connection.vendor == 'sqlite', "SQLite não suporta escrita concorrente entre threads.")
+class RetiradaConcorrenteTests(TransactionTestCase):
+    NUM_MESAS = 8
+
+    def test_apenas_uma_mesa_consegue_retirar_a_chave(self):
+        _, (chave,), pessoas = criar_dados_basicos(num_pessoas=self.NUM_MESAS)
+        barreira = threading.Barrier(self.NUM_MESAS)
+        resultados = []
+
+        def retirar(pessoa):
+            try:
+                barreira.wait()
+                registrar_retirada(chave.id, pessoa.id, timezone.now())
+                resultados.append(True)
+            except ChaveIndisponivelError:
+                resultados.append(False)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=retirar, args=(p,)) for p in pessoas]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(resultados.count(True), 1)
+        self.assertEqual(resultados.count(False), self.NUM_MESAS - 1)
+        self.assertEqual(Emprestimo.objects.filter(chave=chave, data_devolucao__isnull=True).count(), 1)
+
+
+#------------------------------------------------------------------
+# DEVOLUÇÃO DE CHAVES
+#------------------------------------------------------------------
+class RegistrarDevolucoesTests(TestCase):
+    def setUp(self):
+        _, self.chaves, (self.pessoa, self.outra_pessoa) = criar_dados_basicos(num_chaves=5, num_pessoas=2)
+        agora = timezone.now()
+        self.emprestimos = [registrar_retirada(c.id, self.pessoa.id, agora) for c in self.chaves[:4]]
+        self.emprestimo_outra = registrar_retirada(self.chaves[4].id, self.outra_pessoa.id, agora)
+
+    def test_devolve_lista_de_emprestimos(self):
+        ids = [e.id for e in self.emprestimos[:3]]
+        resultados = registrar_devolucoes(emprestimo_ids=ids)
+        self.assertEqual(resultados, {i: DEVOLVIDO for i in ids})
+        self.assertEqual(Chave.objects.filter(emprestimo_atual__isnull=True).count(), 3)
+        self.assertEqual(set(Chave.objects.filter(emprestimo_atual__isnull=False).values_list('emprestimo_atual_id', flat=True)),
+                         {e.id for e in self.emprestimos[3:]} | {self.emprestimo_outra.id})
+        self.assertFalse(Emprestimo.objects.filter(id__in=ids, data_devolucao__isnull=True).exists())
+
+    def test_devolve_tudo_da_pessoa(self):
+        resultados = registrar_devolucoes(pessoa_id=self.pessoa.id)
+        self.assertEqual(set(resultados), {e.id for e in self.emprestimos})
+        self.emprestimo_outra.refresh_from_db()
+        self.assertIsNone(self.emprestimo_outra.data_devolucao)
+
+    def test_devolucao_anterior_a_retirada_fica_na_retirada(self):
+        # Uma retirada gravada com o relógio adiantado (ou antes da validação da data)
+        chave = Chave.objects.create(unidade=self.chaves[0].unidade, descricao="Sala adiantada", local=self.chaves[0].local)
+        retirada = timezone.now() + timedelta(days=1)
+        emprestimo = Emprestimo.objects.create(unidade=chave.unidade, chave=chave, pessoa=self.pessoa, data_retirada=retirada)
+        Chave.objects.filter(pk=chave.pk).update(emprestimo_atual=emprestimo)
+
+        agora = timezone.now()
+        resultados = registrar_devolucoes(emprestimo_ids=[emprestimo.id, self.emprestimos[0].id], data_devolucao=agora)
+        self.assertEqual(resultados, {emprestimo.id: DEVOLVIDO, self.emprestimos[0].id: DEVOLVIDO})
+        emprestimo.refresh_from_db()
+        self.assertEqual(emprestimo.data_devolucao, retirada)
+        self.assertEqual(Emprestimo.objects.get(pk=self.emprestimos[0].id).data_devolucao, agora)
+        self.assertIsNone(Chave.objects.get(pk=chave.pk).emprestimo_atual)
+        dia, hora = timezone.localtime(retirada).date(), timezone.localtime(retirada).hour
+        self.assertEqual(ResumoHorario.objects.get(chave=chave, dia=dia, hora=hora).devolucoes, 1)
+
+    def test_resultados_por_id(self):
+        registrar_devolucoes(emprestimo_ids=[self.emprestimos[0].id])
+        resultados = registrar_devolucoes(emprestimo_ids=[self.emprestimos[0].id, self.emprestimos[1].id, 999999])
+        self.assertEqual(resultados, {
+            self.emprestimos[0].id: JA_DEVOLVIDO,
+            self.emprestimos[1].id: DEVOLVIDO,
+            999999: NAO_ENCONTRADO,
+        })
+
+    def test_numero_de_consultas_nao_cresce_com_o_lote(self):
+        # 1 SELECT ... FOR UPDATE + 1 UPDATE nos empréstimos + 1 UPDATE nas chaves
+        # + 1 INSERT ... ON CONFLICT nos resumos (+ SAVEPOINT e RELEASE)
+        with self.assertNumQueries(6):
+            registrar_devolucoes(pessoa_id=self.pessoa.id)
+
+    def test_api_de_devolucao_em_lote(self):
+        usuario = User.objects.create_user('mesa', password='x')
+        unidade_de_teste().membros.add(usuario)
+        self.client.force_login(usuario)
+        ids = [self.emprestimos[0].id, self.emprestimos[1].id]
+        response = self.client.post(reverse('registrar_devolucoes_em_lote'), {'emprestimo_ids': ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['devolvidos'], 2)
+        self.assertEqual(response.json()['resultados'], {str(i): DEVOLVIDO for i in ids})
+
+
+#------------------------------------------------------------------
+# EVENTOS AO VIVO (SSE)
+#------------------------------------------------------------------
+async def _proximo(assinatura):
+    """ Próximo evento de verdade de uma assinatura (pula os sinais de vida). """
+    while (evento := await anext(assinatura)) is None:
+        pass
+    return evento
+
+
+class BackendEventosTests(TestCase):
+    async def test_reconexao_recebe_o_que_perdeu(self):
+        backend = eventos.MemoriaBackend()
+        primeiro = backend.distribuir(eventos.RETIRADA, {'chave_id': 1})
+        segundo = backend.distribuir(eventos.DEVOLUCAO, {'chave_id': 1})
+
+        assinatura = backend.assinar(ultimo_id=primeiro.id)
+        self.assertEqual(await _proximo(assinatura), segundo)
+        await assinatura.aclose()
+        self.assertEqual(backend.assinantes(), 0)
+
+        # Um id que o processo não conhece (outro worker, ou antigo demais): só recarregando
+        assinatura = backend.assinar(ultimo_id='outro-processo-7')
+        self.assertEqual((await _proximo(assinatura)).tipo, eventos.RECARREGAR)
+        await assinatura.aclose()
+
+    async def test_cliente_lento_recebe_recarregar(self):
+        backend = eventos.MemoriaBackend(tamanho_fila=2)
+        assinatura = backend.assinar()
+        espera = asyncio.ensure_future(_proximo(assinatura))
+        while not backend.assinantes():
+            await asyncio.sleep(0)
+        for chave_id in range(5):
+            backend.distribuir(eventos.RETIRADA, {'chave_id': chave_id})
+        # A rajada estourou a fila: o que sobrou foi só o pedido de recarga
+        self.assertEqual((await espera).tipo, eventos.RECARREGAR)
+        # E a assinatura continua valendo para os próximos eventos
+        espera = asyncio.ensure_future(_proximo(assinatura))
+        await asyncio.sleep(0)
+        backend.distribuir(eventos.RETIRADA, {'chave_id': 5})
+        self.assertEqual((await espera).dados, {'chave_id': 5})
+        await assinatura.aclose()
+
+    async def test_assinatura_so_recebe_a_propria_unidade(self):
+        backend = eventos.MemoriaBackend()
+        primeiro = backend.distribuir(eventos.RETIRADA, {'unidade_id': 1, 'chave_id': 1})
+        backend.distribuir(eventos.RETIRADA, {'unidade_id': 2, 'chave_id': 2})
+        terceiro = backend.distribuir(eventos.DEVOLUCAO, {'unidade_id': 1, 'chave_id': 1})
+        assinatura = backend.assinar(ultimo_id=primeiro.id, unidade_id=1)
+        self.assertEqual(await _proximo(assinatura), terceiro)
+        espera = asyncio.ensure_future(_proximo(assinatura))
+        await asyncio.sleep(0)
+        backend.distribuir(eventos.RETIRADA, {'unidade_id': 2, 'chave_id': 3})
+        backend.distribuir(eventos.RETIRADA, {'unidade_id': 1, 'chave_id': 4})
+        self.assertEqual((await espera).dados, {'unidade_id': 1, 'chave_id': 4})
+        await assinatura.aclose()
+
+    async def test_pulso_sem_eventos(self):
+        assinatura = eventos.MemoriaBackend().assinar(pulso=0.01)
+        self.assertIsNone(await anext(assinatura))
+        await assinatura.aclose()
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO, CLAVICULARIO_EVENTOS_BACKEND=eventos.BACKEND_PADRAO)
+class EventosTests(TestCase):
+    NUM_MESAS = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.local, cls.chaves, (cls.pessoa,) = criar_dados_basicos(num_chaves=2)
+        cls.usuario = User.objects.create_superuser('mesa', 'mesa@exemplo.com', 'x')
+
+    def setUp(self):
+        self.publicados = []
+        publicar = mock.patch.object(eventos.backend(), 'publicar', side_effect=lambda *evento: self.publicados.append(evento))
+        publicar.start()
+        self.addCleanup(publicar.stop)
+
+    def test_servicos_publicam_so_depois_da_confirmacao(self):
+        retirada = timezone.now()
+        with self.captureOnCommitCallbacks() as callbacks:
+            emprestimo = registrar_retirada(self.chaves[0].id, self.pessoa.id, retirada)
+        self.assertEqual(self.publicados, [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.publicados, [(eventos.RETIRADA, {
+            'unidade_id': self.local.unidade_id, 'emprestimo_id': emprestimo.id, 'chave_id': self.chaves[0].id, 'chave': 'Sala 0',
+            'local_id': self.local.id, 'local': 'Bloco A', 'pessoa_id': self.pessoa.id, 'pessoa': 'Pessoa 0',
+            'data_retirada': retirada.isoformat(), 'previsao_devolucao': None,
+        })])
+
+        self.publicados.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_devolucoes(emprestimo_ids=[emprestimo.id])
+        tipo, dados = self.publicados[0]
+        self.assertEqual(tipo, eventos.DEVOLUCAO)
+        self.assertEqual((dados['emprestimo_id'], dados['chave_id'], dados['local_id']), (emprestimo.id, self.chaves[0].id, self.local.id))
+
+    def test_desativar_chave_publica_evento(self):
+        self.client.force_login(self.usuario)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('chave_desativar', args=[self.chaves[1].id]))
+        self.assertEqual(self.publicados, [(eventos.CHAVE_DESATIVADA, {'unidade_id': self.local.unidade_id, 'chave_id': self.chaves[1].id,
+                                                                     'local_id': self.local.id})])
+
+    def test_atrasos_sao_anunciados_uma_vez(self):
+        agora = timezone.now()
+        vencido = registrar_retirada(self.chaves[0].id, self.pessoa.id, agora - timedelta(hours=2),
+                                     previsao_devolucao=agora - timedelta(minutes=1))
+        registrar_retirada(self.chaves[1].id, self.pessoa.id, agora, previsao_devolucao=agora + timedelta(hours=1))
+        anunciados = []
+
+        proximo = eventos.publicar_atrasos(agora - timedelta(minutes=5), agora, lambda *evento: anunciados.append(evento))
+        self.assertEqual([(tipo, dados['emprestimo_id']) for tipo, dados in anunciados], [(eventos.ATRASO, vencido.id)])
+        self.assertEqual(proximo, agora + timedelta(hours=1))
+
+        anunciados.clear()
+        eventos.publicar_atrasos(agora, agora + timedelta(minutes=5), lambda *evento: anunciados.append(evento))
+        self.assertEqual(anunciados, [])
+
+    def test_sob_wsgi_responde_204(self):
+        self.assertEqual(self.client.get(reverse('eventos_stream')).status_code, 302)
+        self.client.force_login(self.usuario)
+        self.assertEqual(self.client.get(reverse('eventos_stream')).status_code, 204)
+
+    @mock.patch.object(eventos, 'iniciar_vigia_de_atrasos')
+    async def test_um_evento_chega_a_todas_as_mesas_sem_consultas(self, _vigia):
+        backend = eventos.backend()
+        fluxos = []
+        for _ in range(self.NUM_MESAS):
+            client = AsyncClient()
+            await client.aforce_login(self.usuario)
+            response = await client.get(reverse('eventos_stream'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            conteudo = aiter(response.streaming_content)
+            self.assertTrue((await anext(conteudo)).startswith(b'retry:'))
+            fluxos.append(conteudo)
+
+        # Cada conexão fica esperando o próximo evento na fila do backend
+        esperas = [asyncio.ensure_future(anext(conteudo)) for conteudo in fluxos]
+        while backend.assinantes() < self.NUM_MESAS:
+            await asyncio.sleep(0.01)
+
+        # O acesso ao banco vindo do código assíncrono passa pela thread principal (sync_to_async)
+        consultas = CaptureQueriesContext(connection)
+        await sync_to_async(consultas.__enter__)()
+        evento = backend.distribuir(eventos.RETIRADA, {'chave_id': self.chaves[0].id, 'chave': 'Sala 0'})
+        recebidos = await asyncio.wait_for(asyncio.gather(*esperas), timeout=5)
+        await sync_to_async(consultas.__exit__)(None, None, None)
+        self.assertEqual(len(consultas), 0)
+        self.assertEqual(recebidos, [evento.texto.encode()] * self.NUM_MESAS)
+        self.assertIn(b'event: retirada\n', recebidos[0])
+        for conteudo in fluxos:
+            await conteudo.aclose()
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "LISTEN/NOTIFY só existe no PostgreSQL.")
+class PostgresBackendTests(TransactionTestCase):
+    async def test_evento_publicado_chega_pelo_listen(self):
+        backend = eventos.PostgresBackend()
+        backend.INTERVALO = 0.2
+        assinatura = backend.assinar(pulso=0.1)
+        espera = asyncio.ensure_future(_proximo(assinatura))
+        while not backend.assinantes():
+            await asyncio.sleep(0.01)
+        # O LISTEN acontece na thread do ouvinte: publica até ele estar escutando
+        while not espera.done():
+            await sync_to_async(backend.publicar)(eventos.CHAVE_DESATIVADA, {'chave_id': 3})
+            await asyncio.wait([espera], timeout=0.2)
+        self.assertEqual(espera.result().dados, {'chave_id': 3})
+
+        await assinatura.aclose()
+        await sync_to_async(backend._ouvinte.join)(timeout=10)
+        self.assertFalse(backend._ouvinte.is_alive())
+        await sync_to_async(connections.close_all)()
+
+
+#------------------------------------------------------------------
+# APIS ASSÍNCRONAS (ASGI)
+#------------------------------------------------------------------
+class UrlsApisAssincronas:
+    """ As APIs JSON das mesas nas versões assíncronas, como ficam com CLAVICULARIO_APIS_ASSINCRONAS. """
+    urlpatterns = [
+        path('api/pessoas/', views.filtrar_pessoas_async, name='filtrar_pessoas'),
+        path('api/chaves/', views.filtrar_chaves_por_local_async, name='filtrar_chaves_por_local'),
+        path('api/analytics-data/', views.analytics_data_async, name='analytics_data'),
+        path('retirada/verificar/', views.verificar_pin_e_registrar_async, name='verificar_pin_e_registrar'),
+    ]
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+class ApisAssincronasTests(TestCase):
+    """ As versões assíncronas respondem exatamente o mesmo que as síncronas, com as mesmas consultas. """
+    @classmethod
+    def setUpTestData(cls):
+        cls.local, cls.chaves, cls.pessoas = criar_dados_basicos(num_chaves=4, num_pessoas=3)
+        criar_historico(50, cls.chaves, cls.pessoas, inicio=timezone.now() - timedelta(days=5))
+        resumo.reconstruir()
+
+    def setUp(self):
+        self.usuario = usuario_gerente(self.client)
+
+    def _comparar(self, nome, parametros):
+        with CaptureQueriesContext(connection) as sincronas:
+            esperado = self.client.get(reverse(nome), parametros)
+        with override_settings(ROOT_URLCONF=UrlsApisAssincronas), CaptureQueriesContext(connection) as assincronas:
+            obtido = self.client.get(reverse(nome), parametros)
+        self.assertEqual((obtido.status_code, obtido.json()), (esperado.status_code, esperado.json()))
+        self.assertEqual(len(assincronas), len(sincronas))
+        return obtido.json()
+
+    def test_mesmas_respostas(self):
+        self.assertEqual(len(self._comparar('filtrar_pessoas', {'q': 'pessoa', 'limite': 2})['results']), 2)
+        self._comparar('filtrar_pessoas', {'page': 'x'})
+        self.assertEqual(len(self._comparar('filtrar_chaves_por_local', {'local_id': self.local.id})['results']), 4)
+        for group_by in ('day', 'time_of_day_avg', 'weekday', 'monthday_avg', 'desconhecido'):
+            self._comparar('analytics_data', {'group_by': group_by})
+        with self.assertLogs('claviculario_app.views', 'ERROR'):
+            self.assertEqual(self._comparar('analytics_data', {'start_date': 'ontem'}),
+                             {'error': "Erro no servidor ao montar os gráficos."})
+
+    # Depois do histórico: a chave não pode ter estado com duas pessoas ao mesmo tempo
+    AGORA = timezone.localtime().replace(second=0, microsecond=0)
+
+    def _retirar(self, **dados):
+        parametros = {'chave_id': self.chaves[0].id, 'pessoa_id': self.pessoas[0].id, 'pin': '1234',
+                      'data_retirada': self.AGORA.strftime('%Y-%m-%dT%H:%M'), **dados}
+        with override_settings(ROOT_URLCONF=UrlsApisAssincronas):
+            return self.client.post(reverse('verificar_pin_e_registrar'), parametros).json()
+
+    def test_retirada_com_pin(self):
+        self.assertEqual(self._retirar(pin='0000'), {'success': False, 'message': 'PIN incorreto!'})
+        self.assertEqual(self._retirar(pessoa_id=999999)['message'], 'Pessoa não encontrada.')
+        self.assertFalse(Emprestimo.objects.filter(data_devolucao__isnull=True).exists())
+
+        self.assertTrue(self._retirar()['success'])
+        emprestimo = Emprestimo.objects.get(data_devolucao__isnull=True)
+        self.assertEqual((emprestimo.chave_id, emprestimo.data_retirada), (self.chaves[0].id, self.AGORA))
+        self.assertIn('retirada por outra pessoa', self._retirar()['message'])
+
+    async def test_sob_o_cliente_asgi(self):
+        client = AsyncClient()
+        await client.aforce_login(self.usuario)
+        with override_settings(ROOT_URLCONF=UrlsApisAssincronas):
+            response = await client.get(reverse('filtrar_chaves_por_local'), {'local_id': self.local.id})
+        self.assertEqual([r['id'] for r in response.json()['results']], [chave.id for chave in self.chaves])
+
+
+#------------------------------------------------------------------
+# CONFERÊNCIA DO PIN
+#------------------------------------------------------------------
+# O hasher dos PINs com poucas iterações, mais o MD5 fazendo o papel de um hasher antigo
+HASHERS_PIN = ['claviculario_app.hashers.PBKDF2PinHasher'] + HASHER_RAPIDO
+
+
+@override_settings(PASSWORD_HASHERS=HASHERS_PIN, CLAVICULARIO_PIN_ITERACOES=1000,
+                   CLAVICULARIO_PIN_TENTATIVAS=5, CLAVICULARIO_PIN_TENTATIVAS_IP=30, CLAVICULARIO_PIN_BLOQUEIO_SEGUNDOS=900)
+class VerificarPinTests(TestCase):
+    IP = '10.0.0.1'
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.local, (self.chave,), self.pessoas = criar_dados_basicos(num_pessoas=3)
+        self.pessoa = self.pessoas[0]
+
+    def _errar(self, vezes, pessoa=None, ip=IP):
+        for _ in range(vezes):
+            self.assertFalse(verificar_pin(pessoa or self.pessoa, '0000', ip))
+
+    def test_pin_novo_usa_o_hasher_dos_pins(self):
+        self.assertTrue(self.pessoa.pin.startswith('pbkdf2_pin$1000$'))
+        self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+
+    def test_bloqueio_por_pessoa_dispensa_o_hash(self):
+        self._errar(5)
+        with mock.patch.object(pin, '_conferir') as conferir:
+            with self.assertRaises(PinBloqueadoError) as contexto:
+                verificar_pin(self.pessoa, '1234', self.IP)
+        conferir.assert_not_called()
+        self.assertEqual(contexto.exception.segundos, 900)
+        # Outra pessoa na mesma mesa continua conseguindo, e de outra mesa também não passa
+        self.assertTrue(verificar_pin(self.pessoas[1], '1234', self.IP))
+        with self.assertRaises(PinBloqueadoError):
+            verificar_pin(self.pessoa, '1234', '10.0.0.2')
+
+    def test_acerto_zera_os_erros_da_pessoa(self):
+        self._errar(4)
+        self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+        self._errar(4)
+        self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+
+    @override_settings(CLAVICULARIO_PIN_TENTATIVAS_IP=4)
+    def test_bloqueio_por_ip(self):
+        self._errar(2, self.pessoas[0])
+        self._errar(2, self.pessoas[1])
+        with self.assertRaises(PinBloqueadoError):
+            verificar_pin(self.pessoas[2], '1234', self.IP)
+        self.assertTrue(verificar_pin(self.pessoas[2], '1234', '10.0.0.2'))
+        # O acerto de uma pessoa não libera o endereço
+        with self.assertRaises(PinBloqueadoError):
+            verificar_pin(self.pessoas[2], '1234', self.IP)
+
+    @override_settings(CLAVICULARIO_PIN_TENTATIVAS_IP=None)
+    def test_pessoas_no_mesmo_ip_sem_contador_por_ip(self):
+        # Atrás de um proxy ou NAT, todos chegam com o mesmo endereço: os erros
+        # de uma pessoa não podem travar as retiradas das outras
+        self._errar(5, self.pessoas[0])
+        self._errar(4, self.pessoas[1])
+        with self.assertRaises(PinBloqueadoError):
+            verificar_pin(self.pessoas[0], '1234', self.IP)
+        for _ in range(10):
+            self.assertTrue(verificar_pin(self.pessoas[1], '1234', self.IP))
+            self._errar(4, self.pessoas[1])
+        self.assertTrue(verificar_pin(self.pessoas[2], '1234', self.IP))
+
+    def test_ip_do_cliente(self):
+        requisicao = RequestFactory().get('/', REMOTE_ADDR='10.9.9.9', HTTP_X_FORWARDED_FOR='1.1.1.1, 200.1.1.1, 10.0.0.5')
+        self.assertEqual(pin.ip_do_cliente(requisicao), '10.9.9.9')
+        with override_settings(CLAVICULARIO_PIN_IP_CABECALHO='HTTP_X_FORWARDED_FOR'):
+            # Um proxy nosso: o endereço que ele anotou, não o que o cliente mandou
+            self.assertEqual(pin.ip_do_cliente(requisicao), '10.0.0.5')
+            with override_settings(CLAVICULARIO_PIN_PROXIES_CONFIAVEIS=2):
+                self.assertEqual(pin.ip_do_cliente(requisicao), '200.1.1.1')
+            self.assertIsNone(pin.ip_do_cliente(RequestFactory().get('/', REMOTE_ADDR='10.9.9.9')))
+
+    @override_settings(CLAVICULARIO_PIN_BLOQUEIO_SEGUNDOS=1)
+    def test_bloqueio_expira(self):
+        self._errar(5)
+        with self.assertRaises(PinBloqueadoError):
+            verificar_pin(self.pessoa, '1234', self.IP)
+        time.sleep(1.1)
+        self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+
+    def test_pin_antigo_refeito_no_acerto(self):
+        Pessoa.objects.filter(pk=self.pessoa.pk).update(pin=make_password('1234', hasher='md5'))
+        self.pessoa.refresh_from_db()
+        self._errar(1)
+        self.assertTrue(Pessoa.objects.get(pk=self.pessoa.pk).pin.startswith('md5$'))
+
+        self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+        self.assertTrue(Pessoa.objects.get(pk=self.pessoa.pk).pin.startswith('pbkdf2_pin$1000$'))
+        # Mudar as iterações também refaz o PIN no próximo acerto
+        with override_settings(CLAVICULARIO_PIN_ITERACOES=2000):
+            self.assertTrue(verificar_pin(self.pessoa, '1234', self.IP))
+        self.assertTrue(Pessoa.objects.get(pk=self.pessoa.pk).pin.startswith('pbkdf2_pin$2000$'))
+
+    def test_hasher_dos_pins_fora_de_password_hashers(self):
+        with override_settings(PASSWORD_HASHERS=HASHER_RAPIDO):
+            pessoa = Pessoa(unidade=self.pessoa.unidade, nome="Pessoa nova", cpf_saran="99999999999")
+            pessoa.set_pin('4321')
+            self.assertTrue(pessoa.pin.startswith('md5$'))
+            self.assertTrue(pessoa.check_pin('4321'))
+
+    async def test_versao_assincrona(self):
+        for _ in range(5):
+            self.assertFalse(await verificar_pin_async(self.pessoa, '0000', self.IP))
+        with self.assertRaises(PinBloqueadoError):
+            await verificar_pin_async(self.pessoa, '1234', self.IP)
+        self.assertTrue(await verificar_pin_async(self.pessoas[1], '1234', self.IP))
+
+    def test_views_respondem_429(self):
+        usuario_gerente(self.client)
+        parametros = {'chave_id': self.chave.id, 'pessoa_id': self.pessoa.id, 'pin': '0000',
+                      'data_retirada': '2026-03-02T08:00'}
+        for _ in range(5):
+            self.assertEqual(self.client.post(reverse('verificar_pin_e_registrar'), parametros).json()['message'], 'PIN incorreto!')
+        for urlconf in ('config.urls', UrlsApisAssincronas):
+            with override_settings(ROOT_URLCONF=urlconf):
+                response = self.client.post(reverse('verificar_pin_e_registrar'), {**parametros, 'pin': '1234'})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '900')
+            self.assertEqual(response.json(), {
+                'success': False, 'message': 'Muitas tentativas com PIN incorreto. Tente novamente em até 15 minutos.',
+            })
+        self.assertFalse(Emprestimo.objects.exists())
+
+
+#------------------------------------------------------------------
+# IMPORTAÇÃO DE PLANILHAS
+#------------------------------------------------------------------
+def planilha_pessoas(num_linhas, inicio=0):
+    return pd.DataFrame({
+        'nome_completo': [f"Pessoa {i}" for i in range(inicio, inicio + num_linhas)],
+        'empresa': ['FAB' if i % 2 else None for i in range(inicio, inicio + num_linhas)],
+        'cpf_saran': [f"{i:011d}" for i in range(inicio, inicio + num_linhas)],
+        'pin': [f"{i % 10000:04d}" for i in range(inicio, inicio + num_linhas)],
+    })
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+class ImportarPessoasTests(TestCase):
+    def setUp(self):
+        self.unidade = unidade_de_teste()
+
+    def test_cria_pessoas_novas(self):
+        resultado = importacao.importar_pessoas(planilha_pessoas(10), self.unidade)
+        self.assertEqual(resultado, {'criados': 10, 'ignorados': 0, 'conflitos': []})
+        pessoa = Pessoa.objects.get(cpf_saran='00000000003')
+        self.assertTrue(pessoa.check_pin('0003'))
+        self.assertEqual(pessoa.empresa, 'FAB')
+        self.assertIsNone(Pessoa.objects.get(cpf_saran='00000000002').empresa)
+
+    def test_existentes_sao_ignoradas_e_conflitos_reportados(self):
+        Pessoa.objects.create(unidade=self.unidade, nome="Pessoa 1", cpf_saran='00000000001', pin='x')
+        Pessoa.objects.create(unidade=self.unidade, nome="Outro Nome", cpf_saran='00000000002', pin='x')
+        resultado = importacao.importar_pessoas(planilha_pessoas(5), self.unidade)
+        self.assertEqual(resultado['criados'], 3)
+        self.assertEqual(resultado['ignorados'], 2)
+        self.assertEqual(len(resultado['conflitos']), 1)
+        self.assertIn('Outro Nome', resultado['conflitos'][0])
+        self.assertEqual(Pessoa.objects.get(cpf_saran='00000000002').nome, "Outro Nome")
+
+    def test_linhas_vazias_e_repetidas(self):
+        df = pd.concat([planilha_pessoas(3), planilha_pessoas(1)], ignore_index=True)
+        df.loc[len(df)] = [None, None, '00000000099', '1234']
+        resultado = importacao.importar_pessoas(df, self.unidade)
+        self.assertEqual(resultado, {'criados': 3, 'ignorados': 1, 'conflitos': []})
+
+    def test_pessoa_cadastrada_durante_a_importacao_vira_conflito(self):
+        def cadastrar_no_meio(feitas):
+            if feitas == 0:
+                Pessoa.objects.create(unidade=self.unidade, nome="Pessoa 2", cpf_saran='00000000002', pin='x')
+        resultado = importacao.importar_pessoas(planilha_pessoas(4), self.unidade, tamanho_lote=2,
+                                                progresso=cadastrar_no_meio)
+        self.assertEqual(resultado, {
+            'criados': 3, 'ignorados': 1,
+            'conflitos': ["CPF/SARAN 00000000002: cadastrado durante a importação. Nenhum dado foi alterado."],
+        })
+        self.assertEqual(Pessoa.objects.count(), 4)
+        self.assertEqual(Pessoa.objects.get(cpf_saran='00000000002').pin, 'x')
+
+    def test_numero_de_consultas_independe_do_tamanho(self):
+        # 1 SELECT dos CPFs existentes + 3 lotes de 100 linhas, cada um na sua
+        # transação (aqui, SAVEPOINT, INSERT e RELEASE)
+        with self.assertNumQueries(10):
+            importacao.importar_pessoas(planilha_pessoas(250), self.unidade, tamanho_lote=100)
+
+    @mock.patch.object(importacao, 'MINIMO_PARA_POOL', 1)
+    def test_hashes_em_paralelo(self):
+        hashes = importacao.gerar_hashes_pins(['1111', '2222', '3333'], workers=2)
+        # Os processos começam do zero ('spawn'): usam as configurações do
+        # projeto, não as alteradas por este teste
+        with self.settings(PASSWORD_HASHERS=HASHERS_PIN):
+            self.assertTrue(check_password('1111', hashes[0]))
+            self.assertTrue(check_password('3333', hashes[2]))
+
+
+def planilha_chaves(num_chaves, num_locais=30):
+    return pd.DataFrame({
+        'descricao_chave': [f"Sala {i}" for i in range(num_chaves)],
+        'nome_local': [f"Bloco {i % num_locais}" for i in range(num_chaves)],
+    })
+
+
+class ImportarChavesTests(TestCase):
+    def setUp(self):
+        self.unidade = unidade_de_teste()
+
+    def test_cria_chaves_e_locais(self):
+        Local.objects.create(unidade=self.unidade, nome="Bloco 0")
+        resultado = importacao.importar_chaves(planilha_chaves(10, num_locais=3), self.unidade)
+        self.assertEqual(resultado, {'criados': 10, 'ignorados': 0, 'conflitos': []})
+        self.assertEqual(Local.objects.count(), 3)
+        self.assertEqual(Chave.objects.get(descricao="Sala 4").local.nome, "Bloco 1")
+
+    def test_reporta_linhas_ignoradas(self):
+        local = Local.objects.create(unidade=self.unidade, nome="Bloco 0")
+        Chave.objects.create(unidade=self.unidade, descricao="Sala 1", local=local)
+        df = pd.concat([planilha_chaves(3), planilha_chaves(1)], ignore_index=True)
+        df.loc[len(df)] = ['', 'Bloco 9']
+        resultado = importacao.importar_chaves(df, self.unidade)
+        self.assertEqual(resultado['criados'], 2)
+        self.assertEqual(resultado['ignorados'], 2)
+        self.assertEqual(resultado['conflitos'], [
+            "Linha 3: a chave 'Sala 1' já está cadastrada.",
+            "Linha 5: a chave 'Sala 0' aparece mais de uma vez na planilha.",
+        ])
+
+    def test_chave_cadastrada_durante_a_importacao_vira_conflito(self):
+        def cadastrar_no_meio(feitas):
+            if feitas == 2:
+                local = Local.objects.get(nome="Bloco 0")
+                Chave.objects.create(unidade=self.unidade, descricao="Sala 3", local=local)
+        resultado = importacao.importar_chaves(planilha_chaves(4, num_locais=1), self.unidade, tamanho_lote=2,
+                                               progresso=cadastrar_no_meio)
+        self.assertEqual(resultado, {
+            'criados': 3, 'ignorados': 1,
+            'conflitos': ["Linha 5: a chave 'Sala 3' foi cadastrada durante a importação."],
+        })
+        self.assertEqual(Chave.objects.count(), 4)
+
+    def test_numero_de_consultas_independe_do_tamanho(self):
+        # Descrições + locais + INSERT e SELECT dos locais novos + cada lote de
+        # 1000 chaves na sua transação (aqui, SAVEPOINT e RELEASE). Quantos
+        # INSERTs cabem num lote depende do banco: o SQLite limita os
+        # parâmetros de cada comando, o PostgreSQL grava o lote de uma vez.
+        campos = [campo for campo in Chave._meta.concrete_fields if not campo.primary_key]
+        inserts_por_lote = -(-1000 // connection.ops.bulk_batch_size(campos, [None] * 1000))
+        for num_chaves, unidade in ((2000, self.unidade), (4000, unidade_de_teste("Outra unidade"))):
+            with self.subTest(num_chaves=num_chaves), self.assertNumQueries(4 + num_chaves // 1000 * (2 + inserts_por_lote)):
+                importacao.importar_chaves(planilha_chaves(num_chaves), unidade, tamanho_lote=1000)
+
+
+def arquivo_excel(df, nome='planilha.xlsx'):
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    return SimpleUploadedFile(nome, buffer.getvalue())
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO, CLAVICULARIO_IMPORTACAO_EM_THREAD=False)
+class ImportacaoJobTests(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user('gerente', password='x')
+        unidade_de_teste().membros.add(self.usuario)
+        self.usuario.user_permissions.add(*Permission.objects.filter(codename__in=['add_pessoa', 'add_chave']))
+        self.client.force_login(self.usuario)
+
+    def test_upload_enfileira_e_worker_processa(self):
+        response = self.client.post(reverse('importar_pessoas'), {'arquivo_excel': arquivo_excel(planilha_pessoas(20))})
+        self.assertRedirects(response, reverse('importar_dados_page'))
+        job = ImportacaoJob.objects.get()
+        self.assertEqual(job.status, ImportacaoJob.STATUS_PENDENTE)
+        self.assertEqual(Pessoa.objects.count(), 0)
+
+        self.assertEqual(tarefas.processar_pendentes(), 1)
+        status = self.client.get(reverse('importacao_status', args=[job.id])).json()
+        self.assertEqual(status['status'], ImportacaoJob.STATUS_CONCLUIDA)
+        self.assertEqual((status['total_linhas'], status['linhas_processadas'], status['criados']), (20, 20, 20))
+        self.assertEqual(Pessoa.objects.count(), 20)
+
+    def test_job_nao_e_processado_duas_vezes(self):
+        self.client.post(reverse('importar_chaves'), {'arquivo_excel': arquivo_excel(pd.DataFrame({
+            'descricao_chave': ['Sala 1', 'Sala 2'], 'nome_local': ['Bloco A', 'Bloco B'],
+        }))})
+        job = ImportacaoJob.objects.get()
+        self.assertTrue(tarefas.executar_importacao(job.id))
+        self.assertFalse(tarefas.executar_importacao(job.id))
+        self.assertEqual(Chave.objects.count(), 2)
+
+    def test_planilha_sem_colunas_gera_erro(self):
+        self.client.post(reverse('importar_pessoas'), {'arquivo_excel': arquivo_excel(pd.DataFrame({'x': [1]}))})
+        tarefas.processar_pendentes()
+        job = ImportacaoJob.objects.get()
+        self.assertEqual(job.status, ImportacaoJob.STATUS_ERRO)
+        self.assertIn('colunas necessárias', job.erros)
+
+    def test_arquivo_invalido_nao_cria_job(self):
+        self.client.post(reverse('importar_pessoas'), {'arquivo_excel': SimpleUploadedFile('dados.csv', b'a,b')})
+        self.assertFalse(ImportacaoJob.objects.exists())
+
+    def test_job_parado_em_processando_vira_erro(self):
+        self.client.post(reverse('importar_chaves'), {'arquivo_excel': arquivo_excel(planilha_chaves(2))})
+        job = ImportacaoJob.objects.get()
+        antigo = timezone.now() - timedelta(hours=1)
+        ImportacaoJob.objects.filter(pk=job.pk).update(status=ImportacaoJob.STATUS_PROCESSANDO,
+                                                       iniciado_em=antigo, atualizado_em=antigo)
+        status = self.client.get(reverse('importacao_status', args=[job.id])).json()
+        self.assertEqual(status['status'], ImportacaoJob.STATUS_ERRO)
+        self.assertIn('interrompida', status['erro'])
+
+    def test_job_com_progresso_recente_continua_processando(self):
+        self.client.post(reverse('importar_chaves'), {'arquivo_excel': arquivo_excel(planilha_chaves(2))})
+        job = ImportacaoJob.objects.get()
+        ImportacaoJob.objects.filter(pk=job.pk).update(status=ImportacaoJob.STATUS_PROCESSANDO,
+                                                       iniciado_em=timezone.now() - timedelta(hours=1),
+                                                       atualizado_em=timezone.now())
+        self.assertEqual(tarefas.processar_pendentes(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportacaoJob.STATUS_PROCESSANDO)
+
+        with override_settings(CLAVICULARIO_IMPORTACAO_SEM_PROGRESSO_SEGUNDOS=0):
+            tarefas.processar_pendentes()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportacaoJob.STATUS_ERRO)
+
+
+# TransactionTestCase: o espelho 'reporting' é outra conexão e só vê o que foi confirmado
+@unittest.skipUnless('reporting' in connections, "Configure o banco 'reporting' (ver config/settings.py).")
+class ProgressoDaImportacaoTests(TransactionTestCase):
+    databases = {'default', 'reporting'}
+
+    def test_progresso_e_chaves_ficam_visiveis_a_cada_lote(self):
+        unidade = unidade_de_teste()
+        vistas = []
+        importacao.importar_chaves(planilha_chaves(4), unidade, tamanho_lote=2,
+                                   progresso=lambda feitas: vistas.append(Chave.objects.using('reporting').count()))
+        self.assertEqual(vistas, [2, 4])
+
+
+#------------------------------------------------------------------
+# EXPORTAÇÕES
+#------------------------------------------------------------------
+class ExportarCsvTests(TestCase):
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=3, num_pessoas=2)
+        usuario_gerente(self.client)
+
+    def _baixar(self, **filtros):
+        response = self.client.get(reverse('exportar_relatorio_csv'), filtros)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_conteudo_do_csv(self):
+        criar_historico(5, self.chaves, self.pessoas)
+        registrar_retirada(self.chaves[0].id, self.pessoas[0].id, timezone.now())
+        linhas = self._baixar().splitlines()
+        self.assertEqual(linhas[0], 'Chave,Responsável,CPF/SARAN,Data Retirada,Data Devolução,Observação')
+        self.assertEqual(len(linhas), 7)
+        self.assertTrue(linhas[1].startswith('Sala 0,Pessoa 0,00000000000,'))
+        self.assertIn('Pendente', linhas[1])
+
+    def test_filtros_sao_aplicados(self):
+        criar_historico(6, self.chaves, self.pessoas)
+        linhas = self._baixar(chave=self.chaves[1].id).splitlines()
+        self.assertEqual(len(linhas), 3)
+
+    @mock.patch.object(views, 'TAMANHO_LOTE_EXPORTACAO', 200)
+    def test_memoria_nao_cresce_com_o_numero_de_linhas(self):
+        picos = {}
+        for total in (1000, 8000):
+            Emprestimo.objects.all().delete()
+            criar_historico(total, self.chaves, self.pessoas)
+            response = self.client.get(reverse('exportar_relatorio_csv'))
+            tracemalloc.start()
+            tamanho = sum(len(parte) for parte in response.streaming_content)
+            picos[total] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertGreater(tamanho, total * 40)
+        # Oito vezes mais linhas, praticamente o mesmo pico de memória
+        self.assertLess(picos[8000], picos[1000] * 1.5)
+
+
+class ExportarExcelTests(TestCase):
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=2, num_pessoas=2)
+        usuario_gerente(self.client)
+
+    @mock.patch.object(views, 'TAMANHO_LOTE_EXPORTACAO', 3)
+    def test_conteudo_da_planilha(self):
+        emprestimos = criar_historico(7, self.chaves, self.pessoas)
+        registrar_retirada(self.chaves[0].id, self.pessoas[0].id, timezone.now(), observacao="Urgente")
+
+        response = self.client.get(reverse('exportar_relatorio_excel'))
+        self.assertIn('relatorio_claviculario.xlsx', response['Content-Disposition'])
+        ws = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        linhas = list(ws.values)
+
+        self.assertEqual(list(linhas[0]), views.CABECALHO_EXPORTACAO)
+        self.assertEqual(len(linhas), 9)
+        self.assertEqual(linhas[1][4], 'Pendente')
+        self.assertEqual(linhas[1][5], 'Urgente')
+        # Datas no horário local, sem fuso
+        mais_antigo = emprestimos[0]
+        um_segundo = timedelta(seconds=1)
+        self.assertAlmostEqual(linhas[-1][3], timezone.localtime(mais_antigo.data_retirada).replace(tzinfo=None), delta=um_segundo)
+        self.assertAlmostEqual(linhas[-1][4], timezone.localtime(mais_antigo.data_devolucao).replace(tzinfo=None), delta=um_segundo)
+
+
+#------------------------------------------------------------------
+# PÁGINA INICIAL (DASHBOARD)
+#------------------------------------------------------------------
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.local, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=4, num_pessoas=2)
+        usuario_gerente(self.client)
+        agora = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_retirada(self.chaves[0].id, self.pessoas[0].id, agora - timedelta(hours=3), previsao_devolucao=agora - timedelta(hours=1))
+            registrar_retirada(self.chaves[1].id, self.pessoas[1].id, agora, previsao_devolucao=agora + timedelta(hours=2))
+
+    def _contexto(self):
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_contadores_e_listas(self):
+        contexto = self._contexto()
+        self.assertEqual(contexto['total_chaves'], 4)
+        self.assertEqual(contexto['chaves_emprestadas_count'], 2)
+        self.assertEqual(contexto['chaves_disponiveis'], 2)
+        self.assertEqual(contexto['chaves_atrasadas_count'], 1)
+        self.assertEqual([e.chave_id for e in contexto['emprestimos_atrasados']], [self.chaves[0].id])
+        self.assertEqual(len(contexto['ultimas_atividades']), 2)
+
+    def test_orcamento_de_consultas(self):
+        # sessão + usuário + unidade + total de chaves + contagens dos empréstimos + atrasados + últimas atividades
+        with self.assertNumQueries(7):
+            self._contexto()
+        # Com o cache preenchido, só a sessão, o usuário e a unidade
+        with self.assertNumQueries(3):
+            self._contexto()
+
+    def test_retirada_e_devolucao_invalidam_o_cache(self):
+        self._contexto()
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_retirada(self.chaves[2].id, self.pessoas[0].id, timezone.now())
+        self.assertEqual(self._contexto()['chaves_emprestadas_count'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_devolucoes(pessoa_id=self.pessoas[0].id)
+        contexto = self._contexto()
+        self.assertEqual(contexto['chaves_emprestadas_count'], 1)
+        self.assertEqual(contexto['chaves_atrasadas_count'], 0)
+
+    def test_cadastro_e_desativacao_de_chave_invalidam_o_cache(self):
+        self._contexto()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('chave_create'), {'descricao': "Sala nova", 'local': self.local.id})
+        self.assertEqual(self._contexto()['total_chaves'], 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('chave_desativar', args=[self.chaves[3].id]))
+        self.assertIsNone(cache.get(painel._chave_cache(self.local.unidade_id)))
+
+    def test_cache_expira_quando_um_emprestimo_vence(self):
+        with mock.patch.object(painel.cache, 'set', wraps=painel.cache.set) as cache_set:
+            self._contexto()
+        tempo = cache_set.call_args.args[2]
+        # O empréstimo da chave 1 vence em 2h, depois do tempo máximo do cache
+        self.assertEqual(tempo, 30)
+
+        agora = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_retirada(self.chaves[2].id, self.pessoas[0].id, agora, previsao_devolucao=agora + timedelta(seconds=10))
+        with mock.patch.object(painel.cache, 'set', wraps=painel.cache.set) as cache_set:
+            self._contexto()
+        self.assertLessEqual(cache_set.call_args.args[2], 10)
+
+
+#------------------------------------------------------------------
+# UNIDADES
+#------------------------------------------------------------------
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+class UnidadesTests(TestCase):
+    """ Cada unidade só enxerga o próprio cadastro e o próprio histórico. """
+    @classmethod
+    def setUpTestData(cls):
+        cls.base = unidade_de_teste("Base Norte")
+        cls.outra = unidade_de_teste("Base Sul")
+        # Os mesmos nomes, descrições e CPFs nas duas unidades
+        cls.local, cls.chaves, (cls.pessoa,) = criar_dados_basicos(num_chaves=2, unidade=cls.base)
+        cls.local_outra, cls.chaves_outra, (cls.pessoa_outra,) = criar_dados_basicos(num_chaves=2, unidade=cls.outra)
+        cls.usuario = User.objects.create_user('mesa', password='x')
+        cls.usuario.user_permissions.set(Permission.objects.filter(content_type__app_label='claviculario_app'))
+        cls.base.membros.add(cls.usuario)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.usuario)
+
+    def _trocar(self, unidade):
+        return self.client.post(reverse('selecionar_unidade'), {'unidade': unidade.pk})
+
+    def test_listas_so_mostram_a_unidade(self):
+        response = self.client.get(reverse('chave_list'))
+        self.assertEqual({chave.id for chave in response.context['object_list']}, {chave.id for chave in self.chaves})
+        response = self.client.get(reverse('pessoa_list'))
+        self.assertEqual([pessoa.id for pessoa in response.context['object_list']], [self.pessoa.id])
+        resultados = self.client.get(reverse('filtrar_pessoas'), {'q': "Pessoa"}).json()['results']
+        self.assertEqual([resultado['id'] for resultado in resultados], [self.pessoa.id])
+
+    def test_objetos_de_outra_unidade_nao_existem(self):
+        for nome, objeto in (('chave_update', self.chaves_outra[0]), ('pessoa_historico', self.pessoa_outra),
+                             ('local_desativar', self.local_outra)):
+            with self.subTest(url=nome):
+                self.assertEqual(self.client.get(reverse(nome, args=[objeto.pk])).status_code, 404)
+
+    def test_cadastro_repetido_so_dentro_da_unidade(self):
+        response = self.client.post(reverse('chave_create'), {'descricao': "Sala 0", 'local': self.local.pk})
+        self.assertFormError(response.context['form'], 'descricao', "Já existe uma chave com esta descrição.")
+        with self.assertRaises(IntegrityError):
+            Chave.objects.create(unidade=self.base, descricao="Sala 1", local=self.local)
+
+    def test_retirada_com_pessoa_de_outra_unidade(self):
+        with self.assertRaises(Pessoa.DoesNotExist):
+            registrar_retirada(self.chaves[0].id, self.pessoa_outra.id, timezone.now())
+        self.assertFalse(Emprestimo.objects.exists())
+
+    def test_devolucao_em_lote_so_da_unidade(self):
+        agora = timezone.now()
+        nosso = registrar_retirada(self.chaves[0].id, self.pessoa.id, agora)
+        alheio = registrar_retirada(self.chaves_outra[0].id, self.pessoa_outra.id, agora)
+        resultados = registrar_devolucoes(emprestimo_ids=[nosso.id, alheio.id], unidade=self.base)
+        self.assertEqual(resultados, {nosso.id: DEVOLVIDO, alheio.id: NAO_ENCONTRADO})
+        self.assertEqual(Emprestimo.objects.filter(data_devolucao__isnull=True).get(), alheio)
+
+    def test_trocar_de_unidade(self):
+        # Sem acesso à outra unidade, a troca é recusada
+        response = self._trocar(self.outra)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+
+        self.outra.membros.add(self.usuario)
+        html = self.client.get(reverse('selecionar_unidade')).content.decode()
+        self.assertIn("Base Norte", html)
+        self.assertIn("Base Sul", html)
+        self.assertRedirects(self._trocar(self.outra), reverse('dashboard'))
+        response = self.client.get(reverse('chave_list'))
+        self.assertEqual({chave.id for chave in response.context['object_list']}, {chave.id for chave in self.chaves_outra})
+
+        # Perdendo o acesso, volta para a primeira unidade que ainda tem
+        self.outra.membros.remove(self.usuario)
+        response = self.client.get(reverse('chave_list'))
+        self.assertEqual({chave.id for chave in response.context['object_list']}, {chave.id for chave in self.chaves})
+
+    def test_usuario_sem_unidade(self):
+        self.base.membros.remove(self.usuario)
+        self.assertEqual(self.client.get(reverse('chave_list')).status_code, 403)
+        # A troca de unidade abre e explica o que fazer
+        response = self.client.get(reverse('selecionar_unidade'))
+        self.assertContains(response, "ainda não pertence a nenhuma unidade")
+        self.assertContains(response, "Sem unidade")
+
+    def test_usuario_criado_entra_na_unidade_de_quem_criou(self):
+        admin = User.objects.create_superuser('admin', password='x')
+        self.base.membros.add(admin)
+        self.client.force_login(admin)
+        self._trocar(self.outra)
+        response = self.client.post(reverse('user_create'), {
+            'username': 'novo', 'email': 'novo@exemplo.com', 'password1': 'Senha-longa-123', 'password2': 'Senha-longa-123',
+        })
+        self.assertRedirects(response, reverse('user_list'))
+        novo = User.objects.get(username='novo')
+        self.assertEqual(list(novo.unidades_membro.all()), [self.outra])
+
+        self.client.force_login(novo)
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('selecionar_unidade')).status_code, 200)
+
+    def test_administrador_inclui_usuario_em_unidades(self):
+        admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_login(admin)
+        sem_unidade = User.objects.create_user('social')
+        response = self.client.post(reverse('user_update', args=[sem_unidade.pk]), {
+            'username': 'social', 'email': '', 'is_active': 'on', 'unidades': [self.outra.pk],
+        })
+        self.assertRedirects(response, reverse('user_list'))
+        self.assertEqual(list(sem_unidade.unidades_membro.all()), [self.outra])
+
+    def test_cadastro_social_entra_na_unidade_padrao(self):
+        sem_unidade = User.objects.create_user('social')
+        user_signed_up.send(sender=User, request=None, user=sem_unidade)
+        self.assertFalse(sem_unidade.unidades_membro.exists())
+
+        outro = User.objects.create_user('social2')
+        with override_settings(CLAVICULARIO_UNIDADE_NOVOS_USUARIOS=self.outra.pk):
+            user_signed_up.send(sender=User, request=None, user=outro)
+        self.assertEqual(list(outro.unidades_membro.all()), [self.outra])
+
+    def test_painel_de_cada_unidade(self):
+        self.assertEqual(painel.estatisticas_dashboard(self.base)['chaves_emprestadas_count'], 0)
+        self.assertEqual(painel.estatisticas_dashboard(self.outra)['chaves_emprestadas_count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            registrar_retirada(self.chaves_outra[0].id, self.pessoa_outra.id, timezone.now())
+        # Só o painel da outra unidade foi invalidado
+        self.assertIsNotNone(cache.get(painel._chave_cache(self.base.pk)))
+        self.assertEqual(painel.estatisticas_dashboard(self.outra)['chaves_emprestadas_count'], 1)
+        self.assertEqual(painel.estatisticas_dashboard(self.base)['chaves_emprestadas_count'], 0)
+
+    def test_resumo_e_consulta_por_horario_da_unidade(self):
+        agora = timezone.now()
+        nosso = registrar_retirada(self.chaves[0].id, self.pessoa.id, agora - timedelta(hours=1))
+        registrar_retirada(self.chaves_outra[0].id, self.pessoa_outra.id, agora - timedelta(hours=1))
+        self.assertEqual(set(ResumoHorario.objects.values_list('unidade_id', 'chave_id')),
+                         {(self.base.pk, self.chaves[0].pk), (self.outra.pk, self.chaves_outra[0].pk)})
+        dados = self.client.get(reverse('consulta_horario_dados'), {
+            'instante': timezone.localtime(agora).strftime('%Y-%m-%dT%H:%M'),
+        }).json()
+        self.assertEqual([linha['id'] for linha in dados['results']], [nosso.id])
+
+
+#------------------------------------------------------------------
+# ORÇAMENTO DE CONSULTAS POR PÁGINA
+#------------------------------------------------------------------
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO, CLAVICULARIO_IMPORTACAO_EM_THREAD=False)
+class OrcamentoConsultasTests(TestCase):
+    """
+    Teto de consultas SQL de cada URL do app, com um volume de dados parecido
+    com o de produção. Um N+1 faz o número de consultas crescer com os dados
+    e estoura o orçamento. Toda URL nova precisa entrar em ORCAMENTOS.
+    """
+    NUM_CHAVES = 60
+    NUM_PESSOAS = 40
+    NUM_HISTORICO = 300
+    NUM_ABERTOS = 20
+
+    # nome da URL: (método, teto de consultas)
+    ORCAMENTOS = {
+        'user_list': ('get', 6),
+        'user_create': ('get', 3),
+        'user_update': ('get', 8),
+        'user_desativar': ('get', 5),
+        'dashboard': ('get', 7),
+        'selecionar_unidade': ('get', 5),
+        'pessoa_list': ('get', 5),
+        'pessoa_create': ('get', 3),
+        'pessoa_update': ('get', 4),
+        'pessoa_desativar': ('get', 4),
+        'pessoa_historico': ('get', 5),
+        'chave_list': ('get', 5),
+        'chave_create': ('get', 4),
+        'chave_update': ('get', 5),
+        'chave_desativar': ('get', 5),
+        'chave_historico': ('get', 5),
+        'local_list': ('get', 5),
+        'local_create': ('get', 3),
+        'local_update': ('get', 4),
+        'local_desativar': ('get', 4),
+        'view_retirada': ('get', 6),
+        'view_devolucao': ('get', 6),
+        'registrar_devolucao': ('post', 10),
+        'registrar_devolucoes_em_lote': ('post', 9),
+        'view_relatorio': ('get', 6),
+        'relatorio_dados': ('get', 4),
+        'view_consulta_horario': ('get', 6),
+        'consulta_horario_dados': ('get', 5),
+        'eventos_stream': ('get', 2),
+        'cadastrar_pessoa': ('post', 5),
+        'filtrar_pessoas': ('get', 4),
+        'verificar_pin_e_registrar': ('post', 11),
+        'filtrar_chaves_por_local': ('get', 4),
+        'buscar_chaves': ('get', 4),
+        'exportar_relatorio_csv': ('get', 4),
+        'exportar_relatorio_excel': ('get', 4),
+        'importar_dados_page': ('get', 4),
+        'download_template_pessoas': ('get', 2),
+        'download_template_chaves': ('get', 2),
+        'importar_pessoas': ('post', 4),
+        'importar_chaves': ('post', 4),
+        'importacao_status': ('get', 4),
+        'analytics_page': ('get', 5),
+        'analytics_data': ('get', 5),
+        'logout': ('post', 4),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.unidade = unidade_de_teste()
+        locais = [Local.objects.create(unidade=cls.unidade, nome=f"Bloco {i}") for i in range(5)]
+        cls.chaves = Chave.objects.bulk_create([
+            Chave(unidade=cls.unidade, descricao=f"Sala {i:03d}", local=locais[i % len(locais)]) for i in range(cls.NUM_CHAVES)
+        ])
+        cls.pessoas = [Pessoa(unidade=cls.unidade, nome=f"Pessoa {i}", cpf_saran=f"{i:011d}", empresa="FAB")
+                       for i in range(cls.NUM_PESSOAS)]
+        for pessoa in cls.pessoas:
+            pessoa.set_pin("1234")
+        Pessoa.objects.bulk_create(cls.pessoas)
+        criar_historico(cls.NUM_HISTORICO, cls.chaves, cls.pessoas)
+        agora = timezone.now()
+        cls.abertos = [
+            registrar_retirada(chave.id, cls.pessoas[i].id, agora - timedelta(hours=i),
+                               previsao_devolucao=agora + timedelta(hours=10 - i))
+            for i, chave in enumerate(cls.chaves[:cls.NUM_ABERTOS])
+        ]
+        resumo.reconstruir()
+
+        cls.gerente = usuario_gerente()
+        grupos = [Group.objects.create(name=nome) for nome in ("Portaria", "Gerência")]
+        for i in range(20):
+            usuario = User.objects.create_user(f"usuario{i}", f"usuario{i}@exemplo.com", "x")
+            usuario.groups.set(grupos[:i % 3])
+        cls.outro_usuario = usuario
+        cls.job = ImportacaoJob.objects.create(unidade=cls.unidade, tipo=ImportacaoJob.TIPO_PESSOAS, usuario=cls.gerente,
+                                               nome_arquivo="pessoas.xlsx", arquivo=b"")
+
+    def _argumentos(self, nome):
+        """ Argumentos da URL e dados extras de cada endpoint que precisa deles. """
+        chave_livre = self.chaves[-1]
+        pessoa = self.pessoas[-1]
+        argumentos = {
+            'user_update': [self.outro_usuario.pk],
+            'user_desativar': [self.outro_usuario.pk],
+            'pessoa_update': [pessoa.pk],
+            'pessoa_desativar': [pessoa.pk],
+            'pessoa_historico': [self.pessoas[0].pk],
+            'chave_update': [chave_livre.pk],
+            'chave_desativar': [chave_livre.pk],
+            'chave_historico': [self.chaves[0].pk],
+            'local_update': [chave_livre.local_id],
+            'local_desativar': [chave_livre.local_id],
+            'registrar_devolucao': [self.abertos[0].pk],
+            'importacao_status': [self.job.pk],
+        }
+        dados = {
+            'registrar_devolucoes_em_lote': {'emprestimo_ids': [e.pk for e in self.abertos[1:6]]},
+            'cadastrar_pessoa': {'nome': "Nova Pessoa", 'cpf_saran': "99999999999", 'pin': "1234", 'confirmar_pin': "1234"},
+            'verificar_pin_e_registrar': {'chave_id': chave_livre.pk, 'pessoa_id': pessoa.pk, 'pin': "1234",
+                                          'data_retirada': timezone.now().isoformat()},
+            'filtrar_pessoas': {'nome': "Pessoa"},
+            'filtrar_chaves_por_local': {'local_id': chave_livre.local_id},
+            'buscar_chaves': {'q': "sala"},
+            'view_consulta_horario': {'instante': timezone.localtime().strftime('%Y-%m-%dT%H:%M'), 'local': chave_livre.local_id},
+            'consulta_horario_dados': {'inicio': (timezone.localtime() - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M'),
+                                       'fim': timezone.localtime().strftime('%Y-%m-%dT%H:%M'), 'pessoa': pessoa.pk},
+            'importar_pessoas': {'arquivo_excel': arquivo_excel(planilha_pessoas(5, inicio=1000))},
+            'importar_chaves': {'arquivo_excel': arquivo_excel(planilha_chaves(5))},
+        }
+        return argumentos.get(nome, []), dados.get(nome, {})
+
+    def test_todas_as_urls_tem_orcamento(self):
+        nomes = {padrao.name for padrao in urls.urlpatterns if padrao.name}
+        self.assertEqual(nomes, set(self.ORCAMENTOS))
+
+    def test_orcamento_de_consultas(self):
+        for nome, (metodo, teto) in self.ORCAMENTOS.items():
+            with self.subTest(url=nome):
+                cache.clear()
+                self.client.force_login(self.gerente)
+                argumentos, dados = self._argumentos(nome)
+                with CaptureQueriesContext(connection) as consultas:
+                    response = getattr(self.client, metodo)(reverse(nome, args=argumentos), dados)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertLess(response.status_code, 400, nome)
+                self.assertLessEqual(
+                    len(consultas), teto,
+                    f"{nome}: {len(consultas)} consultas (teto {teto}):\n"
+                    + "\n".join(consulta['sql'] for consulta in consultas.captured_queries),
+                )
+
+
+#------------------------------------------------------------------
+# BUSCA DE PESSOAS (TYPEAHEAD)
+#------------------------------------------------------------------
+def criar_pessoas_em_massa(quantidade, inicio=0, unidade=None):
+    """ Pessoas com nomes variados e o PIN já 'criptografado' (sem custo de hash). """
+    unidade = unidade or unidade_de_teste()
+    nomes = ["Ana", "Bruno", "Carla", "Diego", "Elisa", "Fábio", "Gabriela", "Heitor", "Isabel", "João"]
+    sobrenomes = ["Silva", "Souza", "Oliveira", "Pereira", "Costa", "Rodrigues", "Almeida", "Nascimento", "Lima", "Araújo"]
+    empresas = ["FAB", "Limpeza Total", "Segurança Alfa", None]
+    return Pessoa.objects.bulk_create([
+        Pessoa(
+            unidade=unidade,
+            nome=f"{nomes[i % 10]} {sobrenomes[(i // 10) % 10]} {sobrenomes[(i // 100) % 10]} {i}",
+            empresa=empresas[i % len(empresas)],
+            cpf_saran=f"{i:011d}",
+            pin="!",
+        )
+        for i in range(inicio, inicio + quantidade)
+    ], batch_size=5000)
+
+
+class FiltrarPessoasTests(TestCase):
+    def setUp(self):
+        criar_pessoas_em_massa(120)
+        Pessoa.objects.filter(cpf_saran=f"{3:011d}").update(ativa=False)
+        usuario_gerente(self.client)
+
+    def _buscar(self, **parametros):
+        response = self.client.get(reverse('filtrar_pessoas'), parametros)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_busca_por_nome_empresa_e_inicio_do_cpf(self):
+        textos = [r['text'] for r in self._buscar(q="heitor souza")['results']]
+        self.assertTrue(textos)
+        self.assertTrue(all(t.startswith("Heitor Souza") for t in textos))
+
+        self.assertEqual(len(self._buscar(q="alfa", limite=50)['results']), 30)
+
+    def test_cpf_so_pelo_inicio(self):
+        resultados = self._buscar(q="00000000011")['results']
+        self.assertEqual([r['id'] for r in resultados], [Pessoa.objects.get(cpf_saran="00000000011").id])
+        self.assertEqual(self._buscar(q="0011")['results'], [])
+
+    def test_apenas_pessoas_ativas(self):
+        ids = set()
+        pagina = 1
+        while True:
+            dados = self._buscar(page=pagina, limite=50)
+            ids.update(r['id'] for r in dados['results'])
+            if not dados['pagination']['more']:
+                break
+            pagina += 1
+        self.assertEqual(len(ids), 119)
+        self.assertNotIn(Pessoa.objects.get(cpf_saran=f"{3:011d}").id, ids)
+
+    def test_paginacao_e_limite(self):
+        padrao = self._buscar()
+        self.assertEqual(len(padrao['results']), views.PESSOAS_POR_PAGINA)
+        self.assertTrue(padrao['pagination']['more'])
+        # 12 pessoas chamadas Ana, de 5 em 5
+        self.assertTrue(self._buscar(q="ana", limite=5)['pagination']['more'])
+        ultima = self._buscar(q="ana", limite=5, page=3)
+        self.assertEqual(len(ultima['results']), 2)
+        self.assertFalse(ultima['pagination']['more'])
+        self.assertEqual(len(self._buscar(limite=1000)['results']), views.MAXIMO_PESSOAS_POR_PAGINA)
+        self.assertEqual(self.client.get(reverse('filtrar_pessoas'), {'page': 'x'}).status_code, 400)
+
+    def test_filtros_separados_por_nome_e_empresa(self):
+        resultados = self._buscar(nome="ana", empresa="fab")['results']
+        self.assertTrue(resultados)
+        self.assertTrue(all(r['text'].startswith("Ana ") for r in resultados))
+        self.assertFalse(self._buscar(nome="ana", empresa="limpeza")['results'])
+
+    def test_indice_de_trigramas_no_postgresql(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("Índices de trigramas só existem no PostgreSQL.")
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest("Extensão pg_trgm não instalada neste servidor.")
+        criar_pessoas_em_massa(20_000, inicio=1000)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Pessoa._meta.db_table}")
+        plano = views._buscar_pessoas(unidade_de_teste(), termo="nascimento lima").explain()
+        self.assertIn('pessoa_nome_trgm_idx', plano)
+
+
+#------------------------------------------------------------------
+# PAGINAÇÃO POR CURSOR
+#------------------------------------------------------------------
+class PaginacaoCursorTests(TestCase):
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=3, num_pessoas=2)
+        inicio = timezone.now() - timedelta(days=30)
+        criar_historico(40, self.chaves, self.pessoas, inicio=inicio)
+        # Empréstimos no mesmo instante, cada um de uma chave: o id desempata a ordem
+        outras = [Chave.objects.create(unidade=unidade_de_teste(), descricao=f"Sala {i}", local=self.chaves[0].local) for i in range(3, 10)]
+        criar_historico(7, outras, self.pessoas, inicio=inicio + timedelta(hours=10, minutes=30))
+        Emprestimo.objects.filter(chave__in=outras).update(data_retirada=inicio + timedelta(hours=12),
+                                                          data_devolucao=inicio + timedelta(hours=13))
+        self.esperados = list(Emprestimo.objects.order_by('-data_retirada', '-id').values_list('id', flat=True))
+        usuario_gerente(self.client)
+
+    def _percorrer(self, por_pagina):
+        paginas = [paginacao.paginar_por_cursor(Emprestimo.objects.all(), None, por_pagina)]
+        while paginas[-1].has_next():
+            paginas.append(paginacao.paginar_por_cursor(Emprestimo.objects.all(), paginas[-1].cursor_proximo, por_pagina))
+        return paginas
+
+    def test_ida_e_volta_sem_repetir_nem_pular(self):
+        paginas = self._percorrer(6)
+        self.assertEqual([e.id for pagina in paginas for e in pagina], self.esperados)
+        self.assertFalse(paginas[0].has_previous())
+        self.assertEqual([len(p) for p in paginas], [6] * 7 + [5])
+
+        # Voltando a partir da última, as mesmas páginas na ordem inversa
+        pagina = paginas[-1]
+        for esperada in reversed(paginas[:-1]):
+            pagina = paginacao.paginar_por_cursor(Emprestimo.objects.all(), pagina.cursor_anterior, 6)
+            self.assertEqual([e.id for e in pagina], [e.id for e in esperada])
+        self.assertFalse(pagina.has_previous())
+        self.assertTrue(pagina.has_next())
+
+    def test_sem_count_nem_offset(self):
+        cursor = self._percorrer(10)[2].cursor_proximo
+        with CaptureQueriesContext(connection) as consultas:
+            paginacao.paginar_por_cursor(Emprestimo.objects.all(), cursor, 10)
+        self.assertEqual(len(consultas), 1)
+        sql = consultas[0]['sql'].upper()
+        self.assertNotIn('COUNT(', sql)
+        self.assertNotIn('OFFSET', sql)
+
+    def test_cursor_invalido(self):
+        cursor = self._percorrer(10)[0].cursor_proximo
+        with self.assertRaises(paginacao.CursorInvalido):
+            paginacao.paginar_por_cursor(Emprestimo.objects.all(), cursor[:-2] + 'xx')
+        # Na página HTML, volta para o começo
+        response = self.client.get(reverse('view_relatorio'), {'cursor': 'lixo'})
+        self.assertEqual([e.id for e in response.context['emprestimos_page']], self.esperados[:15])
+        self.assertEqual(self.client.get(reverse('relatorio_dados'), {'cursor': 'lixo'}).status_code, 400)
+
+    def test_historicos_e_relatorio_seguem_o_cursor(self):
+        pessoa = self.pessoas[0]
+        do_historico = list(pessoa.emprestimos.order_by('-data_retirada', '-id').values_list('id', flat=True))
+        primeira = self.client.get(reverse('pessoa_historico', args=[pessoa.pk])).context['emprestimos_page']
+        segunda = self.client.get(reverse('pessoa_historico', args=[pessoa.pk]),
+                                  {'cursor': primeira.cursor_proximo}).context['emprestimos_page']
+        self.assertEqual([e.id for e in primeira] + [e.id for e in segunda], do_historico)
+
+        # Os filtros da página continuam nos links de navegação
+        busca.reindexar()
+        html = self.client.get(reverse('view_relatorio'), {'status': 'todos', 'busca': 'bloco a'}).content.decode()
+        self.assertIn('?status=todos&amp;busca=bloco+a&amp;cursor=', html)
+
+    def test_relatorio_em_json(self):
+        ids = []
+        cursor = None
+        while True:
+            parametros = {'status': 'todos', 'limite': 20, **({'cursor': cursor} if cursor else {})}
+            dados = self.client.get(reverse('relatorio_dados'), parametros).json()
+            ids.extend(linha['id'] for linha in dados['results'])
+            cursor = dados['next']
+            if cursor is None:
+                break
+        self.assertEqual(ids, self.esperados)
+        self.assertEqual(set(dados['results'][0]), set(views.CAMPOS_RELATORIO_JSON))
+        filtrados = self.client.get(reverse('relatorio_dados'), {'chave': self.chaves[0].id}).json()['results']
+        self.assertTrue(all(linha['chave__descricao'] == "Sala 0" for linha in filtrados))
+
+
+#------------------------------------------------------------------
+# ÍNDICES DAS CONSULTAS MAIS FREQUENTES (EXPLAIN)
+#------------------------------------------------------------------
+def consultas_quentes(chave, pessoa, local):
+    """
+    As consultas mais frequentes do app, montadas como nas views e no painel,
+    com o índice (ou os índices) que cada uma pode usar. Como nas views, as
+    listas são sempre as da unidade do local.
+    """
+    agora = timezone.now()
+    emprestimos = Emprestimo.objects.da_unidade(local.unidade)
+    abertos = emprestimos.filter(data_devolucao__isnull=True)
+    # Os dois índices parciais dos empréstimos abertos servem para percorrê-los
+    indices_abertos = ('emprestimo_abertos_idx', 'emprestimo_aberto_por_chave')
+    return {
+        'retirada/devolução: empréstimos abertos': (
+            abertos.select_related('chave', 'pessoa').order_by('-data_retirada'), indices_abertos),
+        'painel: atrasados': (
+            abertos.filter(previsao_devolucao__lt=agora).select_related('chave', 'pessoa').order_by('previsao_devolucao'),
+            'emprestimo_vencimento_idx'),
+        'painel: próximo vencimento': (
+            abertos.filter(previsao_devolucao__gte=agora).order_by('previsao_devolucao').values('previsao_devolucao')[:1],
+            'emprestimo_vencimento_idx'),
+        'relatório: primeira página': (
+            emprestimos.select_related('chave', 'pessoa').order_by('-data_retirada', '-id')[:16],
+            'emprestimo_retirada_idx'),
+        'relatório: período': (
+            emprestimos.filter(data_retirada__gte=agora - timedelta(days=7)).order_by('-data_retirada', '-id')[:16],
+            'emprestimo_retirada_idx'),
+        'histórico da chave': (
+            chave.emprestimos.select_related('pessoa').order_by('-data_retirada', '-id')[:16],
+            'emprestimo_chave_retirada_idx'),
+        'histórico da pessoa': (
+            pessoa.emprestimos.select_related('chave', 'chave__local').order_by('-data_retirada', '-id')[:16],
+            'emprestimo_pessoa_retirada_idx'),
+        'devolução: abertos da pessoa': (
+            abertos.filter(pessoa=pessoa), indices_abertos),
+        'cadastro: pessoas em ordem alfabética': (
+            Pessoa.objects.da_unidade(local.unidade).order_by('nome', 'id')[:16], 'pessoa_nome_idx'),
+        'devolução: chaves emprestadas': (
+            Chave.objects.filter(emprestimo_atual__isnull=False), f'{Chave._meta.db_table}_emprestimo_atual_id_'),
+        'retirada: chaves disponíveis do local': (
+            Chave.objects.da_unidade(local.unidade).filter(emprestimo_atual__isnull=True, ativa=True, local=local)
+            .order_by('descricao'),
+            # Com poucas chaves, o índice único (unidade, descrição) empata: também dá a ordem
+            ('chave_disponiveis_idx', 'chave_descricao_por_unidade')),
+        'consulta por horário: instante': (
+            periodos.no_instante(emprestimos.select_related('chave', 'pessoa'), agora - timedelta(days=1), local.unidade)
+            .order_by('-data_retirada'), 'emprestimo_periodo_idx'),
+        'consulta por horário: intervalo': (
+            periodos.no_intervalo(emprestimos.select_related('chave', 'pessoa'),
+                                  agora - timedelta(days=1, hours=2), agora - timedelta(days=1), local.unidade)
+            .order_by('-data_retirada'), 'emprestimo_periodo_idx'),
+    }
+
+
+def _indices(indice):
+    return (indice,) if isinstance(indice, str) else indice
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Os planos de execução verificados são os do PostgreSQL.")
+class IndicesConsultasTests(TestCase):
+    """
+    Cada consulta frequente tem um índice que ela consegue usar. Com poucos
+    dados o PostgreSQL prefere ler a tabela inteira, então a leitura sequencial
+    é desligada: se o plano ainda assim não citar o índice, ele não serve para
+    a consulta. O IndicesConsultasBenchmark repete a verificação com 1 milhão
+    de empréstimos e as estatísticas reais.
+    """
+    def test_cada_consulta_usa_o_seu_indice(self):
+        local, chaves, pessoas = criar_dados_basicos(num_chaves=5, num_pessoas=3)
+        criar_historico(50, chaves, pessoas)
+        registrar_retirada(chaves[0].id, pessoas[0].id, timezone.now(), previsao_devolucao=timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        for nome, (queryset, indice) in consultas_quentes(chaves[0], pessoas[0], local).items():
+            with self.subTest(consulta=nome):
+                plano = queryset.explain()
+                self.assertTrue(any(nome_indice in plano for nome_indice in _indices(indice)), plano)
+
+
+#------------------------------------------------------------------
+# BUSCA LIVRE NO RELATÓRIO
+#------------------------------------------------------------------
+class BuscaRelatorioTests(TestCase):
+    def setUp(self):
+        self.gerente = usuario_gerente(self.client)
+        self.local = Local.objects.create(unidade=unidade_de_teste(), nome="Hangar Sul")
+        self.chave = Chave.objects.create(unidade=unidade_de_teste(), descricao="Almoxarifado 2", local=self.local)
+        self.outra_chave = Chave.objects.create(unidade=unidade_de_teste(), descricao="Sala 10", local=Local.objects.create(unidade=unidade_de_teste(), nome="Bloco A"))
+        self.joao = Pessoa.objects.create(unidade=unidade_de_teste(), nome="João Araújo", cpf_saran="123.456.789-00", pin="!")
+        self.maria = Pessoa.objects.create(unidade=unidade_de_teste(), nome="Maria Lima", cpf_saran="98765432100", pin="!")
+        agora = timezone.now()
+        self.do_joao = registrar_retirada(self.chave.id, self.joao.id, agora, observacao="Levou o rádio")
+        self.da_maria = registrar_retirada(self.outra_chave.id, self.maria.id, agora - timedelta(hours=1))
+
+    def _ids(self, termo):
+        return set(busca.filtrar(Emprestimo.objects.all(), termo).values_list('id', flat=True))
+
+    def test_texto_normalizado(self):
+        self.assertEqual(
+            busca.texto_emprestimo("Sala 3-B", "Hangar", "José Ávila", "123.456", "Obs: ok!"),
+            "sala 3 b hangar jose avila 123 456 123456 obs ok",
+        )
+
+    def test_busca_por_chave_local_pessoa_cpf_e_observacao(self):
+        for termo in ("almox", "hangar sul", "joao", "ARAUJO", "123456789", "123.456", "radio", "jo almox"):
+            with self.subTest(termo=termo):
+                self.assertEqual(self._ids(termo), {self.do_joao.id})
+        self.assertEqual(self._ids("sala lima"), {self.da_maria.id})
+        self.assertEqual(self._ids("joao lima"), set())
+        # Só o início das palavras: "xarifado" não é começo de nenhuma
+        self.assertEqual(self._ids("xarifado"), set())
+        self.assertEqual(self._ids("  !! "), {self.do_joao.id, self.da_maria.id})
+
+    def test_relatorio_e_exportacao_usam_a_busca(self):
+        response = self.client.get(reverse('view_relatorio'), {'busca': "maria"})
+        self.assertEqual([e.id for e in response.context['emprestimos_page']], [self.da_maria.id])
+        csv_ = b''.join(self.client.get(reverse('exportar_relatorio_csv'), {'busca': "radio"}).streaming_content).decode()
+        self.assertEqual(len(csv_.splitlines()), 2)
+
+    def test_renomear_chave_atualiza_a_busca(self):
+        Chave.objects.filter(pk=self.chave.pk).update(emprestimo_atual=None)
+        response = self.client.post(reverse('chave_update', args=[self.chave.pk]),
+                                    {'descricao': "Depósito Norte", 'local': self.local.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self._ids("deposito"), {self.do_joao.id})
+        self.assertEqual(self._ids("almox"), set())
+
+    def test_reindexar_preenche_o_historico(self):
+        criados = criar_historico(3, [self.outra_chave], [self.maria])
+        self.assertEqual(self._ids("bloco"), {self.da_maria.id})
+        self.assertEqual(busca.reindexar(), 3)
+        self.assertEqual(self._ids("bloco"), {self.da_maria.id} | {e.id for e in criados})
+        self.assertEqual(busca.reindexar(), 0)
+
+    def test_formulario_nao_lista_o_cadastro_inteiro(self):
+        criar_pessoas_em_massa(50, inicio=100)
+        html = self.client.get(reverse('view_relatorio'), {'pessoa': self.maria.id}).content.decode()
+        self.assertIn(str(self.maria), html)
+        self.assertNotIn(str(self.joao), html)
+        self.assertNotIn(str(self.outra_chave), html)
+        self.assertIn(f'data-busca-url="{reverse("buscar_chaves")}"', html)
+
+    def test_api_de_chaves_e_pessoas_inativas(self):
+        dados = self.client.get(reverse('buscar_chaves'), {'q': "hangar"}).json()
+        self.assertEqual([r['id'] for r in dados['results']], [self.chave.id])
+        Pessoa.objects.filter(pk=self.maria.pk).update(ativa=False)
+        self.assertFalse(self.client.get(reverse('filtrar_pessoas'), {'q': "maria"}).json()['results'])
+        dados = self.client.get(reverse('filtrar_pessoas'), {'q': "maria", 'inativas': 1}).json()
+        self.assertEqual([r['id'] for r in dados['results']], [self.maria.id])
+
+    def test_indice_gin_no_postgresql(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("O índice da busca textual só existe no PostgreSQL.")
+        criar_historico(20_000, [self.chave, self.outra_chave], [self.joao, self.maria],
+                        inicio=timezone.now() - timedelta(days=1000))
+        busca.reindexar()
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Emprestimo._meta.db_table}")
+        plano = busca.filtrar(Emprestimo.objects.all(), "radio").explain()
+        self.assertIn('emprestimo_busca_idx', plano)
+
+
+#------------------------------------------------------------------
+# CONSULTA POR HORÁRIO
+#------------------------------------------------------------------
+class ConsultaHorarioTests(TestCase):
+    def setUp(self):
+        self.gerente = usuario_gerente(self.client)
+        self.hangar = Local.objects.create(unidade=unidade_de_teste(), nome="Hangar Sul")
+        self.bloco = Local.objects.create(unidade=unidade_de_teste(), nome="Bloco A")
+        self.almox = Chave.objects.create(unidade=unidade_de_teste(), descricao="Almoxarifado", local=self.hangar)
+        self.sala = Chave.objects.create(unidade=unidade_de_teste(), descricao="Sala 10", local=self.bloco)
+        self.joao = Pessoa.objects.create(unidade=unidade_de_teste(), nome="João", cpf_saran="1", pin="!")
+        self.maria = Pessoa.objects.create(unidade=unidade_de_teste(), nome="Maria", cpf_saran="2", pin="!")
+        emprestar = lambda chave, pessoa, retirada, devolucao=None: Emprestimo.objects.create(
+            unidade_id=chave.unidade_id, chave=chave, pessoa=pessoa, data_retirada=retirada, data_devolucao=devolucao)
+        self.do_joao = emprestar(self.almox, self.joao, horario_local(2026, 3, 2, 8, 0), horario_local(2026, 3, 2, 10, 0))
+        self.da_maria = emprestar(self.almox, self.maria, horario_local(2026, 3, 2, 10, 0), horario_local(2026, 3, 2, 11, 0))
+        # Ainda não devolvida
+        self.aberto = emprestar(self.sala, self.maria, horario_local(2026, 3, 2, 9, 30))
+
+    def _ids(self, **filtros):
+        return set(periodos.quem_estava(Emprestimo.objects.all(), **filtros).values_list('id', flat=True))
+
+    def test_no_instante(self):
+        self.assertEqual(self._ids(instante=horario_local(2026, 3, 2, 9, 45)), {self.do_joao.id, self.aberto.id})
+        # O período vai da retirada até a devolução, sem incluí-la
+        self.assertEqual(self._ids(instante=horario_local(2026, 3, 2, 10, 0)), {self.da_maria.id, self.aberto.id})
+        self.assertEqual(self._ids(instante=horario_local(2026, 3, 2, 7, 0)), set())
+        self.assertEqual(self._ids(instante=timezone.now()), {self.aberto.id})
+
+    def test_no_intervalo(self):
+        self.assertEqual(self._ids(inicio=horario_local(2026, 3, 2, 10, 30), fim=horario_local(2026, 3, 2, 12, 0)),
+                         {self.da_maria.id, self.aberto.id})
+        self.assertEqual(self._ids(inicio=horario_local(2026, 3, 2, 7, 0), fim=horario_local(2026, 3, 2, 8, 0)), set())
+
+    def test_filtros(self):
+        instante = horario_local(2026, 3, 2, 9, 45)
+        self.assertEqual(self._ids(instante=instante, chave=self.almox), {self.do_joao.id})
+        self.assertEqual(self._ids(instante=instante, local=self.bloco), {self.aberto.id})
+        self.assertEqual(self._ids(instante=instante, pessoa=self.maria), {self.aberto.id})
+
+    def test_pagina(self):
+        response = self.client.get(reverse('view_consulta_horario'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['emprestimos_page'])
+
+        response = self.client.get(reverse('view_consulta_horario'), {'instante': "2026-03-02T09:45"})
+        self.assertEqual([e.id for e in response.context['emprestimos_page']], [self.aberto.id, self.do_joao.id])
+        self.assertContains(response, "Hangar Sul")
+
+        response = self.client.get(reverse('view_consulta_horario'), {'inicio': "2026-03-02T12:00", 'fim': "2026-03-02T11:00"})
+        self.assertContains(response, "O fim do intervalo deve ser depois do início.")
+        self.assertIsNone(response.context['emprestimos_page'])
+
+    def test_api(self):
+        url = reverse('consulta_horario_dados')
+        dados = self.client.get(url, {'inicio': "2026-03-02T10:30", 'fim': "2026-03-02T12:00", 'limite': 1}).json()
+        self.assertEqual([e['id'] for e in dados['results']], [self.da_maria.id])
+        dados = self.client.get(url, {'inicio': "2026-03-02T10:30", 'fim': "2026-03-02T12:00", 'cursor': dados['next']}).json()
+        self.assertEqual([e['id'] for e in dados['results']], [self.aberto.id])
+        self.assertEqual(dados['results'][0]['chave__local__nome'], "Bloco A")
+
+        response = self.client.get(url, {'chave': self.almox.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('__all__', response.json()['errors'])
+        self.assertEqual(self.client.get(url, {'instante': "2026-03-02T09:45", 'cursor': 'lixo'}).status_code, 400)
+
+
+#------------------------------------------------------------------
+# INSTRUMENTAÇÃO DOS RELATÓRIOS
+#------------------------------------------------------------------
+class InstrumentacaoRelatorioTests(TestCase):
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=2, num_pessoas=2)
+        criar_historico(4, self.chaves, self.pessoas)
+        usuario_gerente(self.client)
+
+    def test_relatorio_registra_etapas_e_consultas_no_log(self):
+        with self.assertLogs('claviculario_app.instrumentacao', 'INFO') as logs, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as saida:
+            response = self.client.get(reverse('view_relatorio'), {'pessoa': self.pessoas[0].id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(saida.getvalue(), '')
+
+        medicao = logs.records[0].medicao
+        self.assertEqual(medicao['view'], 'relatorio')
+        self.assertIn('filtros', medicao['etapas_ms'])
+        self.assertGreater(medicao['consultas'], 0)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_formulario_validado_uma_unica_vez(self):
+        full_clean = views.RelatorioForm.full_clean
+        with mock.patch.object(views.RelatorioForm, 'full_clean', autospec=True, side_effect=full_clean) as chamadas:
+            self.client.get(reverse('view_relatorio'), {'chave': self.chaves[0].id})
+        self.assertEqual(chamadas.call_count, 1)
+
+    @override_settings(CLAVICULARIO_SERVER_TIMING=True)
+    def test_cabecalho_server_timing(self):
+        response = self.client.get(reverse('exportar_relatorio_excel'))
+        self.assertRegex(response['Server-Timing'], r'filtros;dur=[\d.]+, sql;dur=[\d.]+;desc="\d+ consultas", view;dur=')
+
+    def test_csv_em_streaming_conta_as_consultas_do_envio(self):
+        with self.assertLogs('claviculario_app.instrumentacao', 'INFO') as logs:
+            response = self.client.get(reverse('exportar_relatorio_csv'))
+            # Nada é registrado antes de o conteúdo ser enviado
+            self.assertEqual(logs.records, [])
+            b''.join(response.streaming_content)
+        medicao = logs.records[0].medicao
+        self.assertEqual(medicao['view'], 'exportar_relatorio_csv')
+        self.assertGreaterEqual(medicao['consultas'], 1)
+
+
+#------------------------------------------------------------------
+# RÉPLICA DE LEITURA DOS RELATÓRIOS
+#------------------------------------------------------------------
+def _tabelas_lidas(consultas):
+    return {tabela for consulta in consultas for tabela in re.findall(r'FROM "(\w+)"', consulta['sql'])}
+
+
+# TransactionTestCase: o espelho 'reporting' é outra conexão e só vê o que foi confirmado
+@unittest.skipUnless('reporting' in connections, "Configure o banco 'reporting' (ver config/settings.py).")
+@override_settings(CLAVICULARIO_BANCO_RELATORIOS='reporting')
+class ReplicasTests(TransactionTestCase):
+    databases = {'default', 'reporting'}
+
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=2, num_pessoas=2)
+        criar_historico(4, self.chaves, self.pessoas)
+        self.usuario = usuario_gerente(self.client)
+
+    def _leituras(self, nome, *args, parametros=None):
+        """ Tabelas lidas no banco principal e na réplica para montar a resposta inteira. """
+        with CaptureQueriesContext(connections['default']) as principal, \
+                CaptureQueriesContext(connections['reporting']) as replica:
+            response = self.client.get(reverse(nome, args=args), parametros)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        return _tabelas_lidas(principal), _tabelas_lidas(replica)
+
+    def test_relatorios_leem_da_replica(self):
+        emprestimos = Emprestimo._meta.db_table
+        for nome, args in (('view_relatorio', ()), ('relatorio_dados', ()), ('exportar_relatorio_csv', ()),
+                           ('exportar_relatorio_excel', ()), ('chave_historico', (self.chaves[0].pk,)),
+                           ('pessoa_historico', (self.pessoas[0].pk,))):
+            with self.subTest(url=nome):
+                principal, replica = self._leituras(nome, *args)
+                self.assertIn(emprestimos, replica)
+                self.assertNotIn(emprestimos, principal)
+
+    def test_graficos_leem_da_replica(self):
+        for urlconf in (settings.ROOT_URLCONF, UrlsApisAssincronas):
+            with self.subTest(urlconf=urlconf), override_settings(ROOT_URLCONF=urlconf):
+                principal, replica = self._leituras('analytics_data')
+                self.assertIn(ResumoHorario._meta.db_table, replica)
+                self.assertNotIn(ResumoHorario._meta.db_table, principal)
+
+    def test_escrita_prende_o_navegador_ao_principal(self):
+        response = self.client.post(reverse('chave_update', args=[self.chaves[1].pk]),
+                                    {'descricao': "Sala Nova", 'local': self.chaves[1].local_id})
+        self.assertEqual(response.status_code, 302)
+        cookie = response.cookies[replicas.COOKIE_PRIMARIO]
+        self.assertEqual(cookie['max-age'], 5)
+        principal, replica = self._leituras('view_relatorio')
+        self.assertIn(Emprestimo._meta.db_table, principal)
+        self.assertEqual(replica, set())
+
+        # Quando o cookie expira, os relatórios voltam para a réplica
+        del self.client.cookies[replicas.COOKIE_PRIMARIO]
+        principal, replica = self._leituras('view_relatorio')
+        self.assertIn(Emprestimo._meta.db_table, replica)
+
+    def test_leituras_das_mesas_ficam_no_principal(self):
+        principal, replica = self._leituras('view_devolucao')
+        self.assertIn(Emprestimo._meta.db_table, principal)
+        self.assertEqual(replica, set())
+
+    @override_settings(CLAVICULARIO_BANCO_RELATORIOS=None)
+    def test_sem_replica(self):
+        principal, replica = self._leituras('exportar_relatorio_csv')
+        self.assertIn(Emprestimo._meta.db_table, principal)
+        self.assertEqual(replica, set())
+        response = self.client.post(reverse('logout'))
+        self.assertNotIn(replicas.COOKIE_PRIMARIO, response.cookies)
+
+    def test_replica_nao_recebe_migracoes(self):
+        roteador = replicas.RelatoriosRouter()
+        self.assertFalse(roteador.allow_migrate('reporting', 'claviculario_app'))
+        self.assertIsNone(roteador.allow_migrate('default', 'claviculario_app'))
+        self.assertIsNone(roteador.db_for_write(Emprestimo))
+
+    def test_instrumentacao_conta_as_consultas_da_replica(self):
+        with self.assertLogs('claviculario_app.instrumentacao', 'INFO') as logs:
+            self.client.get(reverse('view_relatorio'))
+        self.assertGreaterEqual(logs.records[0].medicao['consultas'], 2)
+
+
+#------------------------------------------------------------------
+# PARTIÇÕES POR ANO E ARQUIVO DOS EMPRÉSTIMOS
+#------------------------------------------------------------------
+@unittest.skipUnless(connection.vendor == 'postgresql', "O particionamento dos empréstimos só existe no PostgreSQL.")
+class ParticoesArquivoTests(TestCase):
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=3, num_pessoas=2)
+        # 12 retiradas no fim de 2019, 18 no começo de 2020 e 5 recentes
+        criar_historico(30, self.chaves, self.pessoas, inicio=horario_local(2019, 12, 31, 12, 0))
+        criar_historico(5, self.chaves, self.pessoas)
+        busca.reindexar()
+        resumo.reconstruir()
+        self.esperados = list(Emprestimo.objects.order_by('-data_retirada', '-id').values_list('id', flat=True))
+        diretorio = tempfile.TemporaryDirectory()
+        self.addCleanup(diretorio.cleanup)
+        configuracao = override_settings(CLAVICULARIO_ARQUIVO_EMPRESTIMOS=Path(diretorio.name))
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.ano = timezone.localdate().year
+        particoes.particionar(self.ano + 1)
+
+    def test_conversao_mantem_dados_e_restricoes(self):
+        self.assertTrue(particoes.particionada())
+        self.assertEqual(particoes.anos_particionados(), list(range(2019, self.ano + 2)))
+        self.assertEqual(list(Emprestimo.objects.order_by('-data_retirada', '-id').values_list('id', flat=True)), self.esperados)
+
+        # O id continua vindo do banco, depois dos existentes
+        emprestimo = registrar_retirada(self.chaves[0].id, self.pessoas[0].id, timezone.now())
+        self.assertGreater(emprestimo.id, max(self.esperados))
+        self.assertEqual(Chave.objects.get(pk=self.chaves[0].pk).emprestimo_atual_id, emprestimo.id)
+        # Uma retirada aberta por chave e sem períodos sobrepostos, dentro de cada ano
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Emprestimo.objects.create(unidade=self.chaves[0].unidade, chave=self.chaves[0], pessoa=self.pessoas[1],
+                                      data_retirada=timezone.now())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Emprestimo.objects.create(unidade=self.chaves[0].unidade, chave=self.chaves[0], pessoa=self.pessoas[1],
+                                      data_retirada=horario_local(2019, 12, 31, 12, 10),
+                                      data_devolucao=horario_local(2019, 12, 31, 12, 20))
+
+        with self.assertRaises(particoes.ParticionamentoError):
+            particoes.particionar(self.ano + 1)
+        self.assertEqual(particoes.criar_particoes(self.ano + 3), [self.ano + 2, self.ano + 3])
+        saida = io.StringIO()
+        call_command('particionar_emprestimos', anos_a_frente=3, stdout=saida)
+        self.assertIn("0 partição(ões) criada(s)", saida.getvalue())
+
+    def test_migracoes_que_mexem_no_particionado_sao_barradas(self):
+        self.assertEqual(particoes.verificar_migracoes(databases=['default']), [])
+        alteracao = migrations.AlterField('emprestimo', 'observacao', models.TextField(blank=True))
+        aponta = migrations.AddField('pessoa', 'ultimo_emprestimo', models.ForeignKey(
+            'claviculario_app.Emprestimo', models.SET_NULL, null=True))
+        separada = migrations.SeparateDatabaseAndState(
+            state_operations=[alteracao], database_operations=[migrations.RunSQL("SELECT 1")])
+        self.assertTrue(particoes.mexe_no_particionado('claviculario_app', alteracao))
+        self.assertTrue(particoes.mexe_no_particionado('outro_app', aponta))
+        self.assertTrue(particoes.mexe_no_particionado(
+            'claviculario_app', migrations.RemoveField('chave', 'emprestimo_atual')))
+        self.assertFalse(particoes.mexe_no_particionado('claviculario_app', separada))
+        self.assertFalse(particoes.mexe_no_particionado(
+            'claviculario_app', migrations.AddField('chave', 'etiqueta', models.CharField(max_length=20, default=''))))
+
+        pendente = type('Migration', (migrations.Migration,), {'operations': [alteracao]})('0099_teste', 'claviculario_app')
+        with mock.patch.object(particoes.MigrationExecutor, 'migration_plan', return_value=[(pendente, False)]):
+            erros = run_checks(tags=[Tags.database], databases=['default'])
+        self.assertEqual([erro.id for erro in erros], ['claviculario_app.E001'])
+        self.assertIn("0099_teste", erros[0].msg)
+
+    def _chave_nova(self):
+        return Chave.objects.create(unidade=self.chaves[0].unidade, descricao="Sala extra", local=self.chaves[0].local)
+
+    def _emprestimo(self, chave, retirada, devolucao=None):
+        return Emprestimo.objects.create(unidade=chave.unidade, chave=chave, pessoa=self.pessoas[0],
+                                         data_retirada=retirada, data_devolucao=devolucao)
+
+    def test_uma_retirada_aberta_por_chave_entre_anos(self):
+        chave = self._chave_nova()
+        self._emprestimo(chave, horario_local(self.ano - 1, 6, 1, 8, 0))
+        with self.assertRaises(IntegrityError) as erro, transaction.atomic():
+            self._emprestimo(chave, timezone.now())
+        self.assertEqual(erro.exception.__cause__.pgcode, '23505')
+
+    def test_periodos_nao_se_cruzam_entre_anos(self):
+        chave = self._chave_nova()
+        self._emprestimo(chave, horario_local(self.ano - 1, 12, 31, 22, 0), horario_local(self.ano, 1, 1, 2, 0))
+        with self.assertRaises(IntegrityError) as erro, transaction.atomic():
+            self._emprestimo(chave, horario_local(self.ano, 1, 1, 1, 0), horario_local(self.ano, 1, 1, 3, 0))
+        self.assertEqual(erro.exception.__cause__.pgcode, '23P01')
+        # Pelo serviço, o mesmo PeriodoOcupadoError de antes do particionamento
+        with self.assertRaises(PeriodoOcupadoError):
+            registrar_retirada(chave.id, self.pessoas[0].id, horario_local(self.ano, 1, 1, 1, 0))
+        # Encostar no fim do período anterior continua permitido
+        self._emprestimo(chave, horario_local(self.ano, 1, 1, 2, 0), horario_local(self.ano, 1, 1, 3, 0))
+
+    def test_emprestimo_atual_continua_verificado(self):
+        emprestimo = registrar_retirada(self.chaves[0].id, self.pessoas[0].id, timezone.now())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Chave.objects.filter(pk=self.chaves[1].pk).update(emprestimo_atual_id=max(self.esperados) + 1000)
+            connection.check_constraints()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {particoes.TABELA} WHERE id = %s", [emprestimo.id])
+            connection.check_constraints()
+        # Pelo ORM, o SET_NULL de emprestimo_atual solta a chave antes
+        emprestimo.delete()
+        connection.check_constraints()
+        self.assertIsNone(Chave.objects.get(pk=self.chaves[0].pk).emprestimo_atual)
+
+    def test_arquivar_anos_encerrados(self):
+        saida = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('arquivar_emprestimos', anos=self.ano - 2020, stdout=saida)
+        self.assertIn("2019: 12 empréstimo(s)", saida.getvalue())
+        self.assertEqual(arquivo.anos_arquivados(), [2019])
+        self.assertNotIn(2019, particoes.anos_particionados())
+        self.assertEqual(Emprestimo.objects.count(), len(self.esperados) - 12)
+
+        tabela = pd.read_parquet(arquivo.caminho(2019))
+        self.assertEqual(list(tabela.columns), list(arquivo.COLUNAS))
+        self.assertEqual(sorted(tabela['id'], reverse=True), self.esperados[-12:])
+        self.assertEqual(set(tabela['chave__local__nome']), {"Bloco A"})
+
+    def test_ano_com_emprestimo_aberto_fica_no_banco(self):
+        chave = Chave.objects.create(unidade=self.chaves[0].unidade, descricao="Sala extra", local=self.chaves[0].local)
+        Emprestimo.objects.create(unidade=chave.unidade, chave=chave, pessoa=self.pessoas[0],
+                                  data_retirada=horario_local(2019, 6, 1, 8, 0))
+        with self.assertRaises(particoes.ParticionamentoError):
+            arquivo.arquivar(2019)
+        self.assertIn(2019, particoes.anos_particionados())
+        self.assertEqual(arquivo.anos_arquivados(), [])
+
+    def test_arquivo_so_aparece_depois_da_confirmacao(self):
+        # A remoção da partição é desfeita: o ano continua só no banco
+        with self.assertRaisesMessage(RuntimeError, "falha"), transaction.atomic():
+            arquivo.arquivar(2019)
+            raise RuntimeError("falha na confirmação")
+        self.assertIn(2019, particoes.anos_particionados())
+        self.assertEqual(arquivo.anos_arquivados(), [])
+        self.assertFalse(arquivo.caminho(2019).exists())
+        usuario_gerente(self.client)
+        response = self.client.get(reverse('view_relatorio'), {'data_fim': '2019-12-31'})
+        self.assertEqual([e.id for e in response.context['emprestimos_page']], self.esperados[-12:])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            arquivo.arquivar(2019)
+        self.assertEqual(arquivo.anos_arquivados(), [2019])
+
+    def test_relatorio_inclui_anos_arquivados(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            arquivo.arquivar(2019)
+        usuario_gerente(self.client)
+        url = reverse('view_relatorio')
+        paginas = [self.client.get(url, {'data_inicio': '2019-01-01'}).context['emprestimos_page']]
+        while paginas[-1].has_next():
+            paginas.append(self.client.get(url, {'data_inicio': '2019-01-01', 'cursor': paginas[-1].cursor_proximo})
+                           .context['emprestimos_page'])
+        self.assertEqual([e.id for pagina in paginas for e in pagina], self.esperados)
+        self.assertEqual([len(p) for p in paginas], [15, 15, 5])
+        # Voltando da última página, que só tem linhas do arquivo
+        anterior = self.client.get(url, {'data_inicio': '2019-01-01', 'cursor': paginas[-1].cursor_anterior})
+        self.assertEqual([e.id for e in anterior.context['emprestimos_page']], [e.id for e in paginas[1]])
+        self.assertContains(anterior, "Pessoa 1")
+
+        # Os filtros valem para as linhas arquivadas
+        def ids(**parametros):
+            return [e.id for e in self.client.get(url, {'data_fim': '2019-12-31', **parametros}).context['emprestimos_page']]
+        self.assertEqual(ids(), self.esperados[-12:])
+        self.assertEqual(len(ids(chave=self.chaves[0].id)), 4)
+        self.assertEqual(len(ids(busca='00000000001')), 6)
+        self.assertEqual(ids(status='pendentes'), [])
+        self.assertEqual(ids(data_inicio='2020-01-01'), [])
+
+    def test_analise_segue_com_os_anos_arquivados(self):
+        antes = list(ResumoHorario.objects.filter(dia__year=2019).values_list('dia', 'hora', 'chave_id', 'retiradas'))
+        with self.captureOnCommitCallbacks(execute=True):
+            arquivo.arquivar(2019)
+        resumo.reconstruir()
+        self.assertEqual(list(ResumoHorario.objects.filter(dia__year=2019).values_list('dia', 'hora', 'chave_id', 'retiradas')), antes)
+
+        usuario_gerente(self.client)
+        dados = self.client.get(reverse('analytics_data'), {
+            'start_date': '2019-12-31', 'end_date': '2019-12-31', 'group_by': 'day',
+        }).json()
+        self.assertEqual(dados['retiradas']['data'], [12.0])
+
+
+#------------------------------------------------------------------
+# ANÁLISE (GRÁFICOS)
+#------------------------------------------------------------------
+def horario_local(*args):
+    """ datetime no fuso do projeto (America/Sao_Paulo). """
+    return timezone.make_aware(datetime(*args))
+
+
+class AnalyticsDataTests(TestCase):
+    def setUp(self):
+        _, self.chaves, (self.pessoa,) = criar_dados_basicos(num_chaves=3)
+        usuario_gerente(self.client)
+
+        def emprestimo(chave, retirada, devolucao=None, previsao=None):
+            Emprestimo.objects.create(unidade_id=chave.unidade_id, chave=chave, pessoa=self.pessoa, data_retirada=retirada,
+                                      data_devolucao=devolucao, previsao_devolucao=previsao)
+
+        # Segunda-feira, 23:30 no horário local (já é terça em UTC)
+        emprestimo(self.chaves[0], horario_local(2026, 3, 2, 23, 30))
+        # Quarta-feira: um devolvido no prazo e outro com atraso, no dia seguinte
+        emprestimo(self.chaves[1], horario_local(2026, 3, 4, 8, 10), horario_local(2026, 3, 4, 9, 0), horario_local(2026, 3, 4, 10, 0))
+        emprestimo(self.chaves[2], horario_local(2026, 3, 4, 8, 50), horario_local(2026, 3, 5, 7, 0), horario_local(2026, 3, 4, 12, 0))
+        # Retirada fora do período, devolvida no primeiro dia dele
+        emprestimo(self.chaves[0], horario_local(2026, 2, 28, 23, 59), horario_local(2026, 3, 1, 8, 0))
+        resumo.reconstruir()
+
+    def _dados(self, group_by, **filtros):
+        parametros = {'start_date': '2026-03-01', 'end_date': '2026-03-07', 'group_by': group_by, **filtros}
+        response = self.client.get(reverse('analytics_data'), parametros)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_atrasos(self):
+        self.assertEqual(self._dados('day')['atrasos'], {'labels': ['Em Dia', 'Com Atraso'], 'data': [1, 1]})
+
+    def test_por_dia(self):
+        dados = self._dados('day')
+        self.assertEqual(dados['retiradas']['labels'][0], '01/03/2026')
+        self.assertEqual(len(dados['retiradas']['labels']), 7)
+        self.assertEqual(dados['retiradas']['data'], [0.0, 1.0, 0.0, 2.0, 0.0, 0.0, 0.0])
+        # As devoluções contam pelo dia em que aconteceram
+        self.assertEqual(dados['devolucoes']['data'], [1.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0])
+
+    def test_por_hora_no_fuso_local(self):
+        dados = self._dados('time_of_day')
+        self.assertEqual(dados['retiradas']['labels'][23], '23:00')
+        self.assertEqual(dados['retiradas']['data'][23], 1.0)
+        self.assertEqual(dados['retiradas']['data'][8], 2.0)
+        self.assertEqual(self._dados('time_of_day_avg')['retiradas']['data'][8], 2 / 7)
+
+    def test_por_dia_da_semana(self):
+        dados = self._dados('weekday')
+        self.assertEqual(dados['retiradas']['labels'], ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom'])
+        self.assertEqual(dados['retiradas']['data'], [1.0, 0.0, 2.0, 0.0, 0.0, 0.0, 0.0])
+        self.assertEqual(dados['devolucoes']['data'], [0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 1.0])
+
+    def test_por_dia_do_mes(self):
+        dados = self._dados('monthday_avg')
+        self.assertEqual(len(dados['retiradas']['labels']), 31)
+        self.assertEqual(dados['retiradas']['data'][1], 1.0)
+        self.assertEqual(dados['retiradas']['data'][3], 2.0)
+
+    def test_filtro_por_chave_e_periodo_vazio(self):
+        dados = self._dados('weekday', chave_id=self.chaves[1].id)
+        self.assertEqual(dados['retiradas']['data'], [0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0])
+        vazio = self.client.get(reverse('analytics_data'), {'start_date': '2025-01-01', 'end_date': '2025-01-31'}).json()
+        self.assertEqual(vazio['retiradas'], {'labels': [], 'data': []})
+        self.assertEqual(vazio['devolucoes'], {'labels': [], 'data': []})
+
+    def test_so_conta_a_unidade_da_requisicao(self):
+        _, (chave,), (pessoa,) = criar_dados_basicos(unidade=unidade_de_teste("Outra unidade"))
+        Emprestimo.objects.create(unidade_id=chave.unidade_id, chave=chave, pessoa=pessoa,
+                                  data_retirada=horario_local(2026, 3, 4, 8, 30), previsao_devolucao=horario_local(2026, 3, 4, 9, 0),
+                                  data_devolucao=horario_local(2026, 3, 6, 8, 0))
+        resumo.reconstruir()
+        dados = self._dados('day')
+        self.assertEqual(dados['atrasos']['data'], [1, 1])
+        self.assertEqual(dados['retiradas']['data'], [0.0, 1.0, 0.0, 2.0, 0.0, 0.0, 0.0])
+        self.assertEqual(dados['devolucoes']['data'], [1.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0])
+
+    def test_erro_vai_para_o_log_e_nao_para_a_resposta(self):
+        with self.assertLogs('claviculario_app.views', 'ERROR') as logs:
+            response = self.client.get(reverse('analytics_data'), {'start_date': '2026-13-01'})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': "Erro no servidor ao montar os gráficos."})
+        self.assertIn('Traceback', logs.output[0])
+
+    def test_numero_de_consultas_fixo(self):
+        # sessão + usuário + unidade + atrasos + retiradas e devoluções agrupadas numa consulta, lidas do resumo
+        with self.assertNumQueries(5):
+            self._dados('day')
+
+
+class ResumoHorarioTests(TestCase):
+    CAMPOS = ('dia', 'hora', 'chave_id', 'retiradas', 'devolucoes', 'no_prazo', 'atrasadas')
+
+    def setUp(self):
+        _, self.chaves, self.pessoas = criar_dados_basicos(num_chaves=3, num_pessoas=2)
+
+    def _resumos(self):
+        return list(ResumoHorario.objects.order_by('dia', 'hora', 'chave_id').values_list(*self.CAMPOS))
+
+    def test_servicos_atualizam_o_resumo(self):
+        retirada = horario_local(2026, 3, 2, 23, 30)
+        registrar_retirada(self.chaves[0].id, self.pessoas[0].id, retirada, previsao_devolucao=retirada + timedelta(hours=1))
+        registrar_retirada(self.chaves[1].id, self.pessoas[0].id, retirada, previsao_devolucao=retirada + timedelta(hours=5))
+        registrar_devolucoes(pessoa_id=self.pessoas[0].id, data_devolucao=horario_local(2026, 3, 3, 1, 0))
+
+        self.assertEqual(self._resumos(), [
+            (datetime(2026, 3, 2).date(), 23, self.chaves[0].id, 1, 0, 0, 1),
+            (datetime(2026, 3, 2).date(), 23, self.chaves[1].id, 1, 0, 1, 0),
+            (datetime(2026, 3, 3).date(), 1, self.chaves[0].id, 0, 1, 0, 0),
+            (datetime(2026, 3, 3).date(), 1, self.chaves[1].id, 0, 1, 0, 0),
+        ])
+
+    def test_reconstruir_chega_ao_mesmo_resultado(self):
+        inicio = horario_local(2026, 1, 1, 7, 0)
+        for i in range(30):
+            retirada = inicio + timedelta(hours=i * 5)
+            chave = self.chaves[i % 3]
+            emprestimo = registrar_retirada(chave.id, self.pessoas[i % 2].id, retirada,
+                                            previsao_devolucao=retirada + timedelta(hours=2) if i % 4 else None)
+            if i < 27:  # As três últimas ficam em aberto
+                registrar_devolucoes(emprestimo_ids=[emprestimo.id], data_devolucao=retirada + timedelta(minutes=40 * (i % 6)))
+        incremental = self._resumos()
+
+        ResumoHorario.objects.all().delete()
+        saida = io.StringIO()
+        call_command('reconstruir_resumo', stdout=saida)
+        self.assertEqual(self._resumos(), incremental)
+        self.assertIn(f"{len(incremental)} linha(s)", saida.getvalue())
+
+    def test_reconstruir_apenas_um_periodo(self):
+        criar_historico(72, self.chaves, self.pessoas, inicio=horario_local(2026, 5, 1, 0, 0))
+        resumo.reconstruir()
+        completo = self._resumos()
+
+        ResumoHorario.objects.filter(dia=datetime(2026, 5, 2).date()).update(retiradas=99, devolucoes=99)
+        resumo.reconstruir(inicio=datetime(2026, 5, 2).date(), fim=datetime(2026, 5, 2).date())
+        self.assertEqual(self._resumos(), completo)
+
+    def test_reconstruir_preserva_os_anos_arquivados(self):
+        criar_historico(20, self.chaves, self.pessoas, inicio=horario_local(2025, 12, 31, 0, 0))
+        criar_historico(10, self.chaves, self.pessoas, inicio=horario_local(2026, 1, 2, 0, 0))
+        resumo.reconstruir()
+        completo = self._resumos()
+        Emprestimo.objects.filter(data_retirada__year=2025).delete()
+
+        with tempfile.TemporaryDirectory() as diretorio, override_settings(CLAVICULARIO_ARQUIVO_EMPRESTIMOS=Path(diretorio)):
+            # Só a presença do arquivo do ano importa aqui
+            (Path(diretorio) / 'emprestimos_2025.parquet').touch()
+            resumo.reconstruir()
+        self.assertEqual(self._resumos(), completo)
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+class DadosSinteticosTests(TestCase):
+    def _gerar(self, **opcoes):
+        parametros = dict(locais=3, chaves=40, pessoas=50, dias=20, emprestimos_por_dia=60, abertos=6, semente=7)
+        parametros.update(opcoes)
+        return dados_sinteticos.gerar(**parametros)
+
+    def test_gera_cadastro_e_historico_coerentes(self):
+        totais = self._gerar()
+
+        self.assertEqual((Local.objects.count(), Chave.objects.count(), Pessoa.objects.count()), (3, 40, 50))
+        self.assertEqual(Emprestimo.objects.count(), totais['emprestimos'])
+        self.assertEqual(totais['abertos'], 6)
+        self.assertTrue(Pessoa.objects.first().check_pin('1234'))
+        self.assertFalse(Emprestimo.objects.filter(texto_busca='').exists())
+        self.assertTrue(ResumoHorario.objects.exists())
+
+        # Cada chave emprestada em aberto aponta para o seu empréstimo, e só elas
+        abertos = Emprestimo.objects.filter(data_devolucao__isnull=True)
+        self.assertEqual(set(abertos.values_list('chave_id', 'id')),
+                         set(Chave.objects.filter(emprestimo_atual__isnull=False).values_list('id', 'emprestimo_atual_id')))
+        self.assertTrue(abertos.filter(previsao_devolucao__lt=timezone.now()).exists())
+
+        # Uma chave nunca está com duas pessoas ao mesmo tempo
+        anterior = {}
+        for chave_id, retirada, devolucao in Emprestimo.objects.order_by('chave_id', 'data_retirada').values_list(
+                'chave_id', 'data_retirada', 'data_devolucao'):
+            if chave_id in anterior:
+                self.assertIsNotNone(anterior[chave_id])
+                self.assertLessEqual(anterior[chave_id], retirada)
+            anterior[chave_id] = devolucao
+
+    def test_movimento_concentrado_nos_horarios_de_pico(self):
+        self._gerar()
+        horas = [timezone.localtime(data).hour for data in Emprestimo.objects.values_list('data_retirada', flat=True)]
+        self.assertGreater(horas.count(7), 3 * horas.count(3))
+
+    def test_mesma_semente_gera_os_mesmos_dados(self):
+        self._gerar(dias=3)
+        primeiro = list(Emprestimo.objects.order_by('id').values_list('chave__descricao', 'pessoa__nome', 'data_retirada'))
+        for modelo in (ResumoHorario, Emprestimo, Chave, Pessoa, Local):
+            modelo.objects.all().delete()
+        self._gerar(dias=3)
+        segundo = list(Emprestimo.objects.order_by('id').values_list('chave__descricao', 'pessoa__nome', 'data_retirada'))
+        self.assertEqual([linha[:2] for linha in primeiro], [linha[:2] for linha in segundo])
+
+    def test_comando_recusa_banco_com_dados(self):
+        criar_dados_basicos()
+        with self.assertRaises(CommandError):
+            call_command('gerar_dados_sinteticos', stdout=io.StringIO())
+
+        saida = io.StringIO()
+        call_command('gerar_dados_sinteticos', '--limpar', '--locais=2', '--chaves=10', '--pessoas=10',
+                     '--anos=0.02', '--emprestimos-por-dia=20', '--abertos=2', '--semente=1', stdout=saida)
+        self.assertEqual(Chave.objects.count(), 10)
+        self.assertIn("10 chaves", saida.getvalue())
+
+
+@override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+class TesteCargaTests(TestCase):
+    def setUp(self):
+        dados_sinteticos.gerar(locais=2, chaves=20, pessoas=30, dias=5, emprestimos_por_dia=30, abertos=3, semente=3)
+
+    def test_ciclo_completo_sem_falhas(self):
+        resultados = carga.executar(usuarios=1, iteracoes=3, semente=1)
+        linhas = resultados.resumo()
+
+        for nome in ('dashboard', 'filtrar_chaves_por_local', 'filtrar_pessoas', 'verificar_pin_e_registrar',
+                     'registrar_devolucao', 'view_relatorio', 'relatorio_dados', 'analytics_data'):
+            self.assertEqual(linhas[nome]['requisicoes'], 3, nome)
+            self.assertEqual(linhas[nome]['falhas'], 0, nome)
+        self.assertEqual(linhas['verificar_pin_e_registrar']['recusas'], 0)
+        self.assertLessEqual(linhas['dashboard']['p50_ms'], linhas['dashboard']['p99_ms'])
+        # Tudo o que foi retirado no teste voltou
+        self.assertEqual(Emprestimo.objects.filter(data_devolucao__isnull=True).count(), 3)
+
+    def test_pin_errado_aparece_como_recusa(self):
+        resultados = carga.executar(usuarios=1, iteracoes=2, pin='0000', semente=1)
+        linha = resultados.resumo()['verificar_pin_e_registrar']
+        self.assertEqual((linha['falhas'], linha['recusas']), (0, 2))
+        self.assertNotIn('registrar_devolucao', resultados.resumo())
+
+    def test_comando_mostra_a_tabela(self):
+        saida = io.StringIO()
+        call_command('teste_carga', '--usuarios=1', '--iteracoes=1', stdout=saida)
+        self.assertIn('p95 ms', saida.getvalue())
+        self.assertIn('0 falhas', saida.getvalue())
+
+
+#------------------------------------------------------------------
+# ADMIN
+#------------------------------------------------------------------
+class EmprestimoAdminTests(TestCase):
+    """ O que o admin grava passa pelos resumos dos gráficos e pelo cache do painel, como na mesa. """
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        _, (self.chave,), (self.pessoa,) = criar_dados_basicos()
+        usuario_gerente(self.client)
+        self.retirada = timezone.localtime().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+    def _resumo(self):
+        return ResumoHorario.objects.aggregate(
+            retiradas=Sum('retiradas', default=0), devolucoes=Sum('devolucoes', default=0),
+            no_prazo=Sum('no_prazo', default=0), atrasadas=Sum('atrasadas', default=0),
+        )
+
+    def _em_cache(self):
+        return cache.get(painel._chave_cache(self.chave.unidade_id)) is not None
+
+    def _cadastrar(self, **campos):
+        dados = {
+            'chave': self.chave.pk, 'pessoa': self.pessoa.pk,
+            'data_retirada_0': self.retirada.strftime('%Y-%m-%d'), 'data_retirada_1': self.retirada.strftime('%H:%M:%S'),
+            'previsao_devolucao_0': '', 'previsao_devolucao_1': '', 'observacao': '', **campos,
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('admin:claviculario_app_emprestimo_add'), dados)
+
+    def test_cadastro_e_devolucao_atualizam_resumo_e_painel(self):
+        painel.estatisticas_dashboard(self.chave.unidade)
+        response = self._cadastrar()
+        self.assertEqual(response.status_code, 302)
+        emprestimo = Emprestimo.objects.get()
+        self.assertEqual(Chave.objects.get(pk=self.chave.pk).emprestimo_atual_id, emprestimo.id)
+        self.assertEqual(self._resumo()['retiradas'], 1)
+        self.assertFalse(self._em_cache())
+
+        painel.estatisticas_dashboard(self.chave.unidade)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:claviculario_app_emprestimo_changelist'),
+                             {'action': 'registrar_devolucao', '_selected_action': [emprestimo.id]})
+        self.assertIsNone(Chave.objects.get(pk=self.chave.pk).emprestimo_atual_id)
+        self.assertEqual(self._resumo()['devolucoes'], 1)
+        self.assertFalse(self._em_cache())
+
+    def test_cadastro_com_chave_emprestada_e_recusado(self):
+        registrar_retirada(self.chave.id, self.pessoa.id, self.retirada)
+        response = self._cadastrar()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('chave', response.context['adminform'].form.errors)
+        self.assertEqual(Emprestimo.objects.count(), 1)
+
+    def test_previsao_alterada_e_exclusao_refazem_o_resumo(self):
+        emprestimo = registrar_retirada(self.chave.id, self.pessoa.id, self.retirada,
+                                        previsao_devolucao=self.retirada + timedelta(minutes=30))
+        registrar_devolucoes(emprestimo_ids=[emprestimo.id], data_devolucao=self.retirada + timedelta(hours=1))
+        self.assertEqual(self._resumo(), {'retiradas': 1, 'devolucoes': 1, 'no_prazo': 0, 'atrasadas': 1})
+
+        previsao = timezone.localtime(self.retirada + timedelta(hours=3))
+        painel.estatisticas_dashboard(self.chave.unidade)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:claviculario_app_emprestimo_change', args=[emprestimo.id]), {
+                'pessoa': self.pessoa.pk, 'observacao': '',
+                'previsao_devolucao_0': previsao.strftime('%Y-%m-%d'), 'previsao_devolucao_1': previsao.strftime('%H:%M:%S'),
+            })
+        self.assertEqual(self._resumo(), {'retiradas': 1, 'devolucoes': 1, 'no_prazo': 1, 'atrasadas': 0})
+        self.assertFalse(self._em_cache())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:claviculario_app_emprestimo_delete', args=[emprestimo.id]), {'post': 'yes'})
+        self.assertFalse(Emprestimo.objects.exists())
+        self.assertEqual(self._resumo(), {'retiradas': 0, 'devolucoes': 0, 'no_prazo': 0, 'atrasadas': 0})
+
+
+#------------------------------------------------------------------
+# BENCHMARKS
+#------------------------------------------------------------------
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class RetiradaBenchmark(TestCase):
+    NUM_RETIRADAS = 2000
+
+    def test_vazao_de_retiradas(self):
+        _, chaves, (pessoa,) = criar_dados_basicos(num_chaves=self.NUM_RETIRADAS)
+        agora = timezone.now()
+        inicio = time.perf_counter()
+        for chave in chaves:
+            registrar_retirada(chave.id, pessoa.id, agora)
+        duracao = time.perf_counter() - inicio
+        print(f"\n[benchmark] {self.NUM_RETIRADAS} retiradas em {duracao:.2f}s "
+              f"({self.NUM_RETIRADAS / duracao:.0f} retiradas/s)")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class ImportarPessoasBenchmark(TestCase):
+    TAMANHOS = (1_000, 10_000, 50_000)
+
+    @override_settings(PASSWORD_HASHERS=HASHER_RAPIDO)
+    def test_importacao_sem_custo_de_hash(self):
+        # Mede o pipeline (leitura, diferença de conjuntos e gravação) isolado do PBKDF2
+        for tamanho in self.TAMANHOS:
+            Pessoa.objects.all().delete()
+            df = planilha_pessoas(tamanho)
+            inicio = time.perf_counter()
+            importacao.importar_pessoas(df, unidade_de_teste())
+            duracao = time.perf_counter() - inicio
+            print(f"\n[benchmark] importar_pessoas: {tamanho} linhas em {duracao:.2f}s")
+
+    def test_hash_dos_pins(self):
+        # Custo real do hasher do projeto: serial x pool de processos
+        pins = [f"{i:04d}" for i in range(importacao.MINIMO_PARA_POOL)]
+        for workers in (1, None):
+            inicio = time.perf_counter()
+            importacao.gerar_hashes_pins(pins, workers=workers)
+            duracao = time.perf_counter() - inicio
+            print(f"\n[benchmark] {len(pins)} PINs com workers={workers or os.cpu_count()}: "
+                  f"{duracao:.2f}s ({len(pins) / duracao:.1f} PINs/s)")
+
+
+def _importar_chaves_linha_a_linha(df, unidade):
+    """ Caminho antigo da importação de chaves, mantido só para comparação. """
+    for descricao, nome_local in zip(df['descricao_chave'], df['nome_local']):
+        if Chave.objects.filter(unidade=unidade, descricao=descricao).exists():
+            continue
+        local, _ = Local.objects.get_or_create(unidade=unidade, nome=nome_local, defaults={'ativa': True})
+        Chave.objects.create(unidade=unidade, descricao=descricao, local=local)
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class ImportarChavesBenchmark(TestCase):
+    NUM_CHAVES = 2000
+
+    def test_linha_a_linha_x_em_conjunto(self):
+        df = planilha_chaves(self.NUM_CHAVES)
+        for nome, importar in (('linha a linha', _importar_chaves_linha_a_linha), ('em conjunto', importacao.importar_chaves)):
+            Chave.objects.all().delete()
+            Local.objects.all().delete()
+            inicio = time.perf_counter()
+            importar(df, unidade_de_teste())
+            duracao = time.perf_counter() - inicio
+            print(f"\n[benchmark] importar_chaves ({nome}): {self.NUM_CHAVES} chaves em {duracao:.2f}s")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class ExportacaoBenchmark(TestCase):
+    TAMANHOS = (100_000, 1_000_000)
+
+    def test_tempo_e_memoria_das_exportacoes(self):
+        _, chaves, pessoas = criar_dados_basicos(num_chaves=50, num_pessoas=20)
+        usuario_gerente(self.client)
+        criados = 0
+        for total in self.TAMANHOS:
+            while criados < total:
+                lote = min(50_000, total - criados)
+                criar_historico(lote, chaves, pessoas, inicio=timezone.now() - timedelta(hours=total + criados + 1))
+                criados += lote
+            for nome in ('exportar_relatorio_csv', 'exportar_relatorio_excel'):
+                inicio = time.perf_counter()
+                response = self.client.get(reverse(nome))
+                tamanho = sum(len(parte) for parte in response.streaming_content)
+                duracao = time.perf_counter() - inicio
+                # O pico de RSS do processo só cresce: se a exportação dependesse do
+                # número de linhas, ele subiria de um tamanho para o outro.
+                pico_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                print(f"\n[benchmark] {nome}: {total} empréstimos em {duracao:.1f}s, "
+                      f"{tamanho / 2**20:.1f} MB gerados, pico de RSS do processo {pico_rss:.0f} MB")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class PaginacaoCursorBenchmark(TestCase):
+    TOTAL = 1_000_000
+    POR_PAGINA = 15
+
+    def test_pagina_profunda_custa_o_mesmo_que_a_primeira(self):
+        _, chaves, pessoas = criar_dados_basicos(num_chaves=50, num_pessoas=20)
+        for criados in range(0, self.TOTAL, 50_000):
+            criar_historico(50_000, chaves, pessoas, inicio=timezone.now() - timedelta(hours=self.TOTAL - criados + 1))
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {Emprestimo._meta.db_table}")
+
+        emprestimos = Emprestimo.objects.select_related('chave', 'pessoa')
+        # Cursor da página 5.000, como se o usuário tivesse clicado "Próxima" até lá
+        linha = emprestimos.order_by('-data_retirada', '-id')[5_000 * self.POR_PAGINA - 1]
+        cursores = {1: None, 5_000: paginacao.gerar_cursor(linha, paginacao.PROXIMA)}
+        for numero, cursor in cursores.items():
+            inicio = time.perf_counter()
+            for _ in range(20):
+                list(paginacao.paginar_por_cursor(emprestimos, cursor, self.POR_PAGINA))
+            cursor_ms = (time.perf_counter() - inicio) / 20 * 1000
+
+            inicio = time.perf_counter()
+            for _ in range(3):
+                pagina = Paginator(emprestimos.order_by('-data_retirada', '-id'), self.POR_PAGINA).get_page(numero)
+                list(pagina)
+            offset_ms = (time.perf_counter() - inicio) / 3 * 1000
+            print(f"\n[benchmark] página {numero} de {self.TOTAL} empréstimos: cursor {cursor_ms:.1f}ms, "
+                  f"Paginator (COUNT + OFFSET) {offset_ms:.1f}ms")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class AnalyticsBenchmark(TestCase):
+    TAMANHOS = (10_000, 100_000, 1_000_000)
+    REPETICOES = 5
+
+    def test_latencia_com_o_crescimento_da_tabela(self):
+        # Os períodos consultados são sempre os mesmos; só o histórico anterior cresce
+        _, chaves, pessoas = criar_dados_basicos(num_chaves=50, num_pessoas=20)
+        usuario_gerente(self.client)
+        hoje = timezone.localdate()
+        periodos = {'30 dias': hoje - timedelta(days=29), '3 anos': hoje - timedelta(days=3 * 365)}
+        criados = 0
+        for total in self.TAMANHOS:
+            while criados < total:
+                lote = min(50_000, total - criados)
+                criar_historico(lote, chaves, pessoas, inicio=timezone.now() - timedelta(hours=total + criados + 1))
+                criados += lote
+            inicio = time.perf_counter()
+            linhas = resumo.reconstruir()
+            print(f"\n[benchmark] reconstruir_resumo: {total} empréstimos -> {linhas} linhas em {time.perf_counter() - inicio:.1f}s")
+            if connection.vendor == 'postgresql':
+                # Dentro da transação do teste o autovacuum não vê as linhas novas
+                with connection.cursor() as cursor:
+                    cursor.execute(f"ANALYZE {Emprestimo._meta.db_table}")
+                    cursor.execute(f"ANALYZE {ResumoHorario._meta.db_table}")
+            for nome_periodo, start_date in periodos.items():
+                for group_by in ('day', 'time_of_day', 'weekday_avg'):
+                    parametros = {'group_by': group_by, 'start_date': start_date.isoformat()}
+                    inicio = time.perf_counter()
+                    for _ in range(self.REPETICOES):
+                        self.client.get(reverse('analytics_data'), parametros)
+                    duracao = (time.perf_counter() - inicio) / self.REPETICOES
+                    print(f"\n[benchmark] analytics_data ({group_by}, {nome_periodo}): {total} empréstimos, "
+                          f"{duracao * 1000:.0f}ms por requisição")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+@unittest.skipUnless(connection.vendor == 'postgresql', "Os planos de execução verificados são os do PostgreSQL.")
+class IndicesConsultasBenchmark(TestCase):
+    TOTAL = 1_000_000
+    NUM_CHAVES = 2_000
+    NUM_ABERTOS = 300
+
+    def test_planos_com_um_milhao_de_emprestimos(self):
+        unidade = unidade_de_teste()
+        locais = Local.objects.bulk_create([Local(unidade=unidade, nome=f"Bloco {i}") for i in range(40)])
+        chaves = Chave.objects.bulk_create([
+            Chave(unidade=unidade, descricao=f"Sala {i:05d}", local=locais[i % len(locais)]) for i in range(self.NUM_CHAVES)
+        ])
+        pessoas = criar_pessoas_em_massa(5_000)
+        for criados in range(0, self.TOTAL, 50_000):
+            criar_historico(50_000, chaves, pessoas, inicio=timezone.now() - timedelta(hours=self.TOTAL - criados + 1))
+        # Como em produção, só uma fração pequena está aberta (e parte dela atrasada)
+        agora = timezone.now()
+        for i, chave in enumerate(chaves[:self.NUM_ABERTOS]):
+            registrar_retirada(chave.id, pessoas[i].id, agora - timedelta(hours=i),
+                               previsao_devolucao=agora + timedelta(hours=50 - i))
+        with connection.cursor() as cursor:
+            for modelo in (Emprestimo, Chave, Pessoa, Local):
+                cursor.execute(f"ANALYZE {modelo._meta.db_table}")
+
+        for nome, (queryset, indice) in consultas_quentes(chaves[0], pessoas[0], locais[0]).items():
+            plano = queryset.explain(analyze=True)
+            tempo = re.search(r'Execution Time: ([\d.]+) ms', plano).group(1)
+            print(f"\n[benchmark] {nome}: {tempo}ms ({indice})\n{plano}")
+            with self.subTest(consulta=nome):
+                self.assertTrue(any(nome_indice in plano for nome_indice in _indices(indice)), plano)
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class FiltrarPessoasBenchmark(TestCase):
+    TAMANHOS = (10_000, 100_000)
+    REPETICOES = 20
+    BUSCAS = {
+        'sem filtro': {},
+        'nome comum': {'q': 'silva'},
+        'nome raro': {'q': 'heitor nascimento araújo'},
+        'início do CPF': {'q': '0000001234'},
+        'empresa': {'q': 'limpeza'},
+    }
+
+    def test_latencia_da_busca(self):
+        usuario_gerente(self.client)
+        criados = 0
+        for total in self.TAMANHOS:
+            criar_pessoas_em_massa(total - criados, inicio=criados)
+            criados = total
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(f"ANALYZE {Pessoa._meta.db_table}")
+            for nome, parametros in self.BUSCAS.items():
+                inicio = time.perf_counter()
+                for _ in range(self.REPETICOES):
+                    self.client.get(reverse('filtrar_pessoas'), parametros)
+                duracao = (time.perf_counter() - inicio) / self.REPETICOES
+                print(f"\n[benchmark] filtrar_pessoas ({nome}): {total} pessoas, {duracao * 1000:.1f}ms por requisição")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+@override_settings(PASSWORD_HASHERS=[
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+    'claviculario_app.hashers.PBKDF2PinHasher',
+])
+class PinsHashersBenchmark(TestCase):
+    """ Quanto custa conferir um PIN com cada hasher, e uma tentativa já bloqueada. """
+    REPETICOES = 10
+    HASHERS = [
+        ('pbkdf2_sha256', {}),
+        ('scrypt', {}),
+        ('pbkdf2_pin', {'CLAVICULARIO_PIN_ITERACOES': 20_000}),
+        ('pbkdf2_pin', {'CLAVICULARIO_PIN_ITERACOES': 50_000}),
+        ('pbkdf2_pin', {'CLAVICULARIO_PIN_ITERACOES': 100_000}),
+    ]
+
+    def test_custo_por_conferencia(self):
+        for algoritmo, configuracao in self.HASHERS:
+            with override_settings(**configuracao):
+                codificado = make_password('123456', hasher=algoritmo)
+                inicio = time.perf_counter()
+                for _ in range(self.REPETICOES):
+                    check_password('000000', codificado)
+                duracao = (time.perf_counter() - inicio) / self.REPETICOES
+            # Um PIN curto não resiste a quem tiver os hashes: o custo só muda quanto tempo isso leva
+            nome = f"{algoritmo}, {configuracao['CLAVICULARIO_PIN_ITERACOES']} iterações" if configuracao else algoritmo
+            print(f"\n[benchmark] {nome}: {duracao * 1000:.1f}ms por conferência; "
+                  f"todos os PINs de 4 dígitos em {10_000 * duracao / 60:.1f} min, "
+                  f"de 6 dígitos em {1_000_000 * duracao / 3600:.1f} h (um núcleo)")
+
+    def test_tentativa_bloqueada(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        _, _, (pessoa,) = criar_dados_basicos()
+        inicio = time.perf_counter()
+        for _ in range(5):
+            verificar_pin(pessoa, '0000', '10.0.0.1')
+        conferencia = (time.perf_counter() - inicio) / 5
+        inicio = time.perf_counter()
+        for _ in range(1000):
+            with self.assertRaises(PinBloqueadoError):
+                verificar_pin(pessoa, '0000', '10.0.0.1')
+        bloqueada = (time.perf_counter() - inicio) / 1000
+        print(f"\n[benchmark] tentativa errada: {conferencia * 1000:.1f}ms; "
+              f"tentativa bloqueada: {bloqueada * 1_000_000:.0f}µs")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+@override_settings(CLAVICULARIO_BANCO_RELATORIOS='reporting')
+class ReplicaBenchmark(TransactionTestCase):
+    """
+    Latência da retirada sozinha e durante exportações seguidas de um ano de
+    histórico pela réplica. Com o 'reporting' apontando para o mesmo servidor
+    (e a exportação numa thread deste processo, disputando o GIL), a retirada
+    piora; apontado para uma réplica de verdade, as duas medidas devem ficar
+    próximas.
+    """
+    databases = {'default', 'reporting'}
+    HISTORICO = 200_000
+    RETIRADAS = 300
+
+    def _latencias(self, chaves, pessoa):
+        tempos = []
+        for chave in chaves:
+            inicio = time.perf_counter()
+            emprestimo = registrar_retirada(chave.id, pessoa.id, timezone.now())
+            tempos.append(time.perf_counter() - inicio)
+            registrar_devolucoes(emprestimo_ids=[emprestimo.id])
+        cortes = statistics.quantiles(tempos, n=100, method='inclusive')
+        return cortes[49] * 1000, cortes[94] * 1000
+
+    def _exportar_sem_parar(self, parar, exportacoes):
+        client = Client()
+        client.force_login(User.objects.get(username='gerente_geral'))
+        try:
+            while not parar.is_set():
+                b''.join(client.get(reverse('exportar_relatorio_csv')).streaming_content)
+                exportacoes.append(1)
+        finally:
+            connections.close_all()
+
+    def test_retirada_durante_exportacao(self):
+        _, chaves, pessoas = criar_dados_basicos(num_chaves=self.RETIRADAS + 50, num_pessoas=20)
+        usuario_gerente()
+        for criados in range(0, self.HISTORICO, 50_000):
+            criar_historico(50_000, chaves[self.RETIRADAS:], pessoas,
+                            inicio=timezone.now() - timedelta(hours=self.HISTORICO - criados + 1))
+        sozinha = self._latencias(chaves[:self.RETIRADAS], pessoas[0])
+
+        parar, exportacoes = threading.Event(), []
+        exportando = threading.Thread(target=self._exportar_sem_parar, args=(parar, exportacoes))
+        exportando.start()
+        try:
+            time.sleep(1)
+            concorrente = self._latencias(chaves[:self.RETIRADAS], pessoas[1])
+        finally:
+            parar.set()
+            exportando.join()
+        print(f"\n[benchmark] retirada sozinha: p50 {sozinha[0]:.1f}ms, p95 {sozinha[1]:.1f}ms; durante "
+              f"{len(exportacoes)} exportações de {self.HISTORICO} empréstimos: p50 {concorrente[0]:.1f}ms, "
+              f"p95 {concorrente[1]:.1f}ms")
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+class TesteCargaBenchmark(TransactionTestCase):
+    """ Um ano de histórico e quatro atendentes simultâneos durante 20 segundos. """
+    USUARIOS = 4
+    DURACAO = 20
+
+    def test_latencia_por_endpoint(self):
+        totais = dados_sinteticos.gerar(semente=1)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+        resultados = carga.executar(usuarios=self.USUARIOS, duracao=self.DURACAO, semente=1)
+        print(f"\n[benchmark] teste de carga: {totais['emprestimos']} empréstimos, {self.USUARIOS} atendentes, "
+              f"{self.DURACAO}s\n{resultados.tabela()}")
+
+
+class UrlsComparacaoApis:
+    """ As duas versões de cada API lado a lado, para o benchmark. """
+    urlpatterns = [
+        path('sincrona/pessoas/', views.filtrar_pessoas),
+        path('assincrona/pessoas/', views.filtrar_pessoas_async),
+        path('sincrona/chaves/', views.filtrar_chaves_por_local),
+        path('assincrona/chaves/', views.filtrar_chaves_por_local_async),
+        path('sincrona/analytics/', views.analytics_data),
+        path('assincrona/analytics/', views.analytics_data_async),
+        path('sincrona/pin/', views.verificar_pin_e_registrar),
+        path('assincrona/pin/', views.verificar_pin_e_registrar_async),
+    ]
+
+
+@tag('benchmark')
+@unittest.skipUnless(BENCHMARK, "Defina CLAVICULARIO_BENCHMARK=1 para rodar os benchmarks.")
+@override_settings(ROOT_URLCONF=UrlsComparacaoApis)
+class ApisAssincronasBenchmark(TransactionTestCase):
+    """
+    Mesas simultâneas chamando as APIs JSON de três formas: view síncrona
+    sob WSGI (uma thread por mesa), view síncrona sob ASGI e view assíncrona
+    sob ASGI (o handler ASGI real do Django, chamado direto, sem servidor).
+    O PIN usa o hasher de produção e um PIN errado: o hash é todo calculado,
+    mas nada é gravado.
+    """
+    MESAS = 8
+    REPETICOES = 25
+    REPETICOES_PIN = 2
+
+    def _wsgi(self, caminho, metodo, dados, repeticoes, usuario):
+        resultados = carga.Resultados()
+
+        def mesa():
+            client = Client()
+            client.force_login(usuario)
+            try:
+                for _ in range(repeticoes):
+                    inicio = time.perf_counter()
+                    response = getattr(client, metodo.lower())(caminho, dados)
+                    # Como o WSGIHandler real no fim de cada requisição, com CONN_MAX_AGE = 0
+                    connections.close_all()
+                    resultados.registrar('api', time.perf_counter() - inicio, falha=response.status_code >= 400)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=mesa) for _ in range(self.MESAS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        resultados.fim = time.perf_counter()
+        return resultados
+
+    def _asgi(self, caminho, metodo, dados, repeticoes, usuario):
+        aplicacao = get_asgi_application()
+        client = Client()
+        client.force_login(usuario)
+        token = get_random_string(32)
+        cookies = {'sessionid': client.cookies['sessionid'].value, 'csrftoken': token}
+        resultados = carga.Resultados()
+
+        async def mesa():
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                status, _ = await carga.requisicao_asgi(aplicacao, metodo, caminho, dados, cookies,
+                                                        cabecalhos={'X-CSRFToken': token})
+                resultados.registrar('api', time.perf_counter() - inicio, falha=status >= 400)
+
+        async def todas():
+            await asyncio.gather(*(mesa() for _ in range(self.MESAS)))
+
+        asyncio.run(todas())
+        resultados.fim = time.perf_counter()
+        return resultados
+
+    def test_sincrona_e_assincrona_sob_wsgi_e_asgi(self):
+        dados_sinteticos.gerar(dias=90, semente=1)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+        usuario = User.objects.create_superuser('bancada', 'bancada@exemplo.com', 'x')
+        chave = Chave.objects.filter(emprestimo_atual__isnull=True).first()
+        inicio = (timezone.localdate() - timedelta(days=30)).isoformat()
+        apis = [
+            ('pessoas', 'GET', {'q': 'silva'}, self.REPETICOES),
+            ('chaves', 'GET', {'local_id': chave.local_id}, self.REPETICOES),
+            ('analytics', 'GET', {'group_by': 'day', 'start_date': inicio}, self.REPETICOES),
+            ('pin', 'POST', {'chave_id': chave.id, 'pessoa_id': Pessoa.objects.values_list('id', flat=True).first(),
+                             'pin': '0000', 'data_retirada': '2026-03-02T08:00'}, self.REPETICOES_PIN),
+        ]
+        modos = [
+            ('WSGI, síncrona', self._wsgi, 'sincrona'),
+            ('ASGI, síncrona', self._asgi, 'sincrona'),
+            ('ASGI, assíncrona', self._asgi, 'assincrona'),
+        ]
+        for api, metodo, dados, repeticoes in apis:
+            for modo, executar, versao in modos:
+                linha = executar(f'/{versao}/{api}/', metodo, dados, repeticoes, usuario).resumo()['api']
+                self.assertEqual(linha['falhas'], 0)
+                print(f"\n[benchmark] {api} ({modo}, {self.MESAS} mesas): {linha['por_segundo']:.1f} req/s, "
+                      f"p50={linha['p50_ms']:.1f}ms p95={linha['p95_ms']:.1f}ms p99={linha['p99_ms']:.1f}ms")
+        self.assertFalse(Emprestimo.objects.filter(data_retirada=timezone.make_aware(datetime(2026, 3, 2, 8, 0))).exists())
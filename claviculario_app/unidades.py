@@ -0,0 +1,95 @@
+# claviculario_app/unidades.py
+
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from .models import Unidade
+
+# Unidade escolhida pelo usuário (ver selecionar_unidade)
+SESSAO_UNIDADE = 'claviculario_unidade'
+
+
+def unidades_do_usuario(usuario):
+    """ Unidades que o usuário pode usar: as que criou e as de que é membro (todas, para o superusuário). """
+    if usuario.is_superuser:
+        return Unidade.objects.order_by('id')
+    return Unidade.objects.filter(Q(owner=usuario) | Q(membros=usuario)).distinct().order_by('id')
+
+
+def unidade_da_requisicao(request, usuario=None):
+    """
+    Unidade em que o usuário está trabalhando: a escolhida na sessão, se ele
+    ainda tiver acesso a ela, ou a primeira das suas. Uma consulta por
+    requisição. None para visitantes; PermissionDenied para quem não pertence
+    a nenhuma unidade.
+    """
+    usuario = usuario or request.user
+    if not usuario.is_authenticated:
+        return None
+    unidades = unidades_do_usuario(usuario)
+    escolhida = request.session.get(SESSAO_UNIDADE)
+    unidade = unidades.filter(pk=escolhida).first() if escolhida else None
+    if unidade is None:
+        unidade = unidades.first()
+    if unidade is None:
+        raise PermissionDenied("Seu usuário não pertence a nenhuma unidade.")
+    return unidade
+
+
+async def _aunidade(request):
+    if not hasattr(request, '_unidade'):
+        # request.auser() e request.user guardam o usuário em lugares diferentes
+        usuario = await request.auser()
+        request._unidade = await sync_to_async(unidade_da_requisicao)(request, usuario)
+    return request._unidade
+
+
+def _unidade(request):
+    if not hasattr(request, '_unidade'):
+        request._unidade = unidade_da_requisicao(request)
+    return request._unidade
+
+
+def unidade_ou_nenhuma(request):
+    """
+    request.unidade, ou None para quem ainda não pertence a nenhuma unidade:
+    para as páginas que precisam abrir mesmo assim (o menu e a troca de
+    unidade), em vez do 403.
+    """
+    try:
+        return _unidade(request)
+    except PermissionDenied:
+        return None
+
+
+def contexto(request):
+    """ Context processor: 'unidade_atual' nos templates, lida só se o template usar. """
+    return {'unidade_atual': partial(unidade_ou_nenhuma, request)}
+
+
+def incluir_na_unidade_padrao(request, user, **kwargs):
+    """
+    Receptor do user_signed_up do allauth: quem se cadastra pelo login social
+    entra na unidade CLAVICULARIO_UNIDADE_NOVOS_USUARIOS (id). Sem ela, o
+    usuário fica sem unidade até que um administrador o inclua em uma (ver
+    forms.CustomUserChangeForm).
+    """
+    unidade_id = getattr(settings, 'CLAVICULARIO_UNIDADE_NOVOS_USUARIOS', None)
+    if unidade_id is not None:
+        Unidade.objects.get(pk=unidade_id).membros.add(user)
+
+
+class UnidadeMiddleware(MiddlewareMixin):
+    """
+    request.unidade: a unidade da requisição, resolvida só no primeiro uso.
+    Nas views assíncronas, use 'await request.aunidade()'.
+    """
+    def process_request(self, request):
+        request.unidade = SimpleLazyObject(partial(_unidade, request))
+        request.aunidade = partial(_aunidade, request)
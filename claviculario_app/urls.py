@@ -1,9 +1,16 @@
 # claviculario_app/urls.py
 
+from django.conf import settings
 from django.urls import path
 from . import views
 from django.contrib.auth import views as auth_views
 
+
+def _api(sincrona, assincrona):
+    """ Versão da view conforme CLAVICULARIO_APIS_ASSINCRONAS (a assíncrona só compensa sob ASGI). """
+    return assincrona if getattr(settings, 'CLAVICULARIO_APIS_ASSINCRONAS', False) else sincrona
+
+
 urlpatterns = [
     # --- Autenticação ---
     
@@ -18,6 +25,7 @@ urlpatterns = [
     # --- Rota Principal (Homepage) ---
     # Apenas UMA rota para o caminho vazio (''). Agora ela aponta para a dashboard.
     path('', views.dashboard, name='dashboard'),
+    path('unidade/', views.selecionar_unidade, name='selecionar_unidade'),
     
     # --- Páginas de pessoas
     path('pessoas/', views.PessoaListView.as_view(), name='pessoa_list'),
@@ -43,13 +51,19 @@ urlpatterns = [
     path('retirada/', views.view_retirada, name='view_retirada'),
     path('devolucao/', views.view_devolucao, name='view_devolucao'),
     path('emprestimo/<int:emprestimo_id>/devolver/', views.registrar_devolucao, name='registrar_devolucao'),
+    path('emprestimo/devolver-lote/', views.registrar_devolucoes_em_lote, name='registrar_devolucoes_em_lote'),
     path('relatorio/', views.view_relatorio, name='view_relatorio'),
+    path('api/relatorio/', views.relatorio_dados, name='relatorio_dados'),
+    path('relatorio/horario/', views.view_consulta_horario, name='view_consulta_horario'),
+    path('api/relatorio/horario/', views.consulta_horario_dados, name='consulta_horario_dados'),
+    path('api/eventos/', views.eventos_stream, name='eventos_stream'),
     
     # --- Funcionalidades (APIs) ---
     path('pessoa/cadastrar/', views.cadastrar_pessoa, name='cadastrar_pessoa'),
-    path('api/pessoas/', views.filtrar_pessoas, name='filtrar_pessoas'),
-    path('retirada/verificar/', views.verificar_pin_e_registrar, name='verificar_pin_e_registrar'),
-     path('api/chaves/', views.filtrar_chaves_por_local, name='filtrar_chaves_por_local'),
+    path('api/pessoas/', _api(views.filtrar_pessoas, views.filtrar_pessoas_async), name='filtrar_pessoas'),
+    path('retirada/verificar/', _api(views.verificar_pin_e_registrar, views.verificar_pin_e_registrar_async), name='verificar_pin_e_registrar'),
+     path('api/chaves/', _api(views.filtrar_chaves_por_local, views.filtrar_chaves_por_local_async), name='filtrar_chaves_por_local'),
+    path('api/chaves/busca/', views.buscar_chaves, name='buscar_chaves'),
 
     # --- Exportações
     path('relatorio/exportar/csv/', views.exportar_relatorio_csv, name='exportar_relatorio_csv'),
@@ -63,10 +77,11 @@ urlpatterns = [
     # ---PROCESSAR OS UPLOADS
     path('importar/processar-pessoas/', views.importar_pessoas, name='importar_pessoas'),
     path('importar/processar-chaves/', views.importar_chaves, name='importar_chaves'),
+    path('api/importacoes/<int:pk>/', views.importacao_status, name='importacao_status'),
 
     path('analise/', views.analytics_page, name='analytics_page'),
     # --- API PARA ANALISE DOS DADOS
-    path('api/analytics-data/', views.analytics_data, name='analytics_data'),
+    path('api/analytics-data/', _api(views.analytics_data, views.analytics_data_async), name='analytics_data'),
 
 
 ]
\ No newline at end of file
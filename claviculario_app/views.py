@@ -1,14 +1,19 @@
 
 from datetime import timedelta
 from datetime import datetime
-import traceback
+from itertools import islice
+import io
+import logging
+import tempfile
 
+from django import forms
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
-from django.http import HttpResponse, JsonResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, FileResponse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
-from django.core.paginator import Paginator
 from django.utils import timezone
 from django.contrib.auth.models import User # Importa o modelo User
 from django.views.generic import ListView, CreateView, UpdateView # Importa as CBVs do Django
@@ -17,7 +22,8 @@ from django.views.generic import ListView, CreateView, UpdateView # Importa as C
 import csv
 from openpyxl import Workbook
 import pandas as pd
-from django.db.models import Count, F
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import ExtractIsoWeekDay, ExtractDay
 
 from django.contrib.auth.mixins import AccessMixin
 # IMPORTAÇÃO DOS NOSSOS MIXINS CUSTOMIZADOS
@@ -27,36 +33,60 @@ from .mixins import (
 )
 
 # Imports dos Modelos e Formulários
-from .models import Emprestimo, Chave, Pessoa, Local
+from .models import Emprestimo, Chave, Pessoa, Local, ImportacaoJob, ResumoHorario
 from .forms import (
-    EmprestimoForm, RelatorioForm, PessoaForm, ChaveForm, LocalForm,
+    EmprestimoForm, RelatorioForm, ConsultaHorarioForm, PessoaForm, ChaveForm, LocalForm, SelecionarUnidadeForm,
     CustomUserCreationForm, CustomUserChangeForm # Importa os novos formulários de usuário
 )
+from .tarefas import enfileirar_importacao, encerrar_interrompidos
+from . import arquivo, busca, eventos, periodos
+from .instrumentacao import instrumentar, etapa
+from .replicas import le_da_replica
+from .paginacao import paginar_por_cursor, CursorInvalido
+from .painel import estatisticas_dashboard, invalidar_dashboard
+from .services import (
+    registrar_retirada, registrar_devolucoes, ChaveIndisponivelError, PeriodoOcupadoError, RetiradaNoFuturoError, DEVOLVIDO,
+)
+from .pin import ip_do_cliente, verificar_pin, verificar_pin_async, PinBloqueadoError
+from .unidades import SESSAO_UNIDADE, unidade_ou_nenhuma, unidades_do_usuario
+
+logger = logging.getLogger(__name__)
+
+MENSAGEM_PERIODO_OCUPADO = 'Nesse horário a chave ainda estava com outra pessoa. Confira a data da retirada.'
 
 @login_required
 def view_retirada(request):
     if request.method == 'POST':
-        form = EmprestimoForm(request.POST)
+        form = EmprestimoForm(request.POST, unidade=request.unidade)
         if form.is_valid():
             chave_selecionada = form.cleaned_data['chave']
-            if not chave_selecionada.disponivel:
+            try:
+                registrar_retirada(
+                    chave_id=chave_selecionada.id,
+                    pessoa_id=form.cleaned_data['pessoa'].id,
+                    data_retirada=form.cleaned_data['data_retirada'],
+                    previsao_devolucao=form.cleaned_data['previsao_devolucao'],
+                    observacao=form.cleaned_data['observacao'],
+                )
+            except PeriodoOcupadoError:
+                messages.error(request, MENSAGEM_PERIODO_OCUPADO)
+                return redirect('view_retirada')
+            except ChaveIndisponivelError:
                 messages.error(request, 'Esta chave já foi emprestada. Por favor, selecione outra.')
                 return redirect('view_retirada')
-            form.save()
-            chave_selecionada.disponivel = False
-            chave_selecionada.save()
             messages.success(request, f'Chave "{chave_selecionada.descricao}" emprestada com sucesso!')
             return redirect('view_retirada')
     else:
-        form = EmprestimoForm()
+        form = EmprestimoForm(unidade=request.unidade)
 
-    emprestimos_ativos = Emprestimo.objects.filter(data_devolucao__isnull=True).order_by('-data_retirada')
-    form_pessoa = PessoaForm()
-    locais = Local.objects.all().order_by('nome')
+    emprestimos_ativos = Emprestimo.objects.da_unidade(request.unidade).filter(data_devolucao__isnull=True).select_related('chave', 'pessoa').order_by('-data_retirada')
+    form_pessoa = PessoaForm(unidade=request.unidade)
+    locais = Local.objects.da_unidade(request.unidade).order_by('nome')
     contexto = {
         'form': form,
         'form_pessoa' : form_pessoa,
         'emprestimos_ativos': emprestimos_ativos,
+        'agora': timezone.now(),
         'locais' : locais,
         'pagina_ativa': 'retirada' # Para o menu lateral
     }
@@ -65,11 +95,11 @@ def view_retirada(request):
 # NOVA VIEW PARA A PÁGINA DE DEVOLUÇÃO
 @login_required
 def view_devolucao(request):
-    emprestimos_ativos = Emprestimo.objects.filter(data_devolucao__isnull=True).order_by('chave__descricao')
+    emprestimos_ativos = Emprestimo.objects.da_unidade(request.unidade).filter(data_devolucao__isnull=True).select_related('chave', 'pessoa').order_by('chave__descricao')
     
     # Filtra as chaves e pessoas que têm empréstimos ativos
-    chaves_emprestadas = Chave.objects.filter(id__in=emprestimos_ativos.values_list('chave_id', flat=True)).distinct()
-    pessoas_com_chave = Pessoa.objects.filter(id__in=emprestimos_ativos.values_list('pessoa_id', flat=True)).distinct()
+    chaves_emprestadas = Chave.objects.da_unidade(request.unidade).filter(emprestimo_atual__isnull=False)
+    pessoas_com_chave = Pessoa.objects.da_unidade(request.unidade).filter(id__in=emprestimos_ativos.values_list('pessoa_id', flat=True)).distinct()
 
     # Lógica para filtros GET
     chave_id_filtrada = request.GET.get('chave')
@@ -83,61 +113,194 @@ def view_devolucao(request):
 
     contexto = {
         'emprestimos': emprestimos_ativos,
+        'agora': timezone.now(),
         'chaves_emprestadas': chaves_emprestadas,
         'pessoas_com_chave': pessoas_com_chave,
         'pagina_ativa': 'devolucao' # Para o menu lateral
     }
     return render(request, 'claviculario_app/devolucao.html', contexto)
 
-def paginador(request,lista:list,quant_por_pag:int = 15) :
-    # Cria um Paginator com a nossa lista , mostrando n itens por página
-    paginator = Paginator(lista, quant_por_pag)
-    
-    # Pega o número da página da URL (ex: ?page=2)
-    page_number = request.GET.get('page')
-    
-    # Pega o objeto da página correta
-    pagina = paginator.get_page(page_number)
-
-    return pagina
+def paginador(request, emprestimos, quant_por_pag:int = 15, arquivados=None) :
+    """
+    Página de empréstimos por cursor (parâmetro 'cursor' da URL), do mais
+    recente para o mais antigo. Sem COUNT nem OFFSET: a página 5.000 custa o
+    mesmo que a primeira. Um cursor inválido volta para a primeira página.
+    """
+    try:
+        return paginar_por_cursor(emprestimos, request.GET.get('cursor'), quant_por_pag, arquivados)
+    except CursorInvalido:
+        return paginar_por_cursor(emprestimos, None, quant_por_pag, arquivados)
 
 # NOVA VIEW PARA A PÁGINA DE RELATÓRIO
 @login_required
+@instrumentar('relatorio')
+@le_da_replica
 def view_relatorio(request):
-    form = RelatorioForm(request.GET)
-    emprestimos_list = _get_emprestimos_filtrados(request)
+    form = RelatorioForm(request.GET, unidade=request.unidade)
+    emprestimos_list = _get_emprestimos_filtrados(request, form)
+    # Anos já arquivados (ver arquivo.py) entram quando o período pede por eles
+    arquivados = arquivo.do_relatorio(form, request.unidade)
     contexto = {
         'form': form,
-        'emprestimos_page': paginador(request,emprestimos_list),
+        'emprestimos_page': paginador(request, emprestimos_list, arquivados=arquivados),
         'pagina_ativa': 'relatorio' # Para o menu lateral
     }
     return render(request, 'claviculario_app/relatorio.html', contexto)
 
+# CAMPOS DO RELATÓRIO EM JSON (lidos direto do banco, sem montar objetos)
+CAMPOS_RELATORIO_JSON = (
+    'id', 'chave__descricao', 'chave__local__nome', 'pessoa__nome', 'pessoa__cpf_saran',
+    'data_retirada', 'previsao_devolucao', 'data_devolucao', 'observacao',
+)
+MAXIMO_RELATORIO_JSON = 500
+
+@login_required
+@instrumentar('relatorio_json')
+@le_da_replica
+def relatorio_dados(request):
+    """
+    O relatório em JSON, com os mesmos filtros da página, paginado por cursor.
+
+    Parâmetros: os do RelatorioForm, 'cursor' (o 'next' ou 'previous' de uma
+    resposta anterior) e 'limite'. Não há total: 'next' nulo indica o fim.
+    """
+    try:
+        limite = min(MAXIMO_RELATORIO_JSON, max(1, int(request.GET.get('limite', 50))))
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Limite inválido.'}, status=400)
+    emprestimos = _get_emprestimos_filtrados(request).values(*CAMPOS_RELATORIO_JSON)
+    try:
+        with etapa(request, 'pagina'):
+            pagina = paginar_por_cursor(emprestimos, request.GET.get('cursor'), limite)
+    except CursorInvalido:
+        return JsonResponse({'success': False, 'message': 'Cursor inválido.'}, status=400)
+    return JsonResponse({
+        'results': list(pagina),
+        'next': pagina.cursor_proximo,
+        'previous': pagina.cursor_anterior,
+    })
+
+# CONSULTA "QUEM ESTAVA COM A CHAVE" NUM INSTANTE OU INTERVALO
+def _emprestimos_no_horario(form, unidade):
+    """ Os empréstimos da consulta por horário, com o formulário já validado. """
+    dados = form.cleaned_data
+    return periodos.quem_estava(
+        Emprestimo.objects.da_unidade(unidade).select_related('chave', 'chave__local', 'pessoa').order_by('-data_retirada'),
+        instante=dados['instante'], inicio=dados['inicio'], fim=dados['fim'],
+        chave=dados['chave'], local=dados['local'], pessoa=dados['pessoa'], unidade=unidade,
+    )
+
+@login_required
+def view_consulta_horario(request):
+    form = ConsultaHorarioForm(request.GET or None, unidade=request.unidade)
+    contexto = {
+        'form': form,
+        'emprestimos_page': paginador(request, _emprestimos_no_horario(form, request.unidade)) if form.is_valid() else None,
+        'pagina_ativa': 'consulta_horario'
+    }
+    return render(request, 'claviculario_app/consulta_horario.html', contexto)
+
+@login_required
+def consulta_horario_dados(request):
+    """
+    A consulta por horário em JSON. Parâmetros: os do ConsultaHorarioForm
+    ('instante' ou 'inicio' e 'fim', em ISO 8601, e 'chave', 'local' ou
+    'pessoa'), 'cursor' e 'limite', como em relatorio_dados.
+    """
+    form = ConsultaHorarioForm(request.GET, unidade=request.unidade)
+    if not form.is_valid():
+        return JsonResponse({'success': False, 'message': 'Parâmetros inválidos.', 'errors': form.errors}, status=400)
+    try:
+        limite = min(MAXIMO_RELATORIO_JSON, max(1, int(request.GET.get('limite', 50))))
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Limite inválido.'}, status=400)
+    try:
+        pagina = paginar_por_cursor(_emprestimos_no_horario(form, request.unidade).values(*CAMPOS_RELATORIO_JSON),
+                                    request.GET.get('cursor'), limite)
+    except CursorInvalido:
+        return JsonResponse({'success': False, 'message': 'Cursor inválido.'}, status=400)
+    return JsonResponse({
+        'results': list(pagina),
+        'next': pagina.cursor_proximo,
+        'previous': pagina.cursor_anterior,
+    })
+
 # Esta função permanece quase a mesma, apenas o redirect muda
 @login_required
 def registrar_devolucao(request, emprestimo_id):
     if request.method == 'POST':
-        emprestimo = get_object_or_404(Emprestimo, id=emprestimo_id)
-        if emprestimo.data_devolucao is not None:
+        emprestimo = get_object_or_404(Emprestimo.objects.da_unidade(request.unidade).select_related('chave'), id=emprestimo_id)
+        resultado = registrar_devolucoes(emprestimo_ids=[emprestimo.id], unidade=request.unidade)[emprestimo.id]
+        if resultado != DEVOLVIDO:
             messages.warning(request, 'Esta chave já foi devolvida anteriormente.')
         else:
-            emprestimo.data_devolucao = timezone.now()
-            emprestimo.save()
-            chave = emprestimo.chave
-            chave.disponivel = True
-            chave.save()
-            messages.info(request, f'Devolução da chave "{chave.descricao}" registrada com sucesso.')
+            messages.info(request, f'Devolução da chave "{emprestimo.chave.descricao}" registrada com sucesso.')
     
     # Redireciona de volta para a página de devolução
     return redirect('view_devolucao')
 
+# API PARA DEVOLVER VÁRIAS CHAVES DE UMA SÓ VEZ
+@login_required
+def registrar_devolucoes_em_lote(request):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Método inválido.'}, status=405)
+
+    emprestimo_ids = request.POST.getlist('emprestimo_ids')
+    pessoa_id = request.POST.get('pessoa_id') or None
+    if not emprestimo_ids and not pessoa_id:
+        return JsonResponse({'success': False, 'message': 'Nenhum empréstimo selecionado.'}, status=400)
+
+    try:
+        resultados = registrar_devolucoes(emprestimo_ids=emprestimo_ids or None, pessoa_id=pessoa_id,
+                                          unidade=request.unidade)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Identificadores inválidos.'}, status=400)
+
+    devolvidos = sum(1 for resultado in resultados.values() if resultado == DEVOLVIDO)
+    return JsonResponse({
+        'success': True,
+        'message': f'{devolvidos} chave(s) devolvida(s) com sucesso.',
+        'devolvidos': devolvidos,
+        'resultados': {str(emprestimo_id): resultado for emprestimo_id, resultado in resultados.items()},
+    })
+
+# FLUXO DE EVENTOS (SERVER-SENT EVENTS) PARA AS MESAS
+# Segundos sem eventos até a conexão mandar um comentário (mantém proxies e o navegador atentos)
+PULSO_EVENTOS = 15
+# Espera do navegador antes de reconectar, em milissegundos
+RECONEXAO_EVENTOS = 3000
+
+@login_required
+async def eventos_stream(request):
+    """
+    Retiradas, devoluções, chaves desativadas e atrasos, ao vivo, em
+    text/event-stream. Cada conexão só espera na fila do backend de eventos:
+    nada é consultado no banco por conexão. Precisa de um servidor ASGI
+    (config.asgi); sob WSGI responde 204, e o navegador não tenta de novo.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    ultimo_id = request.headers.get('Last-Event-ID')
+    unidade = await request.aunidade()
+    eventos.iniciar_vigia_de_atrasos()
+
+    async def fluxo():
+        yield f"retry: {RECONEXAO_EVENTOS}\n\n"
+        async for evento in eventos.backend().assinar(ultimo_id, pulso=PULSO_EVENTOS, unidade_id=unidade.pk):
+            yield evento.texto if evento is not None else ": pulso\n\n"
+
+    response = StreamingHttpResponse(fluxo(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Nginx: não segurar os eventos no buffer
+    return response
+
 # NOVA VIEW PARA CADASTRAR PESSOA
 @login_required
 def cadastrar_pessoa(request):
     # Dicionário para a resposta JSON
     data = {'success': False}
     if request.method == 'POST':
-        form = PessoaForm(request.POST)
+        form = PessoaForm(request.POST, unidade=request.unidade)
         if form.is_valid():
             pessoa = form.save()
             data['success'] = True
@@ -150,113 +313,217 @@ def cadastrar_pessoa(request):
     # Retorna uma resposta JSON em vez de renderizar um template
     return JsonResponse(data)
 
-#  VIEW PARA SERVIR COMO API DE FILTRO
+#  VIEWS PARA SERVIR COMO API DE FILTRO (TYPEAHEAD)
+PESSOAS_POR_PAGINA = 20
+MAXIMO_PESSOAS_POR_PAGINA = 50
+
+def _pagina_typeahead(request):
+    """ (início, limite) da página pedida em 'page' e 'limite'. Levanta ValueError se não forem números. """
+    pagina = max(1, int(request.GET.get('page', 1)))
+    limite = min(MAXIMO_PESSOAS_POR_PAGINA, max(1, int(request.GET.get('limite', PESSOAS_POR_PAGINA))))
+    return (pagina - 1) * limite, limite
+
+def _json_typeahead(linhas, limite):
+    data = [{'id': objeto.id, 'text': str(objeto)} for objeto in linhas[:limite]]
+    return JsonResponse({'results': data, 'pagination': {'more': len(linhas) > limite}})
+
+def _resposta_typeahead(request, queryset):
+    """
+    Uma página de 'queryset' no formato do Select2, conforme 'page' e 'limite'.
+    Busca um registro a mais só para saber se existe a próxima página (sem COUNT).
+    """
+    try:
+        inicio, limite = _pagina_typeahead(request)
+    except ValueError:
+        return JsonResponse({'results': [], 'pagination': {'more': False}}, status=400)
+    return _json_typeahead(list(queryset[inicio:inicio + limite + 1]), limite)
+
+async def _resposta_typeahead_async(request, queryset):
+    """ O mesmo que _resposta_typeahead, lendo com o ORM assíncrono. """
+    try:
+        inicio, limite = _pagina_typeahead(request)
+    except ValueError:
+        return JsonResponse({'results': [], 'pagination': {'more': False}}, status=400)
+    return _json_typeahead([objeto async for objeto in queryset[inicio:inicio + limite + 1]], limite)
+
+def _buscar_pessoas(unidade, termo='', nome='', empresa='', inativas=False):
+    pessoas = Pessoa.objects.da_unidade(unidade)
+    if not inativas:
+        pessoas = pessoas.filter(ativa=True)
+    if termo:
+        pessoas = pessoas.filter(Q(nome__icontains=termo) | Q(empresa__icontains=termo) | Q(cpf_saran__startswith=termo))
+    if nome:
+        pessoas = pessoas.filter(nome__icontains=nome)
+    if empresa:
+        pessoas = pessoas.filter(empresa__icontains=empresa)
+    return pessoas
+
 @login_required
 def filtrar_pessoas(request):
-    # Pega os parâmetros da URL (ex: /api/pessoas/?nome=joao&empresa=fab)
-    nome_query = request.GET.get('nome', '')
-    empresa_query = request.GET.get('empresa', '')
+    """
+    Busca paginada de pessoas ativas para o campo de seleção (formato do Select2).
 
-    pessoas = Pessoa.objects.all()
+    Parâmetros: 'q' procura no nome, na empresa e no início do CPF/SARAN;
+    'nome' e 'empresa' filtram cada campo; 'inativas=1' inclui as pessoas
+    desativadas (filtro do relatório); 'page' e 'limite' paginam.
+    No PostgreSQL as buscas por trecho usam os índices de trigramas (pg_trgm).
+    """
+    return _resposta_typeahead(request, _pessoas_do_typeahead(request, request.unidade))
 
-    if nome_query:
-        # Filtra por nome (case-insensitive)
-        pessoas = pessoas.filter(nome__icontains=nome_query)
-    
-    if empresa_query:
-        # Filtra por empresa (case-insensitive)
-        pessoas = pessoas.filter(empresa__icontains=empresa_query)
+@login_required
+async def filtrar_pessoas_async(request):
+    """ filtrar_pessoas com o ORM assíncrono, para quando o app roda sob ASGI. """
+    return await _resposta_typeahead_async(request, _pessoas_do_typeahead(request, await request.aunidade()))
+
+def _pessoas_do_typeahead(request, unidade):
+    pessoas = _buscar_pessoas(
+        unidade,
+        request.GET.get('q', '').strip(),
+        request.GET.get('nome', '').strip(),
+        request.GET.get('empresa', '').strip(),
+        inativas=request.GET.get('inativas') == '1',
+    )
+    return pessoas.only('id', 'nome', 'cpf_saran').order_by('nome', 'id')
 
-    # Ordena por nome
-    pessoas = pessoas.order_by('nome')
+@login_required
+def buscar_chaves(request):
+    """
+    Busca paginada de todas as chaves (inclusive emprestadas e desativadas) pela
+    descrição ou pelo local, para o filtro do relatório. Mesmo formato de filtrar_pessoas.
+    """
+    termo = request.GET.get('q', '').strip()
+    chaves = Chave.objects.da_unidade(request.unidade).select_related('local')
+    if termo:
+        chaves = chaves.filter(Q(descricao__icontains=termo) | Q(local__nome__icontains=termo))
+    return _resposta_typeahead(request, chaves.order_by('descricao', 'id'))
 
-    # Transforma a lista de objetos Pessoa em um formato simples (JSON)
-    data = [{'id': p.id, 'text': str(p)} for p in pessoas]
 
-    return JsonResponse({'results': data})
+#VIEW PARA VALIDAR O PIN E CONCLUIR A RETIRADA
+def _dados_retirada(request):
+    """ Campos do modal de PIN. Levanta ValidationError se as datas forem inválidas. """
+    return {
+        'chave_id': request.POST.get('chave_id'),
+        'pessoa_id': request.POST.get('pessoa_id'),
+        'pin': request.POST.get('pin'),
+        'observacao': request.POST.get('observacao'),
+        # As datas chegam como texto do campo datetime-local: o DateTimeField do
+        # formulário converte para datetime no fuso do projeto
+        'data_retirada': forms.DateTimeField().clean(request.POST.get('data_retirada')),
+        # Se o campo de previsão vier vazio, salvamos como nulo no banco
+        'previsao_devolucao': forms.DateTimeField(required=False).clean(request.POST.get('previsao_devolucao')),
+    }
 
+def _falha_na_retirada(erro):
+    if isinstance(erro, PinBloqueadoError):
+        minutos = -(-erro.segundos // 60)
+        response = JsonResponse({
+            'success': False,
+            'message': f'Muitas tentativas com PIN incorreto. Tente novamente em até {minutos} minutos.',
+        }, status=429)
+        response['Retry-After'] = str(erro.segundos)
+        return response
+    if isinstance(erro, Pessoa.DoesNotExist):
+        mensagem = 'Pessoa não encontrada.'
+    elif isinstance(erro, Chave.DoesNotExist):
+        mensagem = 'Chave não encontrada.'
+    elif isinstance(erro, PeriodoOcupadoError):
+        mensagem = MENSAGEM_PERIODO_OCUPADO
+    elif isinstance(erro, RetiradaNoFuturoError):
+        mensagem = str(erro)
+    elif isinstance(erro, ChaveIndisponivelError):
+        mensagem = 'Esta chave foi retirada por outra pessoa. Atualize a página.'
+    else:
+        mensagem = f'Ocorreu um erro: {erro}'
+    return JsonResponse({'success': False, 'message': mensagem})
+
+def _sucesso_na_retirada(chave):
+    return JsonResponse({'success': True, 'message': f'Chave "{chave.descricao}" emprestada com sucesso!'})
 
-#VIEW PARA VALIDAR O PIN E CONCLUIR A RETIRADA
 @login_required
 def verificar_pin_e_registrar(request):
     if request.method != 'POST':
         return JsonResponse({'success': False, 'message': 'Método inválido.'})
 
     try:
-        chave_id = request.POST.get('chave_id')
-        pessoa_id = request.POST.get('pessoa_id')
-        pin_digitado = request.POST.get('pin')
-        observacao = request.POST.get('observacao')
-        data_retirada = request.POST.get('data_retirada')
-        
-        # 1. ADICIONADO: Capturar a data de previsão do formulário
-        # O 'or None' garante que se o campo vier vazio, salvamos como nulo no banco
-        previsao_devolucao = request.POST.get('previsao_devolucao') or None
-
-        pessoa = Pessoa.objects.get(pk=pessoa_id)
-        chave = Chave.objects.get(pk=chave_id)
-
-        if not pessoa.check_pin(pin_digitado):
+        dados = _dados_retirada(request)
+        pessoa = Pessoa.objects.da_unidade(request.unidade).get(pk=dados['pessoa_id'])
+        chave = Chave.objects.da_unidade(request.unidade).get(pk=dados['chave_id'])
+
+        if not verificar_pin(pessoa, dados['pin'], ip_do_cliente(request)):
             return JsonResponse({'success': False, 'message': 'PIN incorreto!'})
 
-        if not chave.disponivel:
-            return JsonResponse({'success': False, 'message': 'Esta chave foi retirada por outra pessoa. Atualize a página.'})
-            
-        Emprestimo.objects.create(
-            chave=chave,
-            pessoa=pessoa,
-            data_retirada=data_retirada,
-            observacao=observacao,
-            # 2. ADICIONADO: Passar o valor para ser salvo no banco de dados
-            previsao_devolucao=previsao_devolucao
+        # A reserva da chave e a criação do empréstimo acontecem numa única transação
+        registrar_retirada(
+            chave_id=chave.id,
+            pessoa_id=pessoa.id,
+            data_retirada=dados['data_retirada'],
+            observacao=dados['observacao'],
+            previsao_devolucao=dados['previsao_devolucao'],
         )
+        return _sucesso_na_retirada(chave)
+    except Exception as e:
+        return _falha_na_retirada(e)
+
+@login_required
+async def verificar_pin_e_registrar_async(request):
+    """
+    verificar_pin_e_registrar para ASGI. O hash do PIN é calculado no pool
+    limitado de pin.verificar_pin_async, fora do loop de eventos; a retirada,
+    que é uma transação, roda numa thread.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Método inválido.'})
 
-        chave.disponivel = False
-        chave.save()
+    try:
+        dados = _dados_retirada(request)
+        unidade = await request.aunidade()
+        pessoa = await Pessoa.objects.da_unidade(unidade).only('id', 'pin').aget(pk=dados['pessoa_id'])
+        chave = await Chave.objects.da_unidade(unidade).only('id', 'descricao').aget(pk=dados['chave_id'])
 
-        return JsonResponse({'success': True, 'message': f'Chave "{chave.descricao}" emprestada com sucesso!'})
+        if not await verificar_pin_async(pessoa, dados['pin'], ip_do_cliente(request)):
+            return JsonResponse({'success': False, 'message': 'PIN incorreto!'})
 
-    except Pessoa.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'Pessoa não encontrada.'})
-    except Chave.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'Chave não encontrada.'})
+        await sync_to_async(registrar_retirada)(
+            chave_id=chave.id,
+            pessoa_id=pessoa.id,
+            data_retirada=dados['data_retirada'],
+            observacao=dados['observacao'],
+            previsao_devolucao=dados['previsao_devolucao'],
+        )
+        return _sucesso_na_retirada(chave)
     except Exception as e:
-        return JsonResponse({'success': False, 'message': f'Ocorreu um erro: {e}'})
+        return _falha_na_retirada(e)
 
 
 #VIEW DO DASHBOARD (FAZ CALCULOS DE CHAVES)
 @login_required
+@instrumentar('dashboard')
 def dashboard(request):
-    # Cálculos dos cards
-    total_chaves = Chave.objects.count()
-    chaves_emprestadas = Emprestimo.objects.filter(data_devolucao__isnull=True)
-    chaves_emprestadas_count = chaves_emprestadas.count()
-    chaves_disponiveis = total_chaves - chaves_emprestadas_count
-    
-    # O cálculo de chaves atrasadas agora é possível
-    chaves_atrasadas_count = chaves_emprestadas.filter(
-        previsao_devolucao__isnull=False, 
-        previsao_devolucao__lt=timezone.now()
-    ).count()
-
-    # Listas para a Dashboard
-    ultimas_atividades = Emprestimo.objects.order_by('-data_retirada')[:5] # Pega as 5 últimas retiradas
-    emprestimos_atrasados = chaves_emprestadas.filter(
-        previsao_devolucao__isnull=False,
-        previsao_devolucao__lt=timezone.now()
-    ).order_by('previsao_devolucao') # Pega todas as chaves atrasadas, ordenadas pela mais antiga
-
+    # Cards e listas vêm do cache (ver painel.estatisticas_dashboard)
     contexto = {
-        'total_chaves': total_chaves,
-        'chaves_emprestadas_count': chaves_emprestadas_count,
-        'chaves_disponiveis': chaves_disponiveis,
-        'chaves_atrasadas_count': chaves_atrasadas_count,
-        'ultimas_atividades': ultimas_atividades,
-        'emprestimos_atrasados': emprestimos_atrasados,
+        **estatisticas_dashboard(request.unidade),
         'pagina_ativa': 'dashboard' # Para o menu lateral
     }
     return render(request, 'claviculario_app/dashboard.html', contexto)
 
+#VIEW PARA TROCAR A UNIDADE EM QUE O USUÁRIO ESTÁ TRABALHANDO
+@login_required
+def selecionar_unidade(request):
+    # Abre também para quem ainda não tem unidade, para explicar o que fazer
+    form = SelecionarUnidadeForm(request.POST or None, unidades=unidades_do_usuario(request.user),
+                                 initial={'unidade': unidade_ou_nenhuma(request)})
+    if form.is_valid():
+        unidade = form.cleaned_data['unidade']
+        request.session[SESSAO_UNIDADE] = unidade.pk
+        messages.success(request, f'Agora você está trabalhando na unidade "{unidade}".')
+        return redirect('dashboard')
+    contexto = {
+        'form': form,
+        'sem_unidade': form.initial['unidade'] is None,
+        'pagina_ativa': 'unidade'
+    }
+    return render(request, 'claviculario_app/selecionar_unidade.html', contexto)
+
 
 #------------------------------------------------------------------
 # VIEWS DE PESSOAS
@@ -274,6 +541,12 @@ class PessoaCreateView(BasePessoaView, BaseCreateView):
 
 class PessoaUpdateView(BasePessoaView, BaseUpdateView):
     title = 'Editar Pessoa: {objeto.nome}'
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # O nome e o CPF/SARAN fazem parte do texto da busca do relatório
+        if {'nome', 'cpf_saran'} & set(form.changed_data):
+            busca.reindexar(self.object.emprestimos.all())
+        return response
 
 class PessoaDesativarView(BaseDesativarView):
     model = Pessoa
@@ -286,10 +559,9 @@ class PessoaDesativarView(BaseDesativarView):
             return redirect('pessoa_list')
         return super().form_valid(form)
 
-@login_required
-def filtrar_chaves_por_local(request):
+def _chaves_do_local(request, unidade):
     local_id = request.GET.get('local_id')
-    chaves = Chave.objects.filter(disponivel=True, ativa=True) # Começa com todas as chaves disponíveis
+    chaves = Chave.objects.da_unidade(unidade).filter(emprestimo_atual__isnull=True, ativa=True) # Começa com todas as chaves disponíveis
 
     if local_id:
         chaves = chaves.filter(local_id=local_id)
@@ -297,16 +569,23 @@ def filtrar_chaves_por_local(request):
         # Se nenhum local for selecionado, retorna uma lista vazia
         chaves = Chave.objects.none()
 
-    chaves = chaves.order_by('descricao')
-    
+    return chaves.select_related('local').order_by('descricao')
+
+@login_required
+def filtrar_chaves_por_local(request):
     # Transforma a lista de objetos Chave em um formato simples (JSON)
-    data = [{'id': c.id, 'text': str(c)} for c in chaves]
+    data = [{'id': c.id, 'text': str(c)} for c in _chaves_do_local(request, request.unidade)]
+    return JsonResponse({'results': data})
 
+@login_required
+async def filtrar_chaves_por_local_async(request):
+    data = [{'id': c.id, 'text': str(c)} async for c in _chaves_do_local(request, await request.aunidade())]
     return JsonResponse({'results': data})
 
 @permission_required('claviculario_app.view_pessoa', raise_exception=True)
+@le_da_replica
 def pessoa_historico(request, pk):
-    pessoa = get_object_or_404(Pessoa, pk=pk)
+    pessoa = get_object_or_404(Pessoa.objects.da_unidade(request.unidade), pk=pk)
     # Busca todos os empréstimos dessa pessoa, ordenando pelos mais recentes
     emprestimos_list = pessoa.emprestimos.select_related('chave', 'chave__local').order_by('-data_retirada')    
     contexto = {
@@ -325,9 +604,19 @@ class ChaveListView(BaseChaveView, BaseListView):
 
 class ChaveCreateView(BaseChaveView, BaseCreateView):
     title = 'Adicionar Nova Chave'
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        invalidar_dashboard(self.object.unidade_id)
+        return response
 
 class ChaveUpdateView(BaseChaveView, BaseUpdateView):
     title = 'Editar Chave: {objeto.descricao}'
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        invalidar_dashboard(self.object.unidade_id)
+        if {'descricao', 'local'} & set(form.changed_data):
+            busca.reindexar(self.object.emprestimos.all())
+        return response
 
 class ChaveDesativarView(BaseDesativarView):
     model = Chave # <-- Definimos o model explicitamente
@@ -338,17 +627,16 @@ class ChaveDesativarView(BaseDesativarView):
         if not chave.disponivel:
             messages.error(self.request, f"A chave '{chave.descricao}' não pode ser desativada pois está emprestada.")
             return redirect('chave_list')
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        invalidar_dashboard(chave.unidade_id)
+        eventos.publicar(eventos.CHAVE_DESATIVADA, {'unidade_id': chave.unidade_id, 'chave_id': chave.id, 'local_id': chave.local_id})
+        return response
 
 @permission_required('claviculario_app.view_chave', raise_exception=True)
+@le_da_replica
 def chave_historico(request, pk):
-    chave = get_object_or_404(Chave, pk=pk)
+    chave = get_object_or_404(Chave.objects.da_unidade(request.unidade).select_related('local'), pk=pk)
     emprestimos_list = chave.emprestimos.select_related('pessoa').order_by('-data_retirada')
-    # Aplicamos a paginação
-    paginator = Paginator(emprestimos_list, 15)
-    page_number = request.GET.get('page')
-    emprestimos_page = paginator.get_page(page_number)
-    
     contexto = {
         'chave': chave,
         'emprestimos_page': paginador(request,emprestimos_list),
@@ -368,6 +656,11 @@ class LocalCreateView(BaseLocalView, BaseCreateView):
 
 class LocalUpdateView(BaseLocalView, BaseUpdateView):
     title = 'Editar Local: {objeto.nome}'
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        if 'nome' in form.changed_data:
+            busca.reindexar(Emprestimo.objects.filter(chave__local=self.object))
+        return response
 
 class LocalDesativarView(BaseDesativarView):
     model = Local # <-- Definimos o model explicitamente
@@ -382,114 +675,120 @@ class LocalDesativarView(BaseDesativarView):
 # LÓGICA DE FILTRO REUTILIZÁVEL (FUNÇÃO AUXILIAR)
 # claviculario_app/views.py
 
-def _get_emprestimos_filtrados(request):
-    print("\n--- INICIANDO DEBUG DO FILTRO DE RELATÓRIO ---")
-    print(f"[PASSO 1] Dados recebidos na URL (request.GET): {request.GET}")
+def _get_emprestimos_filtrados(request, form=None):
+    """ Aplica os filtros do RelatorioForm. Recebe o formulário já criado pela view, se houver. """
+    with etapa(request, 'filtros'):
+        form = form or RelatorioForm(request.GET, unidade=request.unidade)
+        emprestimos_list = Emprestimo.objects.da_unidade(request.unidade).select_related('chave', 'pessoa').order_by('-data_retirada')
 
-    form = RelatorioForm(request.GET)
-    emprestimos_list = Emprestimo.objects.select_related('chave', 'pessoa').order_by('-data_retirada')
+        if form.is_valid():
+            data_inicio = form.cleaned_data.get('data_inicio')
+            data_fim = form.cleaned_data.get('data_fim')
+            status = form.cleaned_data.get('status')
+            pessoa = form.cleaned_data.get('pessoa')
+            chave = form.cleaned_data.get('chave')
+            termo = form.cleaned_data.get('busca')
+
+            if data_inicio:
+                emprestimos_list = emprestimos_list.filter(data_retirada__date__gte=data_inicio)
+            if data_fim:
+                emprestimos_list = emprestimos_list.filter(data_retirada__date__lte=data_fim)
+            if status == 'pendentes':
+                emprestimos_list = emprestimos_list.filter(data_devolucao__isnull=True)
+
+            if pessoa:
+                emprestimos_list = emprestimos_list.filter(pessoa=pessoa)
+            if chave:
+                emprestimos_list = emprestimos_list.filter(chave=chave)
+            if termo:
+                emprestimos_list = busca.filtrar(emprestimos_list, termo)
+    return emprestimos_list
 
-    print(f"[PASSO 2] O formulário é válido? {form.is_valid()}")
+# COLUNAS USADAS NAS EXPORTAÇÕES (buscadas direto do banco, sem montar objetos)
+COLUNAS_EXPORTACAO = ('chave__descricao', 'pessoa__nome', 'pessoa__cpf_saran', 'data_retirada', 'data_devolucao', 'observacao')
+CABECALHO_EXPORTACAO = ['Chave', 'Responsável', 'CPF/SARAN', 'Data Retirada', 'Data Devolução', 'Observação']
+TAMANHO_LOTE_EXPORTACAO = 2000
+
+
+def _lotes_exportacao(emprestimos):
+    """
+    Lê as colunas exportadas em lotes (cursor no servidor, no PostgreSQL).
+
+    Cada lote vira um DataFrame com as datas já convertidas, de uma vez só, para
+    o horário local e sem fuso (que é o que o Excel espera).
+    """
+    linhas = emprestimos.values_list(*COLUNAS_EXPORTACAO).iterator(chunk_size=TAMANHO_LOTE_EXPORTACAO)
+    fuso = timezone.get_current_timezone_name()
+    while lote := list(islice(linhas, TAMANHO_LOTE_EXPORTACAO)):
+        df = pd.DataFrame(lote, columns=COLUNAS_EXPORTACAO)
+        for coluna in ('data_retirada', 'data_devolucao'):
+            df[coluna] = pd.to_datetime(df[coluna], utc=True).dt.tz_convert(fuso).dt.tz_localize(None)
+        yield df
+
+
+def _linhas_csv(emprestimos):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CABECALHO_EXPORTACAO)
+    for df in _lotes_exportacao(emprestimos):
+        df['data_retirada'] = df['data_retirada'].dt.strftime('%d/%m/%Y %H:%M')
+        df['data_devolucao'] = df['data_devolucao'].dt.strftime('%d/%m/%Y %H:%M').fillna('Pendente')
+        writer.writerows(df.itertuples(index=False, name=None))
+        # Envia o lote e esvazia o buffer: só um lote fica na memória por vez
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
 
-    if form.is_valid():
-        print(f"[PASSO 3] Dados 'limpos' do formulário (cleaned_data): {form.cleaned_data}")
-        
-        data_inicio = form.cleaned_data.get('data_inicio')
-        data_fim = form.cleaned_data.get('data_fim')
-        status = form.cleaned_data.get('status')
-        pessoa = form.cleaned_data.get('pessoa')
-        chave = form.cleaned_data.get('chave')
-
-        if data_inicio:
-            emprestimos_list = emprestimos_list.filter(data_retirada__date__gte=data_inicio)
-        if data_fim:
-            emprestimos_list = emprestimos_list.filter(data_retirada__date__lte=data_fim)
-        if status == 'pendentes':
-            emprestimos_list = emprestimos_list.filter(data_devolucao__isnull=True)
-            
-        if pessoa:
-            print(f"-> Aplicando filtro para a pessoa: {pessoa}")
-            emprestimos_list = emprestimos_list.filter(pessoa=pessoa)
-        if chave:
-            print(f"-> Aplicando filtro para a chave: {chave}")
-            emprestimos_list = emprestimos_list.filter(chave=chave)
-    else:
-        # Se o formulário não for válido, vamos ver os erros
-        print(f"[ERRO] Erros de validação do formulário: {form.errors}")
-    
-    print("--- FIM DO DEBUG ---\n")
-    return emprestimos_list
 
 # NOVA VIEW PARA EXPORTAR CSV
 @login_required
+@instrumentar('exportar_relatorio_csv')
+@le_da_replica
 def exportar_relatorio_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="relatorio_claviculario.csv"'
-    
+    # As linhas são enviadas à medida que são lidas: a memória não cresce com o tamanho do histórico.
     emprestimos = _get_emprestimos_filtrados(request)
-    
-    writer = csv.writer(response)
-    # Cabeçalho do CSV
-    writer.writerow(['Chave', 'Responsável', 'CPF/SARAN', 'Data Retirada', 'Data Devolução', 'Observação'])
-    
-    # Linhas
-    for emprestimo in emprestimos:
-        writer.writerow([
-            emprestimo.chave.descricao,
-            emprestimo.pessoa.nome,
-            emprestimo.pessoa.cpf_saran,
-            emprestimo.data_retirada.strftime('%d/%m/%Y %H:%M'),
-            emprestimo.data_devolucao.strftime('%d/%m/%Y %H:%M') if emprestimo.data_devolucao else 'Pendente',
-            emprestimo.observacao
-        ])
-        
+    response = StreamingHttpResponse(_linhas_csv(emprestimos), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="relatorio_claviculario.csv"'
     return response
 
 # VIEW PARA EXPORTAR EXCEL
 @login_required
+@instrumentar('exportar_relatorio_excel')
+@le_da_replica
 def exportar_relatorio_excel(request):
-    response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename="relatorio_claviculario.xlsx"'
-    
     emprestimos = _get_emprestimos_filtrados(request)
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Relatório"
-    
-    headers = ['Chave', 'Responsável', 'CPF/SARAN', 'Data Retirada', 'Data Devolução', 'Observação']
-    ws.append(headers)
-    
 
-    for emprestimo in emprestimos:
-        # Convert aware datetimes to local time
-        data_retirada_local = timezone.localtime(emprestimo.data_retirada)
-        
-        # Make the datetime "naive" (remove timezone info) for Excel
-        data_retirada_naive = data_retirada_local.replace(tzinfo=None)
-        
-        data_devolucao_final = 'Pendente'
-        if emprestimo.data_devolucao:
-            data_devolucao_local = timezone.localtime(emprestimo.data_devolucao)
-            data_devolucao_final = data_devolucao_local.replace(tzinfo=None)
-            
-        ws.append([
-            emprestimo.chave.descricao,
-            emprestimo.pessoa.nome,
-            emprestimo.pessoa.cpf_saran,
-            data_retirada_naive, # Use the naive datetime
-            data_devolucao_final, # Use the naive datetime or 'Pendente'
-            emprestimo.observacao
-        ])
-        
-    wb.save(response)
-    return response
+    # No modo write_only o openpyxl grava as linhas direto em disco em vez de
+    # manter cada célula na memória. O arquivo final vai para um temporário,
+    # enviado em partes pelo FileResponse e apagado quando a resposta é fechada.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Relatório")
+    ws.append(CABECALHO_EXPORTACAO)
+
+    for df in _lotes_exportacao(emprestimos):
+        df['data_retirada'] = df['data_retirada'].astype(object)
+        df['data_devolucao'] = df['data_devolucao'].astype(object).where(df['data_devolucao'].notna(), 'Pendente')
+        for linha in df.itertuples(index=False, name=None):
+            ws.append(linha)
+
+    arquivo = tempfile.TemporaryFile()
+    wb.save(arquivo)
+    arquivo.seek(0)
+    return FileResponse(
+        arquivo,
+        as_attachment=True,
+        filename='relatorio_claviculario.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
 
 
 # VIEW PARA A PÁGINA DE IMPORTAÇÃO
 @permission_required('claviculario_app.add_pessoa', raise_exception=True) # Só gerentes podem importar
 def importar_dados_page(request):
+    importacoes = ImportacaoJob.objects.da_unidade(request.unidade).defer('arquivo').filter(usuario=request.user)[:10]
     contexto = {
+        'importacoes': importacoes,
         'pagina_ativa': 'importar'
     }
     return render(request, 'claviculario_app/importar_dados_page.html', contexto)
@@ -529,58 +828,29 @@ def download_template_chaves(request):
     return response
 
 
+def _enfileirar_planilha(request, tipo):
+    """ Valida o arquivo enviado e cria o job de importação. A leitura da planilha acontece no worker. """
+    arquivo = request.FILES.get('arquivo_excel')
+    if not arquivo or not arquivo.name.endswith('.xlsx'):
+        messages.error(request, "Por favor, envie um arquivo Excel (.xlsx) válido.")
+        return None
+
+    job = ImportacaoJob.objects.create(
+        unidade=request.unidade,
+        tipo=tipo,
+        usuario=request.user,
+        nome_arquivo=arquivo.name,
+        arquivo=arquivo.read(),
+    )
+    enfileirar_importacao(job)
+    messages.info(request, f"O arquivo '{arquivo.name}' foi enviado e está sendo processado. Acompanhe o progresso abaixo.")
+    return job
+
+
 @permission_required('claviculario_app.add_pessoa', raise_exception=True)
 def importar_pessoas(request):
     if request.method == 'POST':
-        arquivo = request.FILES.get('arquivo_excel')
-        if not arquivo or not arquivo.name.endswith('.xlsx'):
-            messages.error(request, "Por favor, envie um arquivo Excel (.xlsx) válido.")
-            return redirect('importar_dados_page')
-
-        try:
-            df = pd.read_excel(arquivo)
-            # Verifica se as colunas necessárias existem
-            colunas_necessarias = ['nome_completo', 'cpf_saran', 'pin']
-            if not all(coluna in df.columns for coluna in colunas_necessarias):
-                messages.error(request, f"O arquivo enviado não contém as colunas necessárias: {colunas_necessarias}")
-                return redirect('importar_dados_page')
-
-            criados, ignorados, conflitos = 0, 0, []
-
-            for index, row in df.iterrows():
-                cpf_saran = str(row['cpf_saran']).strip()
-                nome = str(row['nome_completo']).strip()
-                pin = str(row['pin']).strip()
-
-                if not cpf_saran or not nome or not pin:
-                    continue # Ignora linhas com dados essenciais faltando
-
-                pessoa_existente = Pessoa.objects.filter(cpf_saran=cpf_saran).first()
-
-                if pessoa_existente:
-                    if pessoa_existente.nome != nome:
-                        conflitos.append(f"CPF/SARAN {cpf_saran}: Nome no sistema '{pessoa_existente.nome}', nome na planilha '{nome}'. Nenhum dado foi alterado.")
-                    ignorados += 1
-                else:
-                    nova_pessoa = Pessoa(
-                        nome=nome,
-                        cpf_saran=cpf_saran,
-                        empresa=row.get('empresa'),
-                    )
-                    nova_pessoa.set_pin(pin)
-                    nova_pessoa.save()
-                    criados += 1
-            
-            messages.success(request, f"Importação de pessoas concluída! {criados} pessoas criadas, {ignorados} já existentes ignoradas.")
-            if conflitos:
-                messages.warning(request, f"Atenção: {len(conflitos)} registros apresentaram conflito de nome e não foram atualizados. Verifique os dados.")
-                # Opcional: mostrar os detalhes dos conflitos
-                # for conflito in conflitos:
-                #     messages.info(request, conflito)
-
-        except Exception as e:
-            messages.error(request, f"Ocorreu um erro ao processar o arquivo: {e}")
-
+        _enfileirar_planilha(request, ImportacaoJob.TIPO_PESSOAS)
     return redirect('importar_dados_page')
 
 
@@ -588,148 +858,177 @@ def importar_pessoas(request):
 @permission_required('claviculario_app.add_chave', raise_exception=True)
 def importar_chaves(request):
     if request.method == 'POST':
-        arquivo = request.FILES.get('arquivo_excel')
-        if not arquivo or not arquivo.name.endswith('.xlsx'):
-            messages.error(request, "Por favor, envie um arquivo Excel (.xlsx) válido.")
-            return redirect('importar_dados_page')
-
-        try:
-            df = pd.read_excel(arquivo)
-            colunas_necessarias = ['descricao_chave', 'nome_local']
-            if not all(coluna in df.columns for coluna in colunas_necessarias):
-                messages.error(request, f"O arquivo enviado não contém as colunas necessárias: {colunas_necessarias}")
-                return redirect('importar_dados_page')
-
-            criadas, ignoradas = 0, 0
-            
-            for index, row in df.iterrows():
-                descricao = str(row['descricao_chave']).strip()
-                nome_local = str(row['nome_local']).strip()
-
-                if not descricao or not nome_local:
-                    continue
-
-                if Chave.objects.filter(descricao=descricao).exists():
-                    ignoradas += 1
-                    continue
-                
-                # Procura pelo local, se não existir, cria um novo (get_or_create)
-                local, local_criado = Local.objects.get_or_create(
-                    nome=nome_local,
-                    defaults={'ativa': True} # Define 'ativa' como True se criar um novo
-                )
-                
-                Chave.objects.create(descricao=descricao, local=local)
-                criadas += 1
-            
-            messages.success(request, f"Importação de chaves concluída! {criadas} chaves criadas, {ignoradas} já existentes ignoradas.")
+        _enfileirar_planilha(request, ImportacaoJob.TIPO_CHAVES)
+    return redirect('importar_dados_page')
 
-        except Exception as e:
-            messages.error(request, f"Ocorreu um erro ao processar o arquivo: {e}")
 
-    return redirect('importar_dados_page')
+# API PARA ACOMPANHAR O PROGRESSO DE UMA IMPORTAÇÃO
+@permission_required('claviculario_app.add_pessoa', raise_exception=True)
+def importacao_status(request, pk):
+    jobs = ImportacaoJob.objects.da_unidade(request.unidade).defer('arquivo')
+    job = get_object_or_404(jobs, pk=pk)
+    # Sem isto, um job cujo worker morreu ficaria "processando" para sempre na página
+    if job.status == ImportacaoJob.STATUS_PROCESSANDO and encerrar_interrompidos(jobs.filter(pk=pk)):
+        job.refresh_from_db()
+    return JsonResponse({
+        'id': job.id,
+        'tipo': job.tipo,
+        'nome_arquivo': job.nome_arquivo,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'finalizada': job.finalizada,
+        'total_linhas': job.total_linhas,
+        'linhas_processadas': job.linhas_processadas,
+        'criados': job.criados,
+        'ignorados': job.ignorados,
+        'conflitos': job.conflitos,
+        # O traceback completo fica só no admin; para o operador basta a primeira linha
+        'erro': job.erros.split('\n', 1)[0] if job.erros else '',
+    })
+
+
+# Expressão de agrupamento de cada opção do gráfico de séries
+# (ExtractIsoWeekDay: 1 = segunda ... 7 = domingo)
+AGRUPAMENTOS_ANALYTICS = {
+    'time_of_day': F('hora'),
+    'time_of_day_avg': F('hora'),
+    'day': F('dia'),
+    'weekday': ExtractIsoWeekDay('dia'),
+    'weekday_avg': ExtractIsoWeekDay('dia'),
+    'monthday': ExtractDay('dia'),
+    'monthday_avg': ExtractDay('dia'),
+}
+
+def _filtros_analytics(request):
+    """ (início, fim, agrupamento) conforme os filtros da página de análise. """
+    start_date_str = request.GET.get('start_date')
+    end_date_str = request.GET.get('end_date')
+    group_by = request.GET.get('group_by', 'day')
+
+    end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else timezone.now().date()
+    start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str else end_date - timedelta(days=29)
+    return start_date, end_date, group_by
+
+def _resumos_analytics(request, unidade, start_date, end_date):
+    """ Os resumos da unidade no período, com os filtros de local e chave da página de análise. """
+    local_id = request.GET.get('local_id')
+    chave_id = request.GET.get('chave_id')
+    # Os gráficos leem os totais pré-calculados por dia x hora x chave, não
+    # os empréstimos: o custo depende do tamanho do período, não do histórico.
+    queryset = ResumoHorario.objects.da_unidade(unidade).filter(dia__gte=start_date, dia__lte=end_date)
+    if local_id: queryset = queryset.filter(chave__local_id=local_id)
+    if chave_id: queryset = queryset.filter(chave_id=chave_id)
+    return queryset
+
+def _totais_por_grupo(queryset, group_by):
+    """ (grupo, retiradas, devoluções) de cada grupo (24, 7, 31 ou um por dia), numa só consulta. """
+    return (
+        queryset.order_by()
+        .annotate(grupo=AGRUPAMENTOS_ANALYTICS[group_by])
+        .values('grupo')
+        .annotate(total_retiradas=Sum('retiradas'), total_devolucoes=Sum('devolucoes'))
+        .values_list('grupo', 'total_retiradas', 'total_devolucoes')
+    )
+
+def _serie_analytics(counts, group_by, start_date, end_date):
+    """ Rótulos e valores de uma série a partir dos totais {grupo: total}. """
+    if not any(counts.values()):
+        return [], []
+    num_dias_no_periodo = (end_date - start_date).days + 1
+
+    if group_by in ['time_of_day', 'time_of_day_avg']:
+        labels = [f"{h:02d}:00" for h in range(24)]
+        data_total = [counts.get(h, 0) for h in range(24)]
+        data = [total / num_dias_no_periodo for total in data_total] if group_by == 'time_of_day_avg' else data_total
+        return labels, data
+    elif group_by == 'day':
+        dias = [start_date + timedelta(days=i) for i in range(num_dias_no_periodo)]
+        labels = [dia.strftime('%d/%m/%Y') for dia in dias]
+        data = [counts.get(dia, 0) for dia in dias]
+        return labels, data
+    elif group_by in ['weekday', 'weekday_avg']:
+        weekday_map = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom']
+        data_total = [counts.get(i, 0) for i in range(1, 8)]
+        if group_by == 'weekday_avg':
+            num_semanas = max(1, num_dias_no_periodo / 7.0)
+            data = [total / num_semanas for total in data_total]
+        else:
+            data = data_total
+        return weekday_map, data
+    elif group_by in ['monthday', 'monthday_avg']:
+        labels = [str(i) for i in range(1, 32)]
+        data_total = [counts.get(i, 0) for i in range(1, 32)]
+        if group_by == 'monthday_avg':
+            num_meses = max(1, (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1)
+            data = [total / num_meses for total in data_total]
+        else:
+            data = data_total
+        return labels, data
+    return [], []
+
+def _dados_analytics(atrasos, totais, start_date, end_date, group_by):
+    """ O JSON dos três gráficos, a partir dos totais já lidos do banco. """
+    dados_atrasos = {'labels': ['Em Dia', 'Com Atraso'], 'data': [atrasos['em_dia'], atrasos['atrasados']]}
+    retiradas_labels, retiradas_data = _serie_analytics(
+        {grupo: retiradas for grupo, retiradas, _ in totais}, group_by, start_date, end_date)
+    devolucoes_labels, devolucoes_data = _serie_analytics(
+        {grupo: devolucoes for grupo, _, devolucoes in totais}, group_by, start_date, end_date)
+
+    # O gráfico sempre recebeu floats (as médias são fracionárias)
+    retiradas_data = [float(x) for x in retiradas_data]
+    devolucoes_data = [float(x) for x in devolucoes_data]
+
+    labels_finais = retiradas_labels if len(retiradas_labels) >= len(devolucoes_labels) else devolucoes_labels
+    if len(devolucoes_data) < len(labels_finais):
+        devolucoes_data.extend([0] * (len(labels_finais) - len(devolucoes_data)))
+
+    return {
+        'atrasos': dados_atrasos,
+        'retiradas': {'labels': labels_finais, 'data': retiradas_data},
+        'devolucoes': {'labels': labels_finais, 'data': devolucoes_data},
+    }
 
+def _erro_analytics():
+    # O traceback vai só para o log: a resposta não expõe detalhes do servidor
+    logger.exception("Erro ao montar os dados da página de análise")
+    return JsonResponse({'error': "Erro no servidor ao montar os gráficos."}, status=500)
+
+TOTAIS_ATRASOS = {'em_dia': Sum('no_prazo', default=0), 'atrasados': Sum('atrasadas', default=0)}
 
 @login_required
+@le_da_replica
 def analytics_data(request):
     try:
-        # --- 1. CAPTURAR E VALIDAR FILTROS ---
-        start_date_str = request.GET.get('start_date')
-        end_date_str = request.GET.get('end_date')
-        group_by = request.GET.get('group_by', 'day')
-        local_id = request.GET.get('local_id')
-        chave_id = request.GET.get('chave_id')
-
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else timezone.now().date()
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str else end_date - timedelta(days=29)
-
-        # --- 2. FILTRAR O CONJUNTO DE DADOS PRINCIPAL ---
-        queryset = Emprestimo.objects.filter(data_retirada__date__gte=start_date, data_retirada__date__lte=end_date)
-        if local_id: queryset = queryset.filter(chave__local_id=local_id)
-        if chave_id: queryset = queryset.filter(chave_id=chave_id)
-
-        # --- 3. GRÁFICO 1: ATRASOS ---
-        devolvidos_qs = queryset.filter(data_devolucao__isnull=False, previsao_devolucao__isnull=False)
-        atrasados = devolvidos_qs.filter(data_devolucao__gt=F('previsao_devolucao')).count()
-        em_dia = devolvidos_qs.count() - atrasados
-        dados_atrasos = {'labels': ['Em Dia', 'Com Atraso'], 'data': [em_dia, atrasados]}
-
-        # --- 4. FUNÇÃO AUXILIAR PARA PROCESSAR OS GRÁFICOS DE SÉRIE ---
-        def processar_agrupamento(qs, date_field):
-            if not qs.exists(): return [], []
-            datas = [timezone.localtime(dt) for dt in qs.values_list(date_field, flat=True) if dt]
-            if not datas: return [], []
-            
-            df = pd.DataFrame(datas, columns=['datetime'])
-            num_dias_no_periodo = (end_date - start_date).days + 1
-            
-            if group_by in ['time_of_day', 'time_of_day_avg']:
-                counts = df['datetime'].dt.hour.value_counts()
-                labels = [f"{h:02d}:00" for h in range(24)]
-                data_total = [counts.get(h, 0) for h in range(24)]
-                data = [total / num_dias_no_periodo for total in data_total] if group_by == 'time_of_day_avg' else data_total
-                return labels, data
-            elif group_by == 'day':
-                counts = df.set_index('datetime').resample('D').size()
-                date_range = pd.date_range(start=start_date, end=end_date, freq='D', tz='America/Sao_Paulo')
-                counts = counts.reindex(date_range, fill_value=0)
-                labels = counts.index.strftime('%d/%m/%Y').tolist()
-                data = counts.values.tolist()
-                return labels, data
-            elif group_by in ['weekday', 'weekday_avg']:
-                counts = df['datetime'].dt.weekday.value_counts()
-                weekday_map = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom']
-                data_total = [counts.get(i, 0) for i in range(7)]
-                if group_by == 'weekday_avg':
-                    num_semanas = max(1, num_dias_no_periodo / 7.0)
-                    data = [total / num_semanas for total in data_total]
-                else:
-                    data = data_total
-                return weekday_map, data
-            elif group_by in ['monthday', 'monthday_avg']:
-                counts = df['datetime'].dt.day.value_counts()
-                labels = [str(i) for i in range(1, 32)]
-                data_total = [counts.get(i, 0) for i in range(1, 32)]
-                if group_by == 'monthday_avg':
-                    num_meses = max(1, (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1)
-                    data = [total / num_meses for total in data_total]
-                else:
-                    data = data_total
-                return labels, data
-            return [], []
-
-        # --- 5. PROCESSAR E RETORNAR OS DADOS FINAIS ---
-        retiradas_labels, retiradas_data = processar_agrupamento(queryset, 'data_retirada')
-        devolucoes_labels, devolucoes_data = processar_agrupamento(queryset.filter(data_devolucao__isnull=False), 'data_devolucao')
-
-        # --- A CORREÇÃO ESTÁ AQUI ---
-        # Converte os números do tipo do pandas (int64) para float padrão do Python
-        retiradas_data = [float(x) for x in retiradas_data]
-        devolucoes_data = [float(x) for x in devolucoes_data]
-        
-        labels_finais = retiradas_labels if len(retiradas_labels) >= len(devolucoes_labels) else devolucoes_labels
-        if len(devolucoes_data) < len(labels_finais):
-            devolucoes_data.extend([0] * (len(labels_finais) - len(devolucoes_data)))
-
-        data = {
-            'atrasos': dados_atrasos,
-            'retiradas': {'labels': labels_finais, 'data': retiradas_data},
-            'devolucoes': {'labels': labels_finais, 'data': devolucoes_data},
-        }
-        return JsonResponse(data)
+        start_date, end_date, group_by = _filtros_analytics(request)
+        queryset = _resumos_analytics(request, request.unidade, start_date, end_date)
+        atrasos = queryset.aggregate(**TOTAIS_ATRASOS)
+        totais = list(_totais_por_grupo(queryset, group_by)) if group_by in AGRUPAMENTOS_ANALYTICS else []
+        return JsonResponse(_dados_analytics(atrasos, totais, start_date, end_date, group_by))
+    except Exception:
+        return _erro_analytics()
 
-    except Exception as e:
-        error_trace = traceback.format_exc()
-        print("="*50, "\nERRO GRAVE NA VIEW analytics_data:\n", error_trace, "\n"+"="*50)
-        return JsonResponse({'error': f"Erro no servidor: {e}", 'traceback': error_trace}, status=500)
+@login_required
+@le_da_replica
+async def analytics_data_async(request):
+    """ analytics_data com o ORM assíncrono, para quando o app roda sob ASGI. """
+    try:
+        start_date, end_date, group_by = _filtros_analytics(request)
+        queryset = _resumos_analytics(request, await request.aunidade(), start_date, end_date)
+        atrasos = await queryset.aaggregate(**TOTAIS_ATRASOS)
+        totais = []
+        if group_by in AGRUPAMENTOS_ANALYTICS:
+            totais = [linha async for linha in _totais_por_grupo(queryset, group_by)]
+        return JsonResponse(_dados_analytics(atrasos, totais, start_date, end_date, group_by))
+    except Exception:
+        return _erro_analytics()
 
 @login_required
 # Só gerentes podem ver a página de análise
 @permission_required('claviculario_app.view_emprestimo', raise_exception=True)
 def analytics_page(request):
     # Precisamos enviar a lista de chaves e locais para os filtros
-    chaves = Chave.objects.filter(ativa=True).order_by('descricao')
-    locais = Local.objects.filter(ativa=True).order_by('nome')
+    chaves = Chave.objects.da_unidade(request.unidade).filter(ativa=True).order_by('descricao')
+    locais = Local.objects.da_unidade(request.unidade).filter(ativa=True).order_by('nome')
     
     contexto = {
         'chaves': chaves,
@@ -753,7 +1052,8 @@ class UserListView(LoginRequiredMixin, PaginaAtivaMixin, ListView):
     def get_queryset(self):
         if self.request.user.is_superuser:
             # CORREÇÃO AQUI: Adiciona o filtro para mostrar apenas usuários ativos.
-            return User.objects.filter(is_active=True).order_by('username')
+            # prefetch_related: os grupos de cada usuário da página vêm numa consulta só
+            return User.objects.filter(is_active=True).prefetch_related('groups').order_by('username')
         return User.objects.none()
 
 class UserCreateView(PaginaAtivaMixin, LoginRequiredMixin, CreateView):
@@ -764,8 +1064,13 @@ class UserCreateView(PaginaAtivaMixin, LoginRequiredMixin, CreateView):
     pagina_ativa = 'contas'
     title = 'Criar Novo Usuário'
     def form_valid(self, form):
+        response = super().form_valid(form)
+        # O novo usuário trabalha na unidade de quem o criou; sem nenhuma, toda página daria 403
+        unidade = unidade_ou_nenhuma(self.request)
+        if unidade is not None:
+            unidade.membros.add(self.object)
         messages.success(self.request, 'Usuário criado com sucesso!')
-        return super().form_valid(form)
+        return response
 
 class UserUpdateView(PaginaAtivaMixin, LoginRequiredMixin, UpdateView):
     model = User
@@ -773,6 +1078,10 @@ class UserUpdateView(PaginaAtivaMixin, LoginRequiredMixin, UpdateView):
     template_name = 'claviculario_app/user_form.html'
     success_url = reverse_lazy('user_list')
     pagina_ativa = 'contas'
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['unidades'] = unidades_do_usuario(self.request.user)
+        return kwargs
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = f'Editar Usuário: {self.object.username}'
@@ -3,6 +3,9 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The live desk updates (/api/eventos/, Server-Sent Events) need an ASGI server,
+e.g. ``uvicorn config.asgi:application``; under WSGI that view answers 204.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -56,6 +56,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'claviculario_app.unidades.UnidadeMiddleware',
+    'claviculario_app.replicas.ReplicaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -74,6 +76,7 @@ TEMPLATES = [
                 'django.template.context_processors.request', # <-- ESTA É A PONTE ESSENCIAL
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'claviculario_app.unidades.contexto',
             ],
         },
     },
@@ -96,6 +99,13 @@ DATABASES = {
         'PORT': '5432',
     }
 }
+# Réplica de leitura (replicação do PostgreSQL) para relatórios, exportações,
+# gráficos e históricos (ver claviculario_app.replicas). Aqui ela aponta para
+# o próprio banco principal; em produção, troque o HOST pelo da réplica e
+# ligue CLAVICULARIO_BANCO_RELATORIOS abaixo. Nos testes, é um espelho do
+# 'default'.
+DATABASES['reporting'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['claviculario_app.replicas.RelatoriosRouter']
 
 
 # Password validation
@@ -174,4 +184,66 @@ ACCOUNT_EMAIL_REQUIRED = True
 ACCOUNT_USERNAME_REQUIRED = False # O usuário não precisará criar um nome de usuário
 ACCOUNT_AUTHENTICATION_METHOD = "username_email" # O login será feito com o e-mail
 # Pula a página de confirmação "Continuar" e redireciona direto para o Google
-SOCIALACCOUNT_LOGIN_ON_GET = True
\ No newline at end of file
+SOCIALACCOUNT_LOGIN_ON_GET = True
+# Cache (contadores da página inicial). O cache em memória é por processo: com
+# vários workers, use o FileBasedCache (ou Redis/Memcached) para que a
+# invalidação feita por um worker chegue aos outros.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'claviculario',
+    }
+}
+# Tempo máximo (em segundos) que os números da página inicial ficam no cache
+CLAVICULARIO_DASHBOARD_CACHE_SEGUNDOS = 30
+# Eventos ao vivo das mesas (/api/eventos/, servido pelo config.asgi). O
+# MemoriaBackend só alcança as conexões do próprio processo: com vários
+# workers, use 'claviculario_app.eventos.PostgresBackend' (LISTEN/NOTIFY).
+CLAVICULARIO_EVENTOS_BACKEND = 'claviculario_app.eventos.MemoriaBackend'
+# Sob ASGI, as APIs JSON das mesas (pessoas, chaves, PIN e gráficos) podem usar
+# as versões assíncronas das views; sob WSGI, mantenha as síncronas.
+CLAVICULARIO_APIS_ASSINCRONAS = False
+# Threads que calculam o hash do PIN (padrão: até 4, conforme os núcleos). Uma
+# rajada de tentativas nunca ocupa mais do que esses núcleos.
+CLAVICULARIO_PIN_THREADS = None
+# PINs usam um PBKDF2 mais leve que o das senhas (ver claviculario_app.hashers e
+# o PinsHashersBenchmark). PINs antigos continuam valendo e são refeitos com o
+# hasher abaixo no próximo acerto; o hasher precisa estar em PASSWORD_HASHERS.
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+    'claviculario_app.hashers.PBKDF2PinHasher',
+]
+CLAVICULARIO_PIN_HASHER = 'pbkdf2_pin'
+CLAVICULARIO_PIN_ITERACOES = 50_000
+# Bloqueio da conferência de PIN: erros aceitos por pessoa e por endereço IP e
+# por quanto tempo (segundos) ficam bloqueados. Os contadores ficam no cache:
+# com o LocMemCache, cada worker conta os seus.
+CLAVICULARIO_PIN_TENTATIVAS = 5
+CLAVICULARIO_PIN_BLOQUEIO_SEGUNDOS = 900
+# O contador por IP vem desligado (None): atrás de um proxy reverso, ou com as
+# mesas saindo por um mesmo NAT, todos os clientes têm o mesmo endereço, e os
+# erros de qualquer um bloqueariam as retiradas do site inteiro. Só ligue com
+# o endereço real do cliente: atrás de proxies, informe o cabeçalho que eles
+# preenchem (ex: 'HTTP_X_FORWARDED_FOR') e quantos deles são seus; o endereço
+# usado é o que o mais externo deles recebeu (ver pin.ip_do_cliente).
+CLAVICULARIO_PIN_TENTATIVAS_IP = None
+CLAVICULARIO_PIN_IP_CABECALHO = None
+CLAVICULARIO_PIN_PROXIES_CONFIAVEIS = 1
+# Alias do banco das leituras pesadas ('reporting', acima). None mantém tudo
+# no banco principal. Depois de uma escrita, o navegador lê do principal por
+# CLAVICULARIO_REPLICA_ATRASO_SEGUNDOS: cubra o atraso normal da réplica.
+CLAVICULARIO_BANCO_RELATORIOS = None
+CLAVICULARIO_REPLICA_ATRASO_SEGUNDOS = 5
+# Onde o arquivar_emprestimos grava os anos de empréstimos que saem do banco
+# (um Parquet por ano). O relatório lê esses arquivos quando o período pede.
+CLAVICULARIO_ARQUIVO_EMPRESTIMOS = BASE_DIR / 'arquivo'
+# Uma importação 'processando' sem progresso por mais que isto (segundos) é
+# dada como interrompida (o processo que a pegou morreu) e marcada como erro.
+CLAVICULARIO_IMPORTACAO_SEM_PROGRESSO_SEGUNDOS = 900
+# Unidade (id) em que entra quem se cadastra pelo login social (allauth). None
+# deixa o usuário sem unidade até que um administrador o inclua em uma.
+CLAVICULARIO_UNIDADE_NOVOS_USUARIOS = None